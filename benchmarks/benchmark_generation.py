@@ -0,0 +1,80 @@
+# End-to-end generation benchmark: TTFT, inter-token latency, throughput and KV memory.
+# GPU, GPT2-medium, 200 requests at 4 req/s:
+#   python benchmarks/benchmark_generation.py --model-name gpt2-medium --num-requests 200 \
+#       --request-rate 4 --prompt-len 32 512 --output-len 16 256 --max-batch-size 32
+# CPU, tiny random model (e.g. for CI):
+#   python benchmarks/benchmark_generation.py --tiny --device cpu --num-requests 8
+import argparse
+import json
+import math
+
+import torch
+from transformers import GPT2Config
+
+from flash_attn.models.gpt import GPTLMHeadModel
+from flash_attn.utils.benchmark_generation import (
+    load_trace,
+    make_trace,
+    replay_engine,
+    replay_static,
+    save_trace,
+)
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--model-name", default="gpt2")
+parser.add_argument("--tiny", action="store_true", help="Tiny randomly initialized GPT2")
+parser.add_argument("--device", default="cuda")
+parser.add_argument("--backend", choices=["engine", "static"], default="engine")
+parser.add_argument("--num-requests", type=int, default=64)
+parser.add_argument("--request-rate", type=float, default=math.inf, help="Requests per second")
+parser.add_argument("--prompt-len", type=int, nargs="+", default=[128], help="Length or min max")
+parser.add_argument("--output-len", type=int, nargs="+", default=[128], help="Length or min max")
+parser.add_argument("--max-batch-size", type=int, default=16)
+parser.add_argument("--trace", help="Recorded trace to replay (JSON lines), instead of make_trace")
+parser.add_argument("--save-trace", help="Save the trace (JSON lines)")
+parser.add_argument("--output", help="Write the results to this JSON file")
+parser.add_argument("--seed", type=int, default=0)
+args = parser.parse_args()
+
+device = args.device
+dtype = torch.float16 if device == "cuda" else torch.float32
+if args.tiny:
+    config = GPT2Config(n_embd=64, n_head=4, n_layer=2, vocab_size=256, n_positions=1024)
+    torch.manual_seed(args.seed)
+    model = GPTLMHeadModel(config, device=device, dtype=dtype)
+else:
+    config = GPT2Config.from_pretrained(args.model_name)
+    if device == "cuda":
+        config.use_flash_attn = True
+        config.fused_bias_fc = True
+        config.fused_mlp = True
+        config.fused_dropout_add_ln = True
+        config.residual_in_fp32 = True
+    model = GPTLMHeadModel.from_pretrained(args.model_name, config, device=device, dtype=dtype)
+model.eval()
+
+as_len = lambda x: x[0] if len(x) == 1 else tuple(x)
+if args.trace is not None:
+    trace = load_trace(args.trace)
+else:
+    trace = make_trace(
+        args.num_requests,
+        request_rate=args.request_rate,
+        prompt_len=as_len(args.prompt_len),
+        output_len=as_len(args.output_len),
+        seed=args.seed,
+    )
+if args.save_trace is not None:
+    save_trace(trace, args.save_trace)
+max_seqlen = max(r.prompt_len + r.output_len for r in trace)
+if args.backend == "engine":
+    results = replay_engine(
+        model, trace, args.max_batch_size, max_seqlen, config.vocab_size, seed=args.seed
+    )
+else:
+    results = replay_static(model, trace, args.max_batch_size, config.vocab_size, seed=args.seed)
+results["config"] = vars(args)
+print(json.dumps(results, indent=2))
+if args.output is not None:
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
@@ -0,0 +1,39 @@
+# Sampling latency per decoding step: the fused Triton kernel (threshold search, no sort) against
+# the sort/topk-based paths of flash_attn.utils.generation.
+#   python benchmarks/benchmark_sampling.py
+import torch
+from triton.testing import do_bench
+
+from flash_attn.ops.triton.sampling import sample_fused
+from flash_attn.utils.generation import _sample_batched_torch, sample
+
+torch.manual_seed(0)
+device = "cuda"
+dtype = torch.float16
+rep = 100
+
+# (top_k, top_p): top-k only, top-p only (the full vocabulary is candidate), both
+settings = [(50, 0.0), (0, 0.9), (50, 0.9)]
+for vocab_size in [32000, 50257, 128256, 256000]:
+    for batch_size in [1, 16, 128]:
+        logits = torch.randn(batch_size, vocab_size, device=device, dtype=dtype) * 4
+        for top_k, top_p in settings:
+            per_row = lambda x, dtype: torch.full((batch_size,), x, device=device, dtype=dtype)
+            args = (
+                logits,
+                per_row(1.0, torch.float32),
+                per_row(top_k, torch.int32),
+                per_row(top_p, torch.float32),
+                per_row(0.0, torch.float32),
+            )
+            ms_fused = do_bench(lambda: sample_fused(*args), rep=rep)
+            ms_torch = do_bench(lambda: _sample_batched_torch(*args), rep=rep)
+            # sample() sorts the whole vocabulary for top-p
+            ms_sort = do_bench(
+                lambda: sample(logits, top_k=top_k, top_p=top_p, temperature=1.0), rep=rep
+            )
+            print(
+                f"{vocab_size = }, {batch_size = }, {top_k = }, {top_p = }: "
+                f"fused {ms_fused * 1e3:.1f}us, topk {ms_torch * 1e3:.1f}us, "
+                f"sort {ms_sort * 1e3:.1f}us"
+            )
@@ -1,8 +1,36 @@
 # Adapted from https://github.com/mlcommons/training_results_v1.1/blob/main/NVIDIA/benchmarks/bert/implementations/pytorch/padding.py
 
+from dataclasses import dataclass
+from typing import Optional
+
 import torch
 import torch.nn.functional as F
 from einops import rearrange, repeat
+from torch import Tensor
+
+try:
+    from flash_attn.ops.triton.index import index_rows
+except ImportError:
+    index_rows = None
+
+
+def _use_triton(x):
+    return index_rows is not None and x.is_cuda
+
+
+def _index_rows(input, indices):
+    """input[indices], with rows of zeros where indices is negative."""
+    if _use_triton(input):
+        return index_rows(input, indices)
+    input = torch.cat([input, input.new_zeros(1, *input.shape[1:])])
+    return input[indices.where(indices >= 0, input.shape[0] - 1)]
+
+
+def _inverse_indices(indices, first_axis_dim):
+    """The inverse of the permutation indices, -1 for the rows not in indices."""
+    inverse = torch.full((first_axis_dim,), -1, device=indices.device, dtype=indices.dtype)
+    inverse[indices] = torch.arange(indices.shape[0], device=indices.device, dtype=indices.dtype)
+    return inverse
 
 
 class IndexFirstAxis(torch.autograd.Function):
@@ -12,6 +40,8 @@ class IndexFirstAxis(torch.autograd.Function):
         assert input.ndim >= 2
         ctx.first_axis_dim, other_shape = input.shape[0], input.shape[1:]
         second_dim = other_shape.numel()
+        if _use_triton(input):
+            return index_rows(input, indices)
         # TD [2022-03-04] For some reason torch.gather is a bit faster than indexing.
         # return input[indices]
         return torch.gather(
@@ -22,6 +52,11 @@ class IndexFirstAxis(torch.autograd.Function):
     def backward(ctx, grad_output):
         (indices,) = ctx.saved_tensors
         assert grad_output.ndim >= 2
+        if _use_triton(grad_output):
+            # The indices are unique: the scatter is a gather with the inverse indices, which
+            # writes each row of grad_input once (zeros included)
+            inverse = _inverse_indices(indices, ctx.first_axis_dim)
+            return index_rows(grad_output, inverse), None
         other_shape = grad_output.shape[1:]
         grad_output = rearrange(grad_output, "b ... -> b (...)")
         grad_input = torch.zeros(
@@ -44,6 +79,8 @@ class IndexPutFirstAxis(torch.autograd.Function):
         ctx.save_for_backward(indices)
         assert indices.ndim == 1
         assert values.ndim >= 2
+        if _use_triton(values):
+            return index_rows(values, _inverse_indices(indices, first_axis_dim))
         output = torch.zeros(
             first_axis_dim, *values.shape[1:], device=values.device, dtype=values.dtype
         )
@@ -55,6 +92,8 @@ class IndexPutFirstAxis(torch.autograd.Function):
     @staticmethod
     def backward(ctx, grad_output):
         (indices,) = ctx.saved_tensors
+        if _use_triton(grad_output):
+            return index_rows(grad_output, indices), None, None
         # TD [2022-03-04] For some reason torch.gather is a bit faster than indexing.
         grad_values = grad_output[indices]
         # grad_values = torch.gather(grad_output, 0, repeat(indices, 'z -> z d', d=grad_output.shape[1]))
@@ -95,12 +134,15 @@ class IndexFirstAxisResidual(torch.autograd.Function):
 index_first_axis_residual = IndexFirstAxisResidual.apply
 
 
-def unpad_input(hidden_states, attention_mask, unused_mask=None):
+def unpad_input(hidden_states, attention_mask, unused_mask=None, max_seqlen=None):
     """
     Arguments:
         hidden_states: (batch, seqlen, ...)
         attention_mask: (batch, seqlen), bool / int, 1 means valid and 0 means not valid.
         unused_mask: (batch, seqlen), bool / int, 1 means the element is allocated but unused.
+        max_seqlen: int, an upper bound of the sequence lengths known on the host (e.g. seqlen),
+            returned as max_seqlen_in_batch to avoid a device to host sync. See also
+            compute_unpad_plan for unpadding without any sync.
     Return:
         hidden_states: (total_nnz, ...), where total_nnz = number of tokens selected in attention_mask + unused_mask.
         indices: (total_nnz), the indices of masked tokens from the flattened input sequence.
@@ -112,7 +154,7 @@ def unpad_input(hidden_states, attention_mask, unused_mask=None):
     seqlens_in_batch = all_masks.sum(dim=-1, dtype=torch.int32)
     used_seqlens_in_batch = attention_mask.sum(dim=-1, dtype=torch.int32)
     indices = torch.nonzero(all_masks.flatten(), as_tuple=False).flatten()
-    max_seqlen_in_batch = seqlens_in_batch.max().item()
+    max_seqlen_in_batch = seqlens_in_batch.max().item() if max_seqlen is None else max_seqlen
     cu_seqlens = F.pad(torch.cumsum(seqlens_in_batch, dim=0, dtype=torch.int32), (1, 0))
     # TD [2022-03-04] We don't want to index with a bool mask, because Pytorch will expand the
     # bool mask, then call nonzero to get the indices, then index with those. The indices is @dim
@@ -128,7 +170,9 @@ def unpad_input(hidden_states, attention_mask, unused_mask=None):
     )
 
 
-def unpad_input_for_concatenated_sequences(hidden_states, attention_mask_in_length):
+def unpad_input_for_concatenated_sequences(
+    hidden_states, attention_mask_in_length, max_seqlen=None
+):
     """
     Supports concatenating short samples in one sequence. The attention_mask_in_length is utilized to mask other short samples. It helps efficient training of variant lengths-based samples (e.g., the supervised fine-tuning task in large language model).
     The motivation for this function is explained [here](https://github.com/Dao-AILab/flash-attention/issues/432#issuecomment-1668822286).
@@ -174,6 +218,8 @@ def unpad_input_for_concatenated_sequences(hidden_states, attention_mask_in_leng
     Arguments:
         hidden_states: (batch, seqlen, ...)
         attention_mask_in_length: (batch, seqlen), int, a nonzero number (e.g., 1, 2, 3, etc.) means length of concatenated sequence in b-th batch, and 0 means none.
+        max_seqlen: int, an upper bound of the sequence lengths known on the host, returned as
+            max_seqlen_in_batch to avoid a device to host sync.
     Return:
         hidden_states: (total_nnz, ...), where total_nnz = number of tokens in selected in attention_mask.
         indices: (total_nnz), the indices of non-masked tokens from the flattened input sequence.
@@ -186,7 +232,7 @@ def unpad_input_for_concatenated_sequences(hidden_states, attention_mask_in_leng
     real_indices_idx = torch.nonzero(attention_mask_in_length.flatten(), as_tuple=False).flatten()
     seqlens_in_batch = attention_mask_in_length.flatten()[real_indices_idx]
     indices = torch.nonzero(attention_mask_2d.flatten(), as_tuple=False).flatten()
-    max_seqlen_in_batch = seqlens_in_batch.max().item()
+    max_seqlen_in_batch = seqlens_in_batch.max().item() if max_seqlen is None else max_seqlen
     cu_seqlens = F.pad(torch.cumsum(seqlens_in_batch, dim=0, dtype=torch.int32), (1, 0))
     # TD [2022-03-04] We don't want to index with a bool mask, because Pytorch will expand the
     # bool mask, then call nonzero to get the indices, then index with those. The indices is @dim
@@ -216,3 +262,116 @@ def pad_input(hidden_states, indices, batch, seqlen):
     # output[indices] = hidden_states
     output = index_put_first_axis(hidden_states, indices, batch * seqlen)
     return rearrange(output, "(b s) ... -> b s ...", b=batch)
+
+
+class IndexRowsFunc(torch.autograd.Function):
+    """input[indices] with zeros for negative indices, where inverse_indices is the inverse of
+    indices (so that the backward is also a gather)."""
+
+    @staticmethod
+    def forward(ctx, input, indices, inverse_indices):
+        ctx.save_for_backward(inverse_indices)
+        return _index_rows(input, indices)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        (inverse_indices,) = ctx.saved_tensors
+        return _index_rows(grad_output, inverse_indices), None, None
+
+
+@dataclass
+class UnpadPlan:
+    """Precomputed unpadding of a batch, see compute_unpad_plan."""
+
+    indices: Tensor  # (max_total_tokens,), -1 past the last token
+    inverse_indices: Tensor  # (batch * seqlen,), -1 for the padding tokens
+    cu_seqlens: Tensor  # (batch + 1,), int32
+    max_seqlen: int
+    seqused: Tensor  # (batch,), int32
+
+    def to(self, device, non_blocking=False):
+        return UnpadPlan(
+            indices=self.indices.to(device, non_blocking=non_blocking),
+            inverse_indices=self.inverse_indices.to(device, non_blocking=non_blocking),
+            cu_seqlens=self.cu_seqlens.to(device, non_blocking=non_blocking),
+            max_seqlen=self.max_seqlen,
+            seqused=self.seqused.to(device, non_blocking=non_blocking),
+        )
+
+
+def compute_unpad_plan(
+    attention_mask: Tensor,
+    unused_mask: Optional[Tensor] = None,
+    max_total_tokens: Optional[int] = None,
+    max_seqlen: Optional[int] = None,
+) -> UnpadPlan:
+    """Compute the indices used by unpad_input_with_plan / pad_input_with_plan, without any device
+    to host sync (no nonzero, no .item()), so that it can be captured in a CUDA graph. It can also
+    be computed on CPU by the data loader and moved to the GPU with UnpadPlan.to.
+    Arguments:
+        attention_mask: (batch, seqlen), bool / int, 1 means valid and 0 means not valid.
+        unused_mask: (batch, seqlen), bool / int, 1 means the element is allocated but unused.
+        max_total_tokens: int, the number of rows of the unpadded tensors (default batch * seqlen).
+            Must be at least the number of tokens selected in attention_mask + unused_mask: this
+            isn't checked, since it would need a sync. The rows past the last token are zeros.
+        max_seqlen: int, an upper bound of the sequence lengths (default seqlen).
+    Return:
+        plan: UnpadPlan
+    """
+    batch, seqlen = attention_mask.shape
+    all_masks = (attention_mask + unused_mask) if unused_mask is not None else attention_mask
+    seqlens_in_batch = all_masks.sum(dim=-1, dtype=torch.int32)
+    used_seqlens_in_batch = attention_mask.sum(dim=-1, dtype=torch.int32)
+    max_total_tokens = max_total_tokens if max_total_tokens is not None else batch * seqlen
+    mask = all_masks.flatten().bool()
+    # Position of each token in the unpadded tensor
+    positions = torch.cumsum(mask, dim=0) - 1
+    inverse_indices = torch.where(mask & (positions < max_total_tokens), positions, -1)
+    # Scatter the padding tokens into an extra row that we drop
+    indices = torch.full(
+        (max_total_tokens + 1,), -1, device=attention_mask.device, dtype=inverse_indices.dtype
+    )
+    indices.scatter_(
+        0,
+        torch.where(inverse_indices >= 0, inverse_indices, max_total_tokens),
+        torch.arange(batch * seqlen, device=attention_mask.device, dtype=indices.dtype),
+    )
+    cu_seqlens = F.pad(torch.cumsum(seqlens_in_batch, dim=0, dtype=torch.int32), (1, 0))
+    return UnpadPlan(
+        indices=indices[:max_total_tokens],
+        inverse_indices=inverse_indices,
+        cu_seqlens=cu_seqlens,
+        max_seqlen=max_seqlen if max_seqlen is not None else seqlen,
+        seqused=used_seqlens_in_batch,
+    )
+
+
+def unpad_input_with_plan(hidden_states, plan: UnpadPlan):
+    """
+    Same as unpad_input, with the indices precomputed by compute_unpad_plan.
+    Arguments:
+        hidden_states: (batch, seqlen, ...)
+    Return:
+        hidden_states: (max_total_tokens, ...)
+        indices: (max_total_tokens), -1 past the last token.
+        cu_seqlens: (batch + 1)
+        max_seqlen: int
+        seqused: (batch)
+    """
+    hidden_states = IndexRowsFunc.apply(
+        rearrange(hidden_states, "b s ... -> (b s) ..."), plan.indices, plan.inverse_indices
+    )
+    return hidden_states, plan.indices, plan.cu_seqlens, plan.max_seqlen, plan.seqused
+
+
+def pad_input_with_plan(hidden_states, plan: UnpadPlan, batch, seqlen):
+    """
+    Same as pad_input, with the indices precomputed by compute_unpad_plan. The padded output is
+    written in a single pass, without zero-filling it first.
+    Arguments:
+        hidden_states: (max_total_tokens, ...)
+    Return:
+        hidden_states: (batch, seqlen, ...)
+    """
+    output = IndexRowsFunc.apply(hidden_states, plan.inverse_indices, plan.indices)
+    return rearrange(output, "(b s) ... -> b s ...", b=batch)
@@ -2,7 +2,7 @@
 
 import math
 from functools import partial
-from typing import Optional, Tuple, Union
+from typing import Dict, Optional, Tuple, Union
 
 import torch
 from torch import Tensor
@@ -352,15 +352,49 @@ class RotaryEmbedding(torch.nn.Module):
         base=10000.0,
         interleaved=False,
         scale_base=None,
+        scaling: Optional[dict] = None,
+        max_seqlen: int = 0,
         device=None,
     ):
         """
         interleaved: if True, rotate pairs of even and odd dimensions (GPT-J style) instead
             of 1st half and 2nd half (GPT-NeoX style).
+        scaling: long context scaling, in the format of rope_scaling in Hugging Face configs,
+            e.g. {"type": "yarn", "factor": 4.0, "original_max_position_embeddings": 4096}.
+            Supported types:
+            - "linear": position interpolation (Chen et al., https://arxiv.org/abs/2306.15595),
+                the positions are divided by factor.
+            - "dynamic": dynamic NTK, the base is increased when the sequence length is longer
+                than original_max_position_embeddings.
+            - "yarn": YaRN (Peng et al., https://arxiv.org/abs/2309.00071). Optional keys:
+                beta_fast (default 32) and beta_slow (default 1).
+            - "llama3": Llama 3.1, the low frequencies are divided by factor, the high ones kept,
+                with a smooth transition in between. Optional keys: low_freq_factor (default 1)
+                and high_freq_factor (default 4).
+        max_seqlen: compute the cos / sin tables for at least this length the first time they're
+            needed, instead of growing them with the sequence length. Not used with "dynamic"
+            scaling since the tables then depend on the sequence length.
         """
         super().__init__()
         self.dim = dim
         self.base = float(base)
+        scaling = dict(scaling) if scaling is not None else {}
+        scaling_type = scaling.get("rope_type", scaling.get("type"))
+        self.scaling_type = scaling_type if scaling_type != "default" else None
+        if self.scaling_type not in [None, "linear", "dynamic", "yarn", "llama3"]:
+            raise NotImplementedError(f"Unsupported rotary scaling {self.scaling_type}")
+        assert self.scaling_type is None or scale_base is None, "XPos does not support scaling"
+        self.scaling_factor = float(scaling.get("factor", 1.0))
+        self.original_max_seqlen = scaling.get("original_max_position_embeddings", None)
+        if self.scaling_type in ["dynamic", "yarn", "llama3"]:
+            assert (
+                self.original_max_seqlen is not None
+            ), f"{self.scaling_type} scaling requires original_max_position_embeddings"
+        self.yarn_beta_fast = float(scaling.get("beta_fast", 32.0))
+        self.yarn_beta_slow = float(scaling.get("beta_slow", 1.0))
+        self.low_freq_factor = float(scaling.get("low_freq_factor", 1.0))
+        self.high_freq_factor = float(scaling.get("high_freq_factor", 4.0))
+        self.max_seqlen = max_seqlen
         # Generate and save the inverse frequency buffer (non trainable)
         inv_freq = self._compute_inv_freq(device)
         self.register_buffer("inv_freq", inv_freq, persistent=False)
@@ -379,52 +413,131 @@ class RotaryEmbedding(torch.nn.Module):
         self._cos_k_cached = None
         self._sin_k_cached = None
 
-    def _compute_inv_freq(self, device=None):
-        return 1.0 / (
-            self.base
-            ** (torch.arange(0, self.dim, 2, device=device, dtype=torch.float32) / self.dim)
+    @property
+    def config_key(self):
+        """RotaryEmbedding modules with the same config_key compute the same cos / sin tables."""
+        return (
+            self.dim,
+            self.base,
+            self.interleaved,
+            self.scale_base,
+            self.scaling_type,
+            self.scaling_factor,
+            self.original_max_seqlen,
+            self.yarn_beta_fast,
+            self.yarn_beta_slow,
+            self.low_freq_factor,
+            self.high_freq_factor,
         )
 
+    def _compute_inv_freq(self, device=None, seqlen=None):
+        base = self.base
+        if (
+            self.scaling_type == "dynamic"
+            and seqlen is not None
+            and seqlen > self.original_max_seqlen
+        ):
+            factor = self.scaling_factor * seqlen / self.original_max_seqlen
+            base *= (factor - (self.scaling_factor - 1)) ** (self.dim / (self.dim - 2))
+        inv_freq = 1.0 / (
+            base ** (torch.arange(0, self.dim, 2, device=device, dtype=torch.float32) / self.dim)
+        )
+        if self.scaling_type == "yarn":
+            # Dimensions that rotate more than beta_fast times over the original context are kept
+            # as is (extrapolation), those that rotate less than beta_slow times are interpolated
+            # (divided by factor), with a linear ramp in between.
+            def correction_dim(num_rotations):
+                return (
+                    self.dim
+                    * math.log(self.original_max_seqlen / (num_rotations * 2 * math.pi))
+                    / (2 * math.log(self.base))
+                )
+
+            low = max(math.floor(correction_dim(self.yarn_beta_fast)), 0)
+            high = min(math.ceil(correction_dim(self.yarn_beta_slow)), self.dim - 1)
+            ramp = (
+                (torch.arange(self.dim // 2, device=device, dtype=torch.float32) - low)
+                / max(high - low, 1e-3)
+            ).clamp(0.0, 1.0)
+            inv_freq = inv_freq / self.scaling_factor * ramp + inv_freq * (1.0 - ramp)
+        elif self.scaling_type == "llama3":
+            # Wavelengths longer than original_max_seqlen / low_freq_factor are interpolated, those
+            # shorter than original_max_seqlen / high_freq_factor are kept, with a ramp in between
+            # that is linear in the frequency.
+            num_rotations = self.original_max_seqlen * inv_freq / (2 * math.pi)
+            smooth = (num_rotations - self.low_freq_factor) / (
+                self.high_freq_factor - self.low_freq_factor
+            )
+            smooth = smooth.clamp(0.0, 1.0)
+            inv_freq = inv_freq / self.scaling_factor * (1.0 - smooth) + inv_freq * smooth
+        return inv_freq
+
+    @property
+    def attention_scaling(self):
+        """YaRN scales the cos / sin tables, i.e. the attention logits are multiplied by the
+        square of this factor."""
+        if self.scaling_type == "yarn" and self.scaling_factor > 1.0:
+            return 0.1 * math.log(self.scaling_factor) + 1.0
+        return 1.0
+
     def _update_cos_sin_cache(self, seqlen, device=None, dtype=None):
+        if self.scaling_type == "dynamic":
+            # The base depends on the sequence length past original_max_seqlen, so the tables are
+            # reset whenever that changes, including when the sequence length drops back
+            seqlen = max(seqlen, self.original_max_seqlen)
+            stale = seqlen != self._seq_len_cached
+        else:
+            stale = seqlen > self._seq_len_cached
         # Reset the tables if the sequence length has changed,
-        # if we're on a new device (possibly due to tracing for instance),
-        # or if we're switching from inference mode to training
+        # or if we're on a new device (possibly due to tracing for instance)
         if (
-            seqlen > self._seq_len_cached
+            stale
             or self._cos_cached is None
             or self._cos_cached.device != device
             or self._cos_cached.dtype != dtype
-            or (self.training and self._cos_cached.is_inference())
         ):
+            if self.scaling_type != "dynamic":
+                seqlen = max(seqlen, self._seq_len_cached, self.max_seqlen)
             self._seq_len_cached = seqlen
-            # We want fp32 here, not self.inv_freq.dtype, since the model could be loaded in bf16
-            # And the output of arange can be quite large, so bf16 would lose a lot of precision.
-            t = torch.arange(seqlen, device=device, dtype=torch.float32)
-            # We want fp32 here as well since inv_freq will be multiplied with t, and the output
-            # will be large. Having it in bf16 will lose a lot of precision and cause the
-            # cos & sin output to change significantly.
-            # We want to recompute self.inv_freq if it was not loaded in fp32
-            if self.inv_freq.dtype != torch.float32:
-                inv_freq = self._compute_inv_freq(device=device)
-            else:
-                inv_freq = self.inv_freq
-            # Don't do einsum, it converts fp32 to bf16 under AMP
-            # freqs = torch.einsum("i,j->ij", t, self.inv_freq)
-            freqs = torch.outer(t, inv_freq)
-            if self.scale is None:
-                self._cos_cached = torch.cos(freqs).to(dtype)
-                self._sin_cached = torch.sin(freqs).to(dtype)
-            else:
-                power = (
-                    torch.arange(seqlen, dtype=self.scale.dtype, device=self.scale.device)
-                    - seqlen // 2
-                ) / self.scale_base
-                scale = self.scale.to(device=power.device) ** rearrange(power, "s -> s 1")
-                # We want the multiplication by scale to happen in fp32
-                self._cos_cached = (torch.cos(freqs) * scale).to(dtype)
-                self._sin_cached = (torch.sin(freqs) * scale).to(dtype)
-                self._cos_k_cached = (torch.cos(freqs) / scale).to(dtype)
-                self._sin_k_cached = (torch.sin(freqs) / scale).to(dtype)
+            # The tables are normal tensors even if they're computed in inference mode, so that
+            # they can be reused when switching back to training.
+            with torch.inference_mode(False), torch.no_grad():
+                self._compute_cos_sin_cache(seqlen, device=device, dtype=dtype)
+
+    def _compute_cos_sin_cache(self, seqlen, device=None, dtype=None):
+        # We want fp32 here, not self.inv_freq.dtype, since the model could be loaded in bf16
+        # And the output of arange can be quite large, so bf16 would lose a lot of precision.
+        t = torch.arange(seqlen, device=device, dtype=torch.float32)
+        if self.scaling_type == "linear":
+            t = t / self.scaling_factor
+        # We want fp32 here as well since inv_freq will be multiplied with t, and the output
+        # will be large. Having it in bf16 will lose a lot of precision and cause the
+        # cos & sin output to change significantly.
+        # We want to recompute self.inv_freq if it was not loaded in fp32
+        if self.scaling_type == "dynamic":
+            inv_freq = self._compute_inv_freq(device=device, seqlen=seqlen)
+        elif self.inv_freq.dtype != torch.float32 or self.inv_freq.device != t.device:
+            inv_freq = self._compute_inv_freq(device=device)
+        else:
+            inv_freq = self.inv_freq
+        # Don't do einsum, it converts fp32 to bf16 under AMP
+        # freqs = torch.einsum("i,j->ij", t, self.inv_freq)
+        freqs = torch.outer(t, inv_freq)
+        if self.scale is None:
+            mscale = self.attention_scaling
+            self._cos_cached = (torch.cos(freqs) * mscale).to(dtype)
+            self._sin_cached = (torch.sin(freqs) * mscale).to(dtype)
+        else:
+            power = (
+                torch.arange(seqlen, dtype=self.scale.dtype, device=self.scale.device)
+                - seqlen // 2
+            ) / self.scale_base
+            scale = self.scale.to(device=power.device) ** rearrange(power, "s -> s 1")
+            # We want the multiplication by scale to happen in fp32
+            self._cos_cached = (torch.cos(freqs) * scale).to(dtype)
+            self._sin_cached = (torch.sin(freqs) * scale).to(dtype)
+            self._cos_k_cached = (torch.cos(freqs) / scale).to(dtype)
+            self._sin_k_cached = (torch.sin(freqs) / scale).to(dtype)
 
     def forward(
         self,
@@ -433,19 +546,33 @@ class RotaryEmbedding(torch.nn.Module):
         seqlen_offset: Union[int, torch.Tensor] = 0,
         max_seqlen: Optional[int] = None,
         num_heads_q: Optional[int] = None,
+        cu_seqlens: Optional[torch.Tensor] = None,
+        max_position: Optional[int] = None,
     ) -> Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
         """
         qkv: (batch, seqlen, 3, nheads, headdim) or (batch, seqlen, num_heads_q + 2 * num_heads_k, headdim)
             if kv is none, else it's just q of shape (batch, seqlen, nheads, headdim).
             If qkv has shape (batch, seqlen, num_heads_q + 2 * num_heads_k, headdim) (e.g. MQA / GQA),
             then num_heads_q must be provided.
-        kv: (batch, seqlen, 2, nheads, headdim)
+            If cu_seqlens is not None, the batch and seqlen dimensions are replaced by a single
+            total_seqlen dimension.
+        kv: (batch, seqlen, 2, nheads, headdim), or (total_seqlen, 2, nheads, headdim)
         seqlen_offset: (batch_size,) or int. Each sequence in x is shifted by this amount.
             Most commonly used in inference when we have KV cache.
             If it's a tensor of shape (batch_size,), then to update the cos / sin cache, one
             should pass in max_seqlen, which will update the cos / sin cache up to that length.
-        Apply rotary embedding *inplace* to qkv and / or kv.
+        cu_seqlens: (batch_size + 1,), dtype torch.int32. The cumulative sequence lengths of the
+            sequences in qkv. If passed in, max_seqlen must be the maximum sequence length in
+            the batch, and if seqlen_offset is a tensor, max_position must be an upper bound of
+            seqlen_offset + the sequence lengths (e.g. the length of the KV cache), up to which
+            the cos / sin cache is updated.
+        Apply rotary embedding *inplace* to qkv and / or kv, except for the cu_seqlens case
+        where new tensors are returned.
         """
+        if cu_seqlens is not None:
+            return self._forward_varlen(
+                qkv, kv, cu_seqlens, max_seqlen, seqlen_offset, num_heads_q, max_position
+            )
         seqlen = qkv.shape[1]
         if max_seqlen is not None:
             self._update_cos_sin_cache(max_seqlen, device=qkv.device, dtype=qkv.dtype)
@@ -480,3 +607,56 @@ class RotaryEmbedding(torch.nn.Module):
                 seqlen_offsets=seqlen_offset,
             )
             return q, kv
+
+    def _forward_varlen(
+        self, qkv, kv, cu_seqlens, max_seqlen, seqlen_offset=0, num_heads_q=None, max_position=None
+    ):
+        assert max_seqlen is not None, "If cu_seqlens is passed in, then max_seqlen must be passed"
+        if isinstance(seqlen_offset, int):
+            seqlen_ro = max_seqlen + seqlen_offset
+        else:
+            assert max_position is not None, "A tensor seqlen_offset requires max_position"
+            seqlen_ro = max_position
+        self._update_cos_sin_cache(seqlen_ro, device=qkv.device, dtype=qkv.dtype)
+        rotary_fn = partial(
+            apply_rotary_emb,
+            interleaved=self.interleaved,
+            seqlen_offsets=seqlen_offset,
+            cu_seqlens=cu_seqlens,
+            max_seqlen=max_seqlen,
+        )
+        cos, sin = self._cos_cached, self._sin_cached
+        cos_k = self._cos_cached if self.scale is None else self._cos_k_cached
+        sin_k = self._sin_cached if self.scale is None else self._sin_k_cached
+        if kv is not None:
+            k = rotary_fn(kv[:, 0], cos_k, sin_k)
+            return rotary_fn(qkv, cos, sin), torch.stack([k, kv[:, 1]], dim=1)
+        if qkv.dim() == 4:
+            # (total_seqlen, 3, nheads, headdim)
+            q = rotary_fn(qkv[:, 0], cos, sin)
+            k = rotary_fn(qkv[:, 1], cos_k, sin_k)
+            return torch.stack([q, k, qkv[:, 2]], dim=1)
+        else:
+            # (total_seqlen, num_heads_q + 2 * num_heads_k, headdim)
+            assert num_heads_q is not None
+            num_heads_k = (qkv.shape[1] - num_heads_q) // 2
+            q = rotary_fn(qkv[:, :num_heads_q], cos, sin)
+            k = rotary_fn(qkv[:, num_heads_q : num_heads_q + num_heads_k], cos_k, sin_k)
+            return torch.cat([q, k, qkv[:, num_heads_q + num_heads_k :]], dim=1)
+
+
+def share_rotary_embeddings(model: torch.nn.Module) -> Dict[tuple, RotaryEmbedding]:
+    """Make all the submodules of model (e.g. the MHA layers) with the same rotary configuration
+    use a single RotaryEmbedding, so that the cos / sin tables are computed and stored once for
+    the whole model instead of once per layer.
+    Return:
+        registry: dict from RotaryEmbedding.config_key to the shared RotaryEmbedding.
+    """
+    registry = {}
+    for module in list(model.modules()):
+        rotary_emb = getattr(module, "rotary_emb", None)
+        if isinstance(rotary_emb, RotaryEmbedding):
+            shared = registry.setdefault(rotary_emb.config_key, rotary_emb)
+            shared.max_seqlen = max(shared.max_seqlen, rotary_emb.max_seqlen)
+            module.rotary_emb = shared
+    return registry
@@ -2,8 +2,10 @@
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 from flash_attn.ops.triton.cross_entropy import cross_entropy_loss
+from flash_attn.utils.distributed import all_gather_raw, all_reduce_raw, reduce_scatter_raw
 
 
 class CrossEntropyLoss(nn.Module):
@@ -83,3 +85,208 @@ class CrossEntropyLoss(nn.Module):
             z_loss = z_loss
 
         return loss, z_loss
+
+
+class FusedLinearCrossEntropyFunc(torch.autograd.Function):
+    @staticmethod
+    def forward(
+        ctx,
+        x,
+        weight,
+        bias,
+        labels,
+        label_smoothing=0.0,
+        logit_scale=1.0,
+        lse_square_scale=0.0,
+        ignore_index=-100,
+        reduction="mean",
+        chunk_size=4096,
+        process_group=None,
+        sequence_parallel=True,
+    ):
+        """The logits are computed chunk_size rows at a time, and the gradients wrt x, weight and
+        bias are computed in the forward pass (assuming a gradient of 1.0 for the loss), right
+        after the loss of each chunk: only one chunk of logits is ever materialized.
+        """
+        assert reduction in ["mean", "sum"]
+        x_shape = x.shape
+        x = x.reshape(-1, x.shape[-1])
+        if process_group is not None and sequence_parallel:
+            x, _ = all_gather_raw(x, process_group)
+        labels = labels.reshape(-1)
+        n_rows = x.shape[0]
+        assert labels.shape == (n_rows,)
+        needs_dx, needs_dweight, needs_dbias = ctx.needs_input_grad[:3]
+        dx = torch.empty_like(x) if needs_dx else None
+        dweight = torch.zeros_like(weight) if needs_dweight else None
+        dbias = torch.zeros_like(bias) if bias is not None and needs_dbias else None
+        n_valid = (labels != ignore_index).sum()
+        if reduction == "mean":
+            grad_scale = 1.0 / n_valid.clamp(min=1).float()
+        else:
+            grad_scale = torch.ones((), device=x.device)
+        losses = torch.empty(n_rows, dtype=torch.float, device=x.device)
+        z_losses = torch.empty(n_rows, dtype=torch.float, device=x.device)
+        for start in range(0, n_rows, chunk_size):
+            end = min(start + chunk_size, n_rows)
+            x_chunk = x[start:end]
+            logits = F.linear(x_chunk, weight, bias)
+            with torch.enable_grad():
+                logits.requires_grad_(True)
+                loss, z_loss = cross_entropy_loss(
+                    logits,
+                    labels[start:end],
+                    label_smoothing=label_smoothing,
+                    logit_scale=logit_scale,
+                    lse_square_scale=lse_square_scale,
+                    ignore_index=ignore_index,
+                    inplace_backward=True,
+                    process_group=process_group,
+                )
+                if needs_dx or needs_dweight or needs_dbias:
+                    # The backward of the loss overwrites the logits with their gradient
+                    (dlogits,) = torch.autograd.grad(
+                        loss, logits, grad_outputs=grad_scale.expand(end - start)
+                    )
+            losses[start:end] = loss.detach()
+            z_losses[start:end] = z_loss
+            if needs_dx:
+                torch.matmul(dlogits, weight, out=dx[start:end])
+            if needs_dweight:
+                dweight.addmm_(dlogits.t(), x_chunk)
+            if dbias is not None:
+                dbias += dlogits.sum(dim=0)
+            del logits
+        if process_group is not None and needs_dx:
+            # Each rank has the gradient wrt its part of the vocab
+            if sequence_parallel:
+                dx, _ = reduce_scatter_raw(dx, process_group)
+            else:
+                dx, _ = all_reduce_raw(dx, process_group)
+        ctx.save_for_backward(dx, dweight, dbias)
+        ctx.x_shape = x_shape
+        ctx.mark_non_differentiable(z_losses)
+        if reduction == "mean":
+            return losses.sum() / n_valid, z_losses.sum() / n_valid
+        return losses.sum(), z_losses.sum()
+
+    @staticmethod
+    def backward(ctx, grad_loss, grad_z_loss):
+        del grad_z_loss  # z_loss is only for logging.
+        dx, dweight, dbias = ctx.saved_tensors
+        # The gradients were computed in the forward pass for grad_loss = 1.0
+        if dx is not None:
+            dx = (dx * grad_loss.to(dx.dtype)).reshape(ctx.x_shape)
+        if dweight is not None:
+            dweight = dweight * grad_loss.to(dweight.dtype)
+        if dbias is not None:
+            dbias = dbias * grad_loss.to(dbias.dtype)
+        return dx, dweight, dbias, None, None, None, None, None, None, None, None, None
+
+
+def fused_linear_cross_entropy(
+    x,
+    weight,
+    labels,
+    bias=None,
+    label_smoothing=0.0,
+    logit_scale=1.0,
+    lse_square_scale=0.0,
+    ignore_index=-100,
+    reduction="mean",
+    chunk_size=4096,
+    process_group=None,
+    sequence_parallel=True,
+):
+    """Cross entropy loss of the logits F.linear(x, weight, bias), without materializing the
+    logits of more than chunk_size rows (nor their gradient).
+    Arguments:
+        x: (..., hidden_dim)
+        weight: (vocab_size, hidden_dim), or the part of the vocab of this rank if process_group
+            is not None.
+        labels: (...), the labels of all the rows of x (after the all-gather if sequence_parallel)
+        process_group: if not None, we're doing Tensor Parallel: each process is responsible for
+            one part of the vocab (as ColumnParallelLinear). If sequence_parallel, x is the part
+            of the sequence of this rank, and is all-gathered.
+        label_smoothing, logit_scale, lse_square_scale, ignore_index: see CrossEntropyLoss.
+    Returns:
+        loss: (), float
+        z_loss: (), float, the component of the loss contributed by lse_square_scale (for
+            logging only, no gradient).
+    """
+    return FusedLinearCrossEntropyFunc.apply(
+        x,
+        weight,
+        bias,
+        labels,
+        label_smoothing,
+        logit_scale,
+        lse_square_scale,
+        ignore_index,
+        reduction,
+        chunk_size,
+        process_group,
+        sequence_parallel,
+    )
+
+
+class FusedLinearCrossEntropyLoss(nn.Module):
+    def __init__(
+        self,
+        ignore_index=-100,
+        reduction="mean",
+        label_smoothing=0.0,
+        logit_scale=1.0,
+        lse_square_scale=0.0,
+        chunk_size=4096,
+        process_group=None,
+        sequence_parallel=True,
+        return_z_loss=False,
+    ):
+        """Same as CrossEntropyLoss applied to the output of a linear layer (e.g. the lm_head),
+        computed chunk_size rows at a time so that the full logits are never materialized.
+        Arguments:
+            chunk_size: int. Number of rows of logits materialized at a time.
+            process_group, sequence_parallel: same as the ColumnParallelLinear whose weight is
+                passed to forward.
+            See CrossEntropyLoss for the other arguments.
+        """
+        super().__init__()
+        if reduction not in ["mean", "sum"]:
+            raise NotImplementedError("Only support reduction = 'mean' or 'sum'")
+        self.ignore_index = ignore_index
+        self.reduction = reduction
+        self.label_smoothing = label_smoothing
+        self.logit_scale = logit_scale
+        self.lse_square_scale = lse_square_scale
+        self.chunk_size = chunk_size
+        self.process_group = process_group
+        self.sequence_parallel = sequence_parallel
+        self.return_z_loss = return_z_loss
+
+    def forward(self, input, weight, target, bias=None):
+        """
+        Arguments:
+            input: (..., hidden_dim)
+            weight: (vocab_size, hidden_dim)
+            target: (...)
+        Returns:
+            loss: (), dtype float
+            z_loss: (), dtype float (if self.return_z_loss)
+        """
+        assert input.is_cuda and target.is_cuda, "Only support CUDA tensors"
+        loss, z_loss = fused_linear_cross_entropy(
+            input,
+            weight,
+            target,
+            bias=bias,
+            label_smoothing=self.label_smoothing,
+            logit_scale=self.logit_scale,
+            lse_square_scale=self.lse_square_scale,
+            ignore_index=self.ignore_index,
+            reduction=self.reduction,
+            chunk_size=self.chunk_size,
+            process_group=self.process_group,
+            sequence_parallel=self.sequence_parallel,
+        )
+        return loss if not self.return_z_loss else (loss, z_loss)
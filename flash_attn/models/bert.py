@@ -26,7 +26,9 @@ from flash_attn.bert_padding import (
     index_first_axis,
     index_first_axis_residual,
     pad_input,
+    pad_input_with_plan,
     unpad_input,
+    unpad_input_with_plan,
 )
 from flash_attn.modules.block import Block
 from flash_attn.modules.embedding import BertEmbeddings
@@ -50,6 +52,11 @@ try:
 except ImportError:
     CrossEntropyLoss = None
 
+try:
+    from flash_attn.layers.rotary import share_rotary_embeddings
+except ImportError:
+    share_rotary_embeddings = None
+
 
 logger = logging.getLogger(__name__)
 
@@ -63,6 +70,8 @@ def create_mixer_cls(config, cross_attn=False, return_residual=False):
         rotary_kwargs["rotary_emb_base"] = getattr(config, "rotary_emb_base", 10000.0)
         rotary_kwargs["rotary_emb_scale_base"] = getattr(config, "rotary_emb_scale_base", None)
         rotary_kwargs["rotary_emb_interleaved"] = getattr(config, "rotary_emb_interleaved", False)
+        rotary_kwargs["rotary_emb_scaling"] = getattr(config, "rotary_emb_scaling", None)
+        rotary_kwargs["rotary_emb_max_seqlen"] = getattr(config, "rotary_emb_max_seqlen", 0)
     mixer_cls = partial(
         MHA,
         num_heads=config.num_attention_heads,
@@ -156,11 +165,15 @@ class BertEncoder(nn.Module):
         self.layers = nn.ModuleList(
             [create_block(config, layer_idx=i) for i in range(config.num_hidden_layers)]
         )
+        if share_rotary_embeddings is not None:
+            share_rotary_embeddings(self.layers)
 
-    def forward(self, hidden_states, key_padding_mask=None, subset_mask=None):
+    def forward(self, hidden_states, key_padding_mask=None, subset_mask=None, unpad_plan=None):
         """If subset_mask is not None, we only want output for the subset of the sequence.
         This means that we only compute the last layer output for these tokens.
         subset_mask: (batch, seqlen), dtype=torch.bool
+        unpad_plan: UnpadPlan computed from key_padding_mask (see compute_unpad_plan), e.g. by
+            the data loader. The unpadding then doesn't need any device to host sync.
         """
         if key_padding_mask is None or not self.use_flash_attn:
             mixer_kwargs = (
@@ -172,14 +185,23 @@ class BertEncoder(nn.Module):
                 hidden_states = hidden_states[subset_mask]
         else:
             batch, seqlen = hidden_states.shape[:2]
-            hidden_states, indices, cu_seqlens, max_seqlen_in_batch, _ = unpad_input(
-                hidden_states, key_padding_mask
-            )
+            if unpad_plan is not None:
+                assert subset_mask is None, "unpad_plan is not supported with subset_mask"
+                hidden_states, indices, cu_seqlens, max_seqlen_in_batch, _ = unpad_input_with_plan(
+                    hidden_states, unpad_plan
+                )
+            else:
+                hidden_states, indices, cu_seqlens, max_seqlen_in_batch, _ = unpad_input(
+                    hidden_states, key_padding_mask
+                )
             mixer_kwargs = {"cu_seqlens": cu_seqlens, "max_seqlen": max_seqlen_in_batch}
             if subset_mask is None:
                 for layer in self.layers:
                     hidden_states = layer(hidden_states, mixer_kwargs=mixer_kwargs)
-                hidden_states = pad_input(hidden_states, indices, batch, seqlen)
+                if unpad_plan is not None:
+                    hidden_states = pad_input_with_plan(hidden_states, unpad_plan, batch, seqlen)
+                else:
+                    hidden_states = pad_input(hidden_states, indices, batch, seqlen)
             else:
                 for layer in self.layers[:-1]:
                     hidden_states = layer(hidden_states, mixer_kwargs=mixer_kwargs)
@@ -371,11 +393,13 @@ class BertModel(BertPreTrainedModel):
         token_type_ids=None,
         attention_mask=None,
         masked_tokens_mask=None,
+        unpad_plan=None,
     ):
         """If masked_tokens_mask is not None (i.e. last_layer_subset == True in BertForPreTraining),
         we only want the output for the masked tokens. This means that we only compute the last
         layer output for these tokens.
         masked_tokens_mask: (batch, seqlen), dtype=torch.bool
+        unpad_plan: optional UnpadPlan computed from attention_mask, see BertEncoder.
         """
         hidden_states = self.embeddings(
             input_ids, position_ids=position_ids, token_type_ids=token_type_ids
@@ -402,7 +426,10 @@ class BertModel(BertPreTrainedModel):
             subset_mask = None
 
         sequence_output = self.encoder(
-            hidden_states, key_padding_mask=attention_mask, subset_mask=subset_mask
+            hidden_states,
+            key_padding_mask=attention_mask,
+            subset_mask=subset_mask,
+            unpad_plan=unpad_plan,
         )
 
         if masked_tokens_mask is None:
@@ -5,6 +5,7 @@ import math
 import re
 from collections import OrderedDict, namedtuple
 from collections.abc import Sequence
+from contextlib import nullcontext
 from functools import partial
 from typing import Dict, List
 
@@ -19,6 +20,7 @@ from flash_attn.models.falcon import remap_state_dict_hf_falcon
 from flash_attn.models.gpt_neox import remap_state_dict_hf_gpt_neox
 from flash_attn.models.gptj import remap_state_dict_hf_gptj
 from flash_attn.models.llama import remap_state_dict_hf_llama
+from flash_attn.models.mixtral import remap_state_dict_hf_mixtral
 from flash_attn.models.opt import remap_state_dict_hf_opt
 from flash_attn.modules.block import Block, ParallelBlock
 from flash_attn.modules.embedding import GPT2Embeddings, ParallelGPT2Embeddings
@@ -26,7 +28,9 @@ from flash_attn.modules.mha import MHA, ParallelMHA
 from flash_attn.modules.mlp import (
     FusedMLP,
     GatedMlp,
+    GroupedLinear,
     Mlp,
+    MoEMlp,
     ParallelFusedMLP,
     ParallelGatedMlp,
     ParallelMLP,
@@ -39,7 +43,13 @@ from flash_attn.utils.distributed import (
     sync_shared_params,
 )
 from flash_attn.utils.generation import GenerationMixin
-from flash_attn.utils.pretrained import state_dict_from_pretrained
+from flash_attn.utils.pretrained import (
+    init_empty_weights,
+    load_converted_checkpoint,
+    load_state_dict_streaming,
+    save_converted_checkpoint,
+    state_dict_from_pretrained,
+)
 
 try:
     from flash_attn.ops.fused_dense import ColumnParallelLinear
@@ -56,6 +66,16 @@ try:
 except ImportError:
     layer_norm_fn, RMSNorm = None, None
 
+try:
+    from flash_attn.losses.cross_entropy import FusedLinearCrossEntropyLoss
+except ImportError:
+    FusedLinearCrossEntropyLoss = None
+
+try:
+    from flash_attn.layers.rotary import share_rotary_embeddings
+except ImportError:
+    share_rotary_embeddings = None
+
 logger = logging.getLogger(__name__)
 
 
@@ -77,15 +97,28 @@ def create_mixer_cls(config, layer_idx=None, process_group=None, device=None, dt
     rotary_emb_base = getattr(config, "rotary_emb_base", 10000.0)
     rotary_emb_scale_base = getattr(config, "rotary_emb_scale_base", None)
     rotary_emb_interleaved = getattr(config, "rotary_emb_interleaved", False)
+    rotary_emb_scaling = getattr(config, "rotary_emb_scaling", None)
+    rotary_emb_max_seqlen = getattr(config, "rotary_emb_max_seqlen", 0)
     use_alibi = getattr(config, "use_alibi", False)
     window_size = getattr(config, "window_size", (-1, -1))
+    # e.g. to alternate between local and global layers
+    layer_window_sizes = getattr(config, "layer_window_sizes", None)
+    if layer_window_sizes is not None:
+        assert layer_idx is not None
+        window_size = tuple(layer_window_sizes[layer_idx])
+    # Ring buffer KV cache for the local layers during generation
+    rolling_kv_cache = getattr(config, "rolling_kv_cache", False) and window_size[0] >= 0
     use_flash_attn = getattr(config, "use_flash_attn", False)
     fused_bias_fc = getattr(config, "fused_bias_fc", False)
     if not fused_bias_fc:
         assert process_group is None, "TensorParallel MHA requires fused_bias_fc"
+    if rolling_kv_cache:
+        assert process_group is None, "TensorParallel MHA does not support rolling KV cache yet"
     mha_cls = MHA if process_group is None else ParallelMHA
     serial_kwargs = (
-        {"fused_bias_fc": fused_bias_fc, "dwconv": dwconv} if process_group is None else {}
+        {"fused_bias_fc": fused_bias_fc, "dwconv": dwconv, "rolling_kv_cache": rolling_kv_cache}
+        if process_group is None
+        else {}
     )
     parallel_kwargs = (
         {
@@ -110,6 +143,8 @@ def create_mixer_cls(config, layer_idx=None, process_group=None, device=None, dt
         rotary_emb_base=rotary_emb_base,
         rotary_emb_scale_base=rotary_emb_scale_base,
         rotary_emb_interleaved=rotary_emb_interleaved,
+        rotary_emb_scaling=rotary_emb_scaling,
+        rotary_emb_max_seqlen=rotary_emb_max_seqlen,
         use_alibi=use_alibi,
         window_size=window_size,
         use_flash_attn=use_flash_attn,
@@ -125,6 +160,39 @@ def create_mlp_cls(config, layer_idx=None, process_group=None, device=None, dtyp
     mlp_fc1_bias = getattr(config, "mlp_fc1_bias", True)
     mlp_fc2_bias = getattr(config, "mlp_fc2_bias", True)
     fused_mlp = getattr(config, "fused_mlp", False)
+    num_experts = getattr(config, "num_experts", 0)
+    if num_experts > 0:
+        assert not fused_mlp, "fused_mlp is not supported with MoE"
+        assert config.activation_function in ["gelu", "relu", "glu", "swiglu", "geglu"]
+        activation = {
+            "gelu": F.gelu,
+            "relu": F.relu,
+            "glu": F.sigmoid,
+            "swiglu": F.silu,
+            "geglu": F.gelu,
+        }[config.activation_function]
+        parallel_kwargs = (
+            {
+                "process_group": process_group,
+                "sequence_parallel": getattr(config, "sequence_parallel", True),
+            }
+            if process_group is not None
+            else {}
+        )
+        return partial(
+            MoEMlp,
+            hidden_features=config.n_inner,
+            num_experts=num_experts,
+            top_k=getattr(config, "num_experts_per_tok", 2),
+            activation=activation,
+            gated=config.activation_function in ["glu", "swiglu", "geglu"],
+            multiple_of=getattr(config, "mlp_multiple_of", 128),
+            capacity_factor=getattr(config, "moe_capacity_factor", None),
+            aux_loss_coef=getattr(config, "moe_aux_loss_coef", 0.01),
+            router_z_loss_coef=getattr(config, "moe_router_z_loss_coef", 0.0),
+            **parallel_kwargs,
+            **factory_kwargs,
+        )
     if fused_mlp:
         assert config.activation_function in [
             "gelu_new",
@@ -275,6 +343,11 @@ def create_block(config, layer_idx=None, process_group=None, device=None, dtype=
     resid_dropout1 = config.resid_pdrop if layer_idx is None or layer_idx > 0 else config.embd_pdrop
     prenorm = getattr(config, "prenorm", True)
     parallel_block = getattr(config, "parallel_block", False)
+    checkpoint_policy = getattr(config, "checkpoint_policy", "none")
+    # checkpoint_policy could be a list, which contains the checkpoint_policy for each layer
+    if not isinstance(checkpoint_policy, str):
+        assert layer_idx is not None
+        checkpoint_policy = checkpoint_policy[layer_idx]
     if not parallel_block:
         block = Block(
             config.hidden_size,
@@ -288,9 +361,11 @@ def create_block(config, layer_idx=None, process_group=None, device=None, dtype=
             residual_in_fp32=residual_in_fp32,
             sequence_parallel=sequence_parallel and process_group is not None,
             mark_shared_params=process_group is not None,
+            checkpoint_policy=checkpoint_policy,
         )
     else:
         assert prenorm
+        assert checkpoint_policy == "none", "ParallelBlock does not support checkpoint_policy"
         block = ParallelBlock(
             config.hidden_size,
             mixer_cls,
@@ -336,46 +411,73 @@ class GPTPreTrainedModel(nn.Module):
         dtype=None,
         world_size=1,
         rank=0,
+        converted_cache_dir=None,
         **kwargs,
     ):
         """
         Instantiate a GPTPreTrainedModel from a pre-trained model file or a pytorch state dict.
         Download and cache the pre-trained model file if needed.
+        If converted_cache_dir is not None, the remapped (and sharded) state dict of each rank is
+        cached there, keyed by the checkpoint files, config, dtype and world_size, so the next
+        calls load it directly with mmap instead of converting the checkpoint again.
         """
-        # Instantiate model.
-        model = cls(config, *args, device=device, dtype=dtype, **kwargs)
-        # Load state_dict in cpu because we already initialized the model in GPU, and we don't
-        # want extra stuff taking up more GPU memory
-        state_dict = state_dict_from_pretrained(model_name, device="cpu", dtype=dtype)
-        if model_name.startswith("gpt2"):
-            state_dict = remap_state_dict_hf_gpt2(state_dict, config)
-        elif model_name.startswith("facebook/opt"):
-            state_dict = remap_state_dict_hf_opt(state_dict, config)
-        elif model_name.startswith("EleutherAI/gpt-j-") or model_name.startswith(
-            "togethercomputer/GPT-JT-"
-        ):
-            state_dict = remap_state_dict_hf_gptj(state_dict, config)
-        elif (
-            model_name.startswith("EleutherAI/gpt-neox-")
-            or model_name.startswith("EleutherAI/pythia-")
-            or model_name.startswith("togethercomputer/RedPajama-INCITE-")
-        ):
-            state_dict = remap_state_dict_hf_gpt_neox(state_dict, config)
-        elif model_name.startswith("tiiuae/falcon-"):
-            state_dict = remap_state_dict_hf_falcon(state_dict, config)
-        elif model_name.startswith("meta-llama/Llama-"):
-            state_dict = remap_state_dict_hf_llama(state_dict, config)
-        elif model_name.startswith("bigcode/") or model_name.startswith("WizardLM/"):
-            state_dict = remap_state_dict_hf_bigcode(state_dict, config)
-        else:
-            raise NotImplementedError(f"Model {model_name} not supported")
-        if world_size > 1:
-            state_dict = shard_state_dict_tp(state_dict, config, world_size, rank)
-        load_return = model.load_state_dict(state_dict, strict=strict)
+        # Instantiate model. Unless some weights might be missing from the checkpoint, parameters
+        # are created on the meta device and allocated when their weights are loaded, so they're
+        # never randomly initialized.
+        with init_empty_weights() if strict else nullcontext():
+            model = cls(config, *args, device=device, dtype=dtype, **kwargs)
+        state_dict = None
+        if converted_cache_dir is not None:
+            cache_args = (converted_cache_dir, model_name, config, dtype, world_size, rank)
+            state_dict = load_converted_checkpoint(*cache_args)
+        if state_dict is None:
+            # Memory-map the checkpoint: the remapping and the tensor parallel sharding only create
+            # views where possible, and each tensor is only read when it's copied to its parameter.
+            # The weights that the remapping concatenates or permutes are copied into host memory.
+            state_dict = state_dict_from_pretrained(model_name, mmap=True)
+            state_dict = remap_state_dict_hf(model_name, state_dict, config)
+            if world_size > 1:
+                state_dict = shard_state_dict_tp(state_dict, config, world_size, rank)
+            if converted_cache_dir is not None:
+                state_dict = save_converted_checkpoint(state_dict, *cache_args)
+        load_return = load_state_dict_streaming(
+            model, state_dict, strict=strict, device=device if device is not None else "cpu"
+        )
         logger.info(load_return)
+        # Sync the shared parameters between tensor parallel ranks, skipped on the meta device
+        model.tie_weights()
         return model
 
 
+def remap_state_dict_hf(model_name, state_dict, config):
+    """Convert the state_dict of a HF checkpoint to the state_dict of GPTLMHeadModel, according to
+    the model name."""
+    if model_name.startswith("gpt2"):
+        return remap_state_dict_hf_gpt2(state_dict, config)
+    elif model_name.startswith("facebook/opt"):
+        return remap_state_dict_hf_opt(state_dict, config)
+    elif model_name.startswith("EleutherAI/gpt-j-") or model_name.startswith(
+        "togethercomputer/GPT-JT-"
+    ):
+        return remap_state_dict_hf_gptj(state_dict, config)
+    elif (
+        model_name.startswith("EleutherAI/gpt-neox-")
+        or model_name.startswith("EleutherAI/pythia-")
+        or model_name.startswith("togethercomputer/RedPajama-INCITE-")
+    ):
+        return remap_state_dict_hf_gpt_neox(state_dict, config)
+    elif model_name.startswith("tiiuae/falcon-"):
+        return remap_state_dict_hf_falcon(state_dict, config)
+    elif model_name.startswith("meta-llama/Llama-"):
+        return remap_state_dict_hf_llama(state_dict, config)
+    elif model_name.startswith("mistralai/Mixtral-"):
+        return remap_state_dict_hf_mixtral(state_dict, config)
+    elif model_name.startswith("bigcode/") or model_name.startswith("WizardLM/"):
+        return remap_state_dict_hf_bigcode(state_dict, config)
+    else:
+        raise NotImplementedError(f"Model {model_name} not supported")
+
+
 # https://github.com/huggingface/transformers/blob/c28d04e9e252a1a099944e325685f14d242ecdcd/src/transformers/models/gpt2/modeling_gpt2.py#L454
 def _init_weights(
     module, n_layer, initializer_range=0.02, mup_width_scale=1.0, rescale_prenorm_residual=True
@@ -388,6 +490,8 @@ def _init_weights(
         setattr(module.weight, "_optim", optim_cfg)
         if module.bias is not None:
             nn.init.zeros_(module.bias)
+    elif isinstance(module, GroupedLinear):
+        nn.init.normal_(module.weight, std=initializer_range * mup_init_scale)
     elif isinstance(module, nn.Embedding):
         nn.init.normal_(module.weight, std=initializer_range)
 
@@ -468,10 +572,9 @@ class GPTModel(GPTPreTrainedModel):
                 for i in range(config.num_hidden_layers)
             ]
         )
-        rotary_emb_fraction = getattr(config, "rotary_emb_fraction", 0.0)
-        if rotary_emb_fraction > 0.0:  # Tie all the RotaryEmbedding modules to share the same cos/sin cache
-            for layer in self.layers[1:]:
-                layer.mixer.rotary_emb = self.layers[0].mixer.rotary_emb
+        # Tie the RotaryEmbedding modules with the same config to share the same cos/sin cache
+        if share_rotary_embeddings is not None:
+            share_rotary_embeddings(self.layers)
 
         self.fused_dropout_add_ln = getattr(config, "fused_dropout_add_ln", False)
         if self.fused_dropout_add_ln:
@@ -502,7 +605,7 @@ class GPTModel(GPTPreTrainedModel):
         self.tie_weights()
 
     def tie_weights(self):
-        if self.process_group is not None:
+        if self.process_group is not None and not next(self.parameters()).is_meta:
             sync_shared_params(self, self.process_group)
 
     def allocate_inference_cache(self, batch_size, max_seqlen, dtype=None, **kwargs):
@@ -511,7 +614,18 @@ class GPTModel(GPTPreTrainedModel):
             for i, layer in enumerate(self.layers)
         }
 
-    def forward(self, input_ids, position_ids=None, inference_params=None):
+    def forward(
+        self, input_ids, position_ids=None, inference_params=None, cu_seqlens=None, max_seqlen=None
+    ):
+        """
+        input_ids: (batch, seqlen) int tensor
+        cu_seqlens: (num_sequences + 1,), dtype torch.int32. If not None, the (batch * seqlen)
+            tokens of input_ids are treated as num_sequences packed sequences, e.g. prompts of
+            different lengths concatenated into input_ids of shape (1, total_seqlen).
+            position_ids should then restart at the start of each sequence, from 0 or, during
+            generation, from the number of tokens of the sequence already in the KV cache.
+        max_seqlen: int. Maximum sequence length in the batch, must be passed with cu_seqlens.
+        """
         # If using Tensor Parallel with sequence parallel, we combine the batch and the seqlen
         # dimensions so that we can split on it easily, in case of small batch size.
         # Only the attention layers need to know the seqlen.
@@ -533,6 +647,13 @@ class GPTModel(GPTPreTrainedModel):
         )
         if inference_params is not None:
             mixer_kwargs["inference_params"] = inference_params
+        if cu_seqlens is not None:
+            assert self.process_group is None, "cu_seqlens is not supported with Tensor Parallel"
+            assert max_seqlen is not None
+            batch = hidden_states.shape[0]
+            hidden_states = rearrange(hidden_states, "b s d -> (b s) d")
+            mixer_kwargs["cu_seqlens"] = cu_seqlens
+            mixer_kwargs["max_seqlen"] = max_seqlen
         for layer in self.layers:
             if self.prenorm:
                 if not self.parallel_block:
@@ -571,6 +692,8 @@ class GPTModel(GPTPreTrainedModel):
                     prenorm=False,
                     is_rms_norm=isinstance(self.ln_f, RMSNorm)
                 )
+        if cu_seqlens is not None:
+            hidden_states = rearrange(hidden_states, "(b s) d -> b s d", b=batch)
         return hidden_states
 
 
@@ -624,7 +747,7 @@ class GPTLMHeadModel(GPTPreTrainedModel, GenerationMixin):
     def tie_weights(self):
         if self.tie_word_embeddings:
             self.lm_head.weight = self.transformer.embeddings.word_embeddings.weight
-        if self.process_group is not None:
+        if self.process_group is not None and not next(self.parameters()).is_meta:
             sync_shared_params(self, self.process_group)
 
     def allocate_inference_cache(self, batch_size, max_seqlen, dtype=None, **kwargs):
@@ -632,37 +755,91 @@ class GPTLMHeadModel(GPTPreTrainedModel, GenerationMixin):
             batch_size, max_seqlen, dtype=dtype, **kwargs
         )
 
-    def forward(self, input_ids, position_ids=None, inference_params=None, num_last_tokens=0):
+    def aux_loss(self):
+        """Sum of the auxiliary losses of the MoE layers in the last forward pass (see MoEMlp), to
+        be added to the loss of the model. None if there are none, e.g. in eval mode."""
+        aux_losses = [
+            m.aux_loss for m in self.modules() if isinstance(m, MoEMlp) and m.aux_loss is not None
+        ]
+        return sum(aux_losses) if aux_losses else None
+
+    def forward(
+        self,
+        input_ids,
+        position_ids=None,
+        inference_params=None,
+        num_last_tokens=0,
+        cu_seqlens=None,
+        max_seqlen=None,
+        labels=None,
+        loss_fn=None,
+    ):
         """
         input_ids: (batch, seqlen) int tensor
         inference_params: for generation. Adapted from Megatron-LM (and Apex)
         https://github.com/NVIDIA/apex/blob/3ff1a10f72ec07067c4e44759442329804ac5162/apex/transformer/testing/standalone_transformer_lm.py#L470
         num_last_tokens: if > 0, only return the logits for the last n tokens
+        cu_seqlens, max_seqlen: for packed sequences, see GPTModel.forward. If num_last_tokens > 0,
+            the logits of the last n tokens of each sequence are returned, with shape
+            (num_sequences, num_last_tokens, vocab_size).
+        labels: (batch, seqlen) int tensor, the targets of each position (already shifted). If not
+            None, return the loss instead of the logits, computed by loss_fn (default:
+            FusedLinearCrossEntropyLoss) from the hidden states and the lm_head weight, so that the
+            logits are never materialized. The auxiliary losses of the MoE layers are added to it.
         """
         assert (
             input_ids.ndim == 2
         ), f"Expected `input_ids` to have shape [b, slen], but got shape {input_ids.shape}"
         b, slen = input_ids.shape
         hidden_states = self.transformer(
-            input_ids, position_ids=position_ids, inference_params=inference_params
+            input_ids,
+            position_ids=position_ids,
+            inference_params=inference_params,
+            cu_seqlens=cu_seqlens,
+            max_seqlen=max_seqlen,
         )
         if inference_params is not None:
             assert hidden_states.ndim == 3, "sequence_parallel is not supported in generation mode"
         if num_last_tokens > 0:
-            hidden_states = hidden_states[:, -num_last_tokens:]
+            if cu_seqlens is None:
+                hidden_states = hidden_states[:, -num_last_tokens:]
+            else:
+                last_idx = cu_seqlens[1:, None].long() - num_last_tokens + torch.arange(
+                    num_last_tokens, device=hidden_states.device
+                )
+                hidden_states = rearrange(hidden_states, "b s d -> (b s) d")[last_idx]
         if self.project_out is not None:
             hidden_states = self.project_out(hidden_states)
         if self.output_scale != 1.0:
             hidden_states = hidden_states * self.output_scale
+        # ColumnParallelLinear, or its quantized version (see quantize_model)
+        lm_head_parallel = getattr(self.lm_head, "process_group", None) is not None
+        if labels is not None:
+            assert inference_params is None and num_last_tokens == 0
+            if loss_fn is None:
+                assert FusedLinearCrossEntropyLoss is not None, "Triton is not installed"
+                loss_fn = FusedLinearCrossEntropyLoss(
+                    process_group=self.lm_head.process_group if lm_head_parallel else None,
+                    sequence_parallel=getattr(self.lm_head, "sequence_parallel", True),
+                )
+            lm_head_weight = (
+                self.lm_head.weight if not self.norm_head else F.normalize(self.lm_head.weight)
+            )
+            loss = loss_fn(hidden_states, lm_head_weight, labels, bias=self.lm_head.bias)
+            aux_loss = self.aux_loss()
+            if aux_loss is not None:
+                loss = loss + aux_loss
+            CausalLMLoss = namedtuple("CausalLMLoss", ["loss"])
+            return CausalLMLoss(loss=loss)
         if not self.norm_head:
             lm_logits = self.lm_head(hidden_states)
         else:
             lm_head_weight = F.normalize(self.lm_head.weight)
-            if isinstance(self.lm_head, ColumnParallelLinear) and self.lm_head.sequence_parallel:
+            if lm_head_parallel and self.lm_head.sequence_parallel:
                 hidden_states = all_gather(hidden_states, self.lm_head.process_group)
             lm_logits = F.linear(hidden_states, lm_head_weight, bias=self.lm_head.bias)
         # During inference, we want the full logit for sampling
-        if isinstance(self.lm_head, ColumnParallelLinear) and inference_params is not None:
+        if lm_head_parallel and inference_params is not None:
             lm_logits, _ = all_gather_raw(lm_logits, self.lm_head.process_group)
             lm_logits = rearrange(lm_logits, "(n b) ... d -> b ... (n d)", b=b)
         CausalLMOutput = namedtuple("CausalLMOutput", ["logits"])
@@ -799,6 +976,10 @@ def shard_state_dict_tp(state_dict, config, world_size, rank):
         )
         if rank != 0:
             state_dict.pop(f"transformer.layers.{i}.mixer.out_proj.bias", None)
+        if getattr(config, "num_experts", 0) > 0:  # Expert parallel
+            shard_first_dim(state_dict, f"transformer.layers.{i}.mlp.fc1.weight")
+            shard_first_dim(state_dict, f"transformer.layers.{i}.mlp.fc2.weight")
+            continue
         if config.activation_function in ["glu", "swiglu", "geglu"]:
             shard_gatedmlp_fc1_dim(state_dict, f"transformer.layers.{i}.mlp.fc1.weight")
             shard_gatedmlp_fc1_dim(state_dict, f"transformer.layers.{i}.mlp.fc1.bias")
@@ -921,6 +1102,10 @@ def combine_state_dicts_tp(state_dicts: List[Dict[str, torch.Tensor]], config: G
         combine_qkv_headdim(state_dicts, state_dict, f"transformer.layers.{i}.mixer.Wqkv.weight")
         combine_qkv_headdim(state_dicts, state_dict, f"transformer.layers.{i}.mixer.Wqkv.bias")
         combine_dim(state_dicts, state_dict, f"transformer.layers.{i}.mixer.out_proj.weight", -1)
+        if getattr(config, "num_experts", 0) > 0:  # Expert parallel
+            combine_dim(state_dicts, state_dict, f"transformer.layers.{i}.mlp.fc1.weight", 0)
+            combine_dim(state_dicts, state_dict, f"transformer.layers.{i}.mlp.fc2.weight", 0)
+            continue
         mlp_combine_fn(state_dicts, state_dict, f"transformer.layers.{i}.mlp.fc1.weight")
         combine_dim(state_dicts, state_dict, f"transformer.layers.{i}.mlp.fc1.bias", 0)
         combine_dim(state_dicts, state_dict, f"transformer.layers.{i}.mlp.fc2.weight", -1)
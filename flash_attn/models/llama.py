@@ -6,7 +6,7 @@ import os
 import re
 from collections import OrderedDict
 from pathlib import Path
-from typing import Dict, List, Union
+from typing import Dict, List, Optional, Union
 
 import torch
 import torch.nn.functional as F
@@ -153,6 +153,8 @@ def remap_state_dict_hf_llama(
 
     # MLP
     for l in range(config.n_layer):
+        if f"model.layers.{l}.mlp.gate_proj.weight" not in state_dict:
+            continue  # Already converted, e.g. MoE layers (see remap_state_dict_hf_mixtral)
         # Fusing weights this way based on difference in the following:
         # https://github.com/huggingface/transformers/blob/b42010bb1d3cbf262d27e0a328661885be46dfdb/src/transformers/models/llama/modeling_llama.py#L220
         # https://github.com/Dao-AILab/flash-attention/blob/c60851a8253257eb970e06a022c82517a8033e8c/flash_attn/modules/mlp.py#L115
@@ -390,6 +392,27 @@ def state_dicts_from_checkpoint(
     ]
 
 
+def _rope_scaling_from_llama_config(llama_config: LlamaConfig) -> Optional[dict]:
+    """Convert rope_scaling to the scaling argument of RotaryEmbedding."""
+    rope_scaling = getattr(llama_config, "rope_scaling", None)
+    if rope_scaling is None:
+        return None
+    rope_scaling = dict(rope_scaling)
+    rope_type = rope_scaling.get("rope_type", rope_scaling.get("type"))
+    if rope_type in [None, "default"]:
+        return None
+    if rope_type not in ["linear", "dynamic", "yarn", "llama3"]:
+        raise NotImplementedError(
+            f"rope_scaling of type {rope_type} is not supported, only linear, dynamic, yarn and "
+            "llama3 are"
+        )
+    # Same default as Hugging Face
+    rope_scaling.setdefault(
+        "original_max_position_embeddings", llama_config.max_position_embeddings
+    )
+    return rope_scaling
+
+
 def llama_config_to_gpt2_config(llama_config: LlamaConfig) -> GPT2Config:
     return GPT2Config(
         vocab_size=llama_config.vocab_size,
@@ -419,4 +442,5 @@ def llama_config_to_gpt2_config(llama_config: LlamaConfig) -> GPT2Config:
         mlp_fc2_bias=False,
         rotary_emb_base=getattr(llama_config, "rotary_emb_base", 10000.0),
         n_head_kv=llama_config.num_key_value_heads,
+        rotary_emb_scaling=_rope_scaling_from_llama_config(llama_config),
     )
@@ -0,0 +1,67 @@
+# Copyright (c) 2024, Tri Dao.
+
+from typing import Dict
+
+import torch
+from transformers import GPT2Config, PretrainedConfig
+
+from flash_attn.models.llama import remap_state_dict_hf_llama
+
+
+def remap_state_dict_hf_mixtral(
+    state_dict: Dict[str, torch.Tensor], config: GPT2Config
+) -> Dict[str, torch.Tensor]:
+    """Convert the state_dict of a Mixtral model in Hugging Face format to standard GPT format,
+    with MoEMlp layers. Besides the MoE layers, Mixtral is the same as Llama.
+
+    This function modifies state_dict in place.
+    """
+    for l in range(config.n_layer):
+        prefix = f"model.layers.{l}.block_sparse_moe"
+        state_dict[f"transformer.layers.{l}.mlp.router.weight"] = state_dict.pop(
+            f"{prefix}.gate.weight"
+        )
+        fc1, fc2 = [], []
+        for e in range(config.num_experts):
+            w1 = state_dict.pop(f"{prefix}.experts.{e}.w1.weight")
+            w2 = state_dict.pop(f"{prefix}.experts.{e}.w2.weight")
+            w3 = state_dict.pop(f"{prefix}.experts.{e}.w3.weight")
+            # Same ordering as GatedMlp, see remap_state_dict_hf_llama
+            fc1.append(torch.cat([w3, w1], dim=0))
+            fc2.append(w2)
+        state_dict[f"transformer.layers.{l}.mlp.fc1.weight"] = torch.stack(fc1)
+        state_dict[f"transformer.layers.{l}.mlp.fc2.weight"] = torch.stack(fc2)
+    return remap_state_dict_hf_llama(state_dict, config)
+
+
+def mixtral_config_to_gpt2_config(mixtral_config: PretrainedConfig) -> GPT2Config:
+    return GPT2Config(
+        vocab_size=mixtral_config.vocab_size,
+        n_positions=0,  # No absolute position embedding
+        n_embd=mixtral_config.hidden_size,
+        n_layer=mixtral_config.num_hidden_layers,
+        n_head=mixtral_config.num_attention_heads,
+        n_inner=mixtral_config.intermediate_size,
+        activation_function="swiglu",  # Hardcode since HF calls it 'silu'
+        resid_pdrop=0.0,
+        embd_pdrop=0.0,
+        attn_pdrop=0.0,
+        layer_norm_epsilon=mixtral_config.rms_norm_eps,
+        initializer_range=mixtral_config.initializer_range,
+        bos_token_id=mixtral_config.bos_token_id,
+        eos_token_id=mixtral_config.eos_token_id,
+        # These are new arguments not in the original GPT2Config
+        rms_norm=True,
+        rotary_emb_fraction=1.0,
+        rotary_emb_interleaved=True,
+        tie_word_embeddings=mixtral_config.tie_word_embeddings,
+        qkv_proj_bias=False,
+        out_proj_bias=False,
+        mlp_fc1_bias=False,
+        mlp_fc2_bias=False,
+        rotary_emb_base=mixtral_config.rope_theta,
+        n_head_kv=mixtral_config.num_key_value_heads,
+        num_experts=mixtral_config.num_local_experts,
+        num_experts_per_tok=mixtral_config.num_experts_per_tok,
+        moe_aux_loss_coef=mixtral_config.router_aux_loss_coef,
+    )
@@ -1,7 +1,8 @@
 # Copyright (c) 2024, Tri Dao.
 
+import logging
 from functools import partial
-from typing import Optional
+from typing import List, Optional, Sequence
 
 import torch
 import torch.nn as nn
@@ -17,6 +18,11 @@ try:
 except ImportError:
     layer_norm_fn, RMSNorm = None, None
 
+logger = logging.getLogger(__name__)
+
+# From the least to the most recomputation
+CHECKPOINT_POLICIES = ["none", "norm_act", "attn", "mlp", "full"]
+
 
 class Block(nn.Module):
     def __init__(
@@ -36,6 +42,7 @@ class Block(nn.Module):
         residual_in_fp32=False,
         sequence_parallel=False,
         mark_shared_params=False,
+        checkpoint_policy="none",
     ):
         """
         For prenorm=True, this Block has a slightly different structure compared to a regular
@@ -53,6 +60,16 @@ class Block(nn.Module):
         return_residual: whether each of the sub-layers (mixer and mlp) will return the residual.
         This is for performance reason: for post-norm architecture, returning the input allows us
         to fuse the backward of nn.Linear with the residual connection.
+
+        checkpoint_policy: which activations are recomputed in the backward instead of being
+        saved during the forward:
+            "none": no recomputation.
+            "norm_act": the dropout / add / norms, and the MLP activation if the MLP can
+                recompute it (FusedMLP, see checkpoint_lvl). Cheap to recompute.
+            "attn": the mixer.
+            "mlp": the MLP.
+            "full": the whole block, only its inputs are saved.
+        See plan_checkpoint_policies to pick the policies of each layer for a memory budget.
         """
         super().__init__()
         self.prenorm = prenorm
@@ -74,6 +91,8 @@ class Block(nn.Module):
             self.dropout2 = dropout_cls(resid_dropout2)
             self.drop_path2 = StochasticDepth(drop_path2, mode="row")
             self.norm2 = norm_cls(dim)
+        self._mlp_checkpoint_lvl = getattr(self.mlp, "checkpoint_lvl", None)
+        self.checkpoint_policy = checkpoint_policy
 
         if self.fused_dropout_add_ln:
             assert layer_norm_fn is not None, "Triton is not installed"
@@ -102,9 +121,29 @@ class Block(nn.Module):
                 for p in self.norm2.parameters():
                     p._shared_params = True
 
+    @property
+    def checkpoint_policy(self):
+        return self._checkpoint_policy
+
+    @checkpoint_policy.setter
+    def checkpoint_policy(self, policy):
+        assert policy in CHECKPOINT_POLICIES, f"checkpoint_policy must be in {CHECKPOINT_POLICIES}"
+        self._checkpoint_policy = policy
+        # The fused MLP can recompute its activation in the backward by itself
+        if self._mlp_checkpoint_lvl is not None:
+            lvl = self._mlp_checkpoint_lvl
+            self.mlp.checkpoint_lvl = max(lvl, 1) if policy == "norm_act" else lvl
+
     def allocate_inference_cache(self, batch_size, max_seqlen, dtype=None, **kwargs):
         return self.mixer.allocate_inference_cache(batch_size, max_seqlen, dtype=dtype, **kwargs)
 
+    def _maybe_checkpoint(self, policies, fn, *args, **kwargs):
+        """Run fn(*args, **kwargs), without saving its activations if the checkpoint policy is
+        in policies (they're recomputed in the backward)."""
+        if self._checkpoint_policy in policies and self.training and torch.is_grad_enabled():
+            return torch.utils.checkpoint.checkpoint(fn, *args, use_reentrant=False, **kwargs)
+        return fn(*args, **kwargs)
+
     def forward(
         self,
         hidden_states: Tensor,
@@ -121,140 +160,187 @@ class Block(nn.Module):
                 before applying the query projection. Useful for e.g., ViT where we only care
                 about the CLS token in the last layer.
         """
-        if self.prenorm:
-            if not self.fused_dropout_add_ln:
-                dropped = self.drop_path1(self.dropout1(hidden_states))
-                residual = (dropped + residual) if residual is not None else dropped
-                hidden_states = self.norm1(residual.to(dtype=self.norm1.weight.dtype))
-                if self.residual_in_fp32:
-                    residual = residual.to(torch.float32)
+        return self._maybe_checkpoint(
+            ["full"], self._forward, hidden_states, residual, mixer_subset, mixer_kwargs
+        )
+
+    def _dropout_add_norm_prenorm(self, hidden_states, residual, dropout, drop_path, norm):
+        if not self.fused_dropout_add_ln:
+            dropped = drop_path(dropout(hidden_states))
+            residual = (dropped + residual) if residual is not None else dropped
+            hidden_states = norm(residual.to(dtype=norm.weight.dtype))
+            if self.residual_in_fp32:
+                residual = residual.to(torch.float32)
+        else:
+            if drop_path.p == 0 or not self.training:
+                rowscale = None
             else:
-                if self.drop_path1.p == 0 or not self.training:
-                    rowscale1 = None
-                else:
-                    rowscale1 = self.drop_path1(
-                        torch.ones(
-                            hidden_states.shape[:-1],
-                            device=hidden_states.device,
-                            dtype=hidden_states.dtype,
-                        )
+                rowscale = drop_path(
+                    torch.ones(
+                        hidden_states.shape[:-1],
+                        device=hidden_states.device,
+                        dtype=hidden_states.dtype,
                     )
-                hidden_states, residual = layer_norm_fn(
-                    hidden_states,
-                    self.norm1.weight,
-                    self.norm1.bias,
-                    residual=residual,
-                    eps=self.norm1.eps,
-                    dropout_p=self.dropout1.p if self.training else 0.0,
-                    rowscale=rowscale1,
-                    prenorm=True,
-                    residual_in_fp32=self.residual_in_fp32,
-                    is_rms_norm=isinstance(self.norm1, RMSNorm)
                 )
+            hidden_states, residual = layer_norm_fn(
+                hidden_states,
+                norm.weight,
+                norm.bias,
+                residual=residual,
+                eps=norm.eps,
+                dropout_p=dropout.p if self.training else 0.0,
+                rowscale=rowscale,
+                prenorm=True,
+                residual_in_fp32=self.residual_in_fp32,
+                is_rms_norm=isinstance(norm, RMSNorm)
+            )
+        return hidden_states, residual
+
+    def _dropout_add_norm_postnorm(self, out, hidden_states, dropout, drop_path, norm):
+        if not self.fused_dropout_add_ln:
+            return norm((drop_path(dropout(out)) + hidden_states).to(dtype=norm.weight.dtype))
+        if drop_path.p == 0 or not self.training:
+            rowscale = None
+        else:
+            rowscale = drop_path(torch.ones(out.shape[:-1], device=out.device, dtype=out.dtype))
+        return layer_norm_fn(
+            out,
+            norm.weight,
+            norm.bias,
+            residual=hidden_states,
+            eps=norm.eps,
+            dropout_p=dropout.p if self.training else 0.0,
+            rowscale=rowscale,
+            prenorm=False,
+            is_rms_norm=isinstance(norm, RMSNorm)
+        )
+
+    def _forward(self, hidden_states, residual=None, mixer_subset=None, mixer_kwargs=None):
+        if self.prenorm:
+            hidden_states, residual = self._maybe_checkpoint(
+                ["norm_act"],
+                self._dropout_add_norm_prenorm,
+                hidden_states,
+                residual,
+                self.dropout1,
+                self.drop_path1,
+                self.norm1,
+            )
             if mixer_kwargs is None:
                 mixer_kwargs = {}
             if mixer_subset is not None:
                 mixer_kwargs["mixer_subset"] = mixer_subset
-            hidden_states = self.mixer(hidden_states, **mixer_kwargs)
+            hidden_states = self._maybe_checkpoint(
+                ["attn"], self.mixer, hidden_states, **mixer_kwargs
+            )
             if mixer_subset is not None:
                 residual = residual[:, mixer_subset]
             if not isinstance(self.mlp, nn.Identity):
-                if not self.fused_dropout_add_ln:
-                    dropped = self.drop_path2(self.dropout2(hidden_states))
-                    residual = (dropped + residual) if residual is not None else dropped
-                    hidden_states = self.norm2(residual.to(dtype=self.norm2.weight.dtype))
-                    if self.residual_in_fp32:
-                        residual = residual.to(torch.float32)
-                else:
-                    if self.drop_path2.p == 0 or not self.training:
-                        rowscale2 = None
-                    else:
-                        rowscale2 = self.drop_path2(
-                            torch.ones(
-                                hidden_states.shape[:-1],
-                                device=hidden_states.device,
-                                dtype=hidden_states.dtype,
-                            )
-                        )
-                    hidden_states, residual = layer_norm_fn(
-                        hidden_states,
-                        self.norm2.weight,
-                        self.norm2.bias,
-                        residual=residual,
-                        eps=self.norm2.eps,
-                        dropout_p=self.dropout2.p if self.training else 0.0,
-                        rowscale=rowscale2,
-                        prenorm=True,
-                        residual_in_fp32=self.residual_in_fp32,
-                        is_rms_norm=isinstance(self.norm2, RMSNorm)
-                    )
-                hidden_states = self.mlp(hidden_states)
+                hidden_states, residual = self._maybe_checkpoint(
+                    ["norm_act"],
+                    self._dropout_add_norm_prenorm,
+                    hidden_states,
+                    residual,
+                    self.dropout2,
+                    self.drop_path2,
+                    self.norm2,
+                )
+                hidden_states = self._maybe_checkpoint(["mlp"], self.mlp, hidden_states)
             return hidden_states, residual
         else:
             assert residual is None
-            mixer_out = self.mixer(
-                hidden_states, **(mixer_kwargs if mixer_kwargs is not None else {})
-            )
+            if mixer_kwargs is None:
+                mixer_kwargs = {}
+            mixer_out = self._maybe_checkpoint(["attn"], self.mixer, hidden_states, **mixer_kwargs)
             if self.return_residual:  # mixer out is actually a pair here
                 mixer_out, hidden_states = mixer_out
-            if not self.fused_dropout_add_ln:
-                hidden_states = self.norm1(
-                    (self.drop_path1(self.dropout1(mixer_out)) + hidden_states).to(
-                        dtype=self.norm1.weight.dtype
-                    )
-                )
-            else:
-                if self.drop_path1.p == 0 or not self.training:
-                    rowscale1 = None
-                else:
-                    rowscale1 = self.drop_path1(
-                        torch.ones(
-                            mixer_out.shape[:-1], device=mixer_out.device, dtype=mixer_out.dtype
-                        )
-                    )
-                hidden_states = layer_norm_fn(
-                    mixer_out,
-                    self.norm1.weight,
-                    self.norm1.bias,
-                    residual=hidden_states,
-                    eps=self.norm1.eps,
-                    dropout_p=self.dropout1.p if self.training else 0.0,
-                    rowscale=rowscale1,
-                    prenorm=False,
-                    is_rms_norm=isinstance(self.norm1, RMSNorm)
-                )
+            hidden_states = self._maybe_checkpoint(
+                ["norm_act"],
+                self._dropout_add_norm_postnorm,
+                mixer_out,
+                hidden_states,
+                self.dropout1,
+                self.drop_path1,
+                self.norm1,
+            )
             if not isinstance(self.mlp, nn.Identity):
-                mlp_out = self.mlp(hidden_states)
+                mlp_out = self._maybe_checkpoint(["mlp"], self.mlp, hidden_states)
                 if self.return_residual:  # mlp out is actually a pair here
                     mlp_out, hidden_states = mlp_out
-                if not self.fused_dropout_add_ln:
-                    hidden_states = self.norm2(
-                        (self.drop_path2(self.dropout2(mlp_out)) + hidden_states).to(
-                            dtype=self.norm2.weight.dtype
-                        )
-                    )
-                else:
-                    if self.drop_path2.p == 0 or not self.training:
-                        rowscale2 = None
-                    else:
-                        rowscale2 = self.drop_path2(
-                            torch.ones(
-                                mlp_out.shape[:-1], device=mlp_out.device, dtype=mlp_out.dtype
-                            )
-                        )
-                    hidden_states = layer_norm_fn(
-                        mlp_out,
-                        self.norm2.weight,
-                        self.norm2.bias,
-                        residual=hidden_states,
-                        eps=self.norm2.eps,
-                        dropout_p=self.dropout2.p if self.training else 0.0,
-                        rowscale=rowscale2,
-                        prenorm=False,
-                        is_rms_norm=isinstance(self.norm2, RMSNorm)
-                    )
+                hidden_states = self._maybe_checkpoint(
+                    ["norm_act"],
+                    self._dropout_add_norm_postnorm,
+                    mlp_out,
+                    hidden_states,
+                    self.dropout2,
+                    self.drop_path2,
+                    self.norm2,
+                )
             return hidden_states
 
+    def checkpoint_costs(self, batch_size, seqlen, dtype=torch.bfloat16):
+        """Estimate the activation memory kept for the backward, and the FLOPs recomputed in the
+        backward, for each checkpoint policy. This is a rough model: it counts the inputs saved by
+        the linear layers, attention (FlashAttention keeps q, k, v, not the attention matrix),
+        activations and norms of one forward pass in training, per rank.
+        Return:
+            costs: dict from checkpoint policy to (memory in bytes, recomputed FLOPs).
+        """
+        tokens = batch_size * seqlen
+        elt = torch.finfo(dtype).bits // 8
+        dim = self.norm1.weight.shape[-1]
+        res_elt = 4 if self.residual_in_fp32 else elt
+        # Boundaries of the block, saved by every policy: the input hidden_states and residual
+        base = dim * (elt + res_elt)
+        # Norm: its input, and the dropout mask
+        has_dropout = self.dropout1.p > 0.0 or self.drop_path1.p > 0.0
+        norm_mem = dim * (elt + (1 if has_dropout else 0))
+        norm_flops = 8 * dim
+        mixer = self.mixer
+        if hasattr(mixer, "Wqkv"):
+            qkv_dim = mixer.Wqkv.weight.shape[0]
+        else:
+            qkv_dim = mixer.Wq.weight.shape[0] + mixer.Wkv.weight.shape[0]
+        attn_out_dim = mixer.out_proj.weight.shape[-1]
+        num_heads = getattr(mixer, "num_heads_per_rank", mixer.num_heads)
+        # Wqkv input, q / k / v, out_proj input
+        attn_mem = (dim + qkv_dim + attn_out_dim) * elt
+        if not getattr(mixer, "use_flash_attn", False):
+            # The attention matrix (scores and softmax output)
+            attn_mem += 2 * num_heads * seqlen * elt
+        attn_flops = 2 * dim * qkv_dim + 2 * attn_out_dim * dim
+        attn_flops += 4 * seqlen * attn_out_dim // (2 if getattr(mixer, "causal", False) else 1)
+        if isinstance(self.mlp, nn.Identity):
+            mlp_mem, mlp_flops, act_mem, act_flops = 0, 0, 0, 0
+        else:
+            fc1_out_dim = self.mlp.fc1.weight.shape[-2]
+            fc2_in_dim = self.mlp.fc2.weight.shape[-1]
+            top_k = getattr(self.mlp, "top_k", 1)
+            # fc1 input, activation input, fc2 input
+            act_mem = top_k * fc2_in_dim * elt
+            mlp_mem = dim * elt + top_k * fc1_out_dim * elt + act_mem
+            mlp_flops = top_k * 2 * dim * (fc1_out_dim + fc2_in_dim)
+            act_flops = top_k * 8 * fc1_out_dim
+            if self._mlp_checkpoint_lvl is None:
+                # The activation can only be recomputed by the fused MLP
+                act_mem, act_flops = 0, 0
+            elif self._mlp_checkpoint_lvl >= 1:
+                mlp_mem -= act_mem
+                act_mem, act_flops = 0, 0
+        num_norms = 1 if isinstance(self.mlp, nn.Identity) else 2
+        costs = {
+            "none": (base + num_norms * norm_mem + attn_mem + mlp_mem, 0),
+            # The checkpointed norm of the 2nd half keeps its inputs (attention output, residual)
+            "norm_act": (
+                base + dim * (elt + res_elt) + attn_mem + mlp_mem - act_mem,
+                num_norms * norm_flops + act_flops,
+            ),
+            "attn": (base + num_norms * norm_mem + dim * elt + mlp_mem, attn_flops),
+            "mlp": (base + num_norms * norm_mem + attn_mem + dim * elt, mlp_flops),
+            "full": (base, num_norms * norm_flops + attn_flops + mlp_flops),
+        }
+        return {k: (mem * tokens, flops * tokens) for k, (mem, flops) in costs.items()}
+
 
 class ParallelBlock(nn.Module):
     """The attention (mixer) and MLP blocks are done in parallel, similar to GPT-J, GPT-NeoX,
@@ -395,3 +481,69 @@ class ParallelBlock(nn.Module):
         hidden_states1 = self.mixer(hidden_states1, **mixer_kwargs)
         hidden_states2 = self.mlp(hidden_states2)
         return hidden_states1, hidden_states2, residual
+
+
+def plan_checkpoint_policies(
+    blocks: Sequence[Block],
+    batch_size: int,
+    seqlen: int,
+    memory_budget: int,
+    dtype=torch.bfloat16,
+    apply: bool = True,
+) -> List[str]:
+    """Pick the checkpoint policy of each block so that the activation memory of the blocks
+    (estimated by Block.checkpoint_costs) fits in memory_budget bytes, with as little recomputation
+    as possible.
+    Starting from no recomputation, we repeatedly move one block to its next cheaper policy,
+    choosing the move that saves the most memory per recomputed FLOP, until the budget is met.
+    Arguments:
+        blocks: e.g. model.transformer.layers.
+        memory_budget: in bytes, for the activations of all the blocks of one micro-batch.
+        apply: whether to set the checkpoint_policy of the blocks.
+    Return:
+        policies: the checkpoint policy of each block.
+    """
+    frontiers = []
+    for block in blocks:
+        costs = block.checkpoint_costs(batch_size, seqlen, dtype=dtype)
+        # Only keep the policies that save memory compared to all the ones with less recompute
+        frontier = []
+        for policy in sorted(costs, key=lambda p: (costs[p][1], costs[p][0])):
+            if not frontier or costs[policy][0] < costs[frontier[-1]][0]:
+                frontier.append(policy)
+        frontiers.append((frontier, costs))
+    choice = [0] * len(frontiers)
+
+    def total(i):
+        return sum(costs[frontier[c]][i] for (frontier, costs), c in zip(frontiers, choice))
+
+    while total(0) > memory_budget:
+        best, best_ratio = None, -1.0
+        for layer, ((frontier, costs), c) in enumerate(zip(frontiers, choice)):
+            if c + 1 < len(frontier):
+                mem_saved = costs[frontier[c]][0] - costs[frontier[c + 1]][0]
+                extra_flops = costs[frontier[c + 1]][1] - costs[frontier[c]][1]
+                ratio = mem_saved / max(extra_flops, 1)
+                if ratio > best_ratio:
+                    best, best_ratio = layer, ratio
+        if best is None:
+            logger.warning(
+                f"Activation memory budget of {memory_budget / 2**30:.2f}GB can't be met, "
+                f"checkpointing all the blocks needs {total(0) / 2**30:.2f}GB"
+            )
+            break
+        choice[best] += 1
+    policies = [frontier[c] for (frontier, _), c in zip(frontiers, choice)]
+    no_recompute = sum(costs[frontier[0]][0] for frontier, costs in frontiers)
+    # Forward FLOPs of the blocks, approximated by the recomputed FLOPs of "full"
+    fwd_flops = sum(costs["full"][1] for _, costs in frontiers)
+    logger.info(
+        f"Checkpoint policies: {dict((p, policies.count(p)) for p in CHECKPOINT_POLICIES)}. "
+        f"Activation memory: {total(0) / 2**30:.2f}GB (vs {no_recompute / 2**30:.2f}GB without "
+        f"recomputation), recomputed FLOPs: {total(1) / max(3 * fwd_flops, 1) * 100:.1f}% of the "
+        f"training step"
+    )
+    if apply:
+        for block, policy in zip(blocks, policies):
+            block.checkpoint_policy = policy
+    return policies
@@ -5,6 +5,7 @@ from functools import partial
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from einops import rearrange, repeat
 
 from flash_attn.utils.distributed import get_dim_for_local_rank
@@ -13,6 +14,7 @@ try:
     from flash_attn import (
         flash_attn_kvpacked_func,
         flash_attn_qkvpacked_func,
+        flash_attn_varlen_func,
         flash_attn_varlen_kvpacked_func,
         flash_attn_varlen_qkvpacked_func,
         flash_attn_with_kvcache,
@@ -20,7 +22,7 @@ try:
 except ImportError:
     flash_attn_varlen_qkvpacked_func, flash_attn_varlen_kvpacked_func = None, None
     flash_attn_qkvpacked_func, flash_attn_kvpacked_func = None, None
-    flash_attn_with_kvcache = None
+    flash_attn_varlen_func, flash_attn_with_kvcache = None, None
 
 try:
     from flash_attn.ops.fused_dense import ColumnParallelLinear, RowParallelLinear
@@ -341,8 +343,13 @@ class CrossAttention(nn.Module):
         return output
 
 
-def _update_kv_cache(kv, inference_params, layer_idx):
-    """kv: (batch_size, seqlen, 2, nheads, head_dim) or (batch_size, 1, 2, nheads, head_dim)"""
+def _update_kv_cache(kv, inference_params, layer_idx, cu_seqlens=None):
+    """kv: (batch_size, seqlen, 2, nheads, head_dim) or (batch_size, 1, 2, nheads, head_dim),
+    or (total_seqlen, 2, nheads, head_dim) if cu_seqlens is not None.
+    In the cu_seqlens case (packed sequences of different lengths), the i-th token of the b-th
+    sequence is written to position lengths_per_sample[b] + i (or i, if lengths_per_sample is
+    None) of cache row cache_batch_idx[b] (or batch_size_offset + b), and kv is returned unchanged.
+    """
     # Pre-allocate memory for key-values for inference.
     num_heads, head_dim = kv.shape[-2:]
     if layer_idx not in inference_params.key_value_memory_dict:
@@ -358,8 +365,21 @@ def _update_kv_cache(kv, inference_params, layer_idx):
         inference_params.key_value_memory_dict[layer_idx] = kv_cache
     else:
         kv_cache = inference_params.key_value_memory_dict[layer_idx]
-    # Adjust key and value for inference
     batch_start = inference_params.batch_size_offset
+    if cu_seqlens is not None:
+        token_idx = torch.arange(kv.shape[0], dtype=cu_seqlens.dtype, device=kv.device)
+        seq_idx = torch.searchsorted(cu_seqlens[1:], token_idx, right=True)
+        if inference_params.cache_batch_idx is None:
+            assert batch_start + cu_seqlens.shape[0] - 1 <= kv_cache.shape[0]
+            rows = batch_start + seq_idx
+        else:
+            rows = inference_params.cache_batch_idx[seq_idx]
+        positions = token_idx - cu_seqlens[seq_idx]
+        if inference_params.lengths_per_sample is not None:
+            positions = positions + inference_params.lengths_per_sample[seq_idx]
+        kv_cache[rows.long(), positions.long()] = kv
+        return kv
+    # Adjust key and value for inference
     batch_end = batch_start + kv.shape[0]
     sequence_start = inference_params.seqlen_offset
     sequence_end = sequence_start + kv.shape[1]
@@ -390,8 +410,11 @@ class MHA(nn.Module):
         rotary_emb_base=10000.0,
         rotary_emb_scale_base=None,
         rotary_emb_interleaved=False,
+        rotary_emb_scaling=None,
+        rotary_emb_max_seqlen=0,
         use_alibi=False,
         window_size=(-1, -1),
+        rolling_kv_cache=False,
         fused_bias_fc=False,
         use_flash_attn=False,
         return_residual=False,
@@ -401,6 +424,13 @@ class MHA(nn.Module):
     ) -> None:
         """
         num_heads_kv: can be used to toggle MQA / GQA. If None, use num_heads.
+        rotary_emb_scaling: long context scaling of the rotary embedding, e.g.
+            {"type": "yarn", "factor": 4.0, "original_max_position_embeddings": 4096}.
+            See RotaryEmbedding.
+        rotary_emb_max_seqlen: compute the rotary cos / sin tables once for this length.
+        rolling_kv_cache: for local (sliding window) attention. During generation, only keep the
+            keys and values of the last window_size[0] + 1 tokens, in a ring buffer, so that the
+            memory of the KV cache doesn't grow with the length of the sequence.
         return_residual: whether to return the input x along with the output. This is for
             performance reason: for post-norm architecture, returning the input allows us
             to fuse the backward of nn.Linear with the residual connection.
@@ -423,6 +453,11 @@ class MHA(nn.Module):
             alibi_slopes = None
         if window_size != (-1, -1):
             assert use_flash_attn, "Local (sliding window) attention code path requires flash_attn"
+        if rolling_kv_cache:
+            assert causal and window_size[0] >= 0, "Rolling KV cache requires causal local attention"
+            assert not use_alibi, "Rolling KV cache does not support ALiBi"
+        self.window_size = window_size
+        self.rolling_kv_cache = rolling_kv_cache
 
         self.num_heads = num_heads
         self.num_heads_kv = num_heads_kv if num_heads_kv is not None else num_heads
@@ -442,6 +477,8 @@ class MHA(nn.Module):
                 base=rotary_emb_base,
                 scale_base=rotary_emb_scale_base,
                 interleaved=rotary_emb_interleaved,
+                scaling=rotary_emb_scaling,
+                max_seqlen=rotary_emb_max_seqlen,
                 device=device,
             )
 
@@ -483,6 +520,8 @@ class MHA(nn.Module):
     def allocate_inference_cache(self, batch_size, max_seqlen, dtype=None):
         dtype = self.out_proj.weight.dtype if dtype is None else dtype
         device = self.out_proj.weight.device
+        if self.rolling_kv_cache:
+            max_seqlen = min(max_seqlen, self.window_size[0] + 1)
         return torch.empty(
             batch_size,
             max_seqlen,
@@ -493,11 +532,11 @@ class MHA(nn.Module):
             device=device,
         )
 
-    def _update_kv_cache(self, kv, inference_params):
+    def _update_kv_cache(self, kv, inference_params, cu_seqlens=None):
         """kv: (batch_size, seqlen, 2, nheads, head_dim) or (batch_size, 1, 2, nheads, head_dim)"""
         assert not self.dwconv, "Generation does not support dwconv yet"
         assert self.layer_idx is not None, "Generation requires layer_idx in the constructor"
-        return _update_kv_cache(kv, inference_params, self.layer_idx)
+        return _update_kv_cache(kv, inference_params, self.layer_idx, cu_seqlens=cu_seqlens)
 
     def _apply_rotary_update_kvcache_attention(self, q, kv, inference_params):
         """
@@ -516,7 +555,9 @@ class MHA(nn.Module):
         else:
             rotary_cos, rotary_sin = None, None
         batch = q.shape[0]
-        kv_cache = inference_params.key_value_memory_dict[self.layer_idx][:batch]
+        kv_cache = inference_params.key_value_memory_dict[self.layer_idx]
+        if inference_params.cache_batch_idx is None:
+            kv_cache = kv_cache[:batch]
         cache_seqlens = (
             inference_params.lengths_per_sample[:batch]
             if inference_params.lengths_per_sample is not None
@@ -532,26 +573,226 @@ class MHA(nn.Module):
             rotary_cos=rotary_cos,
             rotary_sin=rotary_sin,
             cache_seqlens=cache_seqlens,
+            cache_batch_idx=inference_params.cache_batch_idx,
             softmax_scale=self.inner_cross_attn.softmax_scale,
             causal=self.inner_cross_attn.causal,
             rotary_interleaved=self.rotary_emb.interleaved if self.rotary_emb_dim > 0 else False,
             alibi_slopes=alibi_slopes,
+            window_size=self.window_size,
         )
         return context
 
-    def _update_kvcache_attention(self, q, kv, inference_params):
+    def _rolling_kvcache_attention(self, q, kv, inference_params):
+        """Local attention with a ring buffer KV cache: the keys and values of position p of a
+        sequence are stored at entry p % cache_len, where cache_len = window_size[0] + 1.
+        Since rotary embedding is already applied to the keys, the order of the entries doesn't
+        matter when a single query attends to all of them.
+        q: (batch_size, seqlen_q, nheads, head_dim)
+        kv: (batch_size, seqlen_q, 2, nheads_kv, head_dim)
+        """
+        assert self.layer_idx is not None, "Generation requires layer_idx in the constructor"
+        batch, seqlen = q.shape[:2]
+        if self.layer_idx not in inference_params.key_value_memory_dict:
+            inference_params.key_value_memory_dict[self.layer_idx] = self.allocate_inference_cache(
+                inference_params.max_batch_size, inference_params.max_seqlen, dtype=kv.dtype
+            )
+        kv_cache = inference_params.key_value_memory_dict[self.layer_idx]
+        cache_len = kv_cache.shape[1]
+        if inference_params.cache_batch_idx is not None:
+            rows = inference_params.cache_batch_idx.long()
+        else:
+            rows = inference_params.batch_size_offset + torch.arange(batch, device=q.device)
+        if seqlen == 1:
+            offsets = (
+                inference_params.lengths_per_sample[:batch].long()
+                if inference_params.lengths_per_sample is not None
+                else torch.full((batch,), inference_params.seqlen_offset, device=q.device)
+            )
+            kv_cache[rows, offsets % cache_len] = kv[:, 0]
+            return flash_attn_with_kvcache(
+                q,
+                kv_cache[:, :, 0],
+                kv_cache[:, :, 1],
+                cache_seqlens=(offsets + 1).clamp(max=cache_len).to(torch.int32),
+                cache_batch_idx=rows.to(torch.int32),
+                softmax_scale=self.inner_cross_attn.softmax_scale,
+                causal=False,
+            )
+        # Several tokens (e.g. the prompt), which start at seqlen_offset in every sequence: attend
+        # to the cached tokens, in order, followed by the new tokens, with the sliding window mask.
+        seqlen_offset = inference_params.seqlen_offset
+        num_cached = min(seqlen_offset, cache_len)
+        if num_cached > 0:
+            pos = torch.arange(seqlen_offset - num_cached, seqlen_offset, device=q.device)
+            kv_attn = torch.cat([kv_cache[rows[:, None], pos % cache_len], kv], dim=1)
+        else:
+            kv_attn = kv
+        context = self.inner_cross_attn(q, kv_attn)
+        num_new = min(seqlen, cache_len)
+        pos = torch.arange(seqlen_offset + seqlen - num_new, seqlen_offset + seqlen, device=q.device)
+        kv_cache[rows[:, None], pos % cache_len] = kv[:, -num_new:]
+        return context
+
+    def _cascade_kvcache_attention(self, q, kv, inference_params):
+        """Cascade attention, for sequences that share a prefix whose KV cache is stored once in
+        inference_params.shared_prefix_kv_dict. The queries of all the sequences attend to the
+        prefix together, as a single sequence with batch_size * seqlen_q queries, so the prefix
+        KV cache is read once instead of once per sequence. Each sequence then attends to its own
+        tokens after the prefix, and the two outputs are merged with their logsumexp.
+        q: (batch_size, seqlen_q, nheads, head_dim)
+        kv: (batch_size, seqlen_q, 2, nheads_kv, head_dim)
+        """
+        assert self.use_flash_attn and flash_attn_with_kvcache is not None
+        assert (
+            getattr(self.inner_cross_attn, "alibi_slopes", None) is None
+        ), "Cascade attention does not support ALiBi"
+        assert self.window_size == (-1, -1), "Cascade attention does not support local attention"
+        batch = q.shape[0]
+        prefix_len = inference_params.shared_prefix_len
+        prefix_kv = inference_params.shared_prefix_kv_dict[self.layer_idx]
+        kv_cache = inference_params.key_value_memory_dict[self.layer_idx]
+        if inference_params.cache_batch_idx is None:
+            kv_cache = kv_cache[:batch]
+        # Number of tokens after the prefix in the KV cache
+        cache_seqlens = (
+            inference_params.lengths_per_sample[:batch] - prefix_len
+            if inference_params.lengths_per_sample is not None
+            else inference_params.seqlen_offset - prefix_len
+        )
+        softmax_scale = self.inner_cross_attn.softmax_scale
+        out_suffix, lse_suffix = flash_attn_with_kvcache(
+            q,
+            kv_cache[:, :, 0],
+            kv_cache[:, :, 1],
+            kv[:, :, 0],
+            kv[:, :, 1],
+            cache_seqlens=cache_seqlens,
+            cache_batch_idx=inference_params.cache_batch_idx,
+            softmax_scale=softmax_scale,
+            causal=self.inner_cross_attn.causal,
+            return_softmax_lse=True,
+        )
+        # All the prefix tokens come before the queries, so there's no causal mask
+        out_prefix, lse_prefix = flash_attn_with_kvcache(
+            rearrange(q, "b s h d -> 1 (b s) h d"),
+            prefix_kv[:, :, 0],
+            prefix_kv[:, :, 1],
+            cache_seqlens=prefix_len,
+            softmax_scale=softmax_scale,
+            causal=False,
+            return_softmax_lse=True,
+        )
+        out_prefix = rearrange(out_prefix, "1 (b s) h d -> b s h d", b=batch)
+        lse_prefix = rearrange(lse_prefix, "1 h (b s) -> b s h 1", b=batch)
+        lse_suffix = rearrange(lse_suffix, "b h s -> b s h 1")
+        lse = torch.logaddexp(lse_prefix, lse_suffix)
+        out = out_prefix.float() * torch.exp(lse_prefix - lse) + out_suffix.float() * torch.exp(
+            lse_suffix - lse
+        )
+        return out.to(q.dtype)
+
+    def _update_kvcache_attention_padded(self, q, kv, inference_params):
+        """Without FlashAttention: write kv to the rows cache_batch_idx of the KV cache, at
+        lengths_per_sample (or seqlen_offset), then attend to the rows with a padding mask.
+        q: (batch_size, seqlen_q, nheads, head_dim)
+        kv: (batch_size, seqlen_q, 2, nheads_kv, head_dim)
+        """
+        assert self.layer_idx is not None, "Generation requires layer_idx in the constructor"
+        batch, seqlen = q.shape[:2]
+        if self.layer_idx not in inference_params.key_value_memory_dict:
+            inference_params.key_value_memory_dict[self.layer_idx] = self.allocate_inference_cache(
+                inference_params.max_batch_size, inference_params.max_seqlen, dtype=kv.dtype
+            )
+        kv_cache = inference_params.key_value_memory_dict[self.layer_idx]
+        rows = inference_params.cache_batch_idx.long()
+        offsets = (
+            inference_params.lengths_per_sample[:batch].long()
+            if inference_params.lengths_per_sample is not None
+            else torch.full((batch,), inference_params.seqlen_offset, device=q.device)
+        )
+        pos = offsets[:, None] + torch.arange(seqlen, device=q.device)
+        kv_cache[rows[:, None], pos] = kv
+        seqlen_k = pos.max().item() + 1
+        key_padding_mask = torch.arange(seqlen_k, device=q.device) < pos[:, -1:] + 1
+        # The padding might not be initialized, zero it so that it can't produce NaN
+        kv = kv_cache[rows, :seqlen_k].masked_fill(
+            ~rearrange(key_padding_mask, "b s -> b s 1 1 1"), 0.0
+        )
+        return self.inner_cross_attn(q, kv, key_padding_mask=key_padding_mask)
+
+    def _varlen_kvcache_attention(self, q, inference_params, cu_seqlens, max_seqlen):
+        """Attention of packed queries (total_seqlen, nheads, head_dim) to the KV cache, where the
+        b-th sequence of q holds the last tokens of cache row cache_batch_idx[b], which has
+        lengths_per_sample[b] + (its number of tokens in q) tokens.
+        Each row of the KV cache is read as a single block of a paged KV cache, so its length must
+        be a multiple of 256.
+        """
+        assert flash_attn_varlen_func is not None, "FlashAttention is not installed"
+        kv_cache = inference_params.key_value_memory_dict[self.layer_idx]
+        assert kv_cache.shape[1] % 256 == 0, "The KV cache length must be a multiple of 256"
+        num_seqs = cu_seqlens.shape[0] - 1
+        if inference_params.cache_batch_idx is None:
+            start = inference_params.batch_size_offset
+            rows = torch.arange(start, start + num_seqs, dtype=torch.int32, device=q.device)
+        else:
+            rows = inference_params.cache_batch_idx
+        seqlens_k = inference_params.lengths_per_sample[:num_seqs] + cu_seqlens.diff()
+        cu_seqlens_k = F.pad(torch.cumsum(seqlens_k, dim=0, dtype=torch.int32), (1, 0))
+        return flash_attn_varlen_func(
+            q,
+            kv_cache[:, :, 0],
+            kv_cache[:, :, 1],
+            cu_seqlens,
+            cu_seqlens_k,
+            max_seqlen,
+            kv_cache.shape[1],
+            softmax_scale=self.inner_cross_attn.softmax_scale,
+            causal=self.inner_cross_attn.causal,
+            window_size=self.window_size,
+            alibi_slopes=getattr(self.inner_cross_attn, "alibi_slopes", None),
+            block_table=rearrange(rows, "b -> b 1"),
+        )
+
+    def _update_kvcache_attention(self, q, kv, inference_params, cu_seqlens=None, max_seqlen=None):
         """Write kv to inference_params, then do attention"""
+        if self.rolling_kv_cache:
+            assert cu_seqlens is None, "Rolling KV cache does not support cu_seqlens"
+            return self._rolling_kvcache_attention(q, kv, inference_params)
+        if inference_params.shared_prefix_len > 0:
+            assert cu_seqlens is None, "Cascade attention does not support cu_seqlens"
+            return self._cascade_kvcache_attention(q, kv, inference_params)
+        if cu_seqlens is not None:
+            # Sequences of different lengths, packed without padding
+            kv = self._update_kv_cache(kv, inference_params, cu_seqlens=cu_seqlens)
+            if inference_params.seqlen_offset == 0:
+                # Nothing in the cache before these tokens
+                return self.inner_cross_attn(
+                    q,
+                    kv,
+                    cu_seqlens=cu_seqlens,
+                    max_seqlen=max_seqlen,
+                    cu_seqlens_k=cu_seqlens,
+                    max_seqlen_k=max_seqlen,
+                )
+            return self._varlen_kvcache_attention(q, inference_params, cu_seqlens, max_seqlen)
         if (
-            inference_params.seqlen_offset == 0
+            (inference_params.seqlen_offset == 0 and inference_params.cache_batch_idx is None)
             or flash_attn_with_kvcache is None
             or not self.use_flash_attn
         ):
+            if inference_params.cache_batch_idx is not None:
+                assert (
+                    not self.use_flash_attn
+                ), "cache_batch_idx with FlashAttention requires flash_attn_with_kvcache"
+                return self._update_kvcache_attention_padded(q, kv, inference_params)
             # TODO: this only uses seqlen_offset and not lengths_per_sample.
             kv = self._update_kv_cache(kv, inference_params)
             return self.inner_cross_attn(q, kv)
         else:
             batch = q.shape[0]
-            kv_cache = inference_params.key_value_memory_dict[self.layer_idx][:batch]
+            kv_cache = inference_params.key_value_memory_dict[self.layer_idx]
+            if inference_params.cache_batch_idx is None:
+                kv_cache = kv_cache[:batch]
             cache_seqlens = (
                 inference_params.lengths_per_sample[:batch]
                 if inference_params.lengths_per_sample is not None
@@ -565,9 +806,11 @@ class MHA(nn.Module):
                 kv[:, :, 0],
                 kv[:, :, 1],
                 cache_seqlens=cache_seqlens,
+                cache_batch_idx=inference_params.cache_batch_idx,
                 softmax_scale=self.inner_cross_attn.softmax_scale,
                 causal=self.inner_cross_attn.causal,
                 alibi_slopes=alibi_slopes,
+                window_size=self.window_size,
             )
 
     def forward(
@@ -589,7 +832,9 @@ class MHA(nn.Module):
             x_kv: (batch, seqlen, hidden_dim), only applicable for cross-attention. If None, use x.
             cu_seqlens: (batch_size + 1,), dtype torch.int32. The cumulative sequence lengths
                 of the sequences in the batch, used to index into x. Only applicable when using
-                FlashAttention.
+                FlashAttention. During generation, the keys and values of each sequence are
+                appended to its own row of the KV cache, after its lengths_per_sample tokens (if
+                seqlen_offset > 0, e.g. prompt chunks mixed with decoding tokens).
             max_seqlen: int. Maximum sequence length in the batch.
             key_padding_mask: boolean mask, True means to keep, False means to mask out.
                 (batch, seqlen). Only applicable when not using FlashAttention.
@@ -604,14 +849,17 @@ class MHA(nn.Module):
             assert key_padding_mask is None
             assert self.use_flash_attn
             assert not self.dwconv
-            assert self.rotary_emb_dim == 0
         if key_padding_mask is not None:
             assert cu_seqlens is None
             assert max_seqlen is None
             assert not self.use_flash_attn
         if inference_params is not None:
             assert key_padding_mask is None
-            assert cu_seqlens is None and max_seqlen is None
+            assert (
+                cu_seqlens is None
+                or inference_params.seqlen_offset == 0
+                or inference_params.lengths_per_sample is not None
+            ), "cu_seqlens after the prompt requires lengths_per_sample"
             assert not self.dwconv
 
         kwargs = (
@@ -628,7 +876,20 @@ class MHA(nn.Module):
                 else inference_params.seqlen_offset
             )
         )
+        if cu_seqlens is not None and isinstance(seqlen_offset, torch.Tensor):
+            seqlen_offset = seqlen_offset[: cu_seqlens.shape[0] - 1]
         rotary_max_seqlen = inference_params.max_seqlen if inference_params is not None else None
+        rotary_kwargs = (
+            {"seqlen_offset": seqlen_offset, "max_seqlen": rotary_max_seqlen}
+            if cu_seqlens is None
+            else {
+                "cu_seqlens": cu_seqlens,
+                "max_seqlen": max_seqlen,
+                "seqlen_offset": seqlen_offset,
+                "max_position": rotary_max_seqlen,
+            }
+        )
+        varlen_kwargs = {"cu_seqlens": cu_seqlens, "max_seqlen": max_seqlen}
         batch, seqlen = x.shape[:2]
         if not self.cross_attn and self.num_heads_kv == self.num_heads:
             assert x_kv is None and mixer_subset is None
@@ -643,11 +904,12 @@ class MHA(nn.Module):
                 or inference_params.seqlen_offset == 0
                 or (self.rotary_emb_dim == 0 or self.rotary_emb_dim % 16 != 0)
                 or not self.use_flash_attn
+                or self.rolling_kv_cache
+                or inference_params.shared_prefix_len > 0
+                or cu_seqlens is not None
             ):
                 if self.rotary_emb_dim > 0:
-                    qkv = self.rotary_emb(
-                        qkv, seqlen_offset=seqlen_offset, max_seqlen=rotary_max_seqlen
-                    )
+                    qkv = self.rotary_emb(qkv, **rotary_kwargs)
                 if inference_params is None:
                     if not self.checkpointing:
                         context = self.inner_attn(qkv, **kwargs)
@@ -655,7 +917,7 @@ class MHA(nn.Module):
                         context = torch.utils.checkpoint.checkpoint(self.inner_attn, qkv, **kwargs)
                 else:
                     context = self._update_kvcache_attention(
-                        qkv[:, :, 0], qkv[:, :, 1:], inference_params
+                        qkv[..., 0, :, :], qkv[..., 1:, :, :], inference_params, **varlen_kwargs
                     )
             else:
                 context = self._apply_rotary_update_kvcache_attention(
@@ -670,6 +932,10 @@ class MHA(nn.Module):
                 qkv = self.Wqkv(x)
                 q = qkv[..., : self.num_heads * self.head_dim]
                 kv = qkv[..., self.num_heads * self.head_dim :]
+                if cu_seqlens is not None and self.use_flash_attn:
+                    # MQA / GQA self-attention: the keys and values have the same sequences
+                    kwargs.setdefault("cu_seqlens_k", cu_seqlens)
+                    kwargs.setdefault("max_seqlen_k", max_seqlen)
             q = rearrange(q, "... (h d) -> ... h d", d=self.head_dim)
             kv = rearrange(kv, "... (two hkv d) -> ... two hkv d", two=2, d=self.head_dim)
             if self.dwconv:
@@ -684,11 +950,12 @@ class MHA(nn.Module):
                 or inference_params.seqlen_offset == 0
                 or (self.rotary_emb_dim == 0 or self.rotary_emb_dim % 16 != 0)
                 or not self.use_flash_attn
+                or self.rolling_kv_cache
+                or inference_params.shared_prefix_len > 0
+                or cu_seqlens is not None
             ):
                 if self.rotary_emb_dim > 0:
-                    q, kv = self.rotary_emb(
-                        q, kv, seqlen_offset=seqlen_offset, max_seqlen=rotary_max_seqlen
-                    )
+                    q, kv = self.rotary_emb(q, kv, **rotary_kwargs)
                 if inference_params is None:
                     if not self.checkpointing:
                         context = self.inner_cross_attn(q, kv, **kwargs)
@@ -697,7 +964,9 @@ class MHA(nn.Module):
                             self.inner_cross_attn, q, kv, **kwargs
                         )
                 else:
-                    context = self._update_kvcache_attention(q, kv, inference_params)
+                    context = self._update_kvcache_attention(
+                        q, kv, inference_params, **varlen_kwargs
+                    )
             else:
                 context = self._apply_rotary_update_kvcache_attention(q, kv, inference_params)
         out = self.out_proj(rearrange(context, "... h d -> ... (h d)"))
@@ -723,6 +992,8 @@ class ParallelMHA(nn.Module):
         rotary_emb_base=10000.0,
         rotary_emb_scale_base=None,
         rotary_emb_interleaved=False,
+        rotary_emb_scaling=None,
+        rotary_emb_max_seqlen=0,
         use_alibi=False,
         window_size=(-1, -1),
         use_flash_attn=False,
@@ -773,6 +1044,7 @@ class ParallelMHA(nn.Module):
             alibi_slopes = None
         if window_size != (-1, -1):
             assert use_flash_attn, "Local (sliding window) attention code path requires flash_attn"
+        self.window_size = window_size
 
         if self.rotary_emb_dim > 0:
             assert RotaryEmbedding is not None, "rotary_emb is not installed"
@@ -781,6 +1053,8 @@ class ParallelMHA(nn.Module):
                 base=rotary_emb_base,
                 scale_base=rotary_emb_scale_base,
                 interleaved=rotary_emb_interleaved,
+                scaling=rotary_emb_scaling,
+                max_seqlen=rotary_emb_max_seqlen,
                 device=device,
             )
 
@@ -847,6 +1121,9 @@ class ParallelMHA(nn.Module):
         """
         assert inference_params is not None and inference_params.seqlen_offset > 0
         assert self.use_flash_attn
+        assert (
+            inference_params.shared_prefix_len == 0
+        ), "Cascade attention is not supported with tensor parallel"
         if self.rotary_emb_dim > 0:
             assert self.rotary_emb.scale is None, "This code path does not support xPos"
             self.rotary_emb._update_cos_sin_cache(
@@ -856,7 +1133,9 @@ class ParallelMHA(nn.Module):
         else:
             rotary_cos, rotary_sin = None, None
         batch = q.shape[0]
-        kv_cache = inference_params.key_value_memory_dict[self.layer_idx][:batch]
+        kv_cache = inference_params.key_value_memory_dict[self.layer_idx]
+        if inference_params.cache_batch_idx is None:
+            kv_cache = kv_cache[:batch]
         cache_seqlens = (
             inference_params.lengths_per_sample[:batch]
             if inference_params.lengths_per_sample is not None
@@ -872,22 +1151,34 @@ class ParallelMHA(nn.Module):
             rotary_cos=rotary_cos,
             rotary_sin=rotary_sin,
             cache_seqlens=cache_seqlens,
+            cache_batch_idx=inference_params.cache_batch_idx,
             softmax_scale=self.inner_cross_attn.softmax_scale,
             causal=self.inner_cross_attn.causal,
             rotary_interleaved=self.rotary_emb.interleaved if self.rotary_emb_dim > 0 else False,
             alibi_slopes=alibi_slopes,
+            window_size=self.window_size,
         )
         return context
 
     def _update_kvcache_attention(self, q, kv, inference_params):
         """Write kv to inference_params, then do attention"""
-        if inference_params.seqlen_offset == 0 or not self.use_flash_attn:
+        assert (
+            inference_params.shared_prefix_len == 0
+        ), "Cascade attention is not supported with tensor parallel"
+        if (
+            inference_params.seqlen_offset == 0 and inference_params.cache_batch_idx is None
+        ) or not self.use_flash_attn:
             # TODO: this only uses seqlen_offset and not lengths_per_sample.
+            assert (
+                inference_params.cache_batch_idx is None
+            ), "cache_batch_idx is only supported with flash_attn_with_kvcache"
             kv = self._update_kv_cache(kv, inference_params)
             return self.inner_cross_attn(q, kv)
         else:
             batch = q.shape[0]
-            kv_cache = inference_params.key_value_memory_dict[self.layer_idx][:batch]
+            kv_cache = inference_params.key_value_memory_dict[self.layer_idx]
+            if inference_params.cache_batch_idx is None:
+                kv_cache = kv_cache[:batch]
             cache_seqlens = (
                 inference_params.lengths_per_sample[:batch]
                 if inference_params.lengths_per_sample is not None
@@ -901,9 +1192,11 @@ class ParallelMHA(nn.Module):
                 kv[:, :, 0],
                 kv[:, :, 1],
                 cache_seqlens=cache_seqlens,
+                cache_batch_idx=inference_params.cache_batch_idx,
                 softmax_scale=self.inner_cross_attn.softmax_scale,
                 causal=self.inner_cross_attn.causal,
                 alibi_slopes=alibi_slopes,
+                window_size=self.window_size,
             )
             return context
 
@@ -1,5 +1,7 @@
 # Copyright (c) 2023, Tri Dao.
 
+import math
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -21,6 +23,13 @@ try:
 except ImportError:
     FusedMLP, ParallelFusedMLP = None, None
 
+try:
+    from flash_attn.ops.triton.grouped_gemm import grouped_gemm
+except ImportError:
+    grouped_gemm = None
+
+from flash_attn.utils.distributed import all_to_all
+
 
 class Mlp(nn.Module):
     def __init__(
@@ -189,3 +198,218 @@ class ParallelGatedMlp(nn.Module):
             y = y * self.activation(gate)
         y = self.fc2(y)
         return y
+
+
+class GroupedLinear(nn.Module):
+    """num_experts linear layers (without bias) applied to an input whose rows are grouped by
+    expert: rows expert_offsets[e]:expert_offsets[e + 1] go through the e-th layer. Rows past
+    expert_offsets[-1] are mapped to zero.
+    """
+
+    def __init__(self, num_experts, in_features, out_features, device=None, dtype=None):
+        factory_kwargs = {"device": device, "dtype": dtype}
+        super().__init__()
+        self.weight = nn.Parameter(
+            torch.empty(num_experts, out_features, in_features, **factory_kwargs)
+        )
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        for weight in self.weight:
+            nn.init.kaiming_uniform_(weight, a=math.sqrt(5))
+
+    def forward(self, x, expert_offsets):
+        if grouped_gemm is not None and x.is_cuda:
+            return grouped_gemm(x, self.weight, expert_offsets)
+        out = torch.zeros(x.shape[0], self.weight.shape[1], device=x.device, dtype=x.dtype)
+        offsets = expert_offsets.tolist()
+        for e in range(self.weight.shape[0]):
+            start, end = offsets[e], offsets[e + 1]
+            out[start:end] = F.linear(x[start:end], self.weight[e])
+        return out
+
+
+class MoEMlp(nn.Module):
+    """Sparse mixture-of-experts MLP: a router picks top_k of num_experts MLPs for each token, and
+    the output is the sum of their outputs weighted by the router probabilities.
+
+    Tokens are permuted so that the tokens of each expert are contiguous, all the experts run as
+    one grouped GEMM (see GroupedLinear), and the outputs are permuted back.
+
+    Arguments:
+        gated: if True, the experts are GatedMlp (e.g. SwiGLU with activation=F.silu, as Mixtral),
+            otherwise Mlp.
+        capacity_factor: if not None, each expert processes at most
+            ceil(capacity_factor * num_tokens * top_k / num_experts) tokens. The assignments past
+            that are dropped, first choices having priority over second choices etc.
+        aux_loss_coef: coefficient of the load balancing loss of Switch Transformer.
+        router_z_loss_coef: coefficient of the router z-loss of ST-MoE.
+        process_group: expert parallelism. Each rank holds num_experts / world_size experts, and
+            tokens are sent to the rank of their experts (all-to-all) and back. The router is
+            replicated. Each rank must process different tokens, so sequence_parallel must be
+            True: with the same tokens on every rank, the gradients of the experts would be
+            summed over the duplicates, i.e. multiplied by the world size.
+
+    In training mode, the auxiliary losses of the last forward pass are stored in self.aux_loss,
+    to be added to the loss of the model.
+    """
+
+    def __init__(
+        self,
+        in_features,
+        hidden_features=None,
+        out_features=None,
+        num_experts=8,
+        top_k=2,
+        activation=F.silu,
+        gated=True,
+        multiple_of=128,
+        normalize_top_k=True,
+        capacity_factor=None,
+        aux_loss_coef=0.01,
+        router_z_loss_coef=0.0,
+        process_group: ProcessGroup = None,
+        sequence_parallel=True,
+        return_residual=False,
+        device=None,
+        dtype=None,
+    ):
+        factory_kwargs = {"device": device, "dtype": dtype}
+        super().__init__()
+        out_features = out_features if out_features is not None else in_features
+        if gated:
+            hidden_features = (
+                hidden_features if hidden_features is not None else int(8 * in_features / 3)
+            )
+            hidden_features = (hidden_features + multiple_of - 1) // multiple_of * multiple_of
+        else:
+            hidden_features = hidden_features if hidden_features is not None else in_features * 4
+        assert 1 <= top_k <= num_experts
+        self.num_experts = num_experts
+        self.top_k = top_k
+        self.activation = activation
+        self.gated = gated
+        self.normalize_top_k = normalize_top_k
+        self.capacity_factor = capacity_factor
+        self.aux_loss_coef = aux_loss_coef
+        self.router_z_loss_coef = router_z_loss_coef
+        self.process_group = process_group
+        self.return_residual = return_residual
+        self.aux_loss = None
+        world_size = (
+            torch.distributed.get_world_size(process_group) if process_group is not None else 1
+        )
+        assert num_experts % world_size == 0, "num_experts must be divisible by the world size"
+        self.num_local_experts = num_experts // world_size
+        self.router = nn.Linear(in_features, num_experts, bias=False, **factory_kwargs)
+        self.fc1 = GroupedLinear(
+            self.num_local_experts,
+            in_features,
+            2 * hidden_features if gated else hidden_features,
+            **factory_kwargs,
+        )
+        self.fc2 = GroupedLinear(
+            self.num_local_experts, hidden_features, out_features, **factory_kwargs
+        )
+        if process_group is not None:
+            assert sequence_parallel, "Expert parallelism requires different tokens on each rank"
+            # The router is replicated: sync its values at init, and its grads since each rank
+            # has different tokens
+            self.router.weight._shared_params = True
+            self.router.weight._sequence_parallel = True
+
+    def _capacity_mask(self, experts, num_tokens):
+        """experts: (num_tokens, top_k). Return a mask of the assignments within capacity."""
+        capacity = math.ceil(self.capacity_factor * num_tokens * self.top_k / self.num_experts)
+        # Rank of each assignment among those of the same expert, first choices first
+        priority = experts.t().flatten()
+        order = torch.argsort(priority, stable=True)
+        counts = torch.bincount(priority, minlength=self.num_experts)
+        starts = torch.cumsum(counts, dim=0) - counts
+        rank = torch.arange(priority.shape[0], device=priority.device) - starts[priority[order]]
+        position = torch.empty_like(priority)
+        position[order] = rank
+        return (position < capacity).view(self.top_k, num_tokens).t()
+
+    def _aux_loss(self, router_logits, probs, experts):
+        aux_loss = router_logits.new_zeros(())
+        if self.aux_loss_coef > 0.0:
+            # num_experts * sum_e (fraction of assignments to e) * (mean probability of e)
+            counts = torch.bincount(experts.flatten(), minlength=self.num_experts)
+            fraction = counts / experts.numel()
+            aux_loss = aux_loss + self.aux_loss_coef * self.num_experts * torch.sum(
+                fraction * probs.mean(dim=0)
+            )
+        if self.router_z_loss_coef > 0.0:
+            z_loss = torch.logsumexp(router_logits, dim=-1).square().mean()
+            aux_loss = aux_loss + self.router_z_loss_coef * z_loss
+        return aux_loss
+
+    def _experts(self, x, expert_offsets):
+        y = self.fc1(x, expert_offsets)
+        if self.gated:
+            y, gate = y.chunk(2, dim=-1)
+            if self.activation == F.silu and swiglu is not None and y.is_cuda:
+                y = swiglu(gate, y)
+            else:
+                y = y * self.activation(gate)
+        else:
+            y = self.activation(y)
+        return self.fc2(y, expert_offsets)
+
+    def _experts_parallel(self, x, counts):
+        """x: (num_assignments, in_features), sorted by expert, counts: (num_experts,) number of
+        rows of each expert. Rows past counts.sum() are dropped assignments."""
+        world_size = torch.distributed.get_world_size(self.process_group)
+        # counts_recv[r, e]: number of rows that rank r sends to our local expert e
+        counts_recv = torch.empty_like(counts)
+        torch.distributed.all_to_all_single(counts_recv, counts, group=self.process_group)
+        counts_recv = counts_recv.view(world_size, self.num_local_experts)
+        input_split_sizes = counts.view(world_size, -1).sum(dim=1).tolist()
+        output_split_sizes = counts_recv.sum(dim=1).tolist()
+        num_kept = sum(input_split_sizes)
+        x_recv = all_to_all(
+            x[:num_kept], output_split_sizes, input_split_sizes, self.process_group
+        )
+        # The received rows are sorted by (source rank, local expert), sort them by local expert
+        local_expert = torch.repeat_interleave(
+            torch.arange(self.num_local_experts, device=x.device).repeat(world_size),
+            counts_recv.flatten(),
+        )
+        order = torch.argsort(local_expert, stable=True)
+        expert_offsets = F.pad(torch.cumsum(counts_recv.sum(dim=0), dim=0), (1, 0))
+        y_sorted = self._experts(x_recv[order], expert_offsets)
+        y_recv = y_sorted[torch.argsort(order)]
+        y = all_to_all(y_recv, input_split_sizes, output_split_sizes, self.process_group)
+        return F.pad(y, (0, 0, 0, x.shape[0] - num_kept))
+
+    def forward(self, x):
+        x_flat = x.reshape(-1, x.shape[-1])
+        num_tokens = x_flat.shape[0]
+        router_logits = self.router(x_flat).float()
+        probs = torch.softmax(router_logits, dim=-1)
+        gates, experts = probs.topk(self.top_k, dim=-1)
+        if self.normalize_top_k:
+            gates = gates / gates.sum(dim=-1, keepdim=True)
+        self.aux_loss = self._aux_loss(router_logits, probs, experts) if self.training else None
+        if self.capacity_factor is not None:
+            keep = self._capacity_mask(experts, num_tokens)
+            # Dropped assignments go to a sentinel expert, sorted last and not computed
+            experts = experts.masked_fill(~keep, self.num_experts)
+            gates = gates * keep
+        experts, gates = experts.flatten(), gates.flatten()
+        # Permute: the assignments of each expert are contiguous
+        order = torch.argsort(experts, stable=True)
+        token_idx = order // self.top_k
+        counts = torch.bincount(experts, minlength=self.num_experts + 1)[: self.num_experts]
+        x_perm = x_flat[token_idx]
+        if self.process_group is None:
+            expert_offsets = F.pad(torch.cumsum(counts, dim=0), (1, 0))
+            y_perm = self._experts(x_perm, expert_offsets)
+        else:
+            y_perm = self._experts_parallel(x_perm, counts)
+        # Unpermute, weighted by the gates
+        y_perm = y_perm * gates[order, None].to(y_perm.dtype)
+        y = torch.zeros(num_tokens, y_perm.shape[-1], device=x.device, dtype=y_perm.dtype)
+        y = y.index_add(0, token_idx, y_perm).reshape(*x.shape[:-1], -1)
+        return y if not self.return_residual else (y, x)
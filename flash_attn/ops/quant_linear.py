@@ -0,0 +1,249 @@
+# Copyright (c) 2024, Tri Dao.
+# Weight-only quantized linear layers for inference: the weights are stored in int8 or int4 with
+# per-channel or group-wise scales, and dequantized inside the GEMM (see
+# flash_attn/ops/triton/quant_linear.py). Quantization is round-to-nearest, so a trained model can
+# be converted without calibration data (quantize_model).
+from fnmatch import fnmatch
+from typing import Optional, Sequence
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch import Tensor
+from torch.distributed import ProcessGroup
+
+from flash_attn.utils.distributed import all_gather, all_reduce, reduce_scatter
+
+try:
+    from flash_attn.ops.triton.quant_linear import triton_quant_linear
+except ImportError:
+    triton_quant_linear = None
+
+try:
+    from flash_attn.ops.fused_dense import ColumnParallelLinear, RowParallelLinear
+except ImportError:
+    ColumnParallelLinear, RowParallelLinear = None, None
+
+
+@torch.no_grad()
+def quantize_weight(weight: Tensor, bits: int = 8, group_size: Optional[int] = None):
+    """Symmetric round-to-nearest quantization, with one scale per output channel and group of
+    group_size input channels (group_size=None: one group per output channel).
+    Return:
+        qweight: (out_features, in_features) int8 if bits == 8, or (out_features, in_features // 2)
+            uint8 if bits == 4: two values (offset by 8) per byte, the even column in the low bits.
+        scales: (out_features, in_features // group_size), same dtype as weight.
+    """
+    assert bits in [4, 8]
+    out_features, in_features = weight.shape
+    group_size = group_size if group_size is not None else in_features
+    assert in_features % group_size == 0, "in_features must be divisible by group_size"
+    w = weight.float().reshape(out_features, in_features // group_size, group_size)
+    qmax = 2 ** (bits - 1) - 1
+    absmax = w.abs().amax(dim=-1)
+    scales = torch.where(absmax > 0, absmax / qmax, torch.ones_like(absmax))
+    qweight = torch.round(w / scales[..., None]).clamp(-qmax, qmax).to(torch.int8)
+    qweight = qweight.reshape(out_features, in_features)
+    if bits == 4:
+        assert in_features % 2 == 0
+        qweight = (qweight + 8).to(torch.uint8)
+        qweight = qweight[:, 0::2] | (qweight[:, 1::2] << 4)
+    return qweight.contiguous(), scales.to(weight.dtype)
+
+
+def dequantize_weight(qweight: Tensor, scales: Tensor, bits: int = 8):
+    """Inverse of quantize_weight, in the dtype of scales."""
+    if bits == 4:
+        qweight = torch.stack([qweight & 0xF, qweight >> 4], dim=-1).flatten(-2).to(torch.int8) - 8
+    out_features, in_features = qweight.shape
+    w = qweight.reshape(out_features, scales.shape[1], -1).to(scales.dtype) * scales[..., None]
+    return w.reshape(out_features, in_features)
+
+
+class QuantLinear(nn.Module):
+    """Linear layer with int8 or int4 weights, for inference. The quantized weight, scales and bias
+    are buffers: they're saved in the state_dict but they're not parameters.
+
+    Use QuantLinear.from_linear or quantize_model to convert trained layers.
+    """
+
+    def __init__(
+        self,
+        in_features: int,
+        out_features: int,
+        bias: bool = True,
+        bits: int = 8,
+        group_size: Optional[int] = None,
+        return_residual: bool = False,
+        device=None,
+        dtype=None,
+    ) -> None:
+        factory_kwargs = {"device": device, "dtype": dtype}
+        super().__init__()
+        assert bits in [4, 8]
+        group_size = group_size if group_size is not None else in_features
+        assert in_features % group_size == 0, "in_features must be divisible by group_size"
+        self.in_features = in_features
+        self.out_features = out_features
+        self.bits = bits
+        self.group_size = group_size
+        self.return_residual = return_residual
+        self.register_buffer(
+            "qweight",
+            torch.zeros(
+                out_features,
+                in_features * bits // 8,
+                device=device,
+                dtype=torch.int8 if bits == 8 else torch.uint8,
+            ),
+        )
+        self.register_buffer(
+            "scales", torch.ones(out_features, in_features // group_size, **factory_kwargs)
+        )
+        if bias:
+            self.register_buffer("bias", torch.zeros(out_features, **factory_kwargs))
+        else:
+            self.register_buffer("bias", None)
+
+    @classmethod
+    def from_linear(
+        cls, linear: nn.Linear, bits: int = 8, group_size: Optional[int] = None, **kwargs
+    ):
+        module = cls(
+            linear.in_features,
+            linear.out_features,
+            bias=linear.bias is not None,
+            bits=bits,
+            group_size=group_size,
+            return_residual=getattr(linear, "return_residual", False),
+            device=linear.weight.device,
+            dtype=linear.weight.dtype,
+            **kwargs,
+        )
+        module.qweight, module.scales = quantize_weight(linear.weight, bits, group_size)
+        if linear.bias is not None:
+            module.bias = linear.bias.detach().clone()
+        return module
+
+    @property
+    def weight(self):
+        """The dequantized weight. The forward pass doesn't materialize it."""
+        return dequantize_weight(self.qweight, self.scales, self.bits)
+
+    def extra_repr(self) -> str:
+        return (
+            f"in_features={self.in_features}, out_features={self.out_features}, "
+            f"bias={self.bias is not None}, bits={self.bits}, group_size={self.group_size}"
+        )
+
+    def _linear(self, x):
+        if triton_quant_linear is not None and x.is_cuda:
+            return triton_quant_linear(x, self.qweight, self.scales, self.bias, bits=self.bits)
+        return F.linear(x, self.weight, self.bias)
+
+    def forward(self, x):
+        out = self._linear(x)
+        return out if not self.return_residual else (out, x)
+
+
+class ColumnParallelQuantLinear(QuantLinear):
+    """Quantized ColumnParallelLinear: in_features is the full dimension, out_features the
+    dimension of this rank."""
+
+    def __init__(
+        self,
+        in_features: int,
+        out_features: int,
+        process_group: ProcessGroup,
+        bias: bool = True,
+        sequence_parallel=True,
+        **kwargs,
+    ) -> None:
+        super().__init__(in_features, out_features, bias=bias, **kwargs)
+        self.process_group = process_group
+        self.sequence_parallel = sequence_parallel
+
+    @classmethod
+    def from_linear(cls, linear, bits=8, group_size=None):
+        return super().from_linear(
+            linear,
+            bits,
+            group_size,
+            process_group=linear.process_group,
+            sequence_parallel=linear.sequence_parallel,
+        )
+
+    def forward(self, x):
+        # If self.sequence_parallel is True, we're doing Tensor Parallel with sequence parallelism:
+        # we do an all_gather of x before doing the matmul.
+        if self.sequence_parallel:
+            x = all_gather(x, self.process_group)
+        return super().forward(x)
+
+
+class RowParallelQuantLinear(QuantLinear):
+    """Quantized RowParallelLinear: in_features is the dimension of this rank, out_features the
+    full dimension. Only rank 0 has a bias."""
+
+    def __init__(
+        self,
+        in_features: int,
+        out_features: int,
+        process_group: ProcessGroup,
+        bias: bool = True,
+        sequence_parallel=True,
+        **kwargs,
+    ) -> None:
+        super().__init__(in_features, out_features, bias=bias, **kwargs)
+        self.process_group = process_group
+        self.sequence_parallel = sequence_parallel
+
+    @classmethod
+    def from_linear(cls, linear, bits=8, group_size=None):
+        return super().from_linear(
+            linear,
+            bits,
+            group_size,
+            process_group=linear.process_group,
+            sequence_parallel=linear.sequence_parallel,
+        )
+
+    def forward(self, x):
+        out = super().forward(x)
+        reduce_fn = reduce_scatter if self.sequence_parallel else all_reduce
+        return reduce_fn(out, self.process_group)
+
+
+@torch.no_grad()
+def quantize_model(
+    model: nn.Module,
+    bits: int = 8,
+    group_size: Optional[int] = None,
+    exclude: Sequence[str] = (),
+) -> nn.Module:
+    """Replace the linear layers of model (nn.Linear, FusedDense, ColumnParallelLinear and
+    RowParallelLinear, e.g. Wqkv, out_proj, fc1, fc2 and lm_head of GPTLMHeadModel) with their
+    quantized versions, in place. Layers whose in_features isn't divisible by group_size are kept.
+    Arguments:
+        exclude: fnmatch patterns of the names of the modules to keep, e.g. ["lm_head"] or
+            ["*.router"].
+    Return:
+        model
+    """
+    for name, module in list(model.named_modules()):
+        for child_name, child in list(module.named_children()):
+            full_name = f"{name}.{child_name}" if name else child_name
+            if any(fnmatch(full_name, pattern) for pattern in exclude):
+                continue
+            if ColumnParallelLinear is not None and isinstance(child, ColumnParallelLinear):
+                cls = ColumnParallelQuantLinear
+            elif RowParallelLinear is not None and isinstance(child, RowParallelLinear):
+                cls = RowParallelQuantLinear
+            elif isinstance(child, nn.Linear):
+                cls = QuantLinear
+            else:
+                continue
+            if child.in_features % (group_size or child.in_features) != 0:
+                continue
+            setattr(module, child_name, cls.from_linear(child, bits=bits, group_size=group_size))
+    return model
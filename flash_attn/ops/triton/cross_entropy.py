@@ -15,6 +15,9 @@ import triton.language as tl
 if "all_gather_into_tensor" not in dir(torch.distributed):
     torch.distributed.all_gather_into_tensor = torch.distributed._all_gather_base
 
+# Minimum number of columns per program when a row is split across several programs
+MIN_SPLIT_SIZE = 8 * 1024
+
 
 @triton.heuristics(
     {
@@ -35,15 +38,23 @@ def cross_entropy_fwd_kernel(
     total_classes,
     class_start_idx,  # Useful for tensor parallel when each rank only has a subset of classes
     n_cols,  # shapes
+    split_size,  # Number of columns processed by each program along the 2nd grid dimension
     logits_row_stride,  # strides
     BLOCK_SIZE: tl.constexpr,
     HAS_SMOOTHING: tl.constexpr,
-    # if SPLIT (e.g. tensor parallel), don't include the LSE in the loss since it's not the final LSE
+    # if SPLIT (e.g. tensor parallel, or several programs per row), don't include the LSE in the
+    # loss since it's not the final LSE
     SPLIT: tl.constexpr,
     PRECOMPUTED_LSE: tl.constexpr,  # If LSE is already computed (also no smoothing and logit_scale == 1.0)
 ):
     row_idx = tl.program_id(0)
-    logits_ptr = logits_ptr + row_idx * logits_row_stride.to(tl.int64)
+    # The partial results of split split_idx are stored at split_idx * n_rows + row_idx
+    split_idx = tl.program_id(1)
+    out_idx = split_idx * tl.num_programs(0) + row_idx
+    col_start = split_idx * split_size
+    logits_ptr = logits_ptr + row_idx * logits_row_stride.to(tl.int64) + col_start
+    n_cols = tl.minimum(split_size, n_cols - col_start)
+    class_start_idx += col_start
     sum_logits = 0.0  # For smoothing
     if not PRECOMPUTED_LSE:
         # Statistics for online softmax
@@ -60,7 +71,7 @@ def cross_entropy_fwd_kernel(
             l_i = tl.exp(m_i - m_i_new) * l_i + tl.sum(tl.exp(logits - m_i_new))
             m_i = m_i_new
         lse = tl.log(l_i) + m_i
-        tl.store(lse_ptr + row_idx, lse)
+        tl.store(lse_ptr + out_idx, lse)
     else:
         lse = tl.load(lse_ptr + row_idx)
     label_idx = tl.load(labels_ptr + row_idx)
@@ -90,7 +101,7 @@ def cross_entropy_fwd_kernel(
             loss += z_loss
         else:
             z_loss = 0.0
-    tl.store(loss_ptr + row_idx, loss)
+    tl.store(loss_ptr + out_idx, loss)
     if not SPLIT:
         tl.store(z_loss_ptr + row_idx, z_loss)
 
@@ -178,23 +189,34 @@ class CrossEntropyLoss(torch.autograd.Function):
         if logits.stride(-1) != 1:
             logits = logits.contiguous()
         MAX_BLOCK_SIZE = 16 * 1024
-        BLOCK_SIZE = min(triton.next_power_of_2(n_cols), MAX_BLOCK_SIZE)
+        # With few rows and a large vocab, one program per row doesn't fill the GPU: each row is
+        # split into n_splits parts processed by different programs, and the partial LSEs and
+        # losses are combined afterwards, the same way as for tensor parallel.
+        n_splits = 1
+        if not use_precomputed_lse and n_cols > 2 * MIN_SPLIT_SIZE:
+            num_sms = torch.cuda.get_device_properties(logits.device).multi_processor_count
+            n_splits = max(min(triton.cdiv(4 * num_sms, n_rows), n_cols // MIN_SPLIT_SIZE), 1)
+        split_size = triton.cdiv(n_cols, n_splits)
+        if n_splits > 1:
+            split_size = triton.cdiv(split_size, MIN_SPLIT_SIZE) * MIN_SPLIT_SIZE
+            n_splits = triton.cdiv(n_cols, split_size)
+        BLOCK_SIZE = min(triton.next_power_of_2(split_size), MAX_BLOCK_SIZE)
         num_warps = (
             4
             if BLOCK_SIZE < 2048
             else (8 if BLOCK_SIZE < 8192 else (16 if BLOCK_SIZE < 128 * 1024 else 32))
         )
-        losses = torch.empty(n_rows, dtype=torch.float, device=logits.device)
+        losses = torch.empty(n_splits, n_rows, dtype=torch.float, device=logits.device)
         if use_precomputed_lse:
             assert precomputed_lse.shape == (n_rows,)
             lse = precomputed_lse.contiguous()
         else:
-            lse = torch.empty(n_rows, dtype=torch.float, device=logits.device)
+            lse = torch.empty(n_splits, n_rows, dtype=torch.float, device=logits.device)
         z_losses = torch.empty(n_rows, dtype=torch.float, device=logits.device)
         # Need this, otherwise Triton tries to launch from cuda:0 and we get
         # ValueError: Pointer argument (at 0) cannot be accessed from Triton (cpu tensor?)
         with torch.cuda.device(logits.device.index):
-            cross_entropy_fwd_kernel[(n_rows,)](
+            cross_entropy_fwd_kernel[(n_rows, n_splits)](
                 losses,  # data ptrs
                 lse,
                 z_losses,
@@ -207,14 +229,18 @@ class CrossEntropyLoss(torch.autograd.Function):
                 total_classes,
                 class_start_idx,
                 n_cols,  # shapes
+                split_size,
                 logits.stride(0),  # strides
                 BLOCK_SIZE=BLOCK_SIZE,  # constants
-                SPLIT=world_size > 1,
+                SPLIT=world_size > 1 or n_splits > 1,
                 PRECOMPUTED_LSE=use_precomputed_lse,
                 num_warps=num_warps,
             )
+        losses = losses.sum(dim=0) if n_splits > 1 else losses.squeeze(0)
+        if not use_precomputed_lse:
+            lse = torch.logsumexp(lse, dim=0) if n_splits > 1 else lse.squeeze(0)
 
-        if world_size > 1:
+        if world_size > 1 or n_splits > 1:
             # If there's no smoothing, if labels are in the vocab of this partition, losses contains
             # - predicted logit, and 0 otherwise.
             # If there's smoothing=0.1, for labels in the vocab of this partition, losses contains
@@ -0,0 +1,200 @@
+# Copyright (c) 2024, Tri Dao.
+# Grouped GEMM for mixture-of-experts: the rows of the input are sorted by expert, and each
+# contiguous group of rows is multiplied by the weight of its expert, in a single launch.
+# The tiling follows flash_attn/ops/triton/linear.py, with the M tiles mapped to (expert, row
+# offset) by a small table that is computed on device, so that there is no host sync.
+
+import torch
+import triton
+import triton.language as tl
+
+# The tile map depends on BLOCK_M, so it's not autotuned
+BLOCK_M = 64
+
+
+def get_configs():
+    configs = []
+    for block_n, block_k, num_warps, num_stages in [
+        (64, 32, 4, 4),
+        (128, 32, 4, 4),
+        (64, 64, 4, 3),
+        (128, 64, 8, 3),
+        (256, 32, 8, 3),
+    ]:
+        configs.append(
+            triton.Config(
+                {"BLOCK_N": block_n, "BLOCK_K": block_k},
+                num_stages=num_stages,
+                num_warps=num_warps,
+            )
+        )
+    return configs
+
+
+@triton.autotune(configs=get_configs(), key=["CACHE_KEY_N", "CACHE_KEY_K"])
+@triton.jit
+def grouped_gemm_kernel(
+    C,  # Pointers to matrices
+    A,
+    B,
+    TILE_EXPERT,
+    TILE_ROW_START,
+    EXPERT_OFFSETS,
+    # Matrix dimensions
+    N,
+    K,
+    CACHE_KEY_N,
+    CACHE_KEY_K,
+    # The stride variables represent how much to increase the ptr by when moving by 1
+    # element in a particular dimension.
+    stride_cm,
+    stride_cn,
+    stride_am,
+    stride_ak,
+    stride_be,
+    stride_bn,
+    stride_bk,
+    # Meta-parameters
+    BLOCK_M: tl.constexpr,
+    BLOCK_N: tl.constexpr,
+    BLOCK_K: tl.constexpr,
+    INPUT_PRECISION: tl.constexpr,
+):
+    """
+    C[rows of expert e] = A[rows of expert e] @ B[e].T
+    A has shape (total_rows, K), B has shape (num_experts, N, K), C has shape (total_rows, N).
+    Program pid_m computes rows TILE_ROW_START[pid_m] : TILE_ROW_START[pid_m] + BLOCK_M, clipped
+    to the rows of expert TILE_EXPERT[pid_m]. There are more programs than tiles, since the grid
+    can't depend on the number of rows per expert; the extra ones have TILE_EXPERT = -1.
+    """
+    pid_m = tl.program_id(axis=0)
+    pid_n = tl.program_id(axis=1)
+    expert = tl.load(TILE_EXPERT + pid_m)
+    if expert < 0:
+        return
+    row_start = tl.load(TILE_ROW_START + pid_m)
+    row_end = tl.load(EXPERT_OFFSETS + expert + 1)
+
+    rm = row_start + tl.arange(0, BLOCK_M)
+    rn = pid_n * BLOCK_N + tl.arange(0, BLOCK_N)
+    rk = tl.arange(0, BLOCK_K)
+    A = A + (rm[:, None].to(tl.int64) * stride_am + rk[None, :] * stride_ak)
+    B = B + expert.to(tl.int64) * stride_be + (rk[:, None] * stride_bk + rn[None, :] * stride_bn)
+
+    acc = tl.zeros((BLOCK_M, BLOCK_N), dtype=tl.float32)
+    for k in range(K, 0, -BLOCK_K):
+        a = tl.load(A, mask=(rm[:, None] < row_end) & (rk[None, :] < k), other=0.0)
+        b = tl.load(B, mask=(rk[:, None] < k) & (rn[None, :] < N), other=0.0)
+        acc += tl.dot(a, b, input_precision=INPUT_PRECISION)
+        A += BLOCK_K * stride_ak
+        B += BLOCK_K * stride_bk
+
+    C = C + (rm[:, None].to(tl.int64) * stride_cm + rn[None, :] * stride_cn)
+    mask = (rm[:, None] < row_end) & (rn[None, :] < N)
+    tl.store(C, acc.to(C.dtype.element_ty), mask=mask)
+
+
+def _tile_map(expert_offsets, num_rows, block_m):
+    """Expert and first row of each M tile, computed on device.
+    Return:
+        tile_expert: (max_tiles,) int32, -1 for the tiles past the last one.
+        tile_row_start: (max_tiles,) int32.
+    """
+    num_experts = expert_offsets.shape[0] - 1
+    counts = expert_offsets[1:] - expert_offsets[:-1]
+    num_tiles = (counts + block_m - 1) // block_m
+    tile_end = torch.cumsum(num_tiles, dim=0)
+    # sum_e ceil(counts[e] / block_m) <= ceil(num_rows / block_m) + num_experts - 1
+    max_tiles = triton.cdiv(num_rows, block_m) + num_experts
+    tile_idx = torch.arange(max_tiles, device=expert_offsets.device)
+    tile_expert = torch.searchsorted(tile_end, tile_idx, right=True)
+    expert = tile_expert.clamp(max=num_experts - 1)
+    tile_row_start = (
+        expert_offsets[expert] + (tile_idx - (tile_end[expert] - num_tiles[expert])) * block_m
+    )
+    tile_expert = torch.where(tile_expert < num_experts, tile_expert, -1)
+    return tile_expert.to(torch.int32), tile_row_start.to(torch.int32)
+
+
+def grouped_gemm_fwd(x, weight, expert_offsets):
+    """
+    Arguments:
+        x: (total_rows, in_features), sorted by expert.
+        weight: (num_experts, out_features, in_features). May be non-contiguous (e.g. a transpose).
+        expert_offsets: (num_experts + 1,) int, rows expert_offsets[e]:expert_offsets[e + 1] of x
+            belong to expert e. expert_offsets[-1] can be smaller than total_rows.
+    Return:
+        out: (total_rows, out_features). Rows past expert_offsets[-1] are zero.
+    """
+    assert x.dim() == 2 and weight.dim() == 3
+    assert x.shape[1] == weight.shape[2], "Incompatible dimensions"
+    assert expert_offsets.shape == (weight.shape[0] + 1,)
+    assert x.dtype == weight.dtype, f"x and weight must have the same dtype, got {x.dtype}"
+    num_rows, K = x.shape
+    N = weight.shape[1]
+    out = torch.zeros(num_rows, N, device=x.device, dtype=x.dtype)
+    if num_rows == 0:
+        return out
+    tile_expert, tile_row_start = _tile_map(expert_offsets, num_rows, BLOCK_M)
+    expert_offsets = expert_offsets.to(torch.int32)
+    # tl.dot rounds fp32 inputs to TF32 by default, follow torch.matmul instead
+    fp32_tf32 = torch.backends.cuda.matmul.allow_tf32
+    input_precision = "ieee" if x.dtype == torch.float32 and not fp32_tf32 else "tf32"
+    grid = lambda META: (tile_expert.shape[0], triton.cdiv(N, META["BLOCK_N"]))
+    grouped_gemm_kernel[grid](
+        out,
+        x,
+        weight,
+        tile_expert,
+        tile_row_start,
+        expert_offsets,
+        N,
+        K,
+        N // 32,  # key for triton cache (limit number of compilations)
+        K // 32,
+        out.stride(0),
+        out.stride(1),
+        x.stride(0),
+        x.stride(1),
+        weight.stride(0),
+        weight.stride(1),
+        weight.stride(2),
+        BLOCK_M=BLOCK_M,
+        INPUT_PRECISION=input_precision,
+    )
+    return out
+
+
+class GroupedGemmFunc(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, x, weight, expert_offsets):
+        ctx.save_for_backward(x, weight, expert_offsets)
+        return grouped_gemm_fwd(x, weight, expert_offsets)
+
+    @staticmethod
+    def backward(ctx, dout):
+        x, weight, expert_offsets = ctx.saved_tensors
+        dx, dweight = None, None
+        if ctx.needs_input_grad[0]:
+            dx = grouped_gemm_fwd(dout, weight.transpose(1, 2), expert_offsets)
+        if ctx.needs_input_grad[1]:
+            # The reduction is over the rows of each expert, one GEMM per expert
+            dweight = torch.empty_like(weight)
+            offsets = expert_offsets.tolist()
+            for e in range(weight.shape[0]):
+                start, end = offsets[e], offsets[e + 1]
+                torch.mm(dout[start:end].t(), x[start:end], out=dweight[e])
+        return dx, dweight, None
+
+
+def grouped_gemm(x, weight, expert_offsets):
+    return GroupedGemmFunc.apply(x, weight, expert_offsets)
+
+
+def grouped_gemm_ref(x, weight, expert_offsets):
+    out = torch.zeros(x.shape[0], weight.shape[1], device=x.device, dtype=x.dtype)
+    offsets = expert_offsets.tolist()
+    for e in range(weight.shape[0]):
+        start, end = offsets[e], offsets[e + 1]
+        out[start:end] = x[start:end] @ weight[e].t()
+    return out
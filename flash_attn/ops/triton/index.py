@@ -0,0 +1,60 @@
+# Copyright (c) 2024, Tri Dao.
+# Gather rows of a tensor, with negative indices giving rows of zeros. With an index and its
+# inverse, this does both the unpadding and the padding of flash_attn/bert_padding.py in a single
+# pass over the output, without zero-filling a buffer and scattering into it.
+
+import torch
+import triton
+import triton.language as tl
+
+
+@triton.jit
+def index_rows_kernel(
+    OUT,
+    IN,
+    INDICES,
+    n_cols,
+    stride_out_row,
+    stride_in_row,
+    BLOCK_N: tl.constexpr,
+):
+    row = tl.program_id(0)
+    cols = tl.program_id(1) * BLOCK_N + tl.arange(0, BLOCK_N)
+    idx = tl.load(INDICES + row).to(tl.int64)
+    mask = cols < n_cols
+    x = tl.load(IN + idx * stride_in_row + cols, mask=mask & (idx >= 0), other=0.0)
+    tl.store(OUT + row.to(tl.int64) * stride_out_row + cols, x, mask=mask)
+
+
+def index_rows(input: torch.Tensor, indices: torch.Tensor) -> torch.Tensor:
+    """
+    Arguments:
+        input: (n_rows, ...)
+        indices: (n_out,), int32 or int64. Rows with a negative index are zero.
+    Return:
+        out: (n_out, ...), out[i] = input[indices[i]] if indices[i] >= 0 else 0.
+    """
+    assert indices.ndim == 1
+    other_shape = input.shape[1:]
+    n_cols = other_shape.numel()
+    input = input.reshape(input.shape[0], n_cols)
+    if input.stride(-1) != 1:
+        input = input.contiguous()
+    indices = indices.contiguous()
+    out = torch.empty(indices.shape[0], n_cols, device=input.device, dtype=input.dtype)
+    if indices.shape[0] == 0 or n_cols == 0:
+        return out.reshape(-1, *other_shape)
+    BLOCK_N = min(triton.next_power_of_2(n_cols), 1024)
+    grid = (indices.shape[0], triton.cdiv(n_cols, BLOCK_N))
+    with torch.cuda.device(input.device.index):
+        index_rows_kernel[grid](
+            out,
+            input,
+            indices,
+            n_cols,
+            out.stride(0),
+            input.stride(0),
+            BLOCK_N=BLOCK_N,
+            num_warps=4 if BLOCK_N <= 512 else 8,
+        )
+    return out.reshape(-1, *other_shape)
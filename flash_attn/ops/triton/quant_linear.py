@@ -0,0 +1,198 @@
+# Copyright (c) 2024, Tri Dao.
+# Linear layer with int8 / int4 weights, dequantized on the fly in the GEMM kernel: the weights are
+# read from memory in their quantized format, which is what matters when decoding with small
+# batches (weight bandwidth bound). Same tiling as kernel_fwd in flash_attn/ops/triton/linear.py.
+
+from typing import Optional
+
+import torch
+import triton
+import triton.language as tl
+
+
+def get_configs():
+    configs = []
+    # Small M first: the main use case is decoding
+    for block_m, block_n, num_warps in [
+        (16, 64, 4),
+        (16, 128, 4),
+        (32, 64, 4),
+        (32, 128, 4),
+        (64, 64, 4),
+        (64, 128, 4),
+        (128, 128, 8),
+    ]:
+        for num_stages in [2, 3, 4]:
+            configs.append(
+                triton.Config(
+                    {"BLOCK_M": block_m, "BLOCK_N": block_n},
+                    num_stages=num_stages,
+                    num_warps=num_warps,
+                )
+            )
+    return configs
+
+
+@triton.autotune(
+    configs=get_configs(),
+    key=["CACHE_KEY_M", "CACHE_KEY_N", "CACHE_KEY_K", "BITS", "BLOCK_K"],
+)
+@triton.jit
+def quant_linear_kernel_fwd(
+    C,  # Pointers to matrices
+    A,
+    B,
+    SCALES,
+    bias,
+    # Matrix dimensions
+    M,
+    N,
+    K,
+    CACHE_KEY_M,
+    CACHE_KEY_N,
+    CACHE_KEY_K,
+    GROUP_SIZE,
+    # The stride variables represent how much to increase the ptr by when moving by 1
+    # element in a particular dimension. E.g. stride_am is how much to increase a_ptr
+    # by to get the element one row down (A has M rows).
+    stride_cm,
+    stride_am,
+    stride_ak,
+    stride_bn,
+    stride_bk,
+    stride_sn,
+    stride_sg,
+    # Meta-parameters
+    BLOCK_M: tl.constexpr,
+    BLOCK_N: tl.constexpr,
+    BLOCK_K: tl.constexpr,
+    # split K not supported
+    GROUP_M: tl.constexpr,
+    BITS: tl.constexpr,
+    BIAS: tl.constexpr,
+):
+    """
+    C = A @ dequantize(B).T + bias
+    A has shape (M, K), C has shape (M, N).
+    B has shape (N, K) int8 if BITS == 8, or (N, K // 2) uint8 if BITS == 4: two 4-bit values
+    (offset by 8) per byte, the even k in the low bits.
+    SCALES has shape (N, K // GROUP_SIZE). A block of BLOCK_K columns is within a single group.
+    """
+    pid = tl.program_id(axis=0)
+
+    grid_m = (M + BLOCK_M - 1) // BLOCK_M
+    grid_n = (N + BLOCK_N - 1) // BLOCK_N
+    # re-order program ID for better L2 performance
+    width = GROUP_M * grid_n
+    group_id = pid // width
+    group_size = min(grid_m - group_id * GROUP_M, GROUP_M)
+    pid_m = group_id * GROUP_M + (pid % group_size)
+    pid_n = (pid % width) // (group_size)
+
+    rm = pid_m * BLOCK_M + tl.arange(0, BLOCK_M)
+    rn = pid_n * BLOCK_N + tl.arange(0, BLOCK_N)
+    rk = tl.arange(0, BLOCK_K)
+
+    acc = tl.zeros((BLOCK_M, BLOCK_N), dtype=tl.float32)
+    for k in range(0, K, BLOCK_K):
+        kk = k + rk
+        a = tl.load(
+            A + rm[:, None] * stride_am + kk[None, :] * stride_ak,
+            mask=(rm[:, None] < M) & (kk[None, :] < K),
+            other=0.0,
+        )
+        mask_b = (kk[:, None] < K) & (rn[None, :] < N)
+        if BITS == 8:
+            b = tl.load(B + kk[:, None] * stride_bk + rn[None, :] * stride_bn, mask=mask_b, other=0)
+            b = b.to(tl.float32)
+        else:
+            # Each byte is loaded twice (once per k), the second load hits the cache
+            b = tl.load(
+                B + (kk // 2)[:, None] * stride_bk + rn[None, :] * stride_bn, mask=mask_b, other=0
+            ).to(tl.int32)
+            b = ((b >> ((kk % 2) * 4)[:, None]) & 0xF).to(tl.float32) - 8.0
+        scale = tl.load(
+            SCALES + rn * stride_sn + (k // GROUP_SIZE) * stride_sg, mask=rn < N, other=0.0
+        ).to(tl.float32)
+        b = (b * scale[None, :]).to(A.dtype.element_ty)
+        acc += tl.dot(a, b)
+
+    if BIAS:
+        bias = tl.load(bias + rn, mask=rn < N, other=0.0).to(tl.float32)
+        acc += bias[None, :]
+
+    C = C + rm[:, None] * stride_cm + rn[None, :]
+    mask = (rm < M)[:, None] & (rn < N)[None, :]
+    tl.store(C, acc, mask=mask)
+
+
+def triton_quant_linear(
+    x: torch.Tensor,
+    qweight: torch.Tensor,
+    scales: torch.Tensor,
+    bias: Optional[torch.Tensor] = None,
+    bits: int = 8,
+) -> torch.Tensor:
+    """
+    Compute x @ dequantize(qweight, scales).T + bias, without materializing the dequantized
+    weight. Inference only (no backward).
+    :param x: input tensor, (..., in_features)
+    :param qweight: (out_features, in_features) int8 if bits == 8,
+        (out_features, in_features // 2) uint8 if bits == 4 (see quantize_weight)
+    :param scales: (out_features, num_groups), same dtype as x
+    :param bias: an optional bias tensor
+    :return: result tensor
+    """
+    assert bits in [4, 8]
+    batch_shape, n = x.shape[:-1], x.shape[-1]
+    batch_dim = batch_shape.numel()
+    x_reshaped = x.reshape(batch_dim, n)
+    if x_reshaped.stride(0) > 1 and x_reshaped.stride(1) > 1:
+        x_reshaped = x_reshaped.contiguous()
+    bias = bias.contiguous() if bias is not None else None
+
+    M, K = x_reshaped.shape
+    N = qweight.shape[0]
+    assert (
+        qweight.shape[1] * (8 // bits) == K
+    ), f"Incompatible dimensions: {x_reshaped.shape} - {qweight.shape}"
+    assert scales.shape[0] == N and K % scales.shape[1] == 0
+    assert x.dtype == scales.dtype, f"Input and scales must have the same dtype, got {x.dtype}"
+    assert bias is None or bias.shape[0] == N, "Incompatible dimensions in between weight and bias"
+    group_size = K // scales.shape[1]
+    if scales.shape[1] == 1:  # Per-channel: all the K blocks use the same scales
+        block_k = 64
+    else:
+        assert group_size % 32 == 0, "group_size must be a multiple of 32"
+        block_k = 64 if group_size % 64 == 0 else 32
+
+    output = torch.empty((M, N), device=x.device, dtype=x.dtype)
+    # 1D launch kernel where each block gets its own program.
+    grid = lambda META: (triton.cdiv(M, META["BLOCK_M"]) * triton.cdiv(N, META["BLOCK_N"]),)  # noqa
+
+    quant_linear_kernel_fwd[grid](
+        output,
+        x_reshaped,
+        qweight,
+        scales,
+        bias if bias is not None else x,  # auto skip bias if not present
+        M,  # shapes
+        N,
+        K,
+        M // 32,  # key for triton cache (limit number of compilations)
+        N // 32,
+        K // 32,
+        group_size if scales.shape[1] > 1 else K,
+        stride_cm=output.stride(0),  # strides
+        stride_am=x_reshaped.stride(0),
+        stride_ak=x_reshaped.stride(1),
+        stride_bn=qweight.stride(0),
+        stride_bk=qweight.stride(1),
+        stride_sn=scales.stride(0),
+        stride_sg=scales.stride(1),
+        BLOCK_K=block_k,
+        GROUP_M=8,  # speed optimization: group the programs
+        BITS=bits,
+        BIAS=bias is not None,
+    )
+    return output.reshape(*batch_shape, output.shape[-1])
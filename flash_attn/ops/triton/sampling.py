@@ -0,0 +1,257 @@
+# Copyright (c) 2024, Tri Dao.
+
+import torch
+
+import triton
+import triton.language as tl
+
+
+@triton.jit
+def _load_scaled_logits(
+    logits_ptr,
+    counts_ptr,
+    cols,
+    n_cols,
+    inv_temperature,
+    repetition_penalty,
+    presence_penalty,
+    frequency_penalty,
+    HAS_PENALTY: tl.constexpr,
+):
+    logits = tl.load(logits_ptr + cols, mask=cols < n_cols, other=-float("inf")).to(tl.float32)
+    if HAS_PENALTY:
+        counts = tl.load(counts_ptr + cols, mask=cols < n_cols, other=0).to(tl.float32)
+        seen = counts > 0
+        logits = tl.where(
+            seen,
+            tl.where(logits > 0, logits / repetition_penalty, logits * repetition_penalty),
+            logits,
+        )
+        logits = logits - presence_penalty * seen.to(tl.float32) - frequency_penalty * counts
+    return logits * inv_temperature
+
+
+@triton.jit
+def sampling_kernel(
+    out_ptr,  # data ptrs
+    logits_ptr,
+    counts_ptr,
+    temperature_ptr,
+    top_k_ptr,
+    top_p_ptr,
+    min_p_ptr,
+    repetition_penalty_ptr,
+    presence_penalty_ptr,
+    frequency_penalty_ptr,
+    seed_ptr,
+    n_cols,  # shapes
+    logits_row_stride,  # strides
+    counts_row_stride,
+    NUM_SELECT_PASSES: tl.constexpr,
+    NUM_BINS: tl.constexpr,
+    BLOCK_SIZE: tl.constexpr,
+    HAS_PENALTY: tl.constexpr,
+):
+    row_idx = tl.program_id(0)
+    seed = tl.load(seed_ptr)
+    logits_ptr = logits_ptr + row_idx * logits_row_stride.to(tl.int64)
+    if HAS_PENALTY:
+        counts_ptr = counts_ptr + row_idx * counts_row_stride.to(tl.int64)
+        repetition_penalty = tl.load(repetition_penalty_ptr + row_idx).to(tl.float32)
+        presence_penalty = tl.load(presence_penalty_ptr + row_idx).to(tl.float32)
+        frequency_penalty = tl.load(frequency_penalty_ptr + row_idx).to(tl.float32)
+    else:
+        repetition_penalty = 1.0
+        presence_penalty = 0.0
+        frequency_penalty = 0.0
+    temperature = tl.load(temperature_ptr + row_idx).to(tl.float32)
+    top_k = tl.load(top_k_ptr + row_idx).to(tl.int32)
+    top_p = tl.load(top_p_ptr + row_idx).to(tl.float32)
+    min_p = tl.load(min_p_ptr + row_idx).to(tl.float32)
+    greedy = (temperature == 0.0) | (top_k == 1)
+    inv_temperature = tl.where(greedy, 1.0, 1.0 / temperature)
+    # For greedy decoding the argmax is always kept, so there's no need to filter
+    top_k = tl.where(greedy, 0, top_k)
+    top_p = tl.where(greedy, 1.0, top_p)
+    # Max and min of the logits
+    m_i = -float("inf")
+    min_i = float("inf")
+    for col_offset in range(0, n_cols, BLOCK_SIZE):
+        cols = col_offset + tl.arange(0, BLOCK_SIZE)
+        logits = _load_scaled_logits(
+            logits_ptr,
+            counts_ptr,
+            cols,
+            n_cols,
+            inv_temperature,
+            repetition_penalty,
+            presence_penalty,
+            frequency_penalty,
+            HAS_PENALTY,
+        )
+        m_i = tl.maximum(m_i, tl.max(logits))
+        min_i = tl.minimum(min_i, tl.min(tl.where(cols < n_cols, logits, float("inf"))))
+    # min-p: prob >= min_p * max prob. log(0) = -inf so min_p = 0 keeps everything.
+    threshold = m_i + tl.log(min_p)
+    # Instead of sorting the vocabulary, search for the thresholds on the value of the logits: the
+    # top-k threshold is the largest t such that at least top_k logits are >= t, and the top-p
+    # threshold is the largest t such that the logits >= t hold at least top_p of the (top-k
+    # renormalized) mass. Each pass reads the row once and evaluates NUM_BINS candidate thresholds
+    # at once (a histogram of the row over [lo, hi]), shrinking the interval by NUM_BINS: 6 passes
+    # of 16 bins give the same 2^-24 resolution as 24 bisection steps, with 4x fewer reads.
+    bins = (tl.arange(0, NUM_BINS) + 1).to(tl.float32) / NUM_BINS
+    threshold_k = min_i
+    if (top_k > 0) & (top_k < n_cols):
+        hi = m_i
+        for _ in range(NUM_SELECT_PASSES):
+            cand = threshold_k + (hi - threshold_k) * bins
+            count = tl.zeros([NUM_BINS], dtype=tl.int32)
+            for col_offset in range(0, n_cols, BLOCK_SIZE):
+                cols = col_offset + tl.arange(0, BLOCK_SIZE)
+                logits = _load_scaled_logits(
+                    logits_ptr,
+                    counts_ptr,
+                    cols,
+                    n_cols,
+                    inv_temperature,
+                    repetition_penalty,
+                    presence_penalty,
+                    frequency_penalty,
+                    HAS_PENALTY,
+                )
+                count += tl.sum((logits[:, None] >= cand[None, :]).to(tl.int32), axis=0)
+            # count is non-increasing in the threshold: the first n_ok candidates are feasible
+            n_ok = tl.sum((count >= top_k).to(tl.int32), axis=0)
+            lo_new = tl.max(tl.where(bins * NUM_BINS == n_ok, cand, threshold_k), axis=0)
+            hi = tl.min(tl.where(bins * NUM_BINS == n_ok + 1, cand, hi), axis=0)
+            threshold_k = lo_new
+    threshold = tl.maximum(threshold, threshold_k)
+    if (top_p > 0.0) & (top_p < 1.0):
+        # Mass of the top-k logits
+        l_k = 0.0
+        for col_offset in range(0, n_cols, BLOCK_SIZE):
+            cols = col_offset + tl.arange(0, BLOCK_SIZE)
+            logits = _load_scaled_logits(
+                logits_ptr,
+                counts_ptr,
+                cols,
+                n_cols,
+                inv_temperature,
+                repetition_penalty,
+                presence_penalty,
+                frequency_penalty,
+                HAS_PENALTY,
+            )
+            l_k += tl.sum(tl.where(logits >= threshold_k, tl.exp(logits - m_i), 0.0))
+        threshold_p = threshold_k
+        hi = m_i
+        for _ in range(NUM_SELECT_PASSES):
+            cand = threshold_p + (hi - threshold_p) * bins
+            mass = tl.zeros([NUM_BINS], dtype=tl.float32)
+            for col_offset in range(0, n_cols, BLOCK_SIZE):
+                cols = col_offset + tl.arange(0, BLOCK_SIZE)
+                logits = _load_scaled_logits(
+                    logits_ptr,
+                    counts_ptr,
+                    cols,
+                    n_cols,
+                    inv_temperature,
+                    repetition_penalty,
+                    presence_penalty,
+                    frequency_penalty,
+                    HAS_PENALTY,
+                )
+                p = tl.exp(logits - m_i)
+                mass += tl.sum(tl.where(logits[:, None] >= cand[None, :], p[:, None], 0.0), axis=0)
+            n_ok = tl.sum((mass >= top_p * l_k).to(tl.int32), axis=0)
+            lo_new = tl.max(tl.where(bins * NUM_BINS == n_ok, cand, threshold_p), axis=0)
+            hi = tl.min(tl.where(bins * NUM_BINS == n_ok + 1, cand, hi), axis=0)
+            threshold_p = lo_new
+        threshold = tl.maximum(threshold, threshold_p)
+    # Sample with the Gumbel-max trick: argmax(logits + Gumbel noise) over the tokens that are kept
+    # is distributed as softmax(logits), so we don't need the normalized probs or a cumsum.
+    best_val = tl.full([BLOCK_SIZE], -float("inf"), dtype=tl.float32)
+    best_idx = tl.zeros([BLOCK_SIZE], dtype=tl.int32)
+    for col_offset in range(0, n_cols, BLOCK_SIZE):
+        cols = col_offset + tl.arange(0, BLOCK_SIZE)
+        logits = _load_scaled_logits(
+            logits_ptr,
+            counts_ptr,
+            cols,
+            n_cols,
+            inv_temperature,
+            repetition_penalty,
+            presence_penalty,
+            frequency_penalty,
+            HAS_PENALTY,
+        )
+        gumbel = -tl.log(-tl.log(tl.rand(seed + row_idx, cols)))
+        val = tl.where(logits >= threshold, logits + tl.where(greedy, 0.0, gumbel), -float("inf"))
+        better = val > best_val
+        best_val = tl.where(better, val, best_val)
+        best_idx = tl.where(better, cols, best_idx)
+    # Ties go to the smallest index, same as torch.argmax
+    max_val = tl.max(best_val, axis=0)
+    token = tl.min(tl.where(best_val == max_val, best_idx, n_cols), axis=0)
+    tl.store(out_ptr + row_idx, token)
+
+
+def sample_fused(
+    logits,
+    temperature,
+    top_k,
+    top_p,
+    min_p,
+    token_counts=None,
+    repetition_penalty=None,
+    presence_penalty=None,
+    frequency_penalty=None,
+    num_select_passes=6,
+):
+    """Temperature, penalties, top-k / top-p / min-p filtering and sampling in a single kernel,
+    with one program per row.
+    Arguments:
+        logits: (batch_size, vocab_size)
+        temperature, top_k, top_p, min_p: (batch_size,)
+        token_counts: (batch_size, vocab_size), optional. If not None, repetition_penalty,
+            presence_penalty, frequency_penalty are (batch_size,) tensors.
+        num_select_passes: passes over the row to find each of the top-k and top-p thresholds,
+            each narrowing the search interval 16x.
+    Return:
+        tokens: (batch_size,), dtype torch.long
+    """
+    assert logits.dim() == 2 and logits.stride(-1) == 1
+    n_rows, n_cols = logits.shape
+    if token_counts is not None:
+        assert token_counts.shape == logits.shape and token_counts.stride(-1) == 1
+    out = torch.empty(n_rows, dtype=torch.int32, device=logits.device)
+    # Seed from the CUDA generator, on the device: torch.manual_seed makes sampling reproducible,
+    # and a CUDA graph that captured this draws a new seed at each replay
+    seed = torch.randint(0, 2**31 - 1, (1,), device=logits.device)
+    # The threshold search works on (BLOCK_SIZE, 16) tiles, so the blocks are smaller than the
+    # usual row-wise kernels
+    BLOCK_SIZE = min(triton.next_power_of_2(n_cols), 1024)
+    num_warps = 4 if BLOCK_SIZE < 1024 else 8
+    with torch.cuda.device(logits.device.index):
+        sampling_kernel[(n_rows,)](
+            out,
+            logits,
+            token_counts,
+            temperature,
+            top_k,
+            top_p,
+            min_p,
+            repetition_penalty,
+            presence_penalty,
+            frequency_penalty,
+            seed,
+            n_cols,
+            logits.stride(0),
+            token_counts.stride(0) if token_counts is not None else 0,
+            NUM_SELECT_PASSES=num_select_passes,
+            NUM_BINS=16,
+            BLOCK_SIZE=BLOCK_SIZE,
+            HAS_PENALTY=token_counts is not None,
+            num_warps=num_warps,
+        )
+    return out.long()
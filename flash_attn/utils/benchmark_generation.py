@@ -0,0 +1,188 @@
+# Copyright (c) 2024, Tri Dao.
+""" End-to-end benchmark of generation: replay a trace of requests and measure latencies. """
+
+import asyncio
+import json
+import math
+import random
+import time
+from dataclasses import asdict, dataclass, field
+from typing import List, Optional
+
+import torch
+
+from flash_attn.utils.generation import decode_stream
+from flash_attn.utils.serving import ServingEngine
+
+
+@dataclass
+class TraceRequest:
+    arrival_time: float  # Seconds since the start of the trace
+    prompt_len: int
+    output_len: int
+
+
+@dataclass
+class RequestMetrics:
+    arrival_time: float
+    prompt_len: int
+    token_times: List[float] = field(default_factory=list)  # Seconds since the start of the trace
+
+    @property
+    def ttft(self):
+        return self.token_times[0] - self.arrival_time
+
+    @property
+    def itls(self):
+        return [b - a for a, b in zip(self.token_times[:-1], self.token_times[1:])]
+
+
+def _sample_len(length, rng):
+    return length if isinstance(length, int) else rng.randint(*length)
+
+
+def make_trace(num_requests, request_rate=math.inf, prompt_len=128, output_len=128, seed=0):
+    """Synthetic trace with Poisson arrivals.
+    Arguments:
+        request_rate: mean number of requests per second. math.inf means that all the requests
+            arrive at time 0.
+        prompt_len, output_len: int, or (min, max) for lengths uniform in [min, max].
+    Return:
+        list of TraceRequest, sorted by arrival time
+    """
+    rng = random.Random(seed)
+    trace, now = [], 0.0
+    for _ in range(num_requests):
+        if request_rate != math.inf:
+            now += rng.expovariate(request_rate)
+        trace.append(TraceRequest(now, _sample_len(prompt_len, rng), _sample_len(output_len, rng)))
+    return trace
+
+
+def save_trace(trace, path):
+    with open(path, "w") as f:
+        for request in trace:
+            f.write(json.dumps(asdict(request)) + "\n")
+
+
+def load_trace(path):
+    """Load a recorded trace: one JSON object per line with arrival_time, prompt_len, output_len."""
+    with open(path) as f:
+        trace = [TraceRequest(**json.loads(line)) for line in f if line.strip()]
+    return sorted(trace, key=lambda r: r.arrival_time)
+
+
+def _percentiles(values, scale=1000.0):
+    """Mean and percentiles, in ms by default."""
+    if not values:
+        return None
+    values = sorted(values)
+    pct = lambda p: values[min(int(p / 100 * len(values)), len(values) - 1)] * scale
+    return {
+        "mean": sum(values) / len(values) * scale,
+        "p50": pct(50),
+        "p90": pct(90),
+        "p99": pct(99),
+        "max": values[-1] * scale,
+    }
+
+
+def summarize(metrics, kv_cache_bytes, peak_kv_bytes):
+    """Aggregate the per-request measurements into a JSON-serializable dict."""
+    num_tokens = sum(len(m.token_times) for m in metrics)
+    duration = max(m.token_times[-1] for m in metrics) - min(m.arrival_time for m in metrics)
+    summary = {
+        "num_requests": len(metrics),
+        "num_prompt_tokens": sum(m.prompt_len for m in metrics),
+        "num_output_tokens": num_tokens,
+        "duration_s": duration,
+        "output_tokens_per_s": num_tokens / duration,
+        "requests_per_s": len(metrics) / duration,
+        "ttft_ms": _percentiles([m.ttft for m in metrics]),
+        "itl_ms": _percentiles([itl for m in metrics for itl in m.itls]),
+        "e2e_latency_ms": _percentiles([m.token_times[-1] - m.arrival_time for m in metrics]),
+        "kv_cache_bytes": kv_cache_bytes,
+        "peak_kv_bytes": peak_kv_bytes,
+    }
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        summary["max_memory_allocated_bytes"] = torch.cuda.max_memory_allocated()
+    return summary
+
+
+def _make_prompts(trace, vocab_size, device, seed):
+    generator = torch.Generator().manual_seed(seed)
+    return [
+        torch.randint(0, vocab_size, (r.prompt_len,), generator=generator).to(device)
+        for r in trace
+    ]
+
+
+def _kv_bytes_per_token(model):
+    kv_cache = model.allocate_inference_cache(1, 1, dtype=next(iter(model.parameters())).dtype)
+    return sum(kv[0, 0].numel() * kv.element_size() for kv in kv_cache.values())
+
+
+def replay_engine(model, trace, max_batch_size, max_seqlen, vocab_size, seed=0, **engine_kwargs):
+    """Replay the trace through ServingEngine (continuous batching). Requests are submitted at
+    their arrival time, so TTFT includes the time spent waiting for admission.
+    Return: dict, see summarize.
+    """
+    prompts = _make_prompts(trace, vocab_size, next(iter(model.parameters())).device, seed)
+    metrics = [RequestMetrics(r.arrival_time, r.prompt_len) for r in trace]
+    peak_kv_bytes = 0
+
+    async def run():
+        nonlocal peak_kv_bytes
+        async with ServingEngine(model, max_batch_size, max_seqlen, **engine_kwargs) as engine:
+            start = time.perf_counter()
+
+            async def client(request, prompt, m):
+                nonlocal peak_kv_bytes
+                await asyncio.sleep(max(request.arrival_time - (time.perf_counter() - start), 0))
+                handle = engine.submit(prompt, max_new_tokens=request.output_len)
+                async for _ in handle:
+                    m.token_times.append(time.perf_counter() - start)
+                    kv_tokens = sum(h.cache_seqlen for h in engine.running)
+                    peak_kv_bytes = max(peak_kv_bytes, kv_tokens * engine.bytes_per_token)
+
+            await asyncio.gather(*[client(*args) for args in zip(trace, prompts, metrics)])
+            return engine.max_batch_size * engine.max_seqlen * engine.bytes_per_token
+
+    kv_cache_bytes = asyncio.run(run())
+    return summarize(metrics, kv_cache_bytes, peak_kv_bytes)
+
+
+def replay_static(model, trace, max_batch_size, vocab_size, seed=0):
+    """Replay the trace with static batching through decode_stream: requests are grouped in
+    arrival order into batches of max_batch_size, and a batch starts once all its requests have
+    arrived and the previous batch is done. Prompts of different lengths in the same batch
+    require FlashAttention.
+    Return: dict, see summarize.
+    """
+    prompts = _make_prompts(trace, vocab_size, next(iter(model.parameters())).device, seed)
+    metrics = [RequestMetrics(r.arrival_time, r.prompt_len) for r in trace]
+    bytes_per_token = _kv_bytes_per_token(model)
+    kv_cache_bytes, peak_kv_bytes = 0, 0
+    start = time.perf_counter()
+    for batch_start in range(0, len(trace), max_batch_size):
+        batch = list(range(batch_start, min(batch_start + max_batch_size, len(trace))))
+        time.sleep(max(trace[batch[-1]].arrival_time - (time.perf_counter() - start), 0))
+        input_ids = [prompts[i] for i in batch]
+        if len(set(p.shape[0] for p in input_ids)) == 1:
+            input_ids = torch.stack(input_ids)
+        max_new_tokens = [trace[i].output_len for i in batch]
+        batch_kv_tokens = len(batch) * max(
+            trace[i].prompt_len + trace[i].output_len for i in batch
+        )
+        kv_cache_bytes = max(kv_cache_bytes, batch_kv_tokens * bytes_per_token)
+        num_generated = [0] * len(batch)
+        for step in decode_stream(input_ids, model, max_new_tokens, vocab_size=vocab_size):
+            now = time.perf_counter() - start
+            for j in step.sequence_idx:
+                metrics[batch[j]].token_times.append(now)
+                num_generated[j] += 1
+            kv_tokens = sum(
+                trace[i].prompt_len + n for i, n in zip(batch, num_generated) if n > 0
+            )
+            peak_kv_bytes = max(peak_kv_bytes, kv_tokens * bytes_per_token)
+    return summarize(metrics, kv_cache_bytes, peak_kv_bytes)
@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import List, Optional
 
 import torch
 from torch import Tensor
@@ -46,6 +46,28 @@ def all_reduce_raw(input_: Tensor, process_group: ProcessGroup, async_op: bool =
     return input_, handle
 
 
+# Raw operation, does not support autograd, but does support async
+def all_to_all_raw(
+    input_: Tensor,
+    output_split_sizes: List[int],
+    input_split_sizes: List[int],
+    process_group: ProcessGroup,
+    async_op: bool = False,
+):
+    output = torch.empty(
+        sum(output_split_sizes), *input_.shape[1:], dtype=input_.dtype, device=input_.device
+    )
+    handle = torch.distributed.all_to_all_single(
+        output,
+        input_.contiguous(),
+        output_split_sizes,
+        input_split_sizes,
+        group=process_group,
+        async_op=async_op,
+    )
+    return output, handle
+
+
 class AllGatherFunc(torch.autograd.Function):
     """Gather the input from sequence parallel region and concatenate."""
 
@@ -102,6 +124,36 @@ class AllReduceFunc(torch.autograd.Function):
 all_reduce = AllReduceFunc.apply
 
 
+class AllToAllFunc(torch.autograd.Function):
+    """Send input_split_sizes[r] rows of the input to rank r, and receive output_split_sizes[r]
+    rows from rank r."""
+
+    @staticmethod
+    def forward(
+        ctx,
+        input_: Tensor,
+        output_split_sizes: List[int],
+        input_split_sizes: List[int],
+        process_group: ProcessGroup,
+    ) -> Tensor:
+        ctx.process_group = process_group
+        ctx.output_split_sizes = output_split_sizes
+        ctx.input_split_sizes = input_split_sizes
+        output, _ = all_to_all_raw(input_, output_split_sizes, input_split_sizes, process_group)
+        return output
+
+    @staticmethod
+    def backward(ctx, grad_output: Tensor):
+        grad_input, _ = all_to_all_raw(
+            grad_output, ctx.input_split_sizes, ctx.output_split_sizes, ctx.process_group
+        )
+        return grad_input, None, None, None
+
+
+# Supports autograd, but does not support async
+all_to_all = AllToAllFunc.apply
+
+
 def sync_shared_params(model: torch.nn.Module, process_group: ProcessGroup):
     # We want to iterate over parameters with _shared_params=True in the same order,
     # as different ranks might have different number of parameters (e.g., only rank 0 has bias).
@@ -1,11 +1,12 @@
 # Copyright (c) 2023, Tri Dao.
 # Adapted from https://github.com/NVIDIA/Megatron-LM/blob/0bb597b42c53355a567aba2a1357cc34b9d99ddd/megatron/text_generation/forward_step.py#L31
+import asyncio
 import gc
 import time
 from collections import namedtuple
 from dataclasses import dataclass, field
 from functools import partial
-from typing import Callable, Optional, Sequence, Union
+from typing import Callable, List, Optional, Sequence, Union
 
 import torch
 import torch.nn.functional as F
@@ -13,12 +14,26 @@ from einops import rearrange, repeat
 from torch import Tensor
 from torch.profiler import ProfilerActivity, profile, record_function
 
+from flash_attn.bert_padding import unpad_input
+
+try:
+    from flash_attn.ops.triton.sampling import sample_fused
+except ImportError:
+    sample_fused = None
+
 try:
     from transformers.generation import GreedySearchDecoderOnlyOutput, SampleDecoderOnlyOutput
 except ImportError:
     GreedySearchDecoderOnlyOutput = namedtuple("GreedySearchDecoderOnlyOutput", ["sequences", "scores"])
     SampleDecoderOnlyOutput = namedtuple("SampleDecoderOnlyOutput", ["sequences", "scores"])
 
+try:
+    from transformers.generation import BeamSearchDecoderOnlyOutput
+except ImportError:
+    BeamSearchDecoderOnlyOutput = namedtuple(
+        "BeamSearchDecoderOnlyOutput", ["sequences", "sequences_scores"]
+    )
+
 
 @dataclass
 class InferenceParams:
@@ -31,14 +46,35 @@ class InferenceParams:
     batch_size_offset: int = 0
     key_value_memory_dict: dict = field(default_factory=dict)
     lengths_per_sample: Optional[Tensor] = None
+    # (batch,), dtype torch.int32. If not None, row i of the batch reads and writes row
+    # cache_batch_idx[i] of the KV cache, instead of row i.
+    cache_batch_idx: Optional[Tensor] = None
+    # Cascade attention: number of leading tokens that all the sequences share. Their KV cache is
+    # stored once per layer in shared_prefix_kv_dict, (1, shared_prefix_len, 2, nheads_kv, headdim),
+    # and the rows of key_value_memory_dict only hold the tokens after the prefix. seqlen_offset
+    # and lengths_per_sample still count the prefix tokens.
+    shared_prefix_len: int = 0
+    shared_prefix_kv_dict: dict = field(default_factory=dict)
 
     def reset(self, max_seqlen, max_batch_size):
         self.max_seqlen = max_seqlen
         self.max_batch_size = max_batch_size
         self.seqlen_offset = 0
+        self.shared_prefix_len = 0
+        self.shared_prefix_kv_dict = {}
         if self.lengths_per_sample is not None:
             self.lengths_per_sample.zero_()
 
+    def set_shared_prefix(self, prefix_len, row=0):
+        """Move the KV cache of the first prefix_len tokens of the given row of the KV cache to
+        shared_prefix_kv_dict, so that cascade attention reads it once for the whole batch.
+        """
+        self.shared_prefix_kv_dict = {
+            layer_idx: kv_cache[row : row + 1, :prefix_len].clone()
+            for layer_idx, kv_cache in self.key_value_memory_dict.items()
+        }
+        self.shared_prefix_len = prefix_len
+
 
 # https://github.com/NVIDIA/Megatron-LM/blob/0bb597b42c53355a567aba2a1357cc34b9d99ddd/megatron/text_generation/sampling.py
 # https://github.com/huggingface/transformers/blob/a44985b41cfa2de48a5e1de7f1f93b7483da25d1/src/transformers/generation/logits_process.py#L231
@@ -95,6 +131,108 @@ def sample(logits, top_k=1, top_p=0.0, temperature=1.0):
             )
 
 
+def _sample_batched_torch(
+    logits,
+    temperature,
+    top_k,
+    top_p,
+    min_p,
+    token_counts=None,
+    repetition_penalty=None,
+    presence_penalty=None,
+    frequency_penalty=None,
+):
+    """Reference implementation of sample_fused, also used when Triton is not available."""
+    logits = logits.float()
+    if token_counts is not None:
+        seen = token_counts > 0
+        penalized = torch.where(
+            logits > 0, logits / repetition_penalty[:, None], logits * repetition_penalty[:, None]
+        )
+        logits = torch.where(seen, penalized, logits)
+        logits = logits - presence_penalty[:, None] * seen - frequency_penalty[:, None] * token_counts
+    greedy = (temperature == 0.0) | (top_k == 1)
+    logits = logits / temperature.masked_fill(greedy, 1.0)[:, None]
+    vocab_size = logits.shape[-1]
+    # min-p: prob >= min_p * max prob
+    max_logits = logits.max(dim=-1).values
+    threshold = max_logits + torch.log(min_p)
+    # Take the top-k first, so that top-p only needs to look at the top-k candidates. Only rows
+    # with top-p and no top-k need the whole vocabulary.
+    has_top_k = (top_k > 0) & (top_k < vocab_size) & ~greedy
+    has_top_p = (top_p > 0.0) & (top_p < 1.0) & ~greedy
+    top_k = top_k.long().masked_fill(~has_top_k, vocab_size)
+    num_candidates = top_k.masked_fill(~(has_top_k | has_top_p), 1)
+    values = logits.topk(num_candidates.max().item(), dim=-1).values
+    idx = torch.arange(values.shape[-1], device=logits.device)
+    threshold_k = values.gather(1, (top_k[:, None] - 1).clamp(max=values.shape[-1] - 1))
+    threshold = torch.where(has_top_k, torch.maximum(threshold, threshold_k[:, 0]), threshold)
+    # top-p: keep the smallest set of top-k candidates that holds at least top_p of their mass
+    probs = torch.softmax(values.masked_fill(idx >= top_k[:, None], float("-inf")), dim=-1)
+    num_top_p = ((probs.cumsum(dim=-1) - probs) < top_p[:, None]).sum(dim=-1, keepdim=True)
+    threshold_p = values.gather(1, (num_top_p - 1).clamp(min=0))[:, 0]
+    threshold = torch.where(has_top_p, torch.maximum(threshold, threshold_p), threshold)
+    logits = logits.masked_fill(logits < threshold[:, None], float("-inf"))
+    sampled = torch.multinomial(torch.softmax(logits, dim=-1), num_samples=1).squeeze(dim=-1)
+    return torch.where(greedy, logits.argmax(dim=-1), sampled)
+
+
+def sample_batched(
+    logits,
+    temperature=1.0,
+    top_k=0,
+    top_p=0.0,
+    min_p=0.0,
+    token_counts=None,
+    repetition_penalty=1.0,
+    presence_penalty=0.0,
+    frequency_penalty=0.0,
+):
+    """Sample with different parameters for each row. Each parameter is either a number, used for
+    all rows, or a tensor of shape (batch_size,).
+    On GPU, penalties, temperature, filtering and sampling are fused in a single Triton kernel
+    that doesn't sort the vocabulary.
+    Arguments:
+        logits: Tensor of shape (batch_size, vocab_size)
+        temperature: 0.0 means greedy.
+        top_k: 0 means no top-k filtering. top_k = 1 means greedy.
+        top_p: 0.0 or 1.0 means no top-p filtering. Applied after top-k, as in sample().
+        min_p: keep the tokens whose prob is at least min_p times the largest prob.
+        token_counts (optional): (batch_size, vocab_size), the number of times each token has
+            appeared so far, for the repetition, presence and frequency penalties.
+    Return:
+        tokens: Tensor of shape (batch_size,)
+    """
+    batch_size = logits.shape[0]
+
+    def per_row(x, dtype):
+        if not isinstance(x, Tensor):
+            x = torch.tensor(x)
+        return x.to(device=logits.device, dtype=dtype).expand(batch_size).contiguous()
+
+    temperature, top_p, min_p = [per_row(x, torch.float32) for x in (temperature, top_p, min_p)]
+    top_k = per_row(top_k, torch.int32)
+    if token_counts is not None:
+        repetition_penalty, presence_penalty, frequency_penalty = [
+            per_row(x, torch.float32)
+            for x in (repetition_penalty, presence_penalty, frequency_penalty)
+        ]
+    else:
+        repetition_penalty = presence_penalty = frequency_penalty = None
+    sample_fn = sample_fused if logits.is_cuda and sample_fused is not None else _sample_batched_torch
+    return sample_fn(
+        logits,
+        temperature,
+        top_k,
+        top_p,
+        min_p,
+        token_counts=token_counts,
+        repetition_penalty=repetition_penalty,
+        presence_penalty=presence_penalty,
+        frequency_penalty=frequency_penalty,
+    )
+
+
 @torch.inference_mode()
 def decode(
     input_ids,
@@ -109,23 +247,62 @@ def decode(
     tensor_parallel=1,
     cg=False,
     enable_timing=False,
+    attention_mask=None,
+    stop_check_interval=1,
+    shared_prefix_len=0,
 ):
     """Decoding, either greedy or with top-k or top-p sampling.
     If top-k = 0, don't limit the number of candidates (pure sampling).
     Top-k and top-p can be used together. If top_k > 0 and top_p > 0, then top-k is applied first,
     then top-p.
-    We assume that all sequences in the same batch have the same length.
+    Sequences in the same batch can have prompts of different lengths: either pass input_ids as a
+    list of 1D tensors, or pass a padded tensor along with attention_mask. The prompts are then
+    processed without padding (this requires the model to use FlashAttention) and each sequence
+    continues from its own length.
 
     Arguments:
-        input_ids: (batch, seq_len)
+        input_ids: (batch, seq_len), or a list of (seq_len_i,) tensors
         max_length: int
         teacher_outputs (optional): (batch, seq_len). If provided, instead of sampling from the
-            logits, the next token is taken from the teacher_outputs. Useful for testing.
+            logits, the next token is taken from the teacher_outputs. Useful for testing. For
+            prompts of different lengths, each row is laid out like the returned sequences.
+        attention_mask (optional): (batch, seq_len), bool / int, 1 for prompt tokens and 0 for
+            padding.
+        stop_check_interval: if eos_token_id is not None, check whether all sequences have
+            produced EOS every this many steps. On GPU, the check doesn't synchronize with it.
+        shared_prefix_len: if > 0, the first shared_prefix_len tokens of input_ids are the same
+            for all sequences (e.g. a system prompt). They are processed once, and their KV cache
+            is stored once and read once per step for the whole batch (cascade attention).
+            Requires FlashAttention.
     Returns: GreedySearchDecoderOnlyOutput or SampleDecoderOnlyOutput, with the following fields:
-        sequences: (batch, max_length)
+        sequences: (batch, max_length). For prompts of different lengths, each row contains the
+            prompt directly followed by the generated tokens, right-padded with 0, and the
+            number of generated tokens is determined by the longest prompt.
         scores: tuples of (batch, vocab_size)
     """
-    batch_size, seqlen_og = input_ids.shape
+    if isinstance(input_ids, (list, tuple)):
+        seqlens = [ids.shape[0] for ids in input_ids]
+        attention_mask = torch.arange(max(seqlens), device=input_ids[0].device) < torch.tensor(
+            seqlens, device=input_ids[0].device
+        ).unsqueeze(1)
+        input_ids = torch.nn.utils.rnn.pad_sequence(list(input_ids), batch_first=True)
+    if attention_mask is not None:
+        input_ids_unpad, indices, cu_seqlens, seqlen_og, _ = unpad_input(
+            rearrange(input_ids, "b s -> b s 1"), attention_mask
+        )
+        input_ids_unpad = rearrange(input_ids_unpad, "t 1 -> 1 t")
+        prompt_seqlens = cu_seqlens[1:] - cu_seqlens[:-1]
+        # Position of each prompt token within its own sequence
+        position_ids_unpad = rearrange(
+            torch.arange(input_ids_unpad.shape[1], device=input_ids.device)
+            - torch.repeat_interleave(cu_seqlens[:-1], prompt_seqlens),
+            "t -> 1 t",
+        )
+        batch_size = input_ids.shape[0]
+    else:
+        batch_size, seqlen_og = input_ids.shape
+    # (batch,), the number of tokens of each sequence in the KV cache, for ragged prompts
+    cache_seqlens = None
     teacher_output_len = teacher_outputs.shape[1] if teacher_outputs is not None else 0
     if cg:
         if not hasattr(model, "_decoding_cache"):
@@ -146,15 +323,31 @@ def decode(
     def get_logits(input_ids, inference_params):
         decoding = inference_params.seqlen_offset > 0
         if decoding:
-            position_ids = torch.full(
-                (batch_size, 1),
-                inference_params.seqlen_offset,
-                dtype=torch.long,
-                device=input_ids.device,
-            )
+            if cache_seqlens is None:
+                # Several tokens after the shared prefix, or one token
+                position_ids = repeat(
+                    torch.arange(
+                        inference_params.seqlen_offset,
+                        inference_params.seqlen_offset + input_ids.shape[1],
+                        device=input_ids.device,
+                    ),
+                    "s -> b s",
+                    b=batch_size,
+                )
+            else:
+                position_ids = rearrange(cache_seqlens.long(), "b -> b 1")
         else:
             position_ids = None
-        if not cg or not decoding:
+        if not decoding and attention_mask is not None:
+            logits = model(
+                input_ids_unpad,
+                position_ids=position_ids_unpad,
+                inference_params=inference_params,
+                num_last_tokens=1,
+                cu_seqlens=cu_seqlens,
+                max_seqlen=seqlen_og,
+            ).logits.squeeze(dim=1)
+        elif not cg or not decoding:
             logits = model(
                 input_ids,
                 position_ids=position_ids,
@@ -163,27 +356,28 @@ def decode(
             ).logits.squeeze(dim=1)
         else:
             logits = model._decoding_cache.run(
-                input_ids, position_ids, inference_params.seqlen_offset
+                input_ids,
+                position_ids,
+                inference_params.seqlen_offset if cache_seqlens is None else cache_seqlens,
             ).squeeze(dim=1)
         return logits[..., :vocab_size] if vocab_size is not None else logits
 
     def sample_tokens(logits, inference_params):
-        if teacher_outputs is None or teacher_output_len <= inference_params.seqlen_offset:
+        if cache_seqlens is not None and teacher_outputs is not None:
+            # Each row continues from its own prompt length
+            token_idx = rearrange(cache_seqlens.long(), "b -> b 1")
+            token = torch.where(
+                token_idx[:, 0] < teacher_output_len,
+                teacher_outputs.gather(1, token_idx.clamp(max=teacher_output_len - 1))[:, 0],
+                sample(logits, top_k=top_k, top_p=top_p, temperature=temperature),
+            )
+        elif teacher_outputs is None or teacher_output_len <= inference_params.seqlen_offset:
             token = sample(logits, top_k=top_k, top_p=top_p, temperature=temperature)
         else:
             token = teacher_outputs[:, inference_params.seqlen_offset]
         # return rearrange(token, "b -> b 1")
         return token.unsqueeze(1)
 
-    def should_stop(current_token, inference_params):
-        if inference_params.seqlen_offset == 0:
-            return False
-        if eos_token_id is not None and (current_token == eos_token_id).all():
-            return True
-        if inference_params.seqlen_offset >= max_length - 1:
-            return True
-        return False
-
     start = torch.cuda.Event(enable_timing=enable_timing)
     end = torch.cuda.Event(enable_timing=enable_timing)
 
@@ -191,11 +385,73 @@ def decode(
         if tensor_parallel > 1:
             torch.distributed.barrier()
         start.record()
-    scores, sequences = [], [input_ids]
-    while not should_stop(sequences[-1], inference_params):
-        scores.append(get_logits(sequences[-1], inference_params))
-        inference_params.seqlen_offset += sequences[-1].shape[1]
-        sequences.append(sample_tokens(scores[-1], inference_params))
+    # The generated tokens and the stop flags stay on the device, so that the loop never waits
+    # for the GPU. Whether all sequences have finished is copied to pinned memory without
+    # blocking, and only read once the copy is done, so we might run a few steps too many.
+    max_new_tokens = max(max_length - seqlen_og, 1)
+    generated = torch.empty(
+        batch_size, max_new_tokens, dtype=input_ids.dtype, device=input_ids.device
+    )
+    if eos_token_id is not None:
+        finished = torch.zeros(batch_size, dtype=torch.bool, device=input_ids.device)
+        # Number of generated tokens of each sequence, up to and including its first EOS
+        num_generated_per_row = torch.zeros(batch_size, dtype=torch.long, device=input_ids.device)
+        if input_ids.is_cuda:
+            all_finished = torch.zeros((), dtype=torch.bool, pin_memory=True)
+        stop_check_event = None
+    scores, current_token = [], input_ids
+    if shared_prefix_len > 0:
+        assert attention_mask is None and not cg, "shared_prefix_len requires equal length prompts"
+        assert 0 < shared_prefix_len < seqlen_og
+        assert (input_ids[:, :shared_prefix_len] == input_ids[:1, :shared_prefix_len]).all()
+        # The prefix is processed for the first sequence only, then each sequence continues with
+        # its own tokens after the prefix.
+        model(
+            input_ids[:1, :shared_prefix_len], inference_params=inference_params, num_last_tokens=1
+        )
+        inference_params.set_shared_prefix(shared_prefix_len)
+        inference_params.seqlen_offset = shared_prefix_len
+        current_token = input_ids[:, shared_prefix_len:]
+    num_steps = 0
+    while num_steps < max_new_tokens:
+        scores.append(get_logits(current_token, inference_params))
+        if attention_mask is None:
+            inference_params.seqlen_offset += current_token.shape[1]
+        elif cache_seqlens is None:  # Just processed the ragged prompts
+            inference_params.seqlen_offset = seqlen_og
+            cache_seqlens = prompt_seqlens.clone()
+            if not cg:
+                inference_params.lengths_per_sample = cache_seqlens
+        else:
+            inference_params.seqlen_offset += 1
+            cache_seqlens += 1
+        token = sample_tokens(scores[-1], inference_params).squeeze(1)
+        if eos_token_id is not None:
+            # Sequences that have finished keep producing EOS
+            token = token.masked_fill(finished, eos_token_id)
+            num_generated_per_row.masked_fill_(~finished, num_steps + 1)
+            finished |= token == eos_token_id
+        generated[:, num_steps] = token
+        current_token = generated[:, num_steps : num_steps + 1]
+        num_steps += 1
+        if eos_token_id is not None and num_steps < max_new_tokens:
+            if not input_ids.is_cuda:
+                # Nothing to overlap on CPU, read the flags directly
+                if num_steps % stop_check_interval == 0 and finished.all():
+                    break
+            else:
+                if stop_check_event is None and num_steps % stop_check_interval == 0:
+                    all_finished.copy_(finished.all(), non_blocking=True)
+                    stop_check_event = torch.cuda.Event()
+                    stop_check_event.record()
+                if stop_check_event is not None and stop_check_event.query():
+                    stop_check_event = None
+                    if all_finished.item():
+                        break
+    if eos_token_id is not None:
+        # Drop the steps that were run after all sequences had finished
+        num_steps = num_generated_per_row.max().item()
+        generated, scores = generated[:, :num_steps], scores[:num_steps]
     if enable_timing:
         end.record()
         if tensor_parallel > 1:
@@ -203,7 +459,353 @@ def decode(
         torch.cuda.synchronize()
         print(f"Prompt processing + decoding time: {(start.elapsed_time(end)):.0f}ms")
     output_cls = GreedySearchDecoderOnlyOutput if top_k == 1 else SampleDecoderOnlyOutput
-    return output_cls(sequences=torch.cat(sequences, dim=1), scores=tuple(scores))
+    if attention_mask is None:
+        sequences = torch.cat([input_ids, generated], dim=1)
+    else:
+        num_generated = generated.shape[1]
+        sequences = torch.zeros(
+            batch_size, seqlen_og + num_generated, dtype=input_ids.dtype, device=input_ids.device
+        )
+        batch_idx = torch.repeat_interleave(
+            torch.arange(batch_size, device=input_ids.device), prompt_seqlens
+        )
+        sequences[batch_idx, position_ids_unpad[0]] = input_ids_unpad[0]
+        gen_idx = rearrange(prompt_seqlens.long(), "b -> b 1") + torch.arange(
+            num_generated, device=input_ids.device
+        )
+        sequences.scatter_(1, gen_idx, generated)
+    return output_cls(sequences=sequences, scores=tuple(scores))
+
+
+def _reorder_beam_slots(parents, beam_slots, key_value_memory_dict, slot_offsets, seqlen):
+    """Assign a row of the KV cache to each new beam without moving the KV cache of the beams
+    that are kept. The first child of each parent inherits the parent's row. The other children
+    (when beams diverge) take the rows that no child uses anymore, and the first seqlen entries of
+    the parent's KV cache are copied there (copy-on-write).
+
+    Arguments:
+        parents: (batch, num_beams), the beam (in 0..num_beams-1) that each new beam extends.
+        beam_slots: (batch, num_beams), the row of the KV cache of each beam, relative to the
+            first of the num_beams rows of its batch element.
+        slot_offsets: (batch, 1), the first row of the KV cache of each batch element.
+    Return:
+        new_beam_slots: (batch, num_beams)
+    """
+    num_beams = parents.shape[1]
+    parent_slots = beam_slots.gather(1, parents)
+    idx = torch.arange(num_beams, device=parents.device)
+    # A child is the first one of its parent if no earlier child has the same parent
+    is_first = ~((parents[:, :, None] == parents[:, None, :]) & (idx < idx[:, None])).any(dim=-1)
+    slot_used = torch.zeros_like(is_first).scatter_(1, parent_slots, True)
+    free_slots = torch.argsort(slot_used.to(torch.uint8), dim=1, stable=True)  # Unused rows first
+    rank = (torch.cumsum(~is_first, dim=1) - 1).clamp(min=0)
+    new_beam_slots = torch.where(is_first, parent_slots, free_slots.gather(1, rank))
+    copy_idx = (~is_first).nonzero(as_tuple=True)
+    if copy_idx[0].numel() > 0:
+        src = (slot_offsets + parent_slots)[copy_idx]
+        dst = (slot_offsets + new_beam_slots)[copy_idx]
+        for kv_cache in key_value_memory_dict.values():
+            kv_cache[dst, :seqlen] = kv_cache[src, :seqlen]
+    return new_beam_slots
+
+
+@torch.inference_mode()
+def beam_search(
+    input_ids,
+    model,
+    max_length,
+    num_beams,
+    length_penalty=1.0,
+    early_stopping=False,
+    eos_token_id=None,
+    pad_token_id=None,
+    num_return_sequences=1,
+    vocab_size=None,
+):
+    """Beam search where the KV cache stays in place: each beam addresses its row of the KV cache
+    through inference_params.cache_batch_idx, so reordering the beams only reorders that index
+    tensor. The KV cache is only copied when several beams extend the same parent.
+    The prompt is processed once per batch element. Requires the model to use FlashAttention.
+
+    Arguments:
+        input_ids: (batch, seq_len)
+        max_length: int
+        length_penalty: finished hypotheses are scored by sum of log-probs / length ** length_penalty,
+            where length is the number of generated tokens.
+        early_stopping: if True, a batch element is done as soon as there are num_beams finished
+            hypotheses. Otherwise, it is done when no running beam can get a better score than
+            the worst of the num_beams finished hypotheses.
+        pad_token_id: used to pad the hypotheses shorter than the longest. Defaults to
+            eos_token_id, or 0 if eos_token_id is None.
+    Returns: BeamSearchDecoderOnlyOutput, with the following fields:
+        sequences: (batch * num_return_sequences, seq_len + num_generated), the best hypotheses
+            of each batch element, best first.
+        sequences_scores: (batch * num_return_sequences,)
+    """
+    batch_size, seqlen_og = input_ids.shape
+    assert num_return_sequences <= num_beams
+    device = input_ids.device
+    if pad_token_id is None:
+        pad_token_id = eos_token_id if eos_token_id is not None else 0
+    max_new_tokens = max(max_length - seqlen_og, 1)
+    param = next(iter(model.parameters()))
+    inference_params = InferenceParams(
+        max_seqlen=max_length,
+        max_batch_size=batch_size * num_beams,
+        key_value_memory_dict=model.allocate_inference_cache(
+            batch_size * num_beams, max_length, dtype=param.dtype
+        ),
+    )
+    slot_offsets = torch.arange(batch_size, device=device)[:, None] * num_beams
+
+    def get_log_probs(input_ids, beam_slots, seqlen_offset):
+        inference_params.cache_batch_idx = (slot_offsets + beam_slots).flatten().to(torch.int32)
+        inference_params.lengths_per_sample = torch.full(
+            (input_ids.shape[0],), seqlen_offset, dtype=torch.int32, device=device
+        )
+        inference_params.seqlen_offset = seqlen_offset
+        position_ids = torch.arange(
+            seqlen_offset, seqlen_offset + input_ids.shape[1], device=device
+        ).expand_as(input_ids)
+        logits = model(
+            input_ids,
+            position_ids=position_ids,
+            inference_params=inference_params,
+            num_last_tokens=1,
+        ).logits.squeeze(dim=1)
+        logits = logits[..., :vocab_size] if vocab_size is not None else logits
+        return torch.log_softmax(logits.float(), dim=-1)
+
+    # Each batch element starts with a single live beam, in the first of its rows of the KV cache
+    beam_slots = torch.arange(num_beams, device=device).expand(batch_size, num_beams)
+    log_probs = repeat(get_log_probs(input_ids, beam_slots[:, :1], 0), "b v -> b k v", k=num_beams)
+    beam_scores = torch.zeros(batch_size, num_beams, device=device)
+    beam_scores[:, 1:] = float("-inf")
+    beam_tokens = torch.full(
+        (batch_size, num_beams, max_new_tokens), pad_token_id, dtype=torch.long, device=device
+    )
+    # The num_beams best finished hypotheses of each batch element, best first
+    hyp_scores = torch.full((batch_size, num_beams), float("-inf"), device=device)
+    hyp_tokens = beam_tokens.clone()
+    hyp_lengths = torch.zeros(batch_size, num_beams, dtype=torch.long, device=device)
+    done = torch.zeros(batch_size, dtype=torch.bool, device=device)
+
+    def add_hypotheses(scores, tokens, lengths):
+        nonlocal hyp_scores, hyp_tokens, hyp_lengths
+        hyp_scores, idx = torch.cat([hyp_scores, scores], dim=1).topk(num_beams, dim=1)
+        hyp_tokens = torch.cat([hyp_tokens, tokens], dim=1).gather(
+            1, repeat(idx, "b k -> b k l", l=max_new_tokens)
+        )
+        hyp_lengths = torch.cat([hyp_lengths, lengths], dim=1).gather(1, idx)
+
+    seqlen = seqlen_og
+    for step in range(max_new_tokens):
+        vocab = log_probs.shape[-1]
+        scores = rearrange(beam_scores[..., None] + log_probs, "b k v -> b (k v)")
+        cand_scores, cand_idx = scores.topk(2 * num_beams, dim=1)
+        cand_parents, cand_tokens = cand_idx // vocab, cand_idx % vocab
+        cand_history = beam_tokens.gather(1, repeat(cand_parents, "b c -> b c l", l=max_new_tokens))
+        cand_history[..., step] = cand_tokens
+        if eos_token_id is not None:
+            is_eos = cand_tokens == eos_token_id
+            # Only EOS candidates ranked among the top num_beams become hypotheses
+            is_hyp = is_eos & (torch.arange(2 * num_beams, device=device) < num_beams)
+            is_hyp &= ~done[:, None]
+            add_hypotheses(
+                torch.where(is_hyp, cand_scores / (step + 1) ** length_penalty, float("-inf")),
+                cand_history,
+                torch.full_like(cand_tokens, step + 1),
+            )
+            # The new beams are the num_beams best candidates that don't end with EOS
+            cand_scores, order = cand_scores.masked_fill(is_eos, float("-inf")).topk(
+                num_beams, dim=1
+            )
+        else:
+            order = torch.arange(num_beams, device=device).expand(batch_size, num_beams)
+            cand_scores = cand_scores[:, :num_beams]
+        beam_scores = cand_scores
+        parents, tokens = cand_parents.gather(1, order), cand_tokens.gather(1, order)
+        beam_tokens = cand_history.gather(1, repeat(order, "b k -> b k l", l=max_new_tokens))
+        if eos_token_id is not None:
+            if early_stopping:
+                done |= hyp_scores[:, -1] > float("-inf")
+            else:
+                best_running = beam_scores[:, 0] / (step + 1) ** length_penalty
+                done |= hyp_scores[:, -1] >= best_running
+        if step == max_new_tokens - 1 or done.all():
+            break
+        beam_slots = _reorder_beam_slots(
+            parents, beam_slots, inference_params.key_value_memory_dict, slot_offsets, seqlen
+        )
+        log_probs = rearrange(
+            get_log_probs(rearrange(tokens, "b k -> (b k) 1"), beam_slots, seqlen),
+            "(b k) v -> b k v",
+            k=num_beams,
+        )
+        seqlen += 1
+    # Batch elements that are not done yet also consider their running beams
+    add_hypotheses(
+        torch.where(done[:, None], float("-inf"), beam_scores / (step + 1) ** length_penalty),
+        beam_tokens,
+        torch.full_like(hyp_lengths, step + 1),
+    )
+    hyp_scores = hyp_scores[:, :num_return_sequences].flatten()
+    hyp_tokens = rearrange(hyp_tokens[:, :num_return_sequences], "b k l -> (b k) l")
+    num_generated = hyp_lengths[:, :num_return_sequences].max().item()
+    sequences = torch.cat(
+        [
+            repeat(input_ids, "b l -> (b k) l", k=num_return_sequences),
+            hyp_tokens[:, :num_generated],
+        ],
+        dim=1,
+    )
+    return BeamSearchDecoderOnlyOutput(sequences=sequences, sequences_scores=hyp_scores)
+
+
+@dataclass
+class GenerationStep:
+    """The tokens generated in one decoding step by the sequences that were still active."""
+
+    sequence_idx: List[int]  # Index of each sequence in the batch
+    tokens: List[int]
+    finished: List[bool]  # Whether the sequence stops after this token
+    logits: Optional[Tensor] = None  # (len(sequence_idx), vocab_size), if output_logits
+
+
+@torch.inference_mode()
+def decode_stream(
+    input_ids,
+    model,
+    max_new_tokens,
+    top_k=1,
+    top_p=0.0,
+    temperature=1.0,
+    eos_token_id=None,
+    stop_token_ids=None,
+    stop_strings=None,
+    tokenizer=None,
+    output_logits=False,
+    vocab_size=None,
+):
+    """Decoding that yields the new token of every active sequence after each step. Sequences that
+    have finished are removed from the batch, so later steps only run on the active ones: each
+    sequence keeps its row of the KV cache, which is addressed through
+    inference_params.cache_batch_idx. This requires the model to use FlashAttention.
+
+    Arguments:
+        input_ids: (batch, seq_len), or a list of (seq_len_i,) tensors
+        max_new_tokens: int, or a list with the max number of new tokens of each sequence.
+        stop_token_ids (optional): list of token id sequences. A sequence stops once its generated
+            tokens end with one of them.
+        stop_strings (optional): list of strings. A sequence stops once the text of its generated
+            tokens contains one of them. Requires tokenizer, to decode the last tokens.
+        output_logits: if True, return the logits of the active sequences at every step.
+    Yields: GenerationStep
+    """
+    if isinstance(input_ids, (list, tuple)):
+        prompt_seqlens = [ids.shape[0] for ids in input_ids]
+        batch_size, device = len(input_ids), input_ids[0].device
+    else:
+        batch_size, seqlen = input_ids.shape
+        prompt_seqlens, device = [seqlen] * batch_size, input_ids.device
+    if isinstance(max_new_tokens, int):
+        max_new_tokens = [max_new_tokens] * batch_size
+    assert len(max_new_tokens) == batch_size
+    assert stop_strings is None or tokenizer is not None, "stop_strings requires a tokenizer"
+    # Number of trailing tokens to decode to look for stop strings (a token is at least 1 char)
+    max_stop_len = max((len(s) for s in stop_strings), default=0) if stop_strings else 0
+    max_seqlen = max(l + n for l, n in zip(prompt_seqlens, max_new_tokens))
+    param = next(iter(model.parameters()))
+    inference_params = InferenceParams(
+        max_seqlen=max_seqlen,
+        max_batch_size=batch_size,
+        key_value_memory_dict=model.allocate_inference_cache(
+            batch_size, max_seqlen, dtype=param.dtype
+        ),
+    )
+
+    def get_logits(logits):
+        logits = logits[..., :vocab_size] if vocab_size is not None else logits
+        return logits.squeeze(dim=1)
+
+    # Prompts
+    if isinstance(input_ids, (list, tuple)):
+        cu_seqlens = F.pad(torch.tensor(prompt_seqlens, device=device).cumsum(0), (1, 0))
+        logits = model(
+            torch.cat(list(input_ids)).unsqueeze(0),
+            position_ids=torch.cat([torch.arange(l, device=device) for l in prompt_seqlens])[None],
+            inference_params=inference_params,
+            num_last_tokens=1,
+            cu_seqlens=cu_seqlens.to(torch.int32),
+            max_seqlen=max(prompt_seqlens),
+        ).logits
+    else:
+        logits = model(input_ids, inference_params=inference_params, num_last_tokens=1).logits
+    logits = get_logits(logits)
+    active = list(range(batch_size))
+    generated = [[] for _ in range(batch_size)]
+    # Rows of the KV cache of the active sequences, and their number of tokens in the KV cache
+    cache_batch_idx = torch.arange(batch_size, dtype=torch.int32, device=device)
+    cache_seqlens = torch.tensor(prompt_seqlens, dtype=torch.int32, device=device)
+    while True:
+        tokens = sample(logits, top_k=top_k, top_p=top_p, temperature=temperature)
+        tokens_host = tokens.tolist()
+        finished = []
+        for i, token in zip(active, tokens_host):
+            generated[i].append(token)
+            stop = len(generated[i]) >= max_new_tokens[i] or token == eos_token_id
+            if stop_token_ids is not None:
+                stop |= any(
+                    len(s) > 0 and generated[i][-len(s) :] == list(s) for s in stop_token_ids
+                )
+            if stop_strings is not None and not stop:
+                text = tokenizer.decode(generated[i][-max_stop_len - 1 :])
+                stop |= any(s in text for s in stop_strings)
+            finished.append(stop)
+        yield GenerationStep(
+            sequence_idx=active,
+            tokens=tokens_host,
+            finished=finished,
+            logits=logits if output_logits else None,
+        )
+        if not all(finished) and any(finished):
+            # Compact the batch, the KV cache stays in place
+            keep = torch.tensor(
+                [j for j, stop in enumerate(finished) if not stop], dtype=torch.long, device=device
+            )
+            cache_batch_idx, cache_seqlens, tokens = (
+                cache_batch_idx[keep], cache_seqlens[keep], tokens[keep]
+            )
+        active = [i for i, stop in zip(active, finished) if not stop]
+        if not active:
+            break
+        inference_params.cache_batch_idx = cache_batch_idx
+        inference_params.lengths_per_sample = cache_seqlens
+        inference_params.seqlen_offset = max(
+            prompt_seqlens[i] + len(generated[i]) - 1 for i in active
+        )
+        logits = get_logits(
+            model(
+                tokens.unsqueeze(1),
+                position_ids=cache_seqlens.long().unsqueeze(1),
+                inference_params=inference_params,
+                num_last_tokens=1,
+            ).logits
+        )
+        cache_seqlens = cache_seqlens + 1
+
+
+async def decode_stream_async(*args, **kwargs):
+    """Same as decode_stream, but each step runs in the default executor of the event loop, so
+    that the loop can serve other clients in the meantime."""
+    loop = asyncio.get_running_loop()
+    steps = decode_stream(*args, **kwargs)
+    done = object()
+    while True:
+        step = await loop.run_in_executor(None, next, steps, done)
+        if step is done:
+            break
+        yield step
 
 
 def sample_speculative(logits, logits_draft, tokens_draft, top_k=1, top_p=0.0, temperature=1.0):
@@ -576,8 +1178,12 @@ class GenerationMixin:
         temperature=1.0,
         return_dict_in_generate=False,
         output_scores=False,
+        num_beams=1,
         **kwargs,
     ):
+        if num_beams > 1:
+            output = beam_search(input_ids, self, max_length, num_beams, **kwargs)
+            return output if return_dict_in_generate else output.sequences
         output = decode(
             input_ids, self, max_length, top_k=top_k, top_p=top_p, temperature=temperature, **kwargs
         )
@@ -585,6 +1191,20 @@ class GenerationMixin:
             output.scores = None
         return output if return_dict_in_generate else output.sequences
 
+    def generate_stream(
+        self, input_ids, max_new_tokens, top_k=1, top_p=0.0, temperature=1.0, **kwargs
+    ):
+        """Yield the new tokens of the active sequences after every step, see decode_stream."""
+        return decode_stream(
+            input_ids,
+            self,
+            max_new_tokens,
+            top_k=top_k,
+            top_p=top_p,
+            temperature=temperature,
+            **kwargs,
+        )
+
 
 def allocate_inference_cache(
     max_batch_size,
@@ -609,11 +1229,37 @@ class DecodingCGCache:
     device = None
     dtype = None
     callables: dict = field(default_factory=dict)
+    batch_size_buckets: tuple = ()
+    decoding_seqlens: tuple = ()
     mempool = None
     inference_params: Optional[InferenceParams] = None
     run: Optional[Callable] = None
 
 
+def get_batch_size_buckets(max_batch_size):
+    """Powers of 2 up to max_batch_size, and max_batch_size."""
+    buckets = [1 << i for i in range(max_batch_size.bit_length()) if 1 << i < max_batch_size]
+    return tuple(buckets + [max_batch_size])
+
+
+def pad_to_bucket(input_ids, position_ids, seqlen, batch_size_buckets):
+    """Pad the batch dimension of input_ids, position_ids, and seqlen if it's a tensor, to the
+    smallest bucket that fits the batch. The padding rows use position 0 (and seqlen 0).
+    Return:
+        input_ids, position_ids, seqlen, bucket
+    """
+    batch_size = input_ids.shape[0]
+    bucket = next((b for b in sorted(batch_size_buckets) if b >= batch_size), None)
+    assert bucket is not None, f"No CUDA graph for batch size {batch_size}"
+    if bucket > batch_size:
+        padding = (0, 0, 0, bucket - batch_size)
+        input_ids = F.pad(input_ids, padding)
+        position_ids = F.pad(position_ids, padding)
+        if isinstance(seqlen, Tensor):
+            seqlen = F.pad(seqlen, (0, bucket - batch_size))
+    return input_ids, position_ids, seqlen, bucket
+
+
 @torch.inference_mode()
 def update_graph_cache(
     model,
@@ -625,26 +1271,51 @@ def update_graph_cache(
     tensor_parallel=1,
     dtype=None,
     n_warmups=2,
+    batch_size_buckets=None,
+    capture_fn=None,
 ):
+    """
+    Arguments:
+        batch_size_buckets: the batch sizes to capture graphs for, e.g.
+            get_batch_size_buckets(max_batch_size). A batch is padded to the smallest bucket that
+            fits it, so that the batch size can change from step to step (e.g. with continuous
+            batching) without capturing new graphs. The graphs of all buckets share one memory pool
+            and one KV cache, allocated for the largest bucket plus one scratch row: the padding
+            rows read and write the scratch row, so they never touch the KV cache of the rows
+            after the batch. Graphs that were already captured are kept as long as the KV cache
+            doesn't need to grow, and a graph is captured for every pair of bucket and decoding
+            seqlen seen so far. If None, use (batch_size,).
+        capture_fn: defaults to capture_graph, can be replaced e.g. to test without a GPU.
+    """
     if cache is None:
         cache = DecodingCGCache()
+    if capture_fn is None:
+        capture_fn = capture_graph
+    if batch_size_buckets is None:
+        batch_size_buckets = (batch_size,)
+    buckets = tuple(sorted(set(batch_size_buckets)))
+    assert batch_size <= buckets[-1], "batch_size must fit in the largest bucket"
+    max_batch_size = max(buckets[-1], cache.max_batch_size)
     param_example = next(iter(model.parameters()))
     device = param_example.device
     if dtype is None:
         dtype = param_example.dtype
     if (
         (device, dtype) != (cache.device, cache.dtype)
-        or batch_size > cache.max_batch_size
+        or max_batch_size > cache.max_batch_size
         or max_seqlen > cache.max_seqlen
     ):  # Invalidate the cache
         cache.callables = {}
+        cache.batch_size_buckets = ()
+        cache.decoding_seqlens = ()
         cache.mempool = None
         cache.inference_params = None
         gc.collect()
         cache.device, cache.dtype = device, dtype
-        cache.max_batch_size, cache.max_seqlen = batch_size, max_seqlen
+        cache.max_batch_size, cache.max_seqlen = max_batch_size, max_seqlen
+        # The last row of the KV cache is the scratch row of the padding rows
         if hasattr(model, "allocate_inference_cache"):
-            inf_cache = model.allocate_inference_cache(batch_size, max_seqlen, dtype)
+            inf_cache = model.allocate_inference_cache(max_batch_size + 1, max_seqlen, dtype)
         else:
             headdim = getattr(
                 model.config,
@@ -652,7 +1323,7 @@ def update_graph_cache(
                 model.config.hidden_size // model.config.num_attention_heads,
             )
             inf_cache = allocate_inference_cache(
-                batch_size,
+                max_batch_size + 1,
                 max_seqlen,
                 model.config.num_attention_heads // tensor_parallel,
                 headdim,
@@ -660,30 +1331,42 @@ def update_graph_cache(
                 device,
                 dtype,
             )
-        lengths_per_sample = torch.full((batch_size,), seqlen_og, dtype=torch.int32, device=device)
+        lengths_per_sample = torch.full(
+            (max_batch_size + 1,), seqlen_og, dtype=torch.int32, device=device
+        )
         cache.inference_params = InferenceParams(
             max_seqlen=max_seqlen,
-            max_batch_size=batch_size,
+            max_batch_size=max_batch_size + 1,
             seqlen_offset=seqlen_og,
             key_value_memory_dict=inf_cache,
             lengths_per_sample=lengths_per_sample,
         )
-        cache.mempool = torch.cuda.graphs.graph_pool_handle()
-    for decoding_seqlen in decoding_seqlens:
-        if (batch_size, decoding_seqlen) not in cache.callables:
-            cache.callables[batch_size, decoding_seqlen] = capture_graph(
-                model,
-                cache.inference_params,
-                batch_size,
-                max_seqlen,
-                decoding_seqlen=decoding_seqlen,
-                mempool=cache.mempool,
-                n_warmups=n_warmups,
-            )
+        cache.mempool = torch.cuda.graphs.graph_pool_handle() if device.type == "cuda" else None
+    cache.batch_size_buckets = tuple(sorted(set(cache.batch_size_buckets) | set(buckets)))
+    cache.decoding_seqlens = tuple(sorted(set(cache.decoding_seqlens) | set(decoding_seqlens)))
+    # Capture the largest batch first, so that the smaller ones can reuse its memory in the pool
+    for bucket in reversed(cache.batch_size_buckets):
+        for decoding_seqlen in cache.decoding_seqlens:
+            if (bucket, decoding_seqlen) not in cache.callables:
+                cache.callables[bucket, decoding_seqlen] = capture_fn(
+                    model,
+                    cache.inference_params,
+                    bucket,
+                    max_seqlen,
+                    decoding_seqlen=decoding_seqlen,
+                    mempool=cache.mempool,
+                    n_warmups=n_warmups,
+                    scratch_row=cache.max_batch_size,
+                )
 
     def dispatch(input_ids, position_ids, seqlen):
         batch_size, decoding_seqlen = input_ids.shape[:2]
-        return cache.callables[batch_size, decoding_seqlen](input_ids, position_ids, seqlen)
+        input_ids, position_ids, seqlen, bucket = pad_to_bucket(
+            input_ids, position_ids, seqlen, cache.batch_size_buckets
+        )
+        return cache.callables[bucket, decoding_seqlen](
+            input_ids, position_ids, seqlen, num_rows=batch_size
+        )[:batch_size]
 
     cache.run = dispatch
     cache.inference_params.seqlen_offset = 0  # Reset so it's not confusing
@@ -691,14 +1374,27 @@ def update_graph_cache(
 
 
 def capture_graph(
-    model, inference_params, batch_size, max_seqlen, decoding_seqlen=1, mempool=None, n_warmups=2
+    model,
+    inference_params,
+    batch_size,
+    max_seqlen,
+    decoding_seqlen=1,
+    mempool=None,
+    n_warmups=2,
+    scratch_row=None,
 ):
+    """If scratch_row is not None, run() can be given a batch whose rows past num_rows are
+    padding: they read and write row scratch_row of the KV cache instead of their own row."""
     device = next(iter(model.parameters())).device
     input_ids = torch.full((batch_size, decoding_seqlen), 0, dtype=torch.long, device=device)
     position_ids = torch.full((batch_size, decoding_seqlen), 0, dtype=torch.long, device=device)
     seqlen_offset_og = inference_params.seqlen_offset
     inference_params.seqlen_offset = max_seqlen - decoding_seqlen
     inference_params.lengths_per_sample[:] = inference_params.seqlen_offset
+    if scratch_row is not None:
+        rows = torch.arange(batch_size, dtype=torch.int32, device=device)
+        cache_batch_idx = rows.clone()
+        inference_params.cache_batch_idx = cache_batch_idx
 
     # Warmup before capture
     s = torch.cuda.Stream()
@@ -729,12 +1425,18 @@ def capture_graph(
             num_last_tokens=decoding_seqlen,
         ).logits
 
-    def run(new_input_ids, new_position_ids, seqlen):
-        inference_params.lengths_per_sample[:] = seqlen
+    def run(new_input_ids, new_position_ids, seqlen, num_rows=None):
+        # seqlen: int, or (batch_size,) tensor if the sequences have different lengths
+        inference_params.lengths_per_sample[:batch_size] = seqlen
+        if scratch_row is not None:
+            num_rows = batch_size if num_rows is None else num_rows
+            inference_params.lengths_per_sample[num_rows:batch_size] = 0
+            torch.where(rows < num_rows, rows, scratch_row, out=cache_batch_idx)
         input_ids.copy_(new_input_ids)
         position_ids.copy_(new_position_ids)
         graph.replay()
         return logits.clone()
 
     inference_params.seqlen_offset = seqlen_offset_og
+    inference_params.cache_batch_idx = None
     return run
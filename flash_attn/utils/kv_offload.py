@@ -0,0 +1,240 @@
+# Copyright (c) 2024, Tri Dao.
+import os
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+import torch
+from torch import Tensor
+
+
+@dataclass
+class OffloadedKV:
+    """The KV cache of one sequence, for all layers, in host memory or in a file on disk."""
+
+    shape: tuple  # (num_layers, seqlen, 2, nheads, headdim)
+    dtype: torch.dtype
+    host: Optional[Tensor] = None  # Pinned if the KV cache is on GPU
+    disk_path: Optional[str] = None
+    event: Optional[torch.cuda.Event] = None  # Recorded after the copy from GPU
+    write: Optional[Future] = None  # Write to disk_path, in the background
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape)) * torch.empty((), dtype=self.dtype).element_size()
+
+
+class TieredKVCache:
+    """Offload the KV cache of idle sequences (e.g. between turns of a chat) out of the GPU KV
+    cache, instead of keeping it resident or recomputing it from the prompt.
+
+    The KV cache of a sequence is first copied to pinned host memory, on a side stream so that it
+    overlaps with the decoding of the other sequences. When the host tier is over budget, the least
+    recently used sequences move to memory-mapped files in disk_dir, and when the disk tier is over
+    budget the least recently used sequences are dropped (and have to be prefilled again). The
+    writes to disk happen on a background thread, so evicting from the host tier doesn't block the
+    caller on the copy from GPU or on disk I/O; the host memory of an evicted sequence is released
+    once it's written.
+    Before the next turn of a sequence, prefetch copies its KV cache back into a row of the GPU KV
+    cache, again on the side stream.
+
+    Copies are asynchronous on GPU: call wait(seq_id) before reusing the row of an offloaded
+    sequence, or before attending to the row of a prefetched sequence. On CPU all copies are
+    synchronous, so the host and disk tiers can be used without a GPU.
+
+    Arguments:
+        host_max_bytes: budget of the pinned host memory tier.
+        disk_max_bytes: budget of the disk tier. 0 disables the disk tier.
+        disk_dir: directory for the memory-mapped files of the disk tier.
+    """
+
+    def __init__(self, host_max_bytes, disk_max_bytes=0, disk_dir=None):
+        assert disk_max_bytes == 0 or disk_dir is not None
+        self.host_max_bytes = host_max_bytes
+        self.disk_max_bytes = disk_max_bytes
+        self.disk_dir = disk_dir
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+        # Least recently used first
+        self.host_entries = OrderedDict()
+        self.disk_entries = OrderedDict()
+        self.host_bytes = 0
+        self.disk_bytes = 0
+        self._streams = {}
+        # Copies that are still in flight, and the tensors they read from or write to
+        self._pending = {}
+        self._next_file_idx = 0
+        self._writer = ThreadPoolExecutor(max_workers=1) if disk_max_bytes > 0 else None
+
+    def _stream(self, device):
+        if device not in self._streams:
+            self._streams[device] = torch.cuda.Stream(device=device)
+        return self._streams[device]
+
+    def tier(self, seq_id):
+        """Return "host", "disk", or None if the sequence is not offloaded."""
+        if seq_id in self.host_entries:
+            return "host"
+        if seq_id in self.disk_entries:
+            return "disk"
+        return None
+
+    def offload(self, seq_id, key_value_memory_dict, slot, seqlen):
+        """Copy the first seqlen tokens of row slot of the KV cache to host memory.
+        Arguments:
+            key_value_memory_dict: dict from layer_idx to (batch_size, max_seqlen, 2, nheads,
+                headdim), e.g. inference_params.key_value_memory_dict.
+        """
+        self.drop(seq_id)
+        self._prune_pending()
+        kv_caches = [kv_cache[slot, :seqlen] for kv_cache in key_value_memory_dict.values()]
+        assert all(kv.shape == kv_caches[0].shape for kv in kv_caches)
+        device = kv_caches[0].device
+        entry = OffloadedKV(shape=(len(kv_caches), *kv_caches[0].shape), dtype=kv_caches[0].dtype)
+        entry.host = torch.empty(
+            entry.shape, dtype=entry.dtype, pin_memory=device.type == "cuda"
+        )
+        if device.type == "cuda":
+            stream = self._stream(device)
+            # Wait for the KV cache to be written
+            stream.wait_stream(torch.cuda.current_stream(device))
+            with torch.cuda.stream(stream):
+                for i, kv in enumerate(kv_caches):
+                    entry.host[i].copy_(kv, non_blocking=True)
+                entry.event = torch.cuda.Event()
+                entry.event.record(stream)
+            self._pending[seq_id] = (entry.event, device, kv_caches)
+        else:
+            for i, kv in enumerate(kv_caches):
+                entry.host[i].copy_(kv)
+        self._add_to_host(seq_id, entry)
+
+    def prefetch(self, seq_id, key_value_memory_dict, slot):
+        """Copy the KV cache of an offloaded sequence back into row slot of the KV cache, and
+        remove it from the offload tiers.
+        Return:
+            seqlen: the number of tokens of the sequence in the KV cache, or None if the sequence
+                is not offloaded (e.g. it was dropped), in which case it has to be prefilled again.
+        """
+        tier = self.tier(seq_id)
+        if tier is None:
+            return None
+        self._prune_pending()
+        if tier == "disk":
+            entry = self.disk_entries.pop(seq_id)
+            self.disk_bytes -= entry.nbytes
+            if self._cancel_write(entry):  # Still in host memory
+                host = entry.host
+            else:
+                host = self._read_from_disk(entry, pin_memory=self._is_cuda(key_value_memory_dict))
+        else:
+            entry = self.host_entries.pop(seq_id)
+            self.host_bytes -= entry.nbytes
+            host = entry.host
+        num_layers, seqlen = entry.shape[:2]
+        kv_caches = [kv_cache[slot, :seqlen] for kv_cache in key_value_memory_dict.values()]
+        assert len(kv_caches) == num_layers
+        if self._is_cuda(key_value_memory_dict):
+            device = kv_caches[0].device
+            stream = self._stream(device)
+            # Wait for the previous user of the row, and for the copy to host if it's in flight
+            stream.wait_stream(torch.cuda.current_stream(device))
+            if entry.event is not None:
+                stream.wait_event(entry.event)
+            with torch.cuda.stream(stream):
+                for i, kv in enumerate(kv_caches):
+                    kv.copy_(host[i], non_blocking=True)
+                event = torch.cuda.Event()
+                event.record(stream)
+            self._pending[seq_id] = (event, device, host)
+        else:
+            for i, kv in enumerate(kv_caches):
+                kv.copy_(host[i])
+        return seqlen
+
+    def wait(self, seq_id):
+        """Make the current stream wait for the copy to or from the GPU of seq_id, if any.
+        Doesn't block the host."""
+        if seq_id in self._pending:
+            event, device, _ = self._pending.pop(seq_id)
+            torch.cuda.current_stream(device).wait_event(event)
+
+    def drop(self, seq_id):
+        if seq_id in self.host_entries:
+            self.host_bytes -= self.host_entries.pop(seq_id).nbytes
+        if seq_id in self.disk_entries:
+            entry = self.disk_entries.pop(seq_id)
+            self.disk_bytes -= entry.nbytes
+            if not self._cancel_write(entry):
+                os.remove(entry.disk_path)
+
+    def flush(self):
+        """Wait for all the writes to disk."""
+        for entry in list(self.disk_entries.values()):
+            if entry.write is not None:
+                entry.write.result()
+
+    def touch(self, seq_id):
+        """Mark the sequence as recently used, e.g. when a new turn is expected soon."""
+        for entries in [self.host_entries, self.disk_entries]:
+            if seq_id in entries:
+                entries.move_to_end(seq_id)
+
+    def _prune_pending(self):
+        """Forget the copies that are done, there's nothing to wait for."""
+        self._pending = {k: v for k, v in self._pending.items() if not v[0].query()}
+
+    @staticmethod
+    def _is_cuda(key_value_memory_dict):
+        return next(iter(key_value_memory_dict.values())).is_cuda
+
+    def _add_to_host(self, seq_id, entry):
+        self.host_entries[seq_id] = entry
+        self.host_bytes += entry.nbytes
+        while self.host_bytes > self.host_max_bytes:
+            evicted_id, evicted = self.host_entries.popitem(last=False)
+            self.host_bytes -= evicted.nbytes
+            self._add_to_disk(evicted_id, evicted)
+
+    def _add_to_disk(self, seq_id, entry):
+        if entry.nbytes > self.disk_max_bytes:
+            return  # Dropped
+        while self.disk_bytes + entry.nbytes > self.disk_max_bytes:
+            self.drop(next(iter(self.disk_entries)))
+        entry.disk_path = os.path.join(self.disk_dir, f"kv_{self._next_file_idx}.bin")
+        self._next_file_idx += 1
+        entry.write = self._writer.submit(self._write_to_disk, entry)
+        self.disk_entries[seq_id] = entry
+        self.disk_bytes += entry.nbytes
+
+    @staticmethod
+    def _write_to_disk(entry):
+        # Runs on the writer thread
+        if entry.event is not None:
+            entry.event.synchronize()  # The copy to host has to be done before writing to disk
+        data = np.memmap(entry.disk_path, dtype=np.uint8, mode="w+", shape=(entry.nbytes,))
+        data[:] = entry.host.view(-1).view(torch.uint8).numpy()
+        data.flush()
+        del data
+        entry.host, entry.event = None, None
+
+    @staticmethod
+    def _cancel_write(entry):
+        """Cancel the write of entry to disk if it hasn't started, otherwise wait for it.
+        Return: whether it was cancelled, i.e. the KV cache is in entry.host and not on disk."""
+        if entry.write is not None and entry.write.cancel():
+            return True
+        if entry.write is not None:
+            entry.write.result()
+        return False
+
+    @staticmethod
+    def _read_from_disk(entry, pin_memory=False):
+        host = torch.empty(entry.shape, dtype=entry.dtype, pin_memory=pin_memory)
+        data = np.memmap(entry.disk_path, dtype=np.uint8, mode="r", shape=(entry.nbytes,))
+        np.copyto(host.view(-1).view(torch.uint8).numpy(), data)
+        del data
+        os.remove(entry.disk_path)
+        return host
@@ -1,8 +1,15 @@
+import hashlib
+import json
 import os
+from contextlib import contextmanager
 from functools import partial
 
+import numpy as np
 import torch
+import torch.nn as nn
 from safetensors.torch import load_file as safe_load_file
+from safetensors.torch import save_file as save_safe_file
+from torch.nn.modules.module import _IncompatibleKeys
 from transformers.utils import (
     SAFE_WEIGHTS_INDEX_NAME,
     SAFE_WEIGHTS_NAME,
@@ -12,9 +19,70 @@ from transformers.utils import (
 from transformers.utils.hub import cached_file, get_checkpoint_shard_files
 
 
-def state_dict_from_pretrained(model_name, device=None, dtype=None):
-    # If not fp32, then we don't want to load directly to the GPU
-    mapped_device = "cpu" if dtype not in [torch.float32, None] else device
+# Bump when the layout of converted checkpoints changes, to invalidate the cached ones
+CONVERTED_CHECKPOINT_VERSION = 1
+
+_SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+def _read_safetensors_header(path):
+    """Return the length in bytes of the header of a safetensors file, and the header."""
+    with open(path, "rb") as f:
+        header_len = int.from_bytes(f.read(8), "little")
+        return header_len, json.loads(f.read(header_len))
+
+
+def mmap_safetensors(path):
+    """Load a safetensors file as views of a (copy-on-write) memory map of the file. Nothing is
+    read until a tensor is used, only the pages that are used are read, and the page cache is
+    shared by all the processes that map the same file (e.g. the ranks of a tensor parallel job).
+    """
+    header_len, header = _read_safetensors_header(path)
+    header.pop("__metadata__", None)
+    if os.path.getsize(path) == 8 + header_len:  # No tensor data, can't map an empty range
+        return {
+            name: torch.empty(info["shape"], dtype=_SAFETENSORS_DTYPES[info["dtype"]])
+            for name, info in header.items()
+        }
+    data = torch.from_numpy(np.memmap(path, dtype=np.uint8, mode="c", offset=8 + header_len))
+    state_dict = {}
+    for name, info in header.items():
+        dtype = _SAFETENSORS_DTYPES[info["dtype"]]
+        start, end = info["data_offsets"]
+        x = data[start:end]
+        if start % torch.empty(0, dtype=dtype).element_size() != 0 or end == start:
+            x = x.clone()  # Viewing as a larger dtype requires an aligned offset
+        state_dict[name] = x.view(dtype).view(info["shape"])
+    return state_dict
+
+
+def _torch_load_mmap(path):
+    """Load a .bin checkpoint (saved with torch.save) as a memory map of the file, like
+    mmap_safetensors. Checkpoints in the legacy (non-zipfile) format, or with torch < 2.1, can't be
+    memory-mapped and are read instead.
+    """
+    if torch.__version__ >= "2.1":
+        try:
+            return torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+        except RuntimeError:  # Legacy format
+            pass
+    return torch.load(path, map_location="cpu")
+
+
+def _resolve_checkpoint_files(model_name):
+    """Return the list of files of the checkpoint (several if it's sharded), and whether they're
+    safetensors files. Download them from the HF hub if needed."""
     is_sharded = False
     load_safe = False
     resolved_archive_file = None
@@ -56,24 +124,192 @@ def state_dict_from_pretrained(model_name, device=None, dtype=None):
     if resolved_archive_file is None:
         raise EnvironmentError(f"Model name {model_name} was not found.")
 
-    if load_safe:
-        loader = partial(safe_load_file, device=mapped_device)
-    else:
-        loader = partial(torch.load, map_location=mapped_device)
-
     if is_sharded:
         # resolved_archive_file becomes a list of files that point to the different
         # checkpoint shards in this case.
         resolved_archive_file, sharded_metadata = get_checkpoint_shard_files(
             model_name, resolved_archive_file
         )
-        state_dict = {}
-        for sharded_file in resolved_archive_file:
-            state_dict.update(loader(sharded_file))
+        return resolved_archive_file, load_safe
+    return [resolved_archive_file], load_safe
+
+
+def state_dict_from_pretrained(model_name, device=None, dtype=None, mmap=False):
+    """
+    Arguments:
+        mmap: if True, the checkpoint is memory-mapped instead of read (see mmap_safetensors,
+            and _torch_load_mmap for .bin checkpoints), and device and dtype are ignored: the
+            tensors stay views of the files, to be converted one at a time, e.g. by
+            load_state_dict_streaming. Note that the remap_state_dict_hf_* functions run on the
+            whole state dict before it's loaded, and the weights they concatenate or permute (e.g.
+            Wqkv from the q, k, v projections of Llama) are copied into host memory, all at once.
+    """
+    # If not fp32, then we don't want to load directly to the GPU
+    mapped_device = "cpu" if dtype not in [torch.float32, None] else device
+    resolved_archive_files, load_safe = _resolve_checkpoint_files(model_name)
+
+    if load_safe and mmap:
+        loader = mmap_safetensors
+    elif mmap:
+        loader = _torch_load_mmap
+    elif load_safe:
+        loader = partial(safe_load_file, device=mapped_device)
     else:
-        state_dict = loader(resolved_archive_file)
+        loader = partial(torch.load, map_location=mapped_device)
+
+    state_dict = {}
+    for resolved_archive_file in resolved_archive_files:
+        state_dict.update(loader(resolved_archive_file))
+    if mmap:
+        return state_dict
     # Convert dtype before moving to GPU to save memory
     if dtype is not None:
         state_dict = {k: v.to(dtype=dtype) for k, v in state_dict.items()}
     state_dict = {k: v.to(device=device) for k, v in state_dict.items()}
     return state_dict
+
+
+def checkpoint_fingerprint(model_name):
+    """Hash of the files of a checkpoint, without reading them: their resolved paths (in the HF
+    hub cache, files are links to blobs named after the hash of their content), sizes and
+    modification times."""
+    resolved_archive_files, _ = _resolve_checkpoint_files(model_name)
+    h = hashlib.sha256()
+    for path in resolved_archive_files:
+        stat = os.stat(path)
+        h.update(f"{os.path.realpath(path)}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return h.hexdigest()
+
+
+def _converted_checkpoint_entry(cache_dir, model_name, config, dtype, world_size, rank):
+    """Path of the converted checkpoint of this rank, and the metadata it must have."""
+    metadata = {
+        "format_version": str(CONVERTED_CHECKPOINT_VERSION),
+        "source": checkpoint_fingerprint(model_name),
+        "config": config.to_json_string(),
+        "dtype": str(dtype),
+        "world_size": str(world_size),
+    }
+    key = hashlib.sha256(json.dumps(metadata, sort_keys=True).encode()).hexdigest()[:16]
+    path = os.path.join(
+        cache_dir,
+        f"{model_name.strip('/').replace('/', '--')}-{key}",
+        f"rank{rank}-of-{world_size}.safetensors",
+    )
+    return path, {**metadata, "rank": str(rank)}
+
+
+def load_converted_checkpoint(cache_dir, model_name, config, dtype=None, world_size=1, rank=0):
+    """Load the state dict of this rank saved by save_converted_checkpoint, memory-mapped.
+    Return None if it's not in the cache, or if it was converted from a different checkpoint or
+    with a different config, dtype or tensor parallel degree.
+    """
+    path, metadata = _converted_checkpoint_entry(
+        cache_dir, model_name, config, dtype, world_size, rank
+    )
+    if not os.path.isfile(path):
+        return None
+    _, header = _read_safetensors_header(path)
+    if header.get("__metadata__") != metadata:
+        return None
+    return mmap_safetensors(path)
+
+
+def save_converted_checkpoint(
+    state_dict, cache_dir, model_name, config, dtype=None, world_size=1, rank=0
+):
+    """Save the state dict of this rank, already remapped (and sharded if world_size > 1), so
+    that the next load_converted_checkpoint with the same arguments doesn't need to convert the
+    original checkpoint again. The file is written atomically, so concurrent workers can share
+    cache_dir.
+    Return:
+        The saved state dict, memory-mapped.
+    """
+    path, metadata = _converted_checkpoint_entry(
+        cache_dir, model_name, config, dtype, world_size, rank
+    )
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Copy, since safetensors doesn't store tensors that share memory (e.g. tied embeddings)
+    state_dict = {
+        k: v.to(dtype=dtype if dtype is not None else v.dtype, copy=True).contiguous()
+        for k, v in state_dict.items()
+    }
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    save_safe_file(state_dict, tmp_path, metadata=metadata)
+    os.replace(tmp_path, path)
+    del state_dict
+    return mmap_safetensors(path)
+
+
+@contextmanager
+def init_empty_weights():
+    """Parameters of the modules constructed in this context are moved to the meta device as soon
+    as they're registered, so they're neither kept in memory nor initialized (initialization of
+    meta tensors is a no-op). Buffers, which are usually computed rather than loaded (e.g. the
+    inverse frequencies of rotary embeddings), are created as usual.
+    Use load_state_dict_streaming(..., device=device) to materialize the parameters.
+    """
+    register_parameter = nn.Module.register_parameter
+
+    def register_empty_parameter(module, name, param):
+        register_parameter(module, name, param)
+        if param is not None and not param.is_meta:
+            meta_param = type(param)(param.to("meta"), requires_grad=param.requires_grad)
+            meta_param.__dict__.update(param.__dict__)
+            module._parameters[name] = meta_param
+
+    nn.Module.register_parameter = register_empty_parameter
+    try:
+        yield
+    finally:
+        nn.Module.register_parameter = register_parameter
+
+
+@torch.no_grad()
+def load_state_dict_streaming(model, state_dict, strict=True, device=None):
+    """Same as model.load_state_dict, but the tensors of state_dict are converted to the dtype and
+    device of the parameters one at a time, and removed from state_dict once copied. With a
+    memory-mapped state_dict (state_dict_from_pretrained(..., mmap=True)), the checkpoint is
+    never fully in host memory, and each tensor parallel rank only reads its own slices.
+
+    Parameters on the meta device (see init_empty_weights) are allocated on device right before
+    their values are copied, so they're never initialized. Tied parameters stay tied.
+
+    This function modifies state_dict in place.
+    """
+    model_state_dict = model.state_dict(keep_vars=True)
+    # Parameters on the meta device, and the modules that hold them
+    meta_params = {}
+    for module in model.modules():
+        for name, param in module._parameters.items():
+            if param is not None and param.is_meta:
+                meta_params.setdefault(id(param), []).append((module, name))
+    materialized = {}
+    missing_keys = [k for k in model_state_dict if k not in state_dict]
+    unexpected_keys = [k for k in state_dict if k not in model_state_dict]
+    if strict and (missing_keys or unexpected_keys):
+        raise RuntimeError(
+            f"Error(s) in loading state_dict for {model.__class__.__name__}: "
+            f"missing keys {missing_keys}, unexpected keys {unexpected_keys}"
+        )
+    for key, param in model_state_dict.items():
+        if key in state_dict:
+            value = state_dict.pop(key)
+            if value.shape != param.shape:
+                raise RuntimeError(
+                    f"size mismatch for {key}: copying a param with shape {tuple(value.shape)}, "
+                    f"the shape in current model is {tuple(param.shape)}"
+                )
+            if param.is_meta:
+                if id(param) not in materialized:
+                    assert device is not None, f"{key} is on the meta device, device is required"
+                    new_param = type(param)(
+                        torch.empty_like(param, device=device), requires_grad=param.requires_grad
+                    )
+                    new_param.__dict__.update(param.__dict__)
+                    for module, name in meta_params[id(param)]:
+                        module._parameters[name] = new_param
+                    materialized[id(param)] = new_param
+                param = materialized[id(param)]
+            param.copy_(value)
+    return _IncompatibleKeys(missing_keys, unexpected_keys)
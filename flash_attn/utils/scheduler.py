@@ -0,0 +1,269 @@
+# Copyright (c) 2024, Tri Dao.
+import math
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+import torch
+from torch import Tensor
+
+from flash_attn.utils.generation import InferenceParams, sample
+
+
+@dataclass
+class SequenceState:
+    request_id: int
+    prompt: Tensor  # (prompt_len,)
+    max_new_tokens: int
+    slot: int = -1  # Row of the KV cache, -1 if not admitted yet
+    num_prefilled: int = 0  # Number of prompt tokens already written to the KV cache
+    output_ids: List[int] = field(default_factory=list)
+    finished: bool = False
+
+    @property
+    def prompt_len(self):
+        return self.prompt.shape[0]
+
+    @property
+    def in_prefill(self):
+        return self.num_prefilled < self.prompt_len
+
+    @property
+    def cache_seqlen(self):
+        """Number of tokens in the KV cache. The last sampled token is not in the cache yet."""
+        return self.num_prefilled + max(len(self.output_ids) - 1, 0)
+
+
+class ChunkedPrefillScheduler:
+    """Continuous batching where long prompts are split into chunks that are interleaved with
+    the decoding steps of the other sequences, so that a long prompt doesn't stall the
+    generation of every sequence that is already running.
+
+    Each step processes at most token_budget tokens: one token per decoding sequence, plus
+    chunks of at most chunk_size tokens of the prompts that are still being prefilled. The
+    decoding tokens and the prompt chunks are packed into a single varlen batch (cu_seqlens), so
+    that each step is one forward pass of the model. Each sequence of the batch is appended to
+    its own row of the KV cache (cache_batch_idx), after the tokens already in it
+    (lengths_per_sample), and attends to that row of the cache. The rows of the KV cache are
+    rounded up to a multiple of 256 tokens, since each row is read as one block of a paged KV
+    cache.
+
+    Arguments:
+        model: a model with allocate_inference_cache (e.g. GPTLMHeadModel) that uses
+            FlashAttention. Tensor parallel models are not supported.
+        max_batch_size: number of rows of the KV cache, i.e. max number of running sequences.
+        max_seqlen: max number of tokens (prompt + generated) per sequence.
+        chunk_size: max number of prompt tokens of one sequence processed in one step.
+        token_budget: max number of tokens (decode + prefill) processed in one step.
+        policy: "decode_first" or "latency_slo". With "decode_first", every decoding sequence gets
+            its token first and the rest of the budget goes to prompt chunks, in arrival order.
+            "latency_slo" does the same, but also limits the prefill tokens of a step so that the
+            estimated step time (measured cost per token) stays under itl_slo_ms whenever
+            sequences are decoding.
+        itl_slo_ms: target inter-token latency in ms, for the "latency_slo" policy.
+        min_prefill_tokens: with the "latency_slo" policy, the prefill budget of a step is never
+            below this, so that new requests are not starved.
+    """
+
+    def __init__(
+        self,
+        model,
+        max_batch_size,
+        max_seqlen,
+        chunk_size=512,
+        token_budget=2048,
+        policy="decode_first",
+        itl_slo_ms=None,
+        min_prefill_tokens=16,
+        top_k=1,
+        top_p=0.0,
+        temperature=1.0,
+        eos_token_id=None,
+        vocab_size=None,
+        dtype=None,
+    ):
+        assert policy in ["decode_first", "latency_slo"]
+        assert policy != "latency_slo" or itl_slo_ms is not None
+        assert chunk_size > 0 and token_budget >= max_batch_size
+        self.model = model
+        param = next(iter(model.parameters()))
+        self.device = param.device
+        self.max_batch_size = max_batch_size
+        self.max_seqlen = max_seqlen
+        self.chunk_size = chunk_size
+        self.token_budget = token_budget
+        self.policy = policy
+        self.itl_slo_ms = itl_slo_ms
+        self.min_prefill_tokens = min_prefill_tokens
+        self.sample_kwargs = dict(top_k=top_k, top_p=top_p, temperature=temperature)
+        self.eos_token_id = eos_token_id
+        self.vocab_size = vocab_size
+        cache_seqlen = math.ceil(max_seqlen / 256) * 256
+        self.inference_params = InferenceParams(
+            max_seqlen=cache_seqlen,
+            max_batch_size=max_batch_size,
+            key_value_memory_dict=model.allocate_inference_cache(
+                max_batch_size, cache_seqlen, dtype=param.dtype if dtype is None else dtype
+            ),
+        )
+        # Metadata of the sequences of a step: row of the KV cache, number of tokens already in
+        # it, and cu_seqlens. Written to pinned memory, then copied to the GPU in one go.
+        pin_memory = self.device.type == "cuda"
+        self._meta_host = torch.zeros(
+            3, max_batch_size + 1, dtype=torch.int32, pin_memory=pin_memory
+        )
+        self._meta = torch.zeros(3, max_batch_size + 1, dtype=torch.int32, device=self.device)
+        # Last sampled token of each row of the KV cache, the input of the next decoding step
+        self._last_tokens = torch.zeros(max_batch_size, dtype=torch.long, device=self.device)
+        self.free_slots = deque(range(max_batch_size))
+        self.waiting = deque()  # Sequences that don't have a row of the KV cache yet
+        self.running: List[SequenceState] = []  # In arrival order
+        self.finished: Dict[int, SequenceState] = {}
+        self.ms_per_token = None  # Moving average of the measured step time per token
+        self._next_request_id = 0
+
+    def add_request(self, input_ids, max_new_tokens):
+        """
+        Arguments:
+            input_ids: (prompt_len,) int tensor
+        Return:
+            request_id: int
+        """
+        assert input_ids.dim() == 1 and input_ids.shape[0] > 0
+        assert input_ids.shape[0] + max_new_tokens <= self.max_seqlen
+        request_id = self._next_request_id
+        self._next_request_id += 1
+        self.waiting.append(
+            SequenceState(request_id, input_ids.to(self.device), max_new_tokens=max_new_tokens)
+        )
+        return request_id
+
+    def has_unfinished(self):
+        return len(self.waiting) > 0 or len(self.running) > 0
+
+    def prefill_budget(self, num_decode_tokens):
+        """Number of prompt tokens that can be processed in the next step."""
+        budget = self.token_budget - num_decode_tokens
+        if self.policy == "latency_slo" and num_decode_tokens > 0 and self.ms_per_token is not None:
+            slo_budget = int(self.itl_slo_ms / self.ms_per_token) - num_decode_tokens
+            budget = min(budget, max(slo_budget, self.min_prefill_tokens))
+        return max(budget, 0)
+
+    def _forward(self, segments):
+        """Run the model on a packed batch of segments [(seq, start, length)]: the tokens
+        start : start + length of each sequence (its prompt followed by its generated tokens),
+        appending them to the KV cache row of the sequence.
+        Return the logits of the last token of each segment, (len(segments), vocab_size).
+        """
+        num_seqs = len(segments)
+        cu_seqlens = [0]
+        for _, _, length in segments:
+            cu_seqlens.append(cu_seqlens[-1] + length)
+        # The copy of the previous step is done, step() waits for the sampled tokens
+        meta = self._meta_host.numpy()
+        meta[0, :num_seqs] = [seq.slot for seq, _, _ in segments]
+        meta[1, :num_seqs] = [start for _, start, _ in segments]
+        meta[2, : num_seqs + 1] = cu_seqlens
+        self._meta.copy_(self._meta_host, non_blocking=True)
+        slots, cache_seqlens = self._meta[0, :num_seqs], self._meta[1, :num_seqs]
+        cu_seqlens_t = self._meta[2, : num_seqs + 1]
+        # The decoding tokens are already on the GPU, the prompt chunks are slices of the prompts
+        input_ids = torch.cat(
+            [
+                (
+                    seq.prompt[start : start + length]
+                    if seq.in_prefill
+                    else self._last_tokens[seq.slot : seq.slot + 1]
+                )
+                for seq, start, length in segments
+            ]
+        )
+        total = cu_seqlens[-1]
+        seq_idx = torch.repeat_interleave(
+            torch.arange(num_seqs, device=self.device), cu_seqlens_t.diff(), output_size=total
+        )
+        position_ids = (
+            cache_seqlens[seq_idx] + torch.arange(total, device=self.device) - cu_seqlens_t[seq_idx]
+        ).long()
+        params = self.inference_params
+        params.cache_batch_idx = slots
+        params.lengths_per_sample = cache_seqlens
+        # Only used to choose the code path, the actual offsets are in lengths_per_sample
+        params.seqlen_offset = max(start for _, start, _ in segments)
+        logits = self.model(
+            input_ids[None],
+            position_ids=position_ids[None],
+            inference_params=params,
+            num_last_tokens=1,
+            cu_seqlens=cu_seqlens_t,
+            max_seqlen=max(length for _, _, length in segments),
+        ).logits.squeeze(dim=1)
+        return logits[..., : self.vocab_size] if self.vocab_size is not None else logits
+
+    @torch.inference_mode()
+    def step(self):
+        """Run one scheduling step.
+        Return:
+            new_tokens: dict from request_id to the token sampled for it in this step.
+        """
+        while self.waiting and self.free_slots:
+            seq = self.waiting.popleft()
+            seq.slot = self.free_slots.popleft()
+            self.running.append(seq)
+        decode_seqs = [s for s in self.running if not s.in_prefill]
+        prefill_seqs = [s for s in self.running if s.in_prefill]
+        budget = self.prefill_budget(len(decode_seqs))
+        start = time.perf_counter()
+        segments = [(seq, seq.cache_seqlen, 1) for seq in decode_seqs]
+        for seq in prefill_seqs:
+            if budget <= 0:
+                break
+            chunk_len = min(self.chunk_size, budget, seq.prompt_len - seq.num_prefilled)
+            segments.append((seq, seq.num_prefilled, chunk_len))
+            budget -= chunk_len
+        if not segments:
+            return {}
+        logits = self._forward(segments)
+        num_tokens = sum(length for _, _, length in segments)
+        for seq, _, length in segments[len(decode_seqs) :]:
+            seq.num_prefilled += length
+        # Sample for every segment. Only the tokens of the decoding sequences and of the prompts
+        # that are now in the KV cache are kept, the others are overwritten once their prompt is
+        # done.
+        sampled_tokens = sample(logits, **self.sample_kwargs)
+        self._last_tokens[self.inference_params.cache_batch_idx] = sampled_tokens
+        # A single host sync per step, to check for stopping conditions
+        tokens = sampled_tokens.tolist()
+        ms_per_token = (time.perf_counter() - start) * 1000 / num_tokens
+        self.ms_per_token = (
+            ms_per_token
+            if self.ms_per_token is None
+            else 0.9 * self.ms_per_token + 0.1 * ms_per_token
+        )
+        new_tokens = {}
+        for (seq, _, _), token in zip(segments, tokens):
+            if seq.in_prefill:
+                continue
+            seq.output_ids.append(token)
+            new_tokens[seq.request_id] = token
+            if len(seq.output_ids) >= seq.max_new_tokens or token == self.eos_token_id:
+                seq.finished = True
+        for seq in self.running:
+            if seq.finished:
+                self.free_slots.append(seq.slot)
+                self.finished[seq.request_id] = seq
+        self.running = [s for s in self.running if not s.finished]
+        return new_tokens
+
+    def run(self):
+        """Step until all requests are finished.
+        Return:
+            outputs: dict from request_id to the generated tokens, (num_generated,) int tensor.
+        """
+        while self.has_unfinished():
+            self.step()
+        return {
+            request_id: torch.tensor(seq.output_ids, dtype=torch.long)
+            for request_id, seq in self.finished.items()
+        }
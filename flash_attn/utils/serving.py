@@ -0,0 +1,294 @@
+# Copyright (c) 2024, Tri Dao.
+import asyncio
+import heapq
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import List, Optional
+
+import torch
+
+from flash_attn.utils.generation import InferenceParams, sample_batched
+
+
+@dataclass
+class SamplingParams:
+    max_new_tokens: int = 16
+    top_k: int = 1
+    top_p: float = 0.0
+    temperature: float = 1.0
+    eos_token_id: Optional[int] = None
+
+
+class RequestHandle:
+    """Returned by ServingEngine.submit. Await result() for all the generated tokens, or iterate
+    with `async for` to get the tokens as they are generated."""
+
+    def __init__(self, engine, request_id, input_ids, params, priority):
+        self.request_id = request_id
+        self.input_ids = input_ids
+        self.params = params
+        self.priority = priority
+        self.output_ids: List[int] = []
+        self.cancelled = False
+        self.slot = -1  # Row of the KV cache, -1 if not admitted
+        self._engine = engine
+        self._tokens = asyncio.Queue()  # New tokens, None when the request is done
+        self._future = asyncio.get_running_loop().create_future()
+
+    @property
+    def cache_seqlen(self):
+        """Number of tokens in the KV cache. The last generated token is not in the cache yet."""
+        return self.input_ids.shape[0] + max(len(self.output_ids) - 1, 0)
+
+    @property
+    def done(self):
+        return self._future.done()
+
+    async def result(self):
+        """Return the generated tokens. Raise asyncio.CancelledError if the request was
+        cancelled."""
+        return await asyncio.shield(self._future)
+
+    async def __aiter__(self):
+        while True:
+            token = await self._tokens.get()
+            if token is None:
+                break
+            yield token
+
+    def cancel(self):
+        if not self.done:
+            self.cancelled = True
+            self._engine._wakeup.set()
+
+
+class ServingEngine:
+    """Serve generation requests from asyncio code. Requests wait in a queue ordered by priority
+    (lower first) then by arrival, are admitted when a row of the KV cache is free and the KV
+    memory they can use (prompt + max_new_tokens) fits in the budget, and are decoded together
+    with the other running requests, one step at a time (continuous batching). The model runs on
+    a dedicated executor thread, so the event loop stays responsive.
+
+    Without FlashAttention (e.g. on CPU), rows of the KV cache are addressed with a padding mask
+    instead of flash_attn_with_kvcache, so everything can be tested with a tiny model.
+
+    Arguments:
+        model: a model with allocate_inference_cache, e.g. GPTLMHeadModel.
+        max_batch_size: number of rows of the KV cache, i.e. max number of running requests.
+        max_seqlen: max number of tokens (prompt + generated) of a request.
+        kv_cache_bytes: budget of KV memory reserved by the running requests. Defaults to the
+            size of the whole KV cache.
+        batch_window_ms: when idle, wait this long after the first request arrives so that the
+            requests that arrive together start in the same step.
+
+    Usage:
+        async with ServingEngine(model, max_batch_size=8, max_seqlen=2048) as engine:
+            tokens = await engine.generate(input_ids, max_new_tokens=32)
+    """
+
+    def __init__(
+        self,
+        model,
+        max_batch_size,
+        max_seqlen,
+        kv_cache_bytes=None,
+        batch_window_ms=1.0,
+        vocab_size=None,
+        dtype=None,
+    ):
+        self.model = model
+        param = next(iter(model.parameters()))
+        self.device = param.device
+        self.max_batch_size = max_batch_size
+        self.max_seqlen = max_seqlen
+        self.batch_window_ms = batch_window_ms
+        self.vocab_size = vocab_size
+        self.inference_params = InferenceParams(
+            max_seqlen=max_seqlen,
+            max_batch_size=max_batch_size,
+            key_value_memory_dict=model.allocate_inference_cache(
+                max_batch_size, max_seqlen, dtype=param.dtype if dtype is None else dtype
+            ),
+        )
+        # Bytes of KV cache per token, over all layers
+        self.bytes_per_token = sum(
+            kv_cache[0, 0].numel() * kv_cache.element_size()
+            for kv_cache in self.inference_params.key_value_memory_dict.values()
+        )
+        if kv_cache_bytes is None:
+            kv_cache_bytes = max_batch_size * max_seqlen * self.bytes_per_token
+        self.kv_cache_bytes = kv_cache_bytes
+        self.reserved_bytes = 0
+        self.free_slots = list(range(max_batch_size))
+        self.waiting = []  # Heap of (priority, arrival, handle)
+        self.running: List[RequestHandle] = []
+        self._arrival = itertools.count()
+        self._executor = None
+        self._task = None
+        self._wakeup = None
+
+    async def start(self):
+        self._wakeup = asyncio.Event()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="serving-engine")
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        """Cancel the remaining requests and stop the engine. Re-raise the error that stopped
+        the engine, if any."""
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        finally:
+            for handle in self.running + [handle for _, _, handle in self.waiting]:
+                self._finish(handle, cancelled=True)
+            self.running, self.waiting = [], []
+            self._executor.shutdown(wait=True)
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    def submit(self, input_ids, priority=0, **kwargs):
+        """
+        Arguments:
+            input_ids: (prompt_len,) int tensor
+            priority: requests with lower priority are admitted first.
+            kwargs: fields of SamplingParams.
+        Return:
+            RequestHandle
+        """
+        assert self._task is not None, "The engine is not started"
+        if self._task.done():
+            raise RuntimeError("The engine is stopped")
+        params = SamplingParams(**kwargs)
+        assert input_ids.dim() == 1 and input_ids.shape[0] > 0
+        assert input_ids.shape[0] + params.max_new_tokens <= self.max_seqlen
+        handle = RequestHandle(
+            self, next(self._arrival), input_ids.to(self.device), params, priority
+        )
+        assert self._reserved(handle) <= self.kv_cache_bytes, "Request doesn't fit in KV budget"
+        heapq.heappush(self.waiting, (priority, handle.request_id, handle))
+        self._wakeup.set()
+        return handle
+
+    async def generate(self, input_ids, priority=0, **kwargs):
+        return await self.submit(input_ids, priority=priority, **kwargs).result()
+
+    def _reserved(self, handle):
+        return (handle.input_ids.shape[0] + handle.params.max_new_tokens) * self.bytes_per_token
+
+    def _admit(self):
+        """Admit waiting requests in priority order while they fit."""
+        admitted = []
+        while self.waiting and self.free_slots:
+            handle = self.waiting[0][2]
+            if not handle.cancelled:
+                if self.reserved_bytes + self._reserved(handle) > self.kv_cache_bytes:
+                    break
+                handle.slot = self.free_slots.pop()
+                self.reserved_bytes += self._reserved(handle)
+                admitted.append(handle)
+            heapq.heappop(self.waiting)
+        return admitted
+
+    def _finish(self, handle, cancelled=False, exception=None):
+        if handle.slot >= 0:
+            self.free_slots.append(handle.slot)
+            self.reserved_bytes -= self._reserved(handle)
+            handle.slot = -1
+        if not handle.done:
+            if cancelled:
+                handle._future.cancel()
+            elif exception is not None:
+                handle._future.set_exception(exception)
+            else:
+                handle._future.set_result(handle.output_ids)
+        handle._tokens.put_nowait(None)
+
+    async def _loop(self):
+        try:
+            await self._run()
+        except Exception as e:
+            # Fail all the requests instead of leaving their clients waiting forever. The error is
+            # raised again by stop().
+            for handle in self.running + [handle for _, _, handle in self.waiting]:
+                self._finish(handle, exception=e)
+            self.running, self.waiting = [], []
+            raise
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self.running and not self.waiting:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                await asyncio.sleep(self.batch_window_ms / 1000)
+            for handle in [h for h in self.running if h.cancelled]:
+                self._finish(handle, cancelled=True)
+            self.running = [h for h in self.running if not h.cancelled]
+            for _, _, handle in self.waiting:
+                if handle.cancelled:
+                    self._finish(handle, cancelled=True)
+            self.waiting = [entry for entry in self.waiting if not entry[2].cancelled]
+            heapq.heapify(self.waiting)
+            prefill = self._admit()
+            decode = self.running
+            if not prefill and not decode:
+                if self.waiting:  # Waiting for KV memory that nobody is going to free
+                    raise RuntimeError("Requests are waiting but none can be admitted")
+                continue
+            tokens = await loop.run_in_executor(self._executor, self._step, prefill, decode)
+            self.running = []
+            for handle, token in zip(prefill + decode, tokens):
+                if handle.cancelled:
+                    self._finish(handle, cancelled=True)
+                    continue
+                handle.output_ids.append(token)
+                handle._tokens.put_nowait(token)
+                params = handle.params
+                if len(handle.output_ids) >= params.max_new_tokens or token == params.eos_token_id:
+                    self._finish(handle)
+                else:
+                    self.running.append(handle)
+
+    def _forward(self, input_ids, handles, cache_seqlens):
+        params = self.inference_params
+        params.cache_batch_idx = torch.tensor(
+            [h.slot for h in handles], dtype=torch.int32, device=self.device
+        )
+        params.lengths_per_sample = torch.tensor(
+            cache_seqlens, dtype=torch.int32, device=self.device
+        )
+        # Only used to choose the code path, the actual offsets are in lengths_per_sample.
+        params.seqlen_offset = max(cache_seqlens)
+        position_ids = params.lengths_per_sample[:, None].long() + torch.arange(
+            input_ids.shape[1], device=self.device
+        )
+        logits = self.model(
+            input_ids, position_ids=position_ids, inference_params=params, num_last_tokens=1
+        ).logits.squeeze(dim=1)
+        return logits[..., : self.vocab_size] if self.vocab_size is not None else logits
+
+    @torch.inference_mode()
+    def _step(self, prefill, decode):
+        """Runs on the executor thread. Return the new token of each request of prefill + decode."""
+        logits = [self._forward(h.input_ids[None], [h], [0]) for h in prefill]
+        if decode:
+            input_ids = torch.tensor(
+                [[h.output_ids[-1]] for h in decode], dtype=torch.long, device=self.device
+            )
+            logits.append(self._forward(input_ids, decode, [h.cache_seqlen for h in decode]))
+        handles = prefill + decode
+        tokens = sample_batched(
+            torch.cat(logits),
+            temperature=torch.tensor([h.params.temperature for h in handles]),
+            top_k=torch.tensor([h.params.top_k for h in handles]),
+            top_p=torch.tensor([h.params.top_p for h in handles]),
+        )
+        return tokens.tolist()
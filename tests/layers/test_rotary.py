@@ -6,7 +6,12 @@ import pytest
 import torch
 import torch.nn.functional as F
 from einops import rearrange
-from flash_attn.layers.rotary import RotaryEmbedding, apply_rotary_emb_func, apply_rotary_emb_qkv_
+from flash_attn.layers.rotary import (
+    RotaryEmbedding,
+    apply_rotary_emb_func,
+    apply_rotary_emb_qkv_,
+    share_rotary_embeddings,
+)
 from transformers.models.gpt_neox.modeling_gpt_neox import RotaryEmbedding as RotaryEmbeddingNeoX
 from transformers.models.gpt_neox.modeling_gpt_neox import (
     apply_rotary_pos_emb as apply_rotary_pos_emb_neox,
@@ -132,3 +137,127 @@ def test_rotary_interleaved(rotary_emb_fraction, seqlen_offset):
     assert torch.allclose(k_pt.grad, qkv.grad[:, :, 1, :, :rotary_dim], rtol=rtol, atol=atol)
     assert torch.equal(qkv.grad[:, :, 0:2, :, rotary_dim:], g_og[:, :, 0:2, :, rotary_dim:])
     assert torch.equal(qkv.grad[:, :, 2], g_og[:, :, 2])
+
+
+def _yarn_inv_freq_ref(dim, base, factor, original_max_seqlen, beta_fast=32.0, beta_slow=1.0):
+    # Reference: _compute_yarn_parameters in transformers/modeling_rope_utils.py
+    def find_correction_dim(num_rotations):
+        return (dim * math.log(original_max_seqlen / (num_rotations * 2 * math.pi))) / (
+            2 * math.log(base)
+        )
+
+    low = max(math.floor(find_correction_dim(beta_fast)), 0)
+    high = min(math.ceil(find_correction_dim(beta_slow)), dim - 1)
+    if low == high:
+        high += 0.001
+    pos_freqs = base ** (torch.arange(0, dim, 2, dtype=torch.float32) / dim)
+    inv_freq_extrapolation = 1.0 / pos_freqs
+    inv_freq_interpolation = 1.0 / (factor * pos_freqs)
+    ramp = ((torch.arange(dim // 2, dtype=torch.float32) - low) / (high - low)).clamp(0, 1)
+    extrapolation_factor = 1 - ramp
+    return (
+        inv_freq_interpolation * (1 - extrapolation_factor)
+        + inv_freq_extrapolation * extrapolation_factor
+    )
+
+
+def _llama3_inv_freq_ref(dim, base, factor, original_max_seqlen, low_freq_factor, high_freq_factor):
+    """Same as _compute_llama3_parameters in Hugging Face transformers."""
+    inv_freq = 1.0 / (base ** (torch.arange(0, dim, 2, dtype=torch.float32) / dim))
+    low_freq_wavelen = original_max_seqlen / low_freq_factor
+    high_freq_wavelen = original_max_seqlen / high_freq_factor
+    wavelen = 2 * math.pi / inv_freq
+    inv_freq_llama = torch.where(wavelen > low_freq_wavelen, inv_freq / factor, inv_freq)
+    smooth_factor = (original_max_seqlen / wavelen - low_freq_factor) / (
+        high_freq_factor - low_freq_factor
+    )
+    smoothed = (1 - smooth_factor) * inv_freq_llama / factor + smooth_factor * inv_freq_llama
+    is_medium = ~(wavelen < high_freq_wavelen) & ~(wavelen > low_freq_wavelen)
+    return torch.where(is_medium, smoothed, inv_freq_llama)
+
+
+@pytest.mark.parametrize("scaling_type", ["linear", "dynamic", "yarn", "llama3"])
+def test_rotary_scaling(scaling_type):
+    device = "cuda"
+    dim, base, factor, original_max_seqlen = 128, 10000.0, 4.0, 2048
+    scaling = {
+        "type": scaling_type,
+        "factor": factor,
+        "original_max_position_embeddings": original_max_seqlen,
+    }
+    rotary = RotaryEmbedding(dim, base=base, scaling=scaling, device=device)
+    rotary_og = RotaryEmbedding(dim, base=base, device=device)
+    seqlen = 4 * original_max_seqlen
+    rotary._update_cos_sin_cache(seqlen, device=device, dtype=torch.float32)
+    t = torch.arange(seqlen, device=device, dtype=torch.float32)
+    if scaling_type == "linear":
+        freqs = torch.outer(t / factor, rotary_og.inv_freq)
+        mscale = 1.0
+    elif scaling_type == "dynamic":
+        base_scaled = base * (factor * seqlen / original_max_seqlen - (factor - 1)) ** (
+            dim / (dim - 2)
+        )
+        inv_freq = 1.0 / (base_scaled ** (torch.arange(0, dim, 2, device=device) / dim))
+        freqs = torch.outer(t, inv_freq)
+        mscale = 1.0
+    elif scaling_type == "yarn":
+        inv_freq = _yarn_inv_freq_ref(dim, base, factor, original_max_seqlen).to(device)
+        freqs = torch.outer(t, inv_freq)
+        mscale = 0.1 * math.log(factor) + 1.0
+    else:
+        inv_freq = _llama3_inv_freq_ref(dim, base, factor, original_max_seqlen, 1.0, 4.0)
+        freqs = torch.outer(t, inv_freq.to(device))
+        mscale = 1.0
+    # The positions go up to 8k, so an ulp of difference in inv_freq shifts the angles by ~1e-5
+    assert torch.allclose(rotary._cos_cached, torch.cos(freqs) * mscale, atol=1e-4)
+    assert torch.allclose(rotary._sin_cached, torch.sin(freqs) * mscale, atol=1e-4)
+
+
+def test_rotary_dynamic_scaling_shorter():
+    """With dynamic scaling, the tables go back to the original base when the sequence length
+    drops back below original_max_position_embeddings."""
+    device = torch.device("cuda", 0)  # Same as the device of the tensors, so the tables are reused
+    dim, original_max_seqlen = 128, 2048
+    scaling = {
+        "type": "dynamic",
+        "factor": 4.0,
+        "original_max_position_embeddings": original_max_seqlen,
+    }
+    rotary = RotaryEmbedding(dim, scaling=scaling, device=device)
+    rotary_og = RotaryEmbedding(dim, device=device)
+    rotary._update_cos_sin_cache(4 * original_max_seqlen, device=device, dtype=torch.float32)
+    cos_long = rotary._cos_cached
+    rotary._update_cos_sin_cache(3 * original_max_seqlen, device=device, dtype=torch.float32)
+    assert rotary._cos_cached.shape[0] == 3 * original_max_seqlen
+    assert not torch.allclose(rotary._cos_cached, cos_long[: 3 * original_max_seqlen])
+    rotary._update_cos_sin_cache(128, device=device, dtype=torch.float32)
+    rotary_og._update_cos_sin_cache(original_max_seqlen, device=device, dtype=torch.float32)
+    assert rotary._seq_len_cached == original_max_seqlen
+    assert torch.allclose(rotary._cos_cached, rotary_og._cos_cached)
+    assert torch.allclose(rotary._sin_cached, rotary_og._sin_cached)
+    # Shorter sequences reuse the tables of the original base
+    cos = rotary._cos_cached
+    rotary._update_cos_sin_cache(1024, device=device, dtype=torch.float32)
+    assert rotary._cos_cached is cos
+
+
+def test_rotary_shared_cache():
+    device = torch.device("cuda", 0)  # Same as the device of the tensors, so the tables are reused
+    rotary = RotaryEmbedding(64, max_seqlen=4096, device=device)
+    with torch.inference_mode():
+        rotary._update_cos_sin_cache(128, device=device, dtype=torch.float16)
+    # Computed once for max_seqlen, and reused in training after inference mode
+    assert rotary._seq_len_cached == 4096
+    cos = rotary._cos_cached
+    assert not cos.is_inference()
+    rotary.train()
+    rotary._update_cos_sin_cache(1024, device=device, dtype=torch.float16)
+    assert rotary._cos_cached is cos
+
+    layers = torch.nn.ModuleList([torch.nn.Module() for _ in range(4)])
+    for i, layer in enumerate(layers):
+        layer.rotary_emb = RotaryEmbedding(64 if i < 3 else 32, device=device)
+    registry = share_rotary_embeddings(layers)
+    assert len(registry) == 2
+    assert layers[0].rotary_emb is layers[1].rotary_emb is layers[2].rotary_emb
+    assert layers[3].rotary_emb is not layers[0].rotary_emb
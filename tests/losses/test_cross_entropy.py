@@ -3,7 +3,7 @@
 import pytest
 import torch
 import torch.nn.functional as F
-from flash_attn.losses.cross_entropy import CrossEntropyLoss
+from flash_attn.losses.cross_entropy import CrossEntropyLoss, FusedLinearCrossEntropyLoss
 
 is_sm8x = torch.cuda.get_device_capability("cuda")[0] >= 8
 
@@ -81,3 +81,93 @@ def test_cross_entropy_loss(
     out_pt.backward(g)
     out.backward(g)
     assert torch.allclose(x.grad, x_pt.grad, rtol=rtol, atol=atol)
+
+
+@pytest.mark.parametrize("dtype", [torch.float32] + ([torch.bfloat16] if is_sm8x else []))
+@pytest.mark.parametrize("inplace_backward", [False, True])
+@pytest.mark.parametrize("lse_square_scale", [0.0, 1e-2])
+@pytest.mark.parametrize("smoothing", [0.0, 0.9])
+@pytest.mark.parametrize("n_rows", [1, 7, 64])
+@pytest.mark.parametrize("vocab_size", [32000, 152064, 256000])
+def test_cross_entropy_loss_few_rows(
+    vocab_size, n_rows, smoothing, lse_square_scale, inplace_backward, dtype
+):
+    """Few rows and a large vocab: each row is split across several programs."""
+    device = "cuda"
+    rtol, atol = (1e-5, 1e-6) if dtype == torch.float32 else (1e-3, 1e-4)
+    # set seed
+    torch.random.manual_seed(0)
+    x_pt = torch.randn(n_rows, vocab_size, device=device, dtype=dtype, requires_grad=True)
+    x = x_pt.detach().clone().requires_grad_()
+    y = torch.randint(0, vocab_size, (n_rows,), dtype=torch.long, device=device)
+    y[0] = vocab_size - 1  # label in the last split
+    if n_rows > 1:
+        y[1] = -100
+    model = CrossEntropyLoss(
+        label_smoothing=smoothing,
+        lse_square_scale=lse_square_scale,
+        return_z_loss=True,
+        inplace_backward=inplace_backward,
+    )
+    out, out_z_loss = model(x, y)
+    out_pt = F.cross_entropy(x_pt.float(), y, label_smoothing=smoothing)
+    lse_pt = torch.logsumexp(x_pt.float(), dim=-1)
+    z_loss_pt = lse_square_scale * (lse_pt[y != -100] ** 2).mean()
+    out_pt += z_loss_pt
+    assert torch.allclose(out_z_loss, z_loss_pt, rtol=1e-5, atol=1e-6)
+    assert torch.allclose(out, out_pt, rtol=1e-5, atol=1e-5)
+
+    g = torch.randn_like(out)
+    out_pt.backward(g)
+    out.backward(g)
+    assert torch.allclose(x.grad, x_pt.grad, rtol=rtol, atol=atol)
+
+
+@pytest.mark.parametrize("dtype", [torch.float16] + ([torch.bfloat16] if is_sm8x else []))
+@pytest.mark.parametrize("has_bias", [False, True])
+@pytest.mark.parametrize("lse_square_scale", [0.0, 1e-2])
+@pytest.mark.parametrize("smoothing", [0.0, 0.9])
+@pytest.mark.parametrize("chunk_size", [1000, 4096])
+@pytest.mark.parametrize("vocab_size", [50257, 128256])
+def test_fused_linear_cross_entropy_loss(
+    vocab_size, chunk_size, smoothing, lse_square_scale, has_bias, dtype
+):
+    device = "cuda"
+    rtol, atol = (1e-3, 1e-3) if dtype == torch.float16 else (1e-2, 1e-2)
+    # set seed
+    torch.random.manual_seed(0)
+    batch_size, seqlen, hidden_dim = 2, 1024, 256
+    x_pt = torch.randn(
+        batch_size, seqlen, hidden_dim, device=device, dtype=dtype, requires_grad=True
+    )
+    weight_pt = torch.randn(vocab_size, hidden_dim, device=device, dtype=dtype) / hidden_dim**0.5
+    weight_pt.requires_grad_()
+    bias_pt = torch.randn(vocab_size, device=device, dtype=dtype) if has_bias else None
+    if has_bias:
+        bias_pt.requires_grad_()
+    x = x_pt.detach().clone().requires_grad_()
+    weight = weight_pt.detach().clone().requires_grad_()
+    bias = bias_pt.detach().clone().requires_grad_() if has_bias else None
+    y = torch.randint(0, vocab_size, (batch_size, seqlen), dtype=torch.long, device=device)
+    y.view(-1)[torch.randperm(batch_size * seqlen)[:10]] = -100
+    model = FusedLinearCrossEntropyLoss(
+        label_smoothing=smoothing,
+        lse_square_scale=lse_square_scale,
+        chunk_size=chunk_size,
+        return_z_loss=True,
+    )
+    out, out_z_loss = model(x, weight, y, bias=bias)
+    logits_pt = F.linear(x_pt, weight_pt, bias_pt)
+    out_pt, out_z_loss_pt = CrossEntropyLoss(
+        label_smoothing=smoothing, lse_square_scale=lse_square_scale, return_z_loss=True
+    )(logits_pt.flatten(0, 1), y.flatten())
+    assert torch.allclose(out, out_pt, rtol=1e-5, atol=1e-5)
+    assert torch.allclose(out_z_loss, out_z_loss_pt, rtol=1e-5, atol=1e-6)
+
+    g = torch.randn_like(out)
+    out_pt.backward(g)
+    out.backward(g)
+    assert torch.allclose(x.grad, x_pt.grad, rtol=rtol, atol=atol)
+    assert torch.allclose(weight.grad, weight_pt.grad, rtol=rtol, atol=atol)
+    if has_bias:
+        assert torch.allclose(bias.grad, bias_pt.grad, rtol=rtol, atol=atol)
@@ -2,6 +2,7 @@ import re
 
 import pytest
 import torch
+import torch.nn.functional as F
 from einops import rearrange
 from flash_attn.models.gpt import (
     GPTLMHeadModel,
@@ -9,7 +10,8 @@ from flash_attn.models.gpt import (
     shard_state_dict_tp,
     combine_state_dicts_tp,
 )
-from flash_attn.utils.generation import InferenceParams
+from flash_attn.utils.generation import InferenceParams, beam_search
+from flash_attn.utils.scheduler import ChunkedPrefillScheduler
 from flash_attn.utils.pretrained import state_dict_from_pretrained
 from transformers import GPT2Config, GPT2Tokenizer
 from transformers.models.gpt2.modeling_gpt2 import GPT2LMHeadModel as GPT2LMHeadModelHF
@@ -339,6 +341,439 @@ def test_gpt2_generation_cg(model_name, rotary, seqlen, maxlen):
     assert torch.equal(logits, logits_cg)
 
 
+@pytest.mark.parametrize("cg", [False, True])
+@pytest.mark.parametrize("rotary", [False, True])
+@pytest.mark.parametrize("model_name", ["gpt2"])
+def test_gpt2_generation_varlen(model_name, rotary, cg):
+    """Check that decoding prompts of different lengths in one batch gives the same scores as
+    decoding each prompt on its own.
+    """
+    dtype = torch.float16
+    device = "cuda"
+    rtol, atol = 3e-3, 3e-1
+    config = GPT2Config.from_pretrained(model_name)
+    if rotary:
+        config.n_positions = 0
+        config.rotary_emb_fraction = 0.5
+    config.residual_in_fp32 = True
+    config.use_flash_attn = True
+    config.fused_bias_fc = True
+    config.fused_mlp = True
+    config.fused_dropout_add_ln = True
+
+    model = GPTLMHeadModel(config, device=device, dtype=dtype)
+    model.eval()
+
+    torch.manual_seed(0)
+    seqlens = [7, 19, 12]
+    prompts = [
+        torch.randint(0, config.vocab_size, (seqlen,), dtype=torch.long, device=device)
+        for seqlen in seqlens
+    ]
+    max_length = 40
+    out = model.generate(
+        prompts, max_length=max_length, cg=cg, return_dict_in_generate=True, output_scores=True
+    )
+    assert out.sequences.shape == (len(seqlens), max_length)
+    scores = torch.stack(out.scores, dim=1)
+    num_generated = max_length - max(seqlens)
+    # Teacher forcing the batch follows each row from its own prompt length
+    out_tf = model.generate(
+        prompts,
+        max_length=max_length,
+        cg=cg,
+        teacher_outputs=out.sequences,
+        return_dict_in_generate=True,
+    )
+    assert torch.equal(out_tf.sequences, out.sequences)
+    for i, (prompt, seqlen) in enumerate(zip(prompts, seqlens)):
+        assert torch.equal(out.sequences[i, :seqlen], prompt)
+        # Teacher-force the tokens generated in the batch so that the steps line up
+        out_ref = model.generate(
+            prompt[None],
+            max_length=seqlen + num_generated,
+            teacher_outputs=out.sequences[i : i + 1, : seqlen + num_generated],
+            return_dict_in_generate=True,
+            output_scores=True,
+        )
+        scores_ref = torch.stack(out_ref.scores, dim=1)
+        assert torch.equal(out_ref.sequences[0], out.sequences[i, : seqlen + num_generated])
+        assert torch.allclose(scores[i], scores_ref[0], rtol=rtol, atol=atol)
+
+
+@pytest.mark.parametrize("stop_check_interval", [1, 4])
+@pytest.mark.parametrize("cg", [False, True])
+@pytest.mark.parametrize("model_name", ["gpt2"])
+def test_gpt2_generation_eos(model_name, cg, stop_check_interval):
+    """Check that with eos_token_id, each sequence is filled with EOS after its first EOS, and
+    that decoding stops once every sequence has produced EOS.
+    """
+    dtype = torch.float16
+    device = "cuda"
+    config = GPT2Config.from_pretrained(model_name)
+    config.residual_in_fp32 = True
+    config.use_flash_attn = True
+    config.fused_bias_fc = True
+    config.fused_mlp = True
+    config.fused_dropout_add_ln = True
+
+    model = GPTLMHeadModel.from_pretrained(model_name, config, device=device, dtype=dtype)
+    model.eval()
+
+    torch.manual_seed(0)
+    batch_size, seqlen, max_length = 2, 10, 40
+    input_ids = torch.randint(
+        0, config.vocab_size, (batch_size, seqlen), dtype=torch.long, device=device
+    )
+    out = model.generate(input_ids, max_length=max_length, cg=cg)
+    # Pick a token that the first sequence produces in the middle of the generation
+    eos_token_id = out[0, seqlen + 5].item()
+    teacher_outputs = out.clone()
+    teacher_outputs[1, seqlen + 12] = eos_token_id
+    out_eos = model.generate(
+        input_ids,
+        max_length=max_length,
+        cg=cg,
+        eos_token_id=eos_token_id,
+        teacher_outputs=teacher_outputs,
+        stop_check_interval=stop_check_interval,
+    )
+    first_eos = [(row[seqlen:] == eos_token_id).nonzero()[0, 0].item() for row in teacher_outputs]
+    assert out_eos.shape == (batch_size, seqlen + max(first_eos) + 1)
+    for i in range(batch_size):
+        end = seqlen + first_eos[i] + 1
+        assert torch.equal(out_eos[i, :end], teacher_outputs[i, :end])
+        assert (out_eos[i, end:] == eos_token_id).all()
+
+
+@pytest.mark.parametrize("stop_check_interval", [1, 4])
+def test_gpt2_generation_eos_cpu(stop_check_interval):
+    """Same as test_gpt2_generation_eos on CPU, where the stop check reads the flags directly."""
+    config = GPT2Config(n_embd=64, n_head=4, n_layer=2, n_positions=64, vocab_size=128)
+    torch.manual_seed(0)
+    model = GPTLMHeadModel(config)
+    model.eval()
+
+    batch_size, seqlen, max_length = 2, 10, 40
+    input_ids = torch.randint(0, config.vocab_size, (batch_size, seqlen), dtype=torch.long)
+    out = model.generate(input_ids, max_length=max_length)
+    eos_token_id = out[0, seqlen + 5].item()
+    teacher_outputs = out.clone()
+    teacher_outputs[1, seqlen + 12] = eos_token_id
+    out_eos = model.generate(
+        input_ids,
+        max_length=max_length,
+        eos_token_id=eos_token_id,
+        teacher_outputs=teacher_outputs,
+        stop_check_interval=stop_check_interval,
+    )
+    first_eos = [(row[seqlen:] == eos_token_id).nonzero()[0, 0].item() for row in teacher_outputs]
+    assert out_eos.shape == (batch_size, seqlen + max(first_eos) + 1)
+    for i in range(batch_size):
+        end = seqlen + first_eos[i] + 1
+        assert torch.equal(out_eos[i, :end], teacher_outputs[i, :end])
+        assert (out_eos[i, end:] == eos_token_id).all()
+
+
+@pytest.mark.parametrize("ragged", [False, True])
+@pytest.mark.parametrize("model_name", ["gpt2"])
+def test_gpt2_generation_stream(model_name, ragged):
+    """Check that streaming generation, where finished sequences leave the batch, gives the same
+    tokens as generating each sequence on its own.
+    """
+    dtype = torch.float16
+    device = "cuda"
+    config = GPT2Config.from_pretrained(model_name)
+    config.residual_in_fp32 = True
+    config.use_flash_attn = True
+    config.fused_bias_fc = True
+    config.fused_mlp = True
+    config.fused_dropout_add_ln = True
+
+    model = GPTLMHeadModel.from_pretrained(model_name, config, device=device, dtype=dtype)
+    model.eval()
+
+    torch.manual_seed(0)
+    seqlens = [9, 17, 4, 12] if ragged else [12] * 4
+    prompts = [
+        torch.randint(0, config.vocab_size, (seqlen,), dtype=torch.long, device=device)
+        for seqlen in seqlens
+    ]
+    max_new_tokens = [5, 20, 12, 1]
+    refs = [
+        model.generate(prompt[None], max_length=prompt.shape[0] + n)[0, prompt.shape[0] :].tolist()
+        for prompt, n in zip(prompts, max_new_tokens)
+    ]
+    # Sequence 2 stops at a token sequence, earlier than its max_new_tokens
+    stop_token_ids = [refs[2][5:7]]
+    input_ids = prompts if ragged else torch.stack(prompts)
+    outputs = [[] for _ in prompts]
+    num_active = []
+    for step in model.generate_stream(
+        input_ids, max_new_tokens, stop_token_ids=stop_token_ids, output_logits=True
+    ):
+        assert step.logits.shape == (len(step.sequence_idx), config.vocab_size)
+        num_active.append(len(step.sequence_idx))
+        for i, token, finished in zip(step.sequence_idx, step.tokens, step.finished):
+            assert not outputs[i] or not outputs[i][-1][1]
+            outputs[i].append((token, finished))
+    for i, ref in enumerate(refs):
+        tokens = [token for token, _ in outputs[i]]
+        expected = ref if i != 2 else ref[: 5 + 2]
+        assert tokens == expected
+        assert outputs[i][-1][1]
+    assert num_active[0] == 4 and num_active[1] == 3 and num_active[-1] == 1
+    assert len(num_active) == max(max_new_tokens)
+
+
+@pytest.mark.parametrize("cg", [False, True])
+@pytest.mark.parametrize("model_name", ["gpt2"])
+def test_gpt2_generation_rolling_kv_cache(model_name, cg):
+    """Check that a ring buffer KV cache for the local layers gives the same scores as a KV cache
+    that holds the whole sequence.
+    """
+    dtype = torch.float16
+    device = "cuda"
+    rtol, atol = 3e-3, 3e-1
+    window = 16
+    config = GPT2Config.from_pretrained(model_name)
+    config.n_positions = 0
+    config.rotary_emb_fraction = 0.5
+    # Alternate between local and global layers
+    config.layer_window_sizes = [
+        (window, 0) if i % 2 == 0 else (-1, -1) for i in range(config.n_layer)
+    ]
+    config.residual_in_fp32 = True
+    config.use_flash_attn = True
+    config.fused_bias_fc = True
+    config.fused_mlp = True
+    config.fused_dropout_add_ln = True
+
+    model = GPTLMHeadModel(config, device=device, dtype=dtype)
+    model.eval()
+    config.rolling_kv_cache = True
+    model_rolling = GPTLMHeadModel(config, device=device, dtype=dtype)
+    model_rolling.load_state_dict(model.state_dict())
+    model_rolling.eval()
+    kv_cache = model_rolling.allocate_inference_cache(2, 100)
+    assert kv_cache[0].shape[1] == window + 1 and kv_cache[1].shape[1] == 100
+
+    torch.manual_seed(0)
+    batch_size, seqlen, max_length = 2, 24, 70
+    input_ids = torch.randint(
+        0, config.vocab_size, (batch_size, seqlen), dtype=torch.long, device=device
+    )
+    out = model.generate(
+        input_ids, max_length=max_length, return_dict_in_generate=True, output_scores=True
+    )
+    out_rolling = model_rolling.generate(
+        input_ids,
+        max_length=max_length,
+        cg=cg,
+        teacher_outputs=out.sequences,
+        return_dict_in_generate=True,
+        output_scores=True,
+    )
+    # The reference decodes with the window too: same scores as a forward pass over the sequence
+    scores = torch.stack(out.scores, dim=1)
+    logits = model(out.sequences).logits[:, seqlen - 1 : -1, : scores.shape[-1]]
+    assert torch.allclose(scores, logits, rtol=rtol, atol=atol)
+    assert torch.equal(out_rolling.sequences, out.sequences)
+    assert torch.allclose(
+        torch.stack(out_rolling.scores, dim=1), torch.stack(out.scores, dim=1), rtol=rtol, atol=atol
+    )
+
+
+@pytest.mark.parametrize("rotary", [False, True])
+@pytest.mark.parametrize("model_name", ["gpt2"])
+def test_gpt2_generation_shared_prefix(model_name, rotary):
+    """Check that cascade attention over a shared prefix gives the same scores as decoding with
+    the prefix copied in every row of the KV cache.
+    """
+    dtype = torch.float16
+    device = "cuda"
+    rtol, atol = 3e-3, 3e-1
+    config = GPT2Config.from_pretrained(model_name)
+    if rotary:
+        config.n_positions = 0
+        config.rotary_emb_fraction = 0.5
+    config.residual_in_fp32 = True
+    config.use_flash_attn = True
+    config.fused_bias_fc = True
+    config.fused_mlp = True
+    config.fused_dropout_add_ln = True
+
+    if rotary:
+        # The pretrained weights have position embeddings, which the rotary model doesn't
+        torch.manual_seed(0)
+        model = GPTLMHeadModel(config, device=device, dtype=dtype)
+    else:
+        model = GPTLMHeadModel.from_pretrained(model_name, config, device=device, dtype=dtype)
+    model.eval()
+
+    torch.manual_seed(0)
+    batch_size, prefix_len, seqlen, max_length = 4, 40, 50, 80
+    input_ids = torch.randint(
+        0, config.vocab_size, (batch_size, seqlen), dtype=torch.long, device=device
+    )
+    input_ids[:, :prefix_len] = input_ids[:1, :prefix_len]
+    out = model.generate(
+        input_ids, max_length=max_length, return_dict_in_generate=True, output_scores=True
+    )
+    out_cascade = model.generate(
+        input_ids,
+        max_length=max_length,
+        shared_prefix_len=prefix_len,
+        teacher_outputs=out.sequences,
+        return_dict_in_generate=True,
+        output_scores=True,
+    )
+    assert torch.equal(out_cascade.sequences, out.sequences)
+    assert torch.allclose(
+        torch.stack(out_cascade.scores, dim=1), torch.stack(out.scores, dim=1), rtol=rtol, atol=atol
+    )
+
+
+@pytest.mark.parametrize("num_beams", [1, 4])
+@pytest.mark.parametrize("model_name", ["gpt2"])
+def test_gpt2_beam_search(model_name, num_beams):
+    """Check beam search with the KV cache reordered through cache_batch_idx against beam search
+    that recomputes the whole sequence at every step. With a single beam, it's greedy decoding.
+    """
+    dtype = torch.float16
+    device = "cuda"
+    config = GPT2Config.from_pretrained(model_name)
+    config.residual_in_fp32 = True
+    config.use_flash_attn = True
+    config.fused_bias_fc = True
+    config.fused_mlp = True
+    config.fused_dropout_add_ln = True
+
+    model = GPTLMHeadModel.from_pretrained(model_name, config, device=device, dtype=dtype)
+    model.eval()
+
+    torch.manual_seed(0)
+    batch_size, seqlen, max_length = 2, 10, 20
+    input_ids = torch.randint(
+        0, config.vocab_size, (batch_size, seqlen), dtype=torch.long, device=device
+    )
+    # generate() only calls beam_search if num_beams > 1
+    out = beam_search(input_ids, model, max_length, num_beams)
+    assert out.sequences.shape == (batch_size, max_length)
+    with torch.inference_mode():
+        for i in range(batch_size):
+            beams, beam_scores = input_ids[i : i + 1], torch.zeros(1, device=device)
+            for _ in range(max_length - seqlen):
+                log_probs = torch.log_softmax(model(beams).logits[:, -1].float(), dim=-1)
+                scores = (beam_scores[:, None] + log_probs).flatten()
+                beam_scores, idx = scores.topk(num_beams)
+                parents, tokens = idx // log_probs.shape[-1], idx % log_probs.shape[-1]
+                beams = torch.cat([beams[parents], tokens[:, None]], dim=1)
+            assert torch.equal(out.sequences[i], beams[0])
+            assert torch.allclose(
+                out.sequences_scores[i],
+                beam_scores[0] / (max_length - seqlen),
+                rtol=1e-3,
+                atol=1e-2,
+            )
+    if num_beams == 1:
+        assert torch.equal(out.sequences, model.generate(input_ids, max_length=max_length))
+
+
+@pytest.mark.parametrize("num_return_sequences", [1, 3])
+@pytest.mark.parametrize("early_stopping", [False, True])
+@pytest.mark.parametrize("length_penalty", [1.0, 0.5])
+def test_gpt2_beam_search_eos(length_penalty, early_stopping, num_return_sequences):
+    """Check the finished hypotheses of beam search (EOS, length_penalty, early_stopping,
+    num_return_sequences) against the beam search of HF, in fp32 on CPU.
+    """
+    # A larger init than GPT2's, so that the random model doesn't repeat the same token
+    config = GPT2Config(
+        n_embd=64, n_head=4, n_layer=2, n_positions=64, vocab_size=64, initializer_range=0.5
+    )
+    torch.manual_seed(0)
+    model_hf = GPT2LMHeadModelHF(config)
+    model_hf.eval()
+    model = GPTLMHeadModel(config)
+    model.load_state_dict(remap_state_dict_hf_gpt2(model_hf.transformer.state_dict(), config))
+    model.eval()
+
+    batch_size, seqlen, max_length, num_beams = 2, 8, 24, 4
+    input_ids = torch.randint(0, config.vocab_size, (batch_size, seqlen), dtype=torch.long)
+    # An EOS that the beams actually reach: a token of the greedy continuation
+    eos_token_id = model.generate(input_ids, max_length=max_length)[0, seqlen + 3].item()
+    kwargs = dict(
+        num_beams=num_beams,
+        length_penalty=length_penalty,
+        early_stopping=early_stopping,
+        num_return_sequences=num_return_sequences,
+        eos_token_id=eos_token_id,
+        pad_token_id=eos_token_id,
+    )
+    out = model.generate(input_ids, max_length=max_length, return_dict_in_generate=True, **kwargs)
+    out_hf = model_hf.generate(
+        input_ids,
+        attention_mask=torch.ones_like(input_ids),
+        max_length=max_length,
+        do_sample=False,
+        return_dict_in_generate=True,
+        output_scores=True,
+        **kwargs,
+    )
+    assert (out.sequences[:, seqlen:] == eos_token_id).any()
+    assert torch.equal(out.sequences, out_hf.sequences)
+    assert torch.allclose(out.sequences_scores, out_hf.sequences_scores, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize("policy", ["decode_first", "latency_slo"])
+@pytest.mark.parametrize("rotary", [False, True])
+@pytest.mark.parametrize("model_name", ["gpt2"])
+def test_gpt2_chunked_prefill(model_name, rotary, policy):
+    """Check that interleaving prompt chunks with decoding steps gives the same greedy outputs
+    as generating each prompt on its own.
+    """
+    dtype = torch.float16
+    device = "cuda"
+    config = GPT2Config.from_pretrained(model_name)
+    if rotary:
+        config.n_positions = 0
+        config.rotary_emb_fraction = 0.5
+    config.residual_in_fp32 = True
+    config.use_flash_attn = True
+    config.fused_bias_fc = True
+    config.fused_mlp = True
+    config.fused_dropout_add_ln = True
+
+    if rotary:
+        model = GPTLMHeadModel(config, device=device, dtype=dtype)
+    else:
+        model = GPTLMHeadModel.from_pretrained(model_name, config, device=device, dtype=dtype)
+    model.eval()
+
+    torch.manual_seed(0)
+    seqlens = [45, 3, 70, 12, 29]
+    prompts = [
+        torch.randint(0, config.vocab_size, (seqlen,), dtype=torch.long, device=device)
+        for seqlen in seqlens
+    ]
+    max_new_tokens = 10
+    scheduler = ChunkedPrefillScheduler(
+        model,
+        max_batch_size=3,
+        max_seqlen=128,
+        chunk_size=16,
+        token_budget=24,
+        policy=policy,
+        itl_slo_ms=1.0,
+        min_prefill_tokens=4,
+    )
+    request_ids = [scheduler.add_request(prompt, max_new_tokens) for prompt in prompts]
+    outputs = scheduler.run()
+    for request_id, prompt in zip(request_ids, prompts):
+        out_ref = model.generate(prompt[None], max_length=prompt.shape[0] + max_new_tokens)
+        assert torch.equal(outputs[request_id], out_ref[0, prompt.shape[0] :].cpu())
+
+
 @pytest.mark.parametrize("optimized", [False, True])
 # @pytest.mark.parametrize("optimized", [False])
 @pytest.mark.parametrize("model_name", ["gpt2"])
@@ -476,3 +911,71 @@ def test_gpt2_shard_unshard(n_heads_q_kv):
         ref = state_dict[k]
         new = state_dict[k]
         assert torch.allclose(ref, new, atol=0.0, rtol=0.0)
+
+
+@pytest.mark.parametrize("model_name", ["gpt2"])
+def test_gpt2_fused_lm_head_loss(model_name):
+    """Check that the loss computed without materializing the logits matches the loss of the
+    logits."""
+    dtype = torch.float16
+    device = "cuda"
+    config = GPT2Config.from_pretrained(model_name)
+    torch.manual_seed(0)
+    model = GPTLMHeadModel(config, device=device, dtype=dtype)
+    model_ref = GPTLMHeadModel(config, device=device, dtype=dtype)
+    model_ref.load_state_dict(model.state_dict())
+    input_ids = torch.randint(0, config.vocab_size, (2, 256), dtype=torch.long, device=device)
+    labels = torch.roll(input_ids, -1, dims=1)
+    labels[:, -1] = -100
+    loss = model(input_ids, labels=labels).loss
+    logits = model_ref(input_ids).logits
+    loss_ref = F.cross_entropy(logits.float().flatten(0, 1), labels.flatten())
+    assert torch.allclose(loss, loss_ref, rtol=1e-3, atol=1e-3)
+    loss.backward()
+    loss_ref.backward()
+    for (name, p), p_ref in zip(model.named_parameters(), model_ref.parameters()):
+        assert torch.allclose(p.grad, p_ref.grad, rtol=1e-2, atol=1e-2), name
+
+
+@pytest.mark.parametrize("n_head_kv", [12, 4])
+@pytest.mark.parametrize("rotary", [False, True])
+def test_gpt2_packed_sequences(rotary, n_head_kv):
+    """Check that training on packed sequences (cu_seqlens) gives the same loss and gradients as
+    training on each sequence separately, including for GQA."""
+    dtype = torch.float16
+    device = "cuda"
+    config = GPT2Config.from_pretrained("gpt2")
+    config.n_layer = 2
+    config.n_head_kv = n_head_kv
+    config.use_flash_attn = True
+    config.fused_bias_fc = True
+    config.fused_dropout_add_ln = True
+    config.residual_in_fp32 = True
+    config.resid_pdrop = config.embd_pdrop = config.attn_pdrop = 0.0
+    if rotary:
+        config.n_positions = 0
+        config.rotary_emb_fraction = 0.5
+    torch.manual_seed(0)
+    model = GPTLMHeadModel(config, device=device, dtype=dtype)
+    model_ref = GPTLMHeadModel(config, device=device, dtype=dtype)
+    model_ref.load_state_dict(model.state_dict())
+    seqlens = [100, 37, 119]
+    cu_seqlens = F.pad(torch.tensor(seqlens, device=device).cumsum(0), (1, 0)).to(torch.int32)
+    input_ids = torch.randint(0, config.vocab_size, (1, sum(seqlens)), device=device)
+    position_ids = torch.cat([torch.arange(s, device=device) for s in seqlens]).unsqueeze(0)
+    logits = model(
+        input_ids, position_ids=position_ids, cu_seqlens=cu_seqlens, max_seqlen=max(seqlens)
+    ).logits
+    logits_ref = torch.cat(
+        [
+            model_ref(input_ids[:, start:end]).logits
+            for start, end in zip(cu_seqlens[:-1].tolist(), cu_seqlens[1:].tolist())
+        ],
+        dim=1,
+    )
+    assert (logits - logits_ref).abs().max().item() < 1e-2
+    g = torch.randn_like(logits) / logits.numel() ** 0.5
+    logits.backward(g)
+    logits_ref.backward(g)
+    for (name, p), p_ref in zip(model.named_parameters(), model_ref.parameters()):
+        assert torch.allclose(p.grad, p_ref.grad, rtol=1e-2, atol=1e-2), name
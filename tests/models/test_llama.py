@@ -61,6 +61,29 @@ def test_llama_state_dict(model_name):
         assert state_dict[k].shape == pretrained_state_dict[k].shape
 
 
+def test_llama_config_rope_scaling():
+    llama_config = LlamaConfig(max_position_embeddings=4096)
+    assert llama_config_to_gpt2_config(llama_config).rotary_emb_scaling is None
+    # HF falls back to max_position_embeddings
+    llama_config.rope_scaling = {"type": "dynamic", "factor": 2.0}
+    scaling = llama_config_to_gpt2_config(llama_config).rotary_emb_scaling
+    assert scaling["original_max_position_embeddings"] == 4096
+    llama_config.rope_scaling = {
+        "rope_type": "llama3",
+        "factor": 8.0,
+        "low_freq_factor": 1.0,
+        "high_freq_factor": 4.0,
+        "original_max_position_embeddings": 8192,
+    }
+    config = llama_config_to_gpt2_config(llama_config)
+    assert config.rotary_emb_scaling["original_max_position_embeddings"] == 8192
+    model = GPTLMHeadModel(config, device="meta")
+    assert model.transformer.layers[0].mixer.rotary_emb.scaling_type == "llama3"
+    llama_config.rope_scaling = {"rope_type": "longrope", "factor": 2.0}
+    with pytest.raises(NotImplementedError, match="longrope"):
+        llama_config_to_gpt2_config(llama_config)
+
+
 # TinyLlama-1.1B is to test MQA
 @pytest.mark.parametrize(
     "model_name", ["meta-llama/Llama-2-7b-hf", "PY007/TinyLlama-1.1B-step-50K-105b"]
@@ -0,0 +1,73 @@
+import pytest
+import torch
+import torch.nn.functional as F
+from transformers import MixtralConfig
+from transformers.models.mixtral.modeling_mixtral import MixtralForCausalLM
+
+from flash_attn.models.gpt import GPTLMHeadModel
+from flash_attn.models.mixtral import mixtral_config_to_gpt2_config, remap_state_dict_hf_mixtral
+
+
+@pytest.mark.parametrize("num_experts_per_tok", [1, 2])
+def test_mixtral_state_dict(num_experts_per_tok):
+    """Check that our implementation of Mixtral matches the HF implementation, on a small randomly
+    initialized model.
+    """
+    device = "cuda"
+    mixtral_config = MixtralConfig(
+        vocab_size=1000,
+        hidden_size=256,
+        intermediate_size=512,
+        num_hidden_layers=2,
+        num_attention_heads=8,
+        num_key_value_heads=2,
+        num_local_experts=4,
+        num_experts_per_tok=num_experts_per_tok,
+    )
+    config = mixtral_config_to_gpt2_config(mixtral_config)
+    torch.manual_seed(0)
+    model_hf = MixtralForCausalLM(mixtral_config).to(device=device).eval()
+    state_dict = {k: v.clone() for k, v in model_hf.state_dict().items()}
+    model = GPTLMHeadModel(config, device=device)
+    model.load_state_dict(remap_state_dict_hf_mixtral(state_dict, config))
+    model.eval()
+
+    input_ids = torch.randint(0, config.vocab_size, (2, 64), dtype=torch.long, device=device)
+    with torch.no_grad():
+        logits = model(input_ids).logits
+        logits_hf = model_hf(input_ids).logits
+    assert (logits - logits_hf).abs().max() < 1e-3
+
+
+def test_mixtral_aux_loss():
+    """The load balancing losses of the MoE layers are added to the loss computed with labels."""
+    device = "cuda"
+    mixtral_config = MixtralConfig(
+        vocab_size=1000,
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        num_local_experts=4,
+    )
+    config = mixtral_config_to_gpt2_config(mixtral_config)
+    torch.manual_seed(0)
+    model = GPTLMHeadModel(config, device=device)
+    input_ids = torch.randint(0, config.vocab_size, (2, 16), dtype=torch.long, device=device)
+    labels = torch.randint(0, config.vocab_size, (2, 16), dtype=torch.long, device=device)
+
+    def loss_fn(hidden_states, weight, labels, bias=None):
+        logits = F.linear(hidden_states, weight, bias)
+        return F.cross_entropy(logits.flatten(0, 1), labels.flatten())
+
+    loss = model(input_ids, labels=labels, loss_fn=loss_fn).loss
+    aux_loss = model.aux_loss()
+    moe_layers = [layer.mlp for layer in model.transformer.layers]
+    assert torch.allclose(aux_loss, sum(mlp.aux_loss for mlp in moe_layers))
+    logits = model(input_ids).logits
+    loss_ref = F.cross_entropy(logits.flatten(0, 1), labels.flatten()) + aux_loss
+    assert torch.allclose(loss, loss_ref)
+    model.eval()
+    model(input_ids)
+    assert model.aux_loss() is None
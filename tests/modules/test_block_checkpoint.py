@@ -0,0 +1,71 @@
+# Run test with:
+# pytest -q -s tests/modules/test_block_checkpoint.py
+
+from functools import partial
+
+import pytest
+import torch
+import torch.nn as nn
+from flash_attn.modules.block import CHECKPOINT_POLICIES, Block, plan_checkpoint_policies
+from flash_attn.modules.mha import MHA
+from flash_attn.modules.mlp import Mlp
+
+
+def create_block(dim, prenorm, checkpoint_policy="none"):
+    return Block(
+        dim,
+        mixer_cls=partial(MHA, num_heads=4, causal=True),
+        mlp_cls=partial(Mlp, hidden_features=4 * dim),
+        prenorm=prenorm,
+        resid_dropout1=0.1,
+        resid_dropout2=0.1,
+        checkpoint_policy=checkpoint_policy,
+    )
+
+
+@pytest.mark.parametrize("prenorm", [True, False])
+@pytest.mark.parametrize("checkpoint_policy", CHECKPOINT_POLICIES)
+def test_block_checkpoint_policy(checkpoint_policy, prenorm):
+    torch.random.manual_seed(0)
+    batch_size, seqlen, dim = 2, 32, 64
+    block_ref = create_block(dim, prenorm)
+    block = create_block(dim, prenorm, checkpoint_policy=checkpoint_policy)
+    block.load_state_dict(block_ref.state_dict())
+    x = torch.randn(batch_size, seqlen, dim)
+    x_ref = x.clone().requires_grad_()
+    x = x.clone().requires_grad_()
+    torch.random.manual_seed(1)
+    out_ref = block_ref(x_ref)
+    torch.random.manual_seed(1)
+    out = block(x)
+    if prenorm:
+        out_ref, out = out_ref[0] + out_ref[1], out[0] + out[1]
+    # Same dropout masks during the recomputation
+    assert torch.allclose(out, out_ref, atol=1e-6)
+    g = torch.randn_like(out)
+    out_ref.backward(g)
+    out.backward(g)
+    assert torch.allclose(x.grad, x_ref.grad, atol=1e-5)
+    for p, p_ref in zip(block.parameters(), block_ref.parameters()):
+        assert torch.allclose(p.grad, p_ref.grad, atol=1e-5)
+
+
+def test_plan_checkpoint_policies():
+    batch_size, seqlen, dim, n_layer = 4, 512, 256, 8
+    blocks = nn.ModuleList([create_block(dim, prenorm=True) for _ in range(n_layer)])
+    costs = blocks[0].checkpoint_costs(batch_size, seqlen)
+    mem_none, mem_full = costs["none"][0], costs["full"][0]
+    assert costs["none"][1] == 0
+    assert all(mem_full <= mem <= mem_none for mem, _ in costs.values())
+    # Enough memory: no recomputation
+    policies = plan_checkpoint_policies(blocks, batch_size, seqlen, n_layer * mem_none)
+    assert policies == ["none"] * n_layer
+    # Not enough memory for anything else than full checkpointing
+    policies = plan_checkpoint_policies(blocks, batch_size, seqlen, n_layer * mem_full)
+    assert policies == ["full"] * n_layer
+    assert all(block.checkpoint_policy == "full" for block in blocks)
+    # In between: the budget is met
+    budget = n_layer * (mem_none + mem_full) // 2
+    policies = plan_checkpoint_policies(blocks, batch_size, seqlen, budget, apply=False)
+    assert sum(costs[p][0] for p in policies) <= budget
+    assert any(p != "full" for p in policies)
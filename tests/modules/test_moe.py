@@ -0,0 +1,113 @@
+# Run test with:
+# pytest -q -s tests/modules/test_moe.py
+
+import math
+
+import pytest
+import torch
+import torch.multiprocessing as mp
+import torch.nn.functional as F
+
+from flash_attn.modules.mlp import MoEMlp
+
+
+def moe_ref(moe, x):
+    """Run every expert on every token, then combine the top-k outputs."""
+    probs = torch.softmax(moe.router(x).float(), dim=-1)
+    gates, experts = probs.topk(moe.top_k, dim=-1)
+    gates = gates / gates.sum(dim=-1, keepdim=True)
+    y = torch.einsum("...d,ehd->...eh", x, moe.fc1.weight)
+    y, gate = y.chunk(2, dim=-1)
+    y = torch.einsum("...eh,edh->...ed", y * F.silu(gate), moe.fc2.weight)
+    y = torch.gather(y, -2, experts[..., None].expand(*experts.shape, y.shape[-1]))
+    return (y * gates[..., None].to(y.dtype)).sum(dim=-2)
+
+
+@pytest.mark.parametrize("top_k", [1, 2])
+@pytest.mark.parametrize("num_experts", [1, 4, 8])
+def test_moe_mlp(num_experts, top_k):
+    if top_k > num_experts:
+        pytest.skip()
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    torch.random.manual_seed(0)
+    moe = MoEMlp(64, 96, num_experts=num_experts, top_k=top_k, device=device)
+    x = torch.randn(2, 37, 64, device=device, requires_grad=True)
+    out = moe(x)
+    out_ref = moe_ref(moe, x)
+    assert out.shape == x.shape
+    assert torch.allclose(out, out_ref, atol=1e-5)
+    # Switch aux loss is aux_loss_coef for perfectly balanced routing, more otherwise
+    assert moe.aux_loss.item() >= 0.01 * (1 - 1e-3)
+
+    g = torch.randn_like(out)
+    grads = torch.autograd.grad(out, [x, *moe.parameters()], g)
+    grads_ref = torch.autograd.grad(out_ref, [x, *moe.parameters()], g)
+    for grad, grad_ref in zip(grads, grads_ref):
+        assert torch.allclose(grad, grad_ref, atol=1e-5)
+    moe.eval()
+    moe(x)
+    assert moe.aux_loss is None
+
+
+@pytest.mark.parametrize("capacity_factor", [0.5, 1.0])
+def test_moe_mlp_capacity(capacity_factor):
+    torch.random.manual_seed(0)
+    num_experts, top_k, num_tokens = 4, 2, 64
+    moe = MoEMlp(32, 64, num_experts=num_experts, top_k=top_k, capacity_factor=capacity_factor)
+    # Route every token to the same two experts
+    with torch.no_grad():
+        moe.router.weight.zero_()
+        moe.router.weight[:2] = 1.0
+        moe.router.weight[0] += 1e-3
+    x = torch.rand(num_tokens, 32) + 0.1
+    capacity = math.ceil(capacity_factor * num_tokens * top_k / num_experts)
+    out = moe(x)
+    moe.capacity_factor = None
+    out_no_drop = moe(x)
+    # Both experts are full: the first tokens are processed, the others are dropped
+    assert torch.allclose(out[:capacity], out_no_drop[:capacity], atol=1e-6)
+    assert torch.all(out[capacity:] == 0)
+
+
+def _run_expert_parallel(rank, world_size, init_method, num_experts, top_k):
+    torch.distributed.init_process_group(
+        "gloo", init_method=init_method, rank=rank, world_size=world_size
+    )
+    torch.random.manual_seed(0)
+    moe_ref = MoEMlp(32, 64, num_experts=num_experts, top_k=top_k, capacity_factor=2.0)
+    x = torch.randn(world_size, 19, 32)
+    g = torch.randn_like(x)
+    moe = MoEMlp(
+        32,
+        64,
+        num_experts=num_experts,
+        top_k=top_k,
+        capacity_factor=2.0,
+        process_group=torch.distributed.group.WORLD,
+    )
+    local_experts = slice(rank * num_experts // world_size, (rank + 1) * num_experts // world_size)
+    with torch.no_grad():
+        moe.router.weight.copy_(moe_ref.router.weight)
+        moe.fc1.weight.copy_(moe_ref.fc1.weight[local_experts])
+        moe.fc2.weight.copy_(moe_ref.fc2.weight[local_experts])
+    # Each rank processes different tokens
+    x_local = x[rank].clone().requires_grad_()
+    out = moe(x_local)
+    x_ref = x.clone().requires_grad_()
+    out_ref = torch.stack([moe_ref(x_ref[r]) for r in range(world_size)])
+    assert torch.allclose(out, out_ref[rank], atol=1e-5)
+    out.backward(g[rank])
+    out_ref.backward(g)
+    assert torch.allclose(x_local.grad, x_ref.grad[rank], atol=1e-5)
+    assert torch.allclose(moe.fc1.weight.grad, moe_ref.fc1.weight.grad[local_experts], atol=1e-5)
+    assert torch.allclose(moe.fc2.weight.grad, moe_ref.fc2.weight.grad[local_experts], atol=1e-5)
+    torch.distributed.destroy_process_group()
+
+
+@pytest.mark.parametrize("top_k", [1, 2])
+@pytest.mark.parametrize("world_size", [2, 4])
+def test_moe_mlp_expert_parallel(world_size, top_k, tmp_path):
+    init_method = f"file://{tmp_path / 'store'}"
+    mp.spawn(
+        _run_expert_parallel, args=(world_size, init_method, 8, top_k), nprocs=world_size
+    )
@@ -0,0 +1,64 @@
+import pytest
+import torch
+import torch.nn as nn
+from transformers import GPT2Config
+
+from flash_attn.models.gpt import GPTLMHeadModel
+from flash_attn.ops.quant_linear import (
+    QuantLinear,
+    dequantize_weight,
+    quantize_model,
+    quantize_weight,
+)
+
+
+@pytest.mark.parametrize("group_size", [None, 16])
+@pytest.mark.parametrize("bits", [8, 4])
+def test_quantize_weight(bits, group_size):
+    torch.random.manual_seed(0)
+    weight = torch.randn(24, 64)
+    weight[3] = 0.0
+    qweight, scales = quantize_weight(weight, bits, group_size)
+    assert qweight.dtype == (torch.int8 if bits == 8 else torch.uint8)
+    assert qweight.shape == (24, 64 if bits == 8 else 32)
+    assert scales.shape == (24, 1 if group_size is None else 4)
+    weight_dq = dequantize_weight(qweight, scales, bits)
+    # Round to nearest: the error is at most half a step
+    step = scales.repeat_interleave(64 // scales.shape[1], dim=1)
+    assert torch.all((weight_dq - weight).abs() <= step / 2 + 1e-6)
+    assert torch.all(weight_dq[3] == 0)
+    # Quantizing again is exact
+    qweight2, scales2 = quantize_weight(weight_dq, bits, group_size)
+    assert torch.equal(qweight2, qweight) and torch.allclose(scales2, scales)
+
+
+@pytest.mark.parametrize("bits", [8, 4])
+def test_quant_linear_from_linear(bits):
+    torch.random.manual_seed(0)
+    linear = nn.Linear(64, 48)
+    qlinear = QuantLinear.from_linear(linear, bits=bits, group_size=32)
+    x = torch.randn(3, 5, 64)
+    out = qlinear(x)
+    assert torch.allclose(out, nn.functional.linear(x, qlinear.weight, linear.bias), atol=1e-5)
+    # The quantized state is saved in the state_dict
+    qlinear2 = QuantLinear(64, 48, bits=bits, group_size=32)
+    qlinear2.load_state_dict(qlinear.state_dict())
+    assert torch.equal(qlinear2(x), out)
+
+
+@pytest.mark.parametrize("bits,group_size,max_rel_error", [(8, None, 0.02), (4, 32, 0.3)])
+def test_quantize_model_gpt(bits, group_size, max_rel_error):
+    config = GPT2Config(n_embd=128, n_head=4, n_layer=2, vocab_size=256, n_positions=64)
+    torch.random.manual_seed(0)
+    model = GPTLMHeadModel(config).eval()
+    input_ids = torch.randint(0, config.vocab_size, (2, 16))
+    with torch.no_grad():
+        logits_ref = model(input_ids).logits
+        quantize_model(model, bits=bits, group_size=group_size, exclude=["*.mlp.fc2"])
+        logits = model(input_ids).logits
+    quantized = [name for name, m in model.named_modules() if isinstance(m, QuantLinear)]
+    assert "lm_head" in quantized and "transformer.layers.0.mixer.Wqkv" in quantized
+    assert "transformer.layers.0.mlp.fc2" not in quantized
+    assert not any(name.endswith("Wqkv.weight") for name, _ in model.named_parameters())
+    rel_error = (logits - logits_ref).norm() / logits_ref.norm()
+    assert rel_error < max_rel_error
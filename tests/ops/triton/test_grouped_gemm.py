@@ -0,0 +1,35 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from flash_attn.ops.triton.grouped_gemm import grouped_gemm, grouped_gemm_ref
+
+
+@pytest.mark.parametrize("dtype", [torch.float16, torch.bfloat16])
+@pytest.mark.parametrize("num_experts", [1, 8, 64])
+@pytest.mark.parametrize("in_features,out_features", [(256, 512), (1000, 333), (4096, 1024)])
+@pytest.mark.parametrize("num_rows", [1, 100, 2048])
+def test_grouped_gemm(num_rows, in_features, out_features, num_experts, dtype):
+    device = "cuda"
+    torch.random.manual_seed(0)
+    # Some experts get no rows, and the last rows don't belong to any expert
+    counts = torch.randint(0, 3, (num_experts,)) * torch.randint(0, num_rows + 1, (num_experts,))
+    counts = (counts * num_rows // max(counts.sum().item() * 5 // 4, 1)).clamp(max=num_rows)
+    expert_offsets = F.pad(torch.cumsum(counts, dim=0), (1, 0)).to(device)
+    x = torch.randn(num_rows, in_features, device=device, dtype=dtype, requires_grad=True)
+    weight = torch.randn(
+        num_experts, out_features, in_features, device=device, dtype=dtype
+    ) / in_features**0.5
+    weight.requires_grad_()
+    out = grouped_gemm(x, weight, expert_offsets)
+    out_ref = grouped_gemm_ref(x.detach().float(), weight.detach().float(), expert_offsets)
+    assert (out.float() - out_ref).abs().max() < 1e-2
+    assert torch.all(out[expert_offsets[-1] :] == 0)
+
+    x_ref = x.detach().float().requires_grad_()
+    weight_ref = weight.detach().float().requires_grad_()
+    g = torch.randn_like(out)
+    out.backward(g)
+    grouped_gemm_ref(x_ref, weight_ref, expert_offsets).backward(g.float())
+    assert (x.grad.float() - x_ref.grad).abs().max() < 1e-2
+    assert (weight.grad.float() - weight_ref.grad).abs().max() < 5e-2
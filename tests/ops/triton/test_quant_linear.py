@@ -0,0 +1,31 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from flash_attn.ops.quant_linear import dequantize_weight, quantize_weight
+from flash_attn.ops.triton.quant_linear import triton_quant_linear
+
+
+@pytest.mark.parametrize("dtype", [torch.float16, torch.bfloat16])
+@pytest.mark.parametrize("has_bias", [False, True])
+@pytest.mark.parametrize("group_size", [None, 32, 128])
+@pytest.mark.parametrize("bits", [8, 4])
+@pytest.mark.parametrize("out_features,in_features", [(1024, 1024), (1000, 2048), (4096, 384)])
+@pytest.mark.parametrize("batch_size", [1, 8, 300])
+def test_quant_linear(batch_size, in_features, out_features, bits, group_size, has_bias, dtype):
+    device = "cuda"
+    torch.random.manual_seed(0)
+    x = torch.randn(batch_size, in_features, device=device, dtype=dtype)
+    weight = torch.randn(out_features, in_features, device=device, dtype=dtype) / in_features**0.5
+    bias = torch.randn(out_features, device=device, dtype=dtype) if has_bias else None
+    qweight, scales = quantize_weight(weight, bits, group_size)
+    out = triton_quant_linear(x, qweight, scales, bias, bits=bits)
+    out_ref = F.linear(
+        x.float(),
+        dequantize_weight(qweight, scales.float(), bits),
+        bias.float() if bias is not None else None,
+    )
+    out_pt = F.linear(x, dequantize_weight(qweight, scales, bits), bias)
+    assert out.dtype == dtype
+    # Same error as computing with the dequantized weight in the same dtype
+    assert (out - out_ref).abs().max().item() <= 2 * (out_pt - out_ref).abs().max().item() + 1e-3
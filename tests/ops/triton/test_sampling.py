@@ -0,0 +1,107 @@
+import pytest
+import torch
+
+from flash_attn.ops.triton.sampling import sample_fused
+from flash_attn.utils.generation import _sample_batched_torch, sample_batched
+
+
+def filtered_probs_ref(logits, temperature, top_k, top_p, min_p):
+    """Probabilities after top-k, then top-p, then min-p filtering, computed with a full sort."""
+    probs = []
+    for i in range(logits.shape[0]):
+        row = logits[i].float() / temperature[i]
+        sorted_row, order = row.sort(descending=True)
+        keep = torch.ones_like(sorted_row, dtype=torch.bool)
+        if 0 < top_k[i] < row.shape[0]:
+            keep[top_k[i] :] = False
+        if 0.0 < top_p[i] < 1.0:
+            p = torch.softmax(sorted_row.masked_fill(~keep, float("-inf")), dim=-1)
+            keep &= (p.cumsum(dim=-1) - p) < top_p[i]
+        keep &= sorted_row >= sorted_row[0] + torch.log(min_p[i])
+        p = torch.softmax(sorted_row.masked_fill(~keep, float("-inf")), dim=-1)
+        probs.append(torch.empty_like(p).scatter_(0, order, p))
+    return torch.stack(probs)
+
+
+@pytest.mark.parametrize("use_triton", [False, True])
+@pytest.mark.parametrize("has_penalty", [False, True])
+@pytest.mark.parametrize("vocab_size", [1000, 50257, 128256])
+def test_sample_greedy(vocab_size, has_penalty, use_triton):
+    device = "cuda" if use_triton else "cpu"
+    batch_size = 8
+    torch.random.manual_seed(0)
+    logits = torch.randn(batch_size, vocab_size, device=device, dtype=torch.float16) * 4
+    token_counts = (
+        torch.randint(0, 3, (batch_size, vocab_size), device=device, dtype=torch.int32)
+        if has_penalty
+        else None
+    )
+    # Half the rows are greedy through temperature = 0, the other half through top_k = 1
+    temperature = torch.tensor([0.0, 0.7] * (batch_size // 2), device=device)
+    top_k = torch.tensor([0, 1] * (batch_size // 2), device=device, dtype=torch.int32)
+    kwargs = dict(
+        temperature=temperature,
+        top_k=top_k,
+        top_p=0.9,
+        min_p=0.05,
+        token_counts=token_counts,
+        repetition_penalty=1.3,
+        presence_penalty=0.5,
+        frequency_penalty=0.2,
+    )
+    out = sample_batched(logits, **kwargs)
+    logits_ref = logits.float()
+    if has_penalty:
+        seen = token_counts > 0
+        logits_ref = torch.where(
+            seen, torch.where(logits_ref > 0, logits_ref / 1.3, logits_ref * 1.3), logits_ref
+        )
+        logits_ref = logits_ref - 0.5 * seen - 0.2 * token_counts
+    assert torch.equal(out, logits_ref.argmax(dim=-1))
+
+
+@pytest.mark.parametrize("use_triton", [False, True])
+@pytest.mark.parametrize("vocab_size", [100, 3000])
+def test_sample_filtering(vocab_size, use_triton):
+    device = "cuda" if use_triton else "cpu"
+    batch_size = 4
+    num_samples = 20000
+    torch.random.manual_seed(0)
+    logits = torch.randn(batch_size, vocab_size, device=device) * 3
+    temperature = torch.tensor([1.0, 0.8, 1.5, 1.2], device=device)
+    top_k = torch.tensor([0, 10, 0, 50], device=device, dtype=torch.int32)
+    top_p = torch.tensor([0.0, 0.0, 0.8, 0.9], device=device)
+    min_p = torch.tensor([0.05, 0.0, 0.0, 0.01], device=device)
+    probs_ref = filtered_probs_ref(logits, temperature, top_k, top_p, min_p)
+    # Sample each row many times at once
+    repeat = lambda x: x.repeat_interleave(num_samples, dim=0)
+    sample_fn = sample_fused if use_triton else _sample_batched_torch
+    out = sample_fn(
+        repeat(logits), repeat(temperature), repeat(top_k), repeat(top_p), repeat(min_p)
+    ).view(batch_size, num_samples)
+    assert (probs_ref.gather(1, out) > 0).all()
+    counts = torch.zeros_like(probs_ref).scatter_add_(1, out, torch.ones_like(out, dtype=torch.float))
+    assert (counts / num_samples - probs_ref).abs().max().item() < 0.02
+
+
+def test_sample_fused_cuda_graph():
+    """Sampling captured in a CUDA graph draws new random numbers at each replay."""
+    device = "cuda"
+    batch_size, vocab_size = 8, 1000
+    torch.random.manual_seed(0)
+    logits = torch.zeros(batch_size, vocab_size, device=device)
+    args = [
+        torch.ones(batch_size, device=device),
+        torch.zeros(batch_size, device=device, dtype=torch.int32),
+        torch.zeros(batch_size, device=device),
+        torch.zeros(batch_size, device=device),
+    ]
+    sample_fused(logits, *args)  # Compile the kernel before capturing
+    graph = torch.cuda.CUDAGraph()
+    with torch.cuda.graph(graph):
+        out = sample_fused(logits, *args)
+    outputs = []
+    for _ in range(2):
+        graph.replay()
+        outputs.append(out.clone())
+    assert not torch.equal(outputs[0], outputs[1])
@@ -0,0 +1,62 @@
+import pytest
+import torch
+from einops import rearrange
+from flash_attn.bert_padding import (
+    compute_unpad_plan,
+    index_first_axis,
+    pad_input,
+    pad_input_with_plan,
+    unpad_input,
+    unpad_input_with_plan,
+)
+
+from test_util import generate_random_padding_mask
+
+
+@pytest.mark.parametrize("device", ["cpu", "cuda"])
+@pytest.mark.parametrize("dtype", [torch.float32, torch.bfloat16])
+@pytest.mark.parametrize("max_total_tokens", [None, "exact", "bound"])
+def test_unpad_with_plan(max_total_tokens, dtype, device):
+    torch.random.manual_seed(0)
+    batch_size, seqlen, nheads, d = 9, 128, 3, 40
+    mask = generate_random_padding_mask(seqlen, batch_size, device, mode="random")
+    x = torch.randn(batch_size, seqlen, nheads, d, device=device, dtype=dtype, requires_grad=True)
+    x_unpad_ref, indices_ref, cu_seqlens_ref, max_seqlen_ref, seqused_ref = unpad_input(x, mask)
+    total = x_unpad_ref.shape[0]
+    if max_total_tokens == "exact":
+        max_total_tokens = total
+    elif max_total_tokens == "bound":
+        max_total_tokens = total + 17
+    plan = compute_unpad_plan(mask.cpu(), max_total_tokens=max_total_tokens).to(device)
+    x_unpad, indices, cu_seqlens, max_seqlen, seqused = unpad_input_with_plan(x, plan)
+    assert x_unpad.shape[0] == (max_total_tokens or batch_size * seqlen)
+    assert torch.equal(x_unpad[:total], x_unpad_ref)
+    assert torch.all(x_unpad[total:] == 0)
+    assert torch.equal(indices[:total], indices_ref)
+    assert torch.all(indices[total:] == -1)
+    assert torch.equal(cu_seqlens, cu_seqlens_ref)
+    assert torch.equal(seqused, seqused_ref)
+    assert max_seqlen == seqlen >= max_seqlen_ref
+
+    out = pad_input_with_plan(x_unpad * 2, plan, batch_size, seqlen)
+    out_ref = pad_input(x_unpad_ref * 2, indices_ref, batch_size, seqlen)
+    assert torch.equal(out, out_ref)
+    g = torch.randn_like(out)
+    (x_grad,) = torch.autograd.grad(out, x, g)
+    (x_grad_ref,) = torch.autograd.grad(out_ref, x, g)
+    assert torch.equal(x_grad, x_grad_ref)
+    assert torch.equal(x_grad, 2 * g * rearrange(mask, "b s -> b s 1 1"))
+
+
+@pytest.mark.parametrize("device", ["cpu", "cuda"])
+def test_index_first_axis(device):
+    torch.random.manual_seed(0)
+    x = torch.randn(1000, 7, 33, device=device, requires_grad=True)
+    indices = torch.randperm(1000, device=device)[:300]
+    out = index_first_axis(x, indices)
+    assert torch.equal(out, x[indices])
+    g = torch.randn_like(out)
+    (x_grad,) = torch.autograd.grad(out, x, g)
+    x_grad_ref = torch.zeros_like(x)
+    x_grad_ref[indices] = g
+    assert torch.equal(x_grad, x_grad_ref)
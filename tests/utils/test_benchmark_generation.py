@@ -0,0 +1,48 @@
+import json
+import math
+
+import pytest
+import torch
+from transformers import GPT2Config
+
+from flash_attn.models.gpt import GPTLMHeadModel
+from flash_attn.utils.benchmark_generation import (
+    load_trace,
+    make_trace,
+    replay_engine,
+    replay_static,
+    save_trace,
+)
+
+
+def test_make_trace(tmp_path):
+    trace = make_trace(1000, request_rate=50.0, prompt_len=(4, 16), output_len=8)
+    arrivals = [r.arrival_time for r in trace]
+    assert arrivals == sorted(arrivals)
+    # Poisson arrivals: mean inter-arrival time is 1 / rate
+    assert abs(arrivals[-1] / len(trace) - 1 / 50.0) < 0.003
+    assert all(4 <= r.prompt_len <= 16 and r.output_len == 8 for r in trace)
+    assert all(r.arrival_time == 0 for r in make_trace(4, request_rate=math.inf))
+    save_trace(trace, tmp_path / "trace.jsonl")
+    assert load_trace(tmp_path / "trace.jsonl") == trace
+
+
+@pytest.mark.parametrize("backend", ["engine", "static"])
+def test_replay(backend):
+    config = GPT2Config(n_embd=32, n_head=2, n_layer=2, vocab_size=64, n_positions=64)
+    torch.manual_seed(0)
+    model = GPTLMHeadModel(config).eval()
+    # decode_stream on CPU needs prompts of the same length in a batch
+    prompt_len = (3, 10) if backend == "engine" else 6
+    trace = make_trace(6, request_rate=200.0, prompt_len=prompt_len, output_len=(2, 5))
+    if backend == "engine":
+        results = replay_engine(model, trace, 2, 16, config.vocab_size)
+    else:
+        results = replay_static(model, trace, 2, config.vocab_size)
+    json.dumps(results)
+    assert results["num_requests"] == 6
+    assert results["num_output_tokens"] == sum(r.output_len for r in trace)
+    assert results["num_prompt_tokens"] == sum(r.prompt_len for r in trace)
+    assert results["ttft_ms"]["p50"] > 0 and results["itl_ms"]["p99"] >= results["itl_ms"]["p50"]
+    assert 0 < results["peak_kv_bytes"] <= results["kv_cache_bytes"]
+    assert results["output_tokens_per_s"] > 0
@@ -0,0 +1,79 @@
+import torch
+from transformers import GPT2Config
+
+from flash_attn.models.gpt import GPTLMHeadModel
+from flash_attn.utils.generation import get_batch_size_buckets, update_graph_cache
+
+
+def test_get_batch_size_buckets():
+    assert get_batch_size_buckets(1) == (1,)
+    assert get_batch_size_buckets(8) == (1, 2, 4, 8)
+    assert get_batch_size_buckets(6) == (1, 2, 4, 6)
+
+
+def test_graph_cache_buckets():
+    """Bucketing and padded dispatch of the CUDA graph cache, with a mock graph that runs on CPU."""
+    config = GPT2Config(n_embd=32, n_head=2, n_layer=2, vocab_size=64)
+    model = GPTLMHeadModel(config)
+    captured, replayed = [], []
+
+    def mock_capture(
+        model,
+        inference_params,
+        batch_size,
+        max_seqlen,
+        decoding_seqlen=1,
+        scratch_row=None,
+        **kwargs,
+    ):
+        captured.append((batch_size, decoding_seqlen))
+        # The scratch row is past the rows of the largest bucket
+        assert scratch_row == inference_params.max_batch_size - 1 >= batch_size
+
+        def run(input_ids, position_ids, seqlen, num_rows=None):
+            assert input_ids.shape == position_ids.shape == (batch_size, decoding_seqlen)
+            replayed.append((batch_size, num_rows))
+            return input_ids[:, -1:].float().expand(-1, config.vocab_size)
+
+        return run
+
+    kwargs = dict(batch_size_buckets=get_batch_size_buckets(8), capture_fn=mock_capture)
+    cache = update_graph_cache(model, None, 3, 4, 32, **kwargs)
+    # Largest bucket first, and the KV cache is allocated for the largest bucket plus the scratch row
+    assert captured == [(8, 1), (4, 1), (2, 1), (1, 1)]
+    assert cache.inference_params.key_value_memory_dict[0].shape[:2] == (9, 32)
+    input_ids = torch.arange(3).unsqueeze(1)
+    out = cache.run(input_ids, input_ids, 5)
+    assert replayed == [(4, 3)]
+    assert torch.equal(out, input_ids.float().expand(-1, config.vocab_size))
+    out = cache.run(input_ids[:1], input_ids[:1], torch.tensor([5]))
+    assert replayed == [(4, 3), (1, 1)] and out.shape == (1, config.vocab_size)
+    # Another batch size that fits: nothing to capture, same KV cache
+    kv_cache = cache.inference_params.key_value_memory_dict
+    cache = update_graph_cache(model, cache, 5, 4, 32, **kwargs)
+    assert len(captured) == 4 and cache.inference_params.key_value_memory_dict is kv_cache
+    # A new bucket is captured incrementally
+    cache = update_graph_cache(
+        model, cache, 6, 4, 32, batch_size_buckets=(6,), capture_fn=mock_capture
+    )
+    assert captured[4:] == [(6, 1)] and cache.batch_size_buckets == (1, 2, 4, 6, 8)
+    cache.run(torch.zeros(5, 1, dtype=torch.long), torch.zeros(5, 1, dtype=torch.long), 5)
+    assert replayed[-1] == (6, 5)
+    # A new decoding seqlen is captured for every bucket, not only the buckets of this call
+    cache = update_graph_cache(
+        model,
+        cache,
+        2,
+        4,
+        32,
+        decoding_seqlens=(2,),
+        batch_size_buckets=(2,),
+        capture_fn=mock_capture,
+    )
+    assert captured[5:] == [(8, 2), (6, 2), (4, 2), (2, 2), (1, 2)]
+    cache.run(torch.zeros(5, 2, dtype=torch.long), torch.zeros(5, 2, dtype=torch.long), 5)
+    assert replayed[-1] == (6, 5)
+    # A longer max_seqlen requires a new KV cache, so every graph is captured again
+    cache = update_graph_cache(model, cache, 3, 4, 64, **kwargs)
+    assert captured[10:] == [(8, 1), (4, 1), (2, 1), (1, 1)]
+    assert cache.inference_params.key_value_memory_dict[0].shape[:2] == (9, 64)
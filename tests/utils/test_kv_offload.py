@@ -0,0 +1,69 @@
+import pytest
+import torch
+
+from flash_attn.utils.kv_offload import TieredKVCache
+
+
+@pytest.mark.parametrize("dtype", [torch.float32, torch.bfloat16])
+@pytest.mark.parametrize("device", ["cpu", "cuda"])
+def test_tiered_kv_cache(device, dtype, tmp_path):
+    if device == "cuda" and not torch.cuda.is_available():
+        pytest.skip("requires CUDA")
+    num_layers, batch_size, max_seqlen, nheads, headdim = 2, 4, 32, 2, 8
+    torch.random.manual_seed(0)
+    kv_caches = {
+        i: torch.randn(batch_size, max_seqlen, 2, nheads, headdim, device=device, dtype=dtype)
+        for i in range(num_layers)
+    }
+    seqlens = [10, 20, 5, 30]
+    nbytes = [num_layers * s * 2 * nheads * headdim * dtype.itemsize for s in seqlens]
+    ref = {i: {l: kv[i, :s].clone() for l, kv in kv_caches.items()} for i, s in enumerate(seqlens)}
+    # Sequence 3 evicts sequences 0, 1 and 2 from host memory, and the disk only has room for
+    # sequences 1 and 2
+    cache = TieredKVCache(
+        host_max_bytes=nbytes[0] + nbytes[1],
+        disk_max_bytes=nbytes[1] + nbytes[2] + nbytes[2] // 2,
+        disk_dir=str(tmp_path),
+    )
+    for i, s in enumerate(seqlens):
+        cache.offload(f"seq{i}", kv_caches, slot=i, seqlen=s)
+    # Least recently used move from host to disk, and are dropped when the disk is full
+    assert [cache.tier(f"seq{i}") for i in range(4)] == [None, "disk", "disk", "host"]
+    assert cache.host_bytes == nbytes[3] and cache.disk_bytes == nbytes[1] + nbytes[2]
+    # The writes to disk are in the background
+    cache.flush()
+    assert len(list(tmp_path.iterdir())) == 2
+    for i in range(4):
+        cache.wait(f"seq{i}")
+    for kv in kv_caches.values():
+        kv.zero_()
+    # Prefetch into different rows than the ones the sequences were offloaded from
+    for seq_id, slot in [("seq1", 0), ("seq2", 1), ("seq3", 2)]:
+        seqlen = cache.prefetch(seq_id, kv_caches, slot)
+        cache.wait(seq_id)
+        assert seqlen == seqlens[int(seq_id[-1])]
+        for l, kv in kv_caches.items():
+            assert torch.equal(kv[slot, :seqlen], ref[int(seq_id[-1])][l])
+        assert cache.tier(seq_id) is None
+    assert cache.prefetch("seq0", kv_caches, 3) is None
+    assert cache.host_bytes == 0 and cache.disk_bytes == 0
+    assert len(list(tmp_path.iterdir())) == 0
+
+
+def test_tiered_kv_cache_prefetch_during_write(tmp_path):
+    num_layers, max_seqlen, nheads, headdim = 2, 64, 2, 8
+    torch.random.manual_seed(0)
+    kv_caches = {i: torch.randn(8, max_seqlen, 2, nheads, headdim) for i in range(num_layers)}
+    ref = {l: kv.clone() for l, kv in kv_caches.items()}
+    nbytes = num_layers * max_seqlen * 2 * nheads * headdim * 4
+    # Every offload evicts the previous sequence to disk
+    cache = TieredKVCache(host_max_bytes=nbytes, disk_max_bytes=8 * nbytes, disk_dir=str(tmp_path))
+    for i in range(8):
+        cache.offload(i, kv_caches, slot=i, seqlen=max_seqlen)
+    # Whether or not their write has started or finished, the sequences come back intact
+    for i in reversed(range(8)):
+        assert cache.prefetch(i, kv_caches, slot=7 - i) == max_seqlen
+        for l, kv in kv_caches.items():
+            assert torch.equal(kv[7 - i], ref[l][i])
+    cache.flush()
+    assert len(list(tmp_path.iterdir())) == 0
@@ -0,0 +1,127 @@
+import os
+
+import pytest
+import torch
+import torch.nn as nn
+from safetensors.torch import save_file
+from transformers import GPT2Config
+
+from flash_attn.models.gpt import GPTLMHeadModel
+from flash_attn.utils.pretrained import (
+    init_empty_weights,
+    load_converted_checkpoint,
+    load_state_dict_streaming,
+    mmap_safetensors,
+    save_converted_checkpoint,
+    state_dict_from_pretrained,
+)
+
+
+@pytest.mark.parametrize("dtype", [torch.float32, torch.float16, torch.bfloat16, torch.int64])
+def test_mmap_safetensors(tmp_path, dtype):
+    torch.manual_seed(0)
+    state_dict = {
+        "a": (torch.randn(7, 5) * 10).to(dtype),
+        "b": (torch.randn(3) * 10).to(dtype),
+        "scalar": torch.tensor(3).to(dtype),
+        "empty": torch.empty(0, 4, dtype=dtype),
+        "mask": torch.tensor([True, False, True]),
+    }
+    path = tmp_path / "model.safetensors"
+    save_file(state_dict, str(path))
+    loaded = mmap_safetensors(str(path))
+    assert loaded.keys() == state_dict.keys()
+    for k, v in state_dict.items():
+        assert loaded[k].dtype == v.dtype and torch.equal(loaded[k], v)
+    # Copy-on-write: writing to the tensors doesn't change the file
+    loaded["a"].zero_()
+    assert torch.equal(mmap_safetensors(str(path))["a"], state_dict["a"])
+
+
+@pytest.mark.parametrize("zipfile", [True, False])
+def test_state_dict_from_pretrained_mmap_bin(tmp_path, zipfile):
+    """.bin checkpoints are memory-mapped, and the legacy format, which can't be, is read."""
+    torch.manual_seed(0)
+    state_dict = {"a": torch.randn(7, 5), "b": torch.randn(3).half()}
+    torch.save(state_dict, tmp_path / "pytorch_model.bin", _use_new_zipfile_serialization=zipfile)
+    loaded = state_dict_from_pretrained(str(tmp_path), mmap=True)
+    assert loaded.keys() == state_dict.keys()
+    for k, v in state_dict.items():
+        assert loaded[k].dtype == v.dtype and torch.equal(loaded[k], v)
+
+
+def test_load_state_dict_streaming(tmp_path):
+    torch.manual_seed(0)
+    model_ref = nn.Sequential(nn.Linear(8, 16), nn.LayerNorm(16), nn.Linear(16, 4))
+    path = tmp_path / "model.safetensors"
+    save_file(model_ref.state_dict(), str(path))
+    model = nn.Sequential(nn.Linear(8, 16), nn.LayerNorm(16), nn.Linear(16, 4)).half()
+    state_dict = mmap_safetensors(str(path))
+    load_return = load_state_dict_streaming(model, state_dict)
+    assert load_return.missing_keys == [] and load_return.unexpected_keys == []
+    assert len(state_dict) == 0  # Every tensor was consumed
+    for p, p_ref in zip(model.parameters(), model_ref.parameters()):
+        assert p.dtype == torch.float16 and torch.equal(p, p_ref.half())
+
+    state_dict = mmap_safetensors(str(path))
+    del state_dict["2.bias"]
+    state_dict["extra"] = torch.zeros(1)
+    with pytest.raises(RuntimeError):
+        load_state_dict_streaming(model, dict(state_dict))
+    load_return = load_state_dict_streaming(model, state_dict, strict=False)
+    assert load_return.missing_keys == ["2.bias"] and load_return.unexpected_keys == ["extra"]
+    state_dict = mmap_safetensors(str(path))
+    state_dict["0.weight"] = state_dict["0.weight"][:4]
+    with pytest.raises(RuntimeError):
+        load_state_dict_streaming(model, state_dict)
+
+
+def test_converted_checkpoint_cache(tmp_path):
+    model_dir = tmp_path / "model"
+    model_dir.mkdir()
+    weight = torch.randn(8, 4)
+    save_file({"weight": weight}, str(model_dir / "model.safetensors"))
+    model_name, cache_dir = str(model_dir), str(tmp_path / "cache")
+    config = GPT2Config(n_embd=32, n_head=2, n_layer=2, vocab_size=64)
+    args = (cache_dir, model_name, config, torch.float16)
+    assert load_converted_checkpoint(*args, world_size=2, rank=1) is None
+    # Tied weights are saved as separate tensors
+    converted = {"a.weight": weight[4:] * 2, "b.weight": weight[4:] * 2}
+    converted["c.weight"] = converted["a.weight"]
+    saved = save_converted_checkpoint(converted, *args, world_size=2, rank=1)
+    loaded = load_converted_checkpoint(*args, world_size=2, rank=1)
+    for state_dict in [saved, loaded]:
+        assert state_dict.keys() == converted.keys()
+        for k, v in converted.items():
+            assert state_dict[k].dtype == torch.float16 and torch.equal(state_dict[k], v.half())
+    # Any change of the key misses the cache
+    assert load_converted_checkpoint(*args, world_size=2, rank=0) is None
+    assert load_converted_checkpoint(*args, world_size=4, rank=1) is None
+    assert load_converted_checkpoint(*args[:3], torch.bfloat16, world_size=2, rank=1) is None
+    config_other = GPT2Config(n_embd=32, n_head=4, n_layer=2, vocab_size=64)
+    assert load_converted_checkpoint(*args[:2], config_other, torch.float16, 2, 1) is None
+    stat = os.stat(model_dir / "model.safetensors")
+    os.utime(model_dir / "model.safetensors", ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert load_converted_checkpoint(*args, world_size=2, rank=1) is None
+
+
+def test_init_empty_weights():
+    config = GPT2Config(n_embd=32, n_head=2, n_layer=2, vocab_size=64, rotary_emb_fraction=0.5)
+    torch.manual_seed(0)
+    model_ref = GPTLMHeadModel(config).eval()
+    with init_empty_weights():
+        model = GPTLMHeadModel(config, dtype=torch.float16).eval()
+    assert all(p.is_meta and p.dtype == torch.float16 for p in model.parameters())
+    # Buffers are created as usual
+    inv_freq = model.transformer.layers[0].mixer.rotary_emb.inv_freq
+    assert torch.equal(inv_freq, model_ref.transformer.layers[0].mixer.rotary_emb.inv_freq)
+    # Attributes of the parameters are kept
+    assert model.transformer.layers[0].mixer.Wqkv.weight._optim == {"lr_multiplier": 1.0}
+
+    load_return = load_state_dict_streaming(model, dict(model_ref.state_dict()), device="cpu")
+    assert load_return.missing_keys == [] and load_return.unexpected_keys == []
+    assert not any(p.is_meta for p in model.parameters())
+    assert model.lm_head.weight is model.transformer.embeddings.word_embeddings.weight
+    assert model.transformer.layers[0].mixer.Wqkv.weight._optim == {"lr_multiplier": 1.0}
+    for (name, p), p_ref in zip(model.named_parameters(), model_ref.parameters()):
+        assert p.dtype == torch.float16 and torch.equal(p, p_ref.half()), name
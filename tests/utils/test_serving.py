@@ -0,0 +1,99 @@
+import asyncio
+
+import pytest
+import torch
+from transformers import GPT2Config
+
+from flash_attn.models.gpt import GPTLMHeadModel
+from flash_attn.utils.serving import ServingEngine
+
+
+def greedy_ref(model, input_ids, max_new_tokens):
+    """Greedy decoding without KV cache."""
+    output_ids = input_ids[None]
+    with torch.inference_mode():
+        for _ in range(max_new_tokens):
+            next_token = model(output_ids).logits[:, -1].argmax(dim=-1, keepdim=True)
+            output_ids = torch.cat([output_ids, next_token], dim=1)
+    return output_ids[0, input_ids.shape[0] :].tolist()
+
+
+def test_serving_engine():
+    """End to end on CPU: more requests than rows of the KV cache, streaming, priorities and
+    cancellation."""
+    config = GPT2Config(n_embd=32, n_head=2, n_layer=2, vocab_size=64, n_positions=64)
+    torch.manual_seed(0)
+    model = GPTLMHeadModel(config).eval()
+    prompts = [torch.randint(0, config.vocab_size, (seqlen,)) for seqlen in [5, 9, 3, 12, 7]]
+    max_new_tokens = [6, 4, 8, 5, 3]
+    expected = [greedy_ref(model, p, n) for p, n in zip(prompts, max_new_tokens)]
+
+    async def client():
+        async with ServingEngine(model, max_batch_size=2, max_seqlen=32) as engine:
+            handles = [
+                engine.submit(p, max_new_tokens=n) for p, n in zip(prompts, max_new_tokens)
+            ]
+            streamed = [token async for token in handles[0]]
+            results = await asyncio.gather(*[h.result() for h in handles])
+            assert streamed == results[0]
+            assert results == expected
+            assert engine.reserved_bytes == 0 and len(engine.free_slots) == 2
+
+        # Strict priority with a single row: the urgent request is served first
+        async with ServingEngine(model, max_batch_size=1, max_seqlen=32) as engine:
+            done = []
+            low = engine.submit(prompts[0], priority=1, max_new_tokens=4)
+            high = engine.submit(prompts[1], priority=0, max_new_tokens=4)
+            cancelled = engine.submit(prompts[2], priority=2, max_new_tokens=4)
+            cancelled.cancel()
+            for handle in [low, high]:
+                handle._future.add_done_callback(lambda _, h=handle: done.append(h))
+            await asyncio.gather(low.result(), high.result())
+            assert done == [high, low]
+            try:
+                await cancelled.result()
+                assert False, "Cancelled request returned a result"
+            except asyncio.CancelledError:
+                pass
+            assert [token async for token in cancelled] == []
+
+        # KV memory budget of a single request: requests run one at a time
+        bytes_per_request = (prompts[3].shape[0] + 5) * engine.bytes_per_token
+        async with ServingEngine(
+            model, max_batch_size=2, max_seqlen=32, kv_cache_bytes=bytes_per_request
+        ) as engine:
+            handles = [engine.submit(p, max_new_tokens=3) for p in prompts[:3]]
+            results = await asyncio.gather(*[h.result() for h in handles])
+            assert results == [e[:3] for e in expected[:3]]
+
+    asyncio.run(client())
+
+
+def test_serving_engine_error():
+    """An error in the engine fails the pending requests, and is raised again by stop()."""
+    config = GPT2Config(n_embd=32, n_head=2, n_layer=2, vocab_size=64, n_positions=64)
+    torch.manual_seed(0)
+    model = GPTLMHeadModel(config).eval()
+    prompt = torch.randint(0, config.vocab_size, (5,))
+
+    async def client():
+        engine = ServingEngine(model, max_batch_size=1, max_seqlen=32)
+        await engine.start()
+
+        def step(prefill, decode):
+            raise torch.cuda.OutOfMemoryError("CUDA out of memory")
+
+        engine._step = step
+        running = engine.submit(prompt, max_new_tokens=4)
+        waiting = engine.submit(prompt, max_new_tokens=4)
+        for handle in [running, waiting]:
+            with pytest.raises(torch.cuda.OutOfMemoryError):
+                await handle.result()
+            assert [token async for token in handle] == []
+        with pytest.raises(RuntimeError, match="stopped"):
+            engine.submit(prompt)
+        with pytest.raises(torch.cuda.OutOfMemoryError):
+            await engine.stop()
+        assert engine.reserved_bytes == 0 and engine.free_slots == [0]
+
+    asyncio.run(client())
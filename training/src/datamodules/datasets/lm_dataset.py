@@ -1,16 +1,29 @@
 # Inspired by https://github.com/NVIDIA/Megatron-LM/blob/main/tasks/zeroshot_gpt/datasets.py
 # Except we don't pad the last block and don't use overlapping eval
 # And we return both the input and the target
+import bisect
 import math
 import numpy as np
 
 import torch
 
 
+# Token dtypes that batched LMDataset reads as is, and the torch dtype of the same size they are
+# stored in (torch has little support for uint16)
+_BATCHED_TOKEN_DTYPES = {np.dtype(np.uint16): torch.int16, np.dtype(np.int32): torch.int32}
+
+
 class LMDataset(torch.utils.data.Dataset):
 
-    def __init__(self, tokens, seq_len, drop_last=True):
+    def __init__(self, tokens, seq_len, drop_last=True, batched=False, pin_memory=False):
         """tokens should be a numpy array
+        If batched, __getitems__ reads each batch with a single np.take into a tensor of the token
+        dtype (to be widened on device with widen_tokens, see
+        LMDataModule.transfer_batch_to_device), and the batches have to be collated with
+        lm_collate_fn. Otherwise the samples are read one at a time, as int64.
+        If pin_memory (requires batched), the batches are read directly into pinned memory. This
+        should only be set when the dataset is read from the main process (e.g. by
+        PrefetchDataLoader), not from DataLoader worker processes.
         """
         self.seq_len = seq_len
         ntokens = len(tokens)
@@ -21,6 +34,12 @@ class LMDataset(torch.utils.data.Dataset):
         # and slicing would load it to memory.
         self.tokens = tokens
         self.total_sequences = math.ceil((self.ntokens - 1) / self.seq_len)
+        if batched:
+            assert np.dtype(tokens.dtype) in _BATCHED_TOKEN_DTYPES, \
+                f'Batched reads only support tokens of dtype uint16 or int32, not {tokens.dtype}'
+        assert batched or not pin_memory, 'pin_memory requires batched'
+        self.batched = batched
+        self.pin_memory = pin_memory
 
     def __len__(self):
         return self.total_sequences
@@ -30,3 +49,136 @@ class LMDataset(torch.utils.data.Dataset):
         seq_len = min(self.seq_len, self.ntokens - 1 - start_idx)
         data = torch.as_tensor(self.tokens[start_idx:(start_idx + seq_len + 1)].astype(np.int64))
         return data[:-1], data[1:].clone()
+
+    def __getitems__(self, indices):
+        """Called by the DataLoader instead of __getitem__ for each index of a batch.
+        If batched, the rows of the batch are read with a single np.take into one
+        (batch, seq_len + 1) tensor of the token dtype, and the inputs and targets are views of it.
+        """
+        starts = np.asarray(indices, dtype=np.int64) * self.seq_len
+        if (not self.batched or len(starts) == 0
+                or starts.max() + self.seq_len + 1 > self.ntokens):
+            # Not batched, or the last sequence is shorter (drop_last=False)
+            return [self[idx] for idx in indices]
+        torch_dtype = _BATCHED_TOKEN_DTYPES[np.dtype(self.tokens.dtype)]
+        data = torch.empty(len(starts), self.seq_len + 1, dtype=torch_dtype,
+                           pin_memory=self.pin_memory)
+        # The indices are in bounds, and with mode='raise' np.take would write to a temporary
+        # buffer before copying to out
+        np.take(self.tokens, starts[:, None] + np.arange(self.seq_len + 1),
+                out=data.numpy().view(self.tokens.dtype), mode='clip')
+        return data[:, :-1], data[:, 1:]
+
+
+def widen_tokens(tokens):
+    """Convert the token ids of a batch read by batched LMDataset to int64."""
+    # uint16 token ids are stored as int16
+    return tokens.long() & 0xFFFF if tokens.dtype == torch.int16 else tokens.long()
+
+
+def lm_collate_fn(batch):
+    """batch is either a list of (x, y) samples (from LMDataset.__getitem__), or a (x, y) batch
+    already read by batched LMDataset.__getitems__.
+    """
+    return batch if isinstance(batch, tuple) else torch.utils.data.default_collate(batch)
+
+
+def best_fit_pack(lengths, capacity):
+    """Best-fit decreasing bin packing: put each item (longest first) in the bin with the least
+    remaining space that still fits it, or in a new bin.
+    lengths: integer numpy array, each <= capacity.
+    Return: a list of bins, each a list of indices into lengths.
+    """
+    # The remaining capacities take at most capacity + 1 distinct values, so we keep the bins
+    # bucketed by remaining capacity, with a sorted list of the non-empty buckets.
+    buckets = {}  # remaining capacity -> list of bin ids
+    caps = []  # sorted remaining capacities with at least one bin
+    bins = []
+    for i in np.argsort(-np.asarray(lengths), kind='stable'):
+        length = int(lengths[i])
+        j = bisect.bisect_left(caps, length)
+        if j < len(caps):
+            cap = caps[j]
+            b = buckets[cap].pop()
+            if not buckets[cap]:
+                del buckets[cap]
+                caps.pop(j)
+        else:
+            cap, b = capacity, len(bins)
+            bins.append([])
+        bins[b].append(i)
+        new_cap = cap - length
+        if new_cap not in buckets:
+            buckets[new_cap] = []
+            bisect.insort(caps, new_cap)
+        buckets[new_cap].append(b)
+    return bins
+
+
+class PackedLMDataset(torch.utils.data.Dataset):
+
+    def __init__(self, tokens, doc_offsets, seq_len):
+        """Each sample is a set of whole documents, packed to fill seq_len tokens with as little
+        padding as possible. Documents longer than seq_len + 1 tokens are split into pieces of
+        seq_len + 1 tokens (overlapping by 1 token, as in LMDataset).
+        tokens: numpy array, all the documents concatenated.
+        doc_offsets: numpy array (num_docs + 1,), the start of each document in tokens, and
+            len(tokens) at the end.
+        """
+        self.seq_len = seq_len
+        self.tokens = tokens
+        doc_offsets = np.asarray(doc_offsets, dtype=np.int64)
+        starts, lens = [], []
+        for doc_start, doc_end in zip(doc_offsets[:-1], doc_offsets[1:]):
+            # A piece of n tokens has n - 1 (input, target) pairs
+            for start in range(doc_start, doc_end - 1, seq_len):
+                starts.append(start)
+                lens.append(min(seq_len + 1, doc_end - start))
+        self.piece_starts = np.array(starts, dtype=np.int64)
+        self.piece_lens = np.array(lens, dtype=np.int64)
+        bins = best_fit_pack(self.piece_lens - 1, seq_len)
+        self.pieces = np.array([i for b in bins for i in b], dtype=np.int64)
+        self.sample_offsets = np.cumsum([0] + [len(b) for b in bins])
+
+    def __len__(self):
+        return len(self.sample_offsets) - 1
+
+    def __getitem__(self, idx):
+        """Return the inputs and targets (padded to seq_len, the targets with -100), and the
+        lengths of the documents in the sample."""
+        pieces = self.pieces[self.sample_offsets[idx]:self.sample_offsets[idx + 1]]
+        data = [torch.as_tensor(self.tokens[start:start + n].astype(np.int64))
+                for start, n in zip(self.piece_starts[pieces], self.piece_lens[pieces])]
+        seqlens = torch.tensor([len(d) - 1 for d in data], dtype=torch.int32)
+        total = seqlens.sum().item()
+        x = torch.zeros(self.seq_len, dtype=torch.long)
+        y = torch.full((self.seq_len,), -100, dtype=torch.long)
+        x[:total] = torch.cat([d[:-1] for d in data])
+        y[:total] = torch.cat([d[1:] for d in data])
+        return x, y, seqlens
+
+
+def packed_collate_fn(batch):
+    """Collate the samples of PackedLMDataset into (x, y, kwargs), where kwargs has the
+    position_ids, cu_seqlens and max_seqlen of the documents in the flattened (batch * seq_len)
+    tokens. The padding at the end of each sample is treated as one more sequence (with targets
+    -100).
+    """
+    xs, ys, seqlens = zip(*batch)
+    seq_len = xs[0].shape[0]
+    all_seqlens = []
+    for s in seqlens:
+        all_seqlens.append(s)
+        if s.sum() < seq_len:
+            all_seqlens.append(torch.tensor([seq_len - s.sum()], dtype=torch.int32))
+    all_seqlens = torch.cat(all_seqlens)
+    cu_seqlens = torch.cumsum(all_seqlens, dim=0, dtype=torch.int32)
+    cu_seqlens = torch.nn.functional.pad(cu_seqlens, (1, 0))
+    starts = torch.repeat_interleave(cu_seqlens[:-1], all_seqlens)
+    position_ids = torch.arange(len(xs) * seq_len, dtype=torch.long) - starts
+    kwargs = {
+        'position_ids': position_ids.reshape(len(xs), seq_len),
+        'cu_seqlens': cu_seqlens,
+        'max_seqlen': int(all_seqlens.max()),
+    }
+    return torch.stack(xs), torch.stack(ys), kwargs
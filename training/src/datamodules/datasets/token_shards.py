@@ -0,0 +1,199 @@
+# Tokenize a dataset into a directory of token shards, in parallel and out-of-core.
+# Each input shard is tokenized by one process, which streams the token ids to its own file, along
+# with the lengths of its documents. A manifest records the finished shards, so an interrupted build
+# resumes where it stopped, and new data can be appended to an existing directory. The shards are
+# then memory-mapped and concatenated without copying (ConcatArray), to be used by LMDataset.
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+from src.utils.utils import get_logger
+
+logger = get_logger()
+
+MANIFEST_NAME = 'manifest.json'
+
+
+class ConcatArray:
+    """Read-only 1D concatenation of numpy arrays (e.g. memmaps), without copying them.
+    Slices within one array are views; slices across arrays and integer-array indexing are copies.
+    """
+
+    def __init__(self, arrays):
+        self.arrays = [a for a in arrays if len(a) > 0]
+        assert len(set(a.dtype for a in self.arrays)) <= 1, 'All arrays must have the same dtype'
+        self.dtype = self.arrays[0].dtype if self.arrays else np.dtype(np.uint16)
+        lengths = [len(a) for a in self.arrays]
+        self.offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    @property
+    def shape(self):
+        return (len(self),)
+
+    def _array_idx(self, idx):
+        return np.searchsorted(self.offsets, idx, side='right') - 1
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            assert step == 1, 'Only contiguous slices are supported'
+            if stop <= start:
+                return np.empty(0, dtype=self.dtype)
+            first, last = self._array_idx(start), self._array_idx(stop - 1)
+            pieces = [self.arrays[i][max(start - self.offsets[i], 0):stop - self.offsets[i]]
+                      for i in range(first, last + 1)]
+            return pieces[0] if len(pieces) == 1 else np.concatenate(pieces)
+        if isinstance(key, (int, np.integer)):
+            if key < 0:
+                key += len(self)
+            if not 0 <= key < len(self):
+                raise IndexError(f'index {key} is out of bounds for size {len(self)}')
+            i = self._array_idx(key)
+            return self.arrays[i][key - self.offsets[i]]
+        return self.take(key)
+
+    def take(self, indices, axis=None, out=None, mode='raise'):
+        """Integer-array indexing, as np.take (which calls this method), e.g. to read a batch of
+        sequences straight into a preallocated out.
+        """
+        assert axis in (None, 0), 'ConcatArray is 1D'
+        indices = np.asarray(indices)
+        if mode == 'clip':
+            indices = np.clip(indices, 0, len(self) - 1)
+        elif mode == 'wrap':
+            indices = indices % len(self)
+        else:
+            assert indices.size == 0 or (indices.min() >= 0 and indices.max() < len(self)), \
+                'index out of bounds'
+        if out is None:
+            out = np.empty(indices.shape, dtype=self.dtype)
+        assert out.shape == indices.shape, 'out must have the shape of indices'
+        array_idx = self._array_idx(indices)
+        for i in np.unique(array_idx):
+            mask = array_idx == i
+            out[mask] = self.arrays[i][indices[mask] - self.offsets[i]]
+        return out
+
+
+def _read_manifest(out_dir):
+    path = Path(out_dir) / MANIFEST_NAME
+    if not path.is_file():
+        return {'splits': {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_manifest(out_dir, manifest):
+    # Write then rename, so that a crash never leaves a truncated manifest
+    path = Path(out_dir) / MANIFEST_NAME
+    tmp_path = path.with_suffix('.json.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _tokenize_shard(dataset, num_shards, index, tokenizer, text_column, add_eos, dtype, out_dir,
+                    name, batch_size=1000):
+    """Tokenize the index-th of num_shards contiguous shards of dataset, writing the token ids to
+    {name}.bin and the lengths of the non-empty documents to {name}.lens.npy in out_dir.
+    """
+    shard = dataset.shard(num_shards, index, contiguous=True)
+    tokens_path, lens_path = Path(out_dir) / f'{name}.bin', Path(out_dir) / f'{name}.lens.npy'
+    tmp_path = Path(out_dir) / f'{name}.bin.tmp'
+    doc_lens = []
+    with open(tmp_path, 'wb') as f:
+        for start in range(0, len(shard), batch_size):
+            texts = shard[start:start + batch_size][text_column]
+            if add_eos:
+                texts = [(text + tokenizer.eos_token) if text else text for text in texts]
+            for ids in tokenizer(texts)['input_ids']:
+                if len(ids) > 0:
+                    f.write(np.asarray(ids, dtype=dtype).tobytes())
+                    doc_lens.append(len(ids))
+    doc_lens = np.asarray(doc_lens, dtype=np.int64)
+    np.save(lens_path, doc_lens)
+    # Rename at the end, so that a crash never leaves a partial {name}.bin
+    os.replace(tmp_path, tokens_path)
+    return {'name': name, 'index': index, 'num_tokens': int(doc_lens.sum()),
+            'num_docs': len(doc_lens)}
+
+
+def build_token_shards(dataset, tokenizer, out_dir, split, num_shards, num_proc=1,
+                       text_column='text', add_eos=True, dtype=np.uint16, source=None):
+    """Tokenize a HF dataset into token shards in out_dir, with num_proc processes.
+    The build can be interrupted and resumed: the shards already recorded in the manifest are
+    skipped. Calling this again with a different source (by default, the dataset's fingerprint)
+    appends its shards to the split, after the existing ones.
+    Return: the list of shard records of the split, in order.
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    source = source if source is not None else dataset._fingerprint
+    manifest = _read_manifest(out_dir)
+    manifest.setdefault('dtype', np.dtype(dtype).name)
+    assert manifest['dtype'] == np.dtype(dtype).name, 'All shards must have the same dtype'
+    split_info = manifest['splits'].setdefault(split, {'sources': {}, 'shards': []})
+    if source in split_info['sources']:
+        assert split_info['sources'][source] == num_shards, \
+            f'{split} was started with {split_info["sources"][source]} shards, not {num_shards}'
+    else:
+        split_info['sources'][source] = num_shards
+        _write_manifest(out_dir, manifest)
+    source_idx = list(split_info['sources']).index(source)
+    done = {s['index'] for s in split_info['shards'] if s['source'] == source}
+    todo = [i for i in range(num_shards) if i not in done]
+    if done:
+        logger.info(f'{split}: {len(done)}/{num_shards} shards of {source} already tokenized')
+    args = [(dataset, num_shards, i, tokenizer, text_column, add_eos, dtype, out_dir,
+             f'{split}-{source_idx:03d}-{i:05d}') for i in todo]
+    with ProcessPoolExecutor(max_workers=max(num_proc, 1)) as executor:
+        futures = [executor.submit(_tokenize_shard, *a) for a in args]
+        for future in as_completed(futures):
+            record = future.result()
+            record['source'] = source
+            split_info['shards'].append(record)
+            # Record each shard as soon as it's done, so that a crash only loses the shards
+            # being processed
+            _write_manifest(out_dir, manifest)
+    return _sorted_shards(split_info)
+
+
+def _sorted_shards(split_info):
+    sources = list(split_info['sources'])
+    return sorted(split_info['shards'], key=lambda s: (sources.index(s['source']), s['index']))
+
+
+def token_shards_complete(out_dir, splits):
+    """Whether all the shards of all the sources of the splits are in the manifest."""
+    manifest = _read_manifest(out_dir)
+    for split in splits:
+        split_info = manifest['splits'].get(split)
+        if split_info is None:
+            return False
+        for source, num_shards in split_info['sources'].items():
+            if sum(s['source'] == source for s in split_info['shards']) != num_shards:
+                return False
+    return True
+
+
+def load_token_shards(out_dir, split):
+    """Memory-map the token shards of a split.
+    Return: tokens (ConcatArray), doc_offsets (numpy array (num_docs + 1,), the start of each
+        document in tokens, and len(tokens) at the end).
+    """
+    out_dir = Path(out_dir)
+    manifest = _read_manifest(out_dir)
+    dtype = np.dtype(manifest['dtype'])
+    shards = _sorted_shards(manifest['splits'][split])
+    arrays = [np.memmap(out_dir / f'{s["name"]}.bin', dtype=dtype, mode='r')
+              for s in shards if s['num_tokens'] > 0]
+    doc_lens = [np.load(out_dir / f'{s["name"]}.lens.npy') for s in shards]
+    doc_lens = np.concatenate(doc_lens) if doc_lens else np.zeros(0, dtype=np.int64)
+    doc_offsets = np.concatenate([[0], np.cumsum(doc_lens)]).astype(np.int64)
+    return ConcatArray(arrays), doc_offsets
@@ -1,5 +1,6 @@
 # Adapted from https://github.com/huggingface/transformers/blob/master/examples/pytorch/language-modeling/run_clm.py
 from itertools import chain
+import math
 from pathlib import Path
 import pickle
 from typing import Any, List, Union
@@ -17,13 +18,20 @@ from datasets import load_dataset
 
 from pytorch_lightning import LightningDataModule
 
-from src.datamodules.datasets.lm_dataset import LMDataset
+from src.datamodules.datasets.lm_dataset import LMDataset, PackedLMDataset
+from src.datamodules.datasets.lm_dataset import lm_collate_fn, packed_collate_fn, widen_tokens
+from src.datamodules.datasets.token_shards import build_token_shards, load_token_shards
+from src.datamodules.datasets.token_shards import token_shards_complete
+from src.datamodules.prefetch_dataloader import PrefetchDataLoader
 from src.datamodules.fault_tolerant_sampler import RandomFaultTolerantSampler
 from src.datamodules.fault_tolerant_sampler import FaultTolerantDistributedSampler
 from src.datamodules.datasets.detokenizer import DATASET_TOKENIZATION_REGISTRY
 from src.utils.utils import get_logger
 logger = get_logger()
 
+# Number of examples per shard when tokenizing into token shards (sharded_cache)
+TOKENIZE_SHARD_SIZE = 10000
+
 
 # https://github.com/numpy/numpy/issues/18294
 class SHMArray(np.ndarray): #copied from https://numpy.org/doc/stable/user/basics.subclassing.html#slightly-more-realistic-example-attribute-added-to-existing-array
@@ -44,7 +52,18 @@ class LMDataModule(LightningDataModule):
                  detokenize=False, val_only=False, batch_size=32, batch_size_eval=None, num_workers=1,
                  shuffle=False, pin_memory=False, drop_last=False, fault_tolerant=False, ddp=False,
                  fast_forward_epochs=None, fast_forward_batches=None,
-                 use_shmem=True):
+                 use_shmem=True, pack_sequences=False, prefetch_batches=0, sharded_cache=False):
+        """If pack_sequences, each sample is made of whole documents (documents longer than
+        max_length are split), packed with best-fit bin packing, and the batches come with
+        position_ids, cu_seqlens and max_seqlen so that attention doesn't cross document
+        boundaries (requires a model that takes these, e.g. GPTLMHeadModel with use_flash_attn).
+        If prefetch_batches > 0 (and not pack_sequences), the batches are loaded by a background
+        thread of the main process instead of a worker process, keeping up to prefetch_batches
+        batches ready, and with pin_memory they are read directly into pinned memory.
+        If sharded_cache, the dataset is tokenized by num_workers processes into token shards in
+        cache_dir, streamed to disk (so it doesn't need to fit in memory) and resumable if
+        interrupted, and the splits are memory-mapped views of the shards (use_shmem is ignored).
+        """
         super().__init__()
         self.dataset_name = dataset_name
         self.dataset_config_name = dataset_config_name
@@ -76,6 +95,11 @@ class LMDataModule(LightningDataModule):
         self.use_shmem = use_shmem
         if self.use_shmem:
             assert cache_dir is not None
+        self.sharded_cache = sharded_cache
+        if self.sharded_cache:
+            assert cache_dir is not None
+        self.pack_sequences = pack_sequences
+        self.prefetch_batches = prefetch_batches
 
     def prepare_data(self):
         if self.cache_dir is None:  # Just download the dataset
@@ -86,18 +110,29 @@ class LMDataModule(LightningDataModule):
     def setup(self, stage=None):
         if stage == 'test' and hasattr(self, 'dataset_test'):
             return
-        concat_ids, self.tokenizer = self.process_dataset()
+        concat_ids, self.tokenizer, doc_offsets = self.process_dataset()
         self.vocab_size = len(self.tokenizer)
         # Create all splits
-        self.dataset_train, self.dataset_val, self.dataset_test = [
-            LMDataset(concat_ids[split], seq_len=self.max_length)
-            for split in ['train', 'validation', 'test']
-        ]
+        if not self.pack_sequences:
+            self.dataset_train, self.dataset_val, self.dataset_test = [
+                LMDataset(concat_ids[split], seq_len=self.max_length,
+                          batched=self.prefetch_batches > 0,
+                          pin_memory=self.pin_memory and self.prefetch_batches > 0)
+                for split in ['train', 'validation', 'test']
+            ]
+        else:
+            self.dataset_train, self.dataset_val, self.dataset_test = [
+                PackedLMDataset(concat_ids[split], doc_offsets[split], seq_len=self.max_length)
+                for split in ['train', 'validation', 'test']
+            ]
 
     def process_dataset(self):
         cache_dir = None if self.cache_dir is None else self.cache_dir / self._cache_dir_name
         if cache_dir is not None:
-            if cache_dir.is_dir():
+            if self.sharded_cache:
+                if token_shards_complete(cache_dir, ['train', 'validation', 'test']):
+                    return self._load_from_shards(cache_dir)
+            elif cache_dir.is_dir():
                 return self._load_from_cache(cache_dir)
 
         raw_datasets = load_dataset(self.dataset_name, self.dataset_config_name)
@@ -132,6 +167,22 @@ class LMDataModule(LightningDataModule):
         # First we tokenize all the texts.
         column_names = raw_datasets["train"].column_names
         text_column_name = "text" if "text" in column_names else column_names[0]
+        dtype = np.uint16 if tokenizer.vocab_size < 64 * 1024 else np.int32
+        if self.sharded_cache:
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            with open(cache_dir / 'tokenizer.pkl', 'wb') as f:
+                pickle.dump(tokenizer, f)
+            # Tokenize straight from the raw datasets, skipping the shards done by a previous run.
+            # The source is the split name rather than the dataset's fingerprint, which can change
+            # between runs (e.g. a non-deterministic fingerprint): resuming must never append the
+            # same data again. Appending new data is an explicit call to build_token_shards.
+            for name, ds in raw_datasets.items():
+                build_token_shards(ds, tokenizer, cache_dir, name,
+                                   num_shards=max(math.ceil(len(ds) / TOKENIZE_SHARD_SIZE), 1),
+                                   num_proc=max(self.num_workers, 1),
+                                   text_column=text_column_name, add_eos=self.add_eos,
+                                   dtype=dtype, source=name)
+            return self._load_from_shards(cache_dir)
         # [2021-12-25] TD: For wikitext, don't need to add the EOS since each example already ends
         # with '\n', and there are no other '\n' in the examples.
         # assert all([t.count('\n') == 1 for t in raw_datasets['train']['text'] if t])
@@ -151,12 +202,14 @@ class LMDataModule(LightningDataModule):
         #     remove_columns=column_names,
         #     desc="Running tokenizer on dataset",
         # )
-        dtype = np.uint16 if tokenizer.vocab_size < 64 * 1024 else np.int32
         def tokenize_concat(examples):
             # We just need 'input_ids', not 'attention_mask' (since it's all 1)
-            input_ids = np.fromiter(chain(*tokenize(examples)['input_ids']), dtype=dtype)
+            tokenized = tokenize(examples)['input_ids']
+            input_ids = np.fromiter(chain(*tokenized), dtype=dtype)
+            # The document lengths, to pack whole documents
+            doc_lens = np.array([len(ids) for ids in tokenized], dtype=np.int64)
             # Need to return a list since we're doing batched processing
-            return {'input_ids': [input_ids], 'len': [len(input_ids)]}
+            return {'input_ids': [input_ids], 'len': [len(input_ids)], 'doc_lens': [doc_lens]}
         tokenized_datasets = raw_datasets.map(
             tokenize_concat,
             batched=True,
@@ -222,18 +275,30 @@ class LMDataModule(LightningDataModule):
                 )
                 concat_ids[name] = np.memmap(filename, dtype=dtype, mode='r', shape=(array_len,))
 
+        doc_offsets = None
+        if self.pack_sequences:
+            # Start of each (non-empty) document in concat_ids, and the total length at the end
+            doc_offsets = {}
+            for name, ds in tokenized_datasets.items():
+                doc_lens = np.concatenate([np.asarray(l, dtype=np.int64) for l in ds['doc_lens']])
+                doc_lens = doc_lens[doc_lens > 0]
+                doc_offsets[name] = np.concatenate([[0], np.cumsum(doc_lens)])
+
         if cache_dir is not None:
-            self._save_to_cache(concat_ids, tokenizer, cache_dir)
+            self._save_to_cache(concat_ids, tokenizer, cache_dir, doc_offsets=doc_offsets)
             if not self.use_shmem:
                 for name in concat_ids:
                     Path(cache_dir / f'{name}.bin').unlink()
-        return concat_ids, tokenizer
+        return concat_ids, tokenizer, doc_offsets
 
-    def _save_to_cache(self, concat_ids, tokenizer, cache_dir):
+    def _save_to_cache(self, concat_ids, tokenizer, cache_dir, doc_offsets=None):
         cache_dir.mkdir(parents=True, exist_ok=True)
         logger.info(f'Saving to cache at {str(cache_dir)}')
         for k, v in concat_ids.items():
             np.save(cache_dir / f'{k}.npy', v)
+        if doc_offsets is not None:
+            for k, v in doc_offsets.items():
+                np.save(cache_dir / f'{k}_doc_offsets.npy', v)
         with open(cache_dir / 'tokenizer.pkl', 'wb') as f:
             pickle.dump(tokenizer, f)
 
@@ -242,13 +307,30 @@ class LMDataModule(LightningDataModule):
         logger.info(f'Load from cache at {str(cache_dir)}')
         concat_ids = {split: np.load(cache_dir / f'{split}.npy', mmap_mode='r')
                       for split in ['train', 'validation', 'test']}
+        doc_offsets = None
+        if self.pack_sequences:
+            doc_offsets = {split: np.load(cache_dir / f'{split}_doc_offsets.npy')
+                           for split in ['train', 'validation', 'test']}
+        with open(cache_dir / 'tokenizer.pkl', 'rb') as f:
+            tokenizer = pickle.load(f)
+        return concat_ids, tokenizer, doc_offsets
+
+    def _load_from_shards(self, cache_dir):
+        logger.info(f'Load from token shards at {str(cache_dir)}')
+        concat_ids, doc_offsets = {}, {}
+        for split in ['train', 'validation', 'test']:
+            concat_ids[split], doc_offsets[split] = load_token_shards(cache_dir, split)
         with open(cache_dir / 'tokenizer.pkl', 'rb') as f:
             tokenizer = pickle.load(f)
-        return concat_ids, tokenizer
+        return concat_ids, tokenizer, doc_offsets if self.pack_sequences else None
 
     @property
     def _cache_dir_name(self):
-        return f'tokenizer_name-{self.tokenizer_name}-val_ratio-{self.val_ratio}-val_split_seed-{self.val_split_seed}-add_eos-{self.add_eos}-detokenize-{self.detokenize}'
+        name = f'tokenizer_name-{self.tokenizer_name}-val_ratio-{self.val_ratio}-val_split_seed-{self.val_split_seed}-add_eos-{self.add_eos}-detokenize-{self.detokenize}'
+        if self.sharded_cache:  # The shards always have the document lengths
+            return f'{name}-sharded'
+        # Keep the name of the existing caches, which don't have the document offsets
+        return name if not self.pack_sequences else f'{name}-pack_sequences-True'
 
     def train_dataloader(self, *args: Any, **kwargs: Any) -> DataLoader:
         """ The train dataloader """
@@ -279,6 +361,17 @@ class LMDataModule(LightningDataModule):
 
     def _data_loader(self, dataset: Dataset, batch_size: int, shuffle: bool = False,
                      sampler=None) -> DataLoader:
+        if self.prefetch_batches > 0 and not self.pack_sequences:
+            # The dataset already writes the batches to pinned memory if self.pin_memory
+            return PrefetchDataLoader(
+                dataset,
+                batch_size=batch_size,
+                shuffle=shuffle,
+                sampler=sampler,
+                drop_last=self.drop_last,
+                collate_fn=lm_collate_fn,
+                prefetch_batches=self.prefetch_batches,
+            )
         return DataLoader(
             dataset,
             batch_size=batch_size,
@@ -287,9 +380,26 @@ class LMDataModule(LightningDataModule):
             sampler=sampler,
             drop_last=self.drop_last,
             pin_memory=self.pin_memory,
+            collate_fn=packed_collate_fn if self.pack_sequences else None,
             # persistent_workers=True
         )
 
+    def transfer_batch_to_device(self, batch: Any, device: torch.device,
+                                 dataloader_idx: int) -> Any:
+        # Batched LMDataset (prefetch_batches > 0) reads the batches in the token dtype, with the
+        # inputs and targets being views of the same tensor: move it once and widen it on the
+        # device.
+        if (isinstance(batch, (tuple, list)) and len(batch) == 2
+                and all(isinstance(t, torch.Tensor) and t.dtype in (torch.int16, torch.int32)
+                        for t in batch)):
+            x, y = batch
+            if x._base is not None and x._base is y._base:
+                data = widen_tokens(x._base.to(device, non_blocking=True))
+                return data[:, :-1], data[:, 1:]
+            return (widen_tokens(x.to(device, non_blocking=True)),
+                    widen_tokens(y.to(device, non_blocking=True)))
+        return super().transfer_batch_to_device(batch, device, dataloader_idx)
+
     def load_state_dict(self, checkpoint):
         if self.fault_tolerant:
             self.fast_forward_epochs = checkpoint['loops']['fit_loop']['epoch_progress']['current']['completed']
@@ -0,0 +1,62 @@
+import queue
+import threading
+
+from torch.utils.data.dataloader import DataLoader
+
+
+class PrefetchDataLoader(DataLoader):
+    """DataLoader that loads the batches in a background thread of the main process, keeping up to
+    prefetch_batches of them ready. Unlike DataLoader workers, the thread can write the batches
+    directly to pinned memory (e.g. LMDataset with pin_memory=True), and it costs no extra process.
+
+    The sampler is also iterated from the thread, so the counter of the fault-tolerant samplers runs
+    up to prefetch_batches batches ahead of the training loop. This doesn't affect resuming: the
+    sampler is fast-forwarded from the trainer's batch progress (LMDataModule.load_state_dict),
+    which only counts the batches that were consumed.
+    """
+
+    def __init__(self, *args, prefetch_batches=2, **kwargs):
+        assert kwargs.get('num_workers', 0) == 0, 'The batches are loaded by the prefetch thread'
+        super().__init__(*args, **kwargs)
+        self.prefetch_batches = prefetch_batches
+
+    def __iter__(self):
+        if self.prefetch_batches <= 0:
+            yield from super().__iter__()
+            return
+        batches = queue.Queue(maxsize=self.prefetch_batches)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            # Don't block forever if the consumer stopped iterating
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def load(iterator):
+            try:
+                for batch in iterator:
+                    if not put((batch, None)):
+                        return
+                put((done, None))
+            except Exception as e:
+                put((None, e))
+
+        thread = threading.Thread(target=load, args=(super().__iter__(),), daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch, exc = batches.get()
+                if exc is not None:
+                    raise exc
+                if batch is done:
+                    break
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
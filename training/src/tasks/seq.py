@@ -169,11 +169,17 @@ class SequenceModel(LightningModule):
 class SequenceLMModel(SequenceModel):
 
     def step(self, batch: Any, is_train=True):
-        x, y = batch
-        output = self.forward(x).logits
+        # With sequence packing, the batch also has the position_ids, cu_seqlens and max_seqlen
+        x, y, *rest = batch
+        kwargs = rest[0] if rest else {}
+        output = self.forward(x, **kwargs).logits
         output = rearrange(output, '... C -> (...) C')
         y = rearrange(y, '... -> (...)')
         loss = self.loss_fn(output, y) if is_train else self.loss_fn_val(output, y)
+        # Load balancing losses of the MoE layers, only computed in training mode
+        aux_loss = self.model.aux_loss() if hasattr(self.model, 'aux_loss') else None
+        if is_train and aux_loss is not None:
+            loss = loss + aux_loss
         return loss, output, y
 
     def shared_step(self, batch: Any, batch_idx: int, phase='train'):
@@ -0,0 +1,64 @@
+import pytest
+
+import numpy as np
+
+import torch
+
+from src.datamodules.datasets.lm_dataset import LMDataset, lm_collate_fn, widen_tokens
+from src.datamodules.datasets.lm_dataset import PackedLMDataset, best_fit_pack, packed_collate_fn
+from src.datamodules.fault_tolerant_sampler import RandomFaultTolerantSampler
+from src.datamodules.prefetch_dataloader import PrefetchDataLoader
+
+
+def test_best_fit_pack():
+    rng = np.random.default_rng(0)
+    lengths = rng.integers(1, 100, size=1000)
+    capacity = 128
+    bins = best_fit_pack(lengths, capacity)
+    assert sorted(i for b in bins for i in b) == list(range(len(lengths)))
+    assert all(lengths[b].sum() <= capacity for b in bins)
+    # Best-fit decreasing uses at most 11/9 OPT + 1 bins
+    assert len(bins) <= 11 / 9 * np.ceil(lengths.sum() / capacity) + 1
+
+
+def test_packed_lm_dataset():
+    rng = np.random.default_rng(0)
+    seq_len = 64
+    doc_lens = np.concatenate([rng.integers(2, 50, size=100), [1, 150]])
+    doc_offsets = np.concatenate([[0], np.cumsum(doc_lens)])
+    tokens = rng.integers(0, 1000, size=doc_offsets[-1]).astype(np.uint16)
+    dataset = PackedLMDataset(tokens, doc_offsets, seq_len=seq_len)
+    # Every (input, target) pair inside a document is in exactly one sample
+    total_pairs = sum(dataset[i][2].sum().item() for i in range(len(dataset)))
+    assert total_pairs == (doc_lens - 1).sum()
+    batch = [dataset[i] for i in range(4)]
+    x, y, kwargs = packed_collate_fn(batch)
+    assert x.shape == y.shape == kwargs['position_ids'].shape == (4, seq_len)
+    cu_seqlens = kwargs['cu_seqlens']
+    assert cu_seqlens.dtype == torch.int32 and cu_seqlens[-1] == 4 * seq_len
+    assert kwargs['max_seqlen'] <= seq_len
+    x, y, position_ids = x.flatten(), y.flatten(), kwargs['position_ids'].flatten()
+    for start, end in zip(cu_seqlens[:-1].tolist(), cu_seqlens[1:].tolist()):
+        assert torch.equal(position_ids[start:end], torch.arange(end - start))
+        # Each sequence is a piece of a document: the targets are the next inputs
+        if (y[start:end] != -100).all():
+            assert torch.equal(y[start:end - 1], x[start + 1:end])
+
+
+@pytest.mark.parametrize('prefetch_batches', [0, 2])
+def test_lm_dataset_batched(prefetch_batches):
+    rng = np.random.default_rng(0)
+    seq_len, batch_size = 32, 5
+    tokens = rng.integers(0, 50000, size=1000).astype(np.uint16)
+    dataset = LMDataset(tokens, seq_len=seq_len, batched=True)
+    sampler = RandomFaultTolerantSampler(dataset, generator=torch.Generator().manual_seed(0))
+    loader = PrefetchDataLoader(dataset, batch_size=batch_size, sampler=sampler,
+                                collate_fn=lm_collate_fn, prefetch_batches=prefetch_batches)
+    indices = torch.randperm(len(dataset), generator=torch.Generator().manual_seed(0)).tolist()
+    for i, (x, y) in enumerate(loader):
+        assert x.dtype == torch.int16 and x._base is y._base
+        x_ref, y_ref = torch.utils.data.default_collate(
+            [dataset[idx] for idx in indices[i * batch_size:(i + 1) * batch_size]]
+        )
+        assert torch.equal(widen_tokens(x), x_ref) and torch.equal(widen_tokens(y), y_ref)
+    assert i + 1 == len(loader)
@@ -0,0 +1,53 @@
+import numpy as np
+
+from datasets import Dataset
+
+from src.datamodules.datasets.token_shards import ConcatArray, build_token_shards
+from src.datamodules.datasets.token_shards import load_token_shards, token_shards_complete
+
+
+class CharTokenizer:
+    """Tokenizer with one token per character, picklable for the tokenization processes."""
+
+    eos_token = '\0'
+
+    def __call__(self, texts):
+        return {'input_ids': [[ord(c) for c in text] for text in texts]}
+
+
+def test_concat_array():
+    rng = np.random.default_rng(0)
+    arrays = [rng.integers(0, 1000, size=n).astype(np.uint16) for n in [10, 0, 7, 25]]
+    concat = ConcatArray(arrays)
+    ref = np.concatenate(arrays)
+    assert len(concat) == len(ref)
+    assert all(concat[i] == ref[i] for i in range(-len(ref), len(ref)))
+    for start, stop in [(0, 42), (3, 8), (8, 12), (5, 40), (17, 17), (30, 100)]:
+        assert np.array_equal(concat[start:stop], ref[start:stop])
+    idx = rng.integers(0, len(ref), size=(4, 9))
+    assert np.array_equal(concat[idx], ref[idx])
+    out = np.empty(idx.shape, dtype=np.uint16)
+    assert np.take(concat, idx, out=out, mode='clip') is out
+    assert np.array_equal(out, ref[idx])
+
+
+def test_build_token_shards(tmp_path):
+    rng = np.random.default_rng(0)
+    texts = [''.join(chr(c) for c in rng.integers(97, 123, size=n))
+             for n in rng.integers(0, 50, size=1000)]
+    tokenizer = CharTokenizer()
+    dataset = Dataset.from_dict({'text': texts[:700]})
+    assert not token_shards_complete(tmp_path, ['train'])
+    build_token_shards(dataset, tokenizer, tmp_path, 'train', num_shards=7, num_proc=3)
+    assert token_shards_complete(tmp_path, ['train'])
+    # Appending new data
+    build_token_shards(Dataset.from_dict({'text': texts[700:]}), tokenizer, tmp_path, 'train',
+                       num_shards=2, num_proc=2)
+    # Resuming doesn't redo any shard
+    mtimes = {p: p.stat().st_mtime_ns for p in tmp_path.glob('*.bin')}
+    build_token_shards(dataset, tokenizer, tmp_path, 'train', num_shards=7, num_proc=3)
+    assert {p: p.stat().st_mtime_ns for p in tmp_path.glob('*.bin')} == mtimes
+    tokens, doc_offsets = load_token_shards(tmp_path, 'train')
+    docs = [[ord(c) for c in text + tokenizer.eos_token] for text in texts if text]
+    assert np.array_equal(tokens[:], np.concatenate(docs))
+    assert np.array_equal(np.diff(doc_offsets), [len(d) for d in docs])